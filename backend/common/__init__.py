@@ -5,8 +5,15 @@ from common.models import (
     AccessLevel, UserRole, SubscriptionTier, Permission,
     DocumentMetadata, DocumentVersion, APIResponse, PaginatedResponse
 )
+from common.temp_workspace import TempWorkspace, TempWorkspaceManager, TempQuotaExceeded
+from common.metrics import MetricsRegistry, metrics
+from common.shared_cache import SharedMemoryCache
+from common.scheduler import FairScheduler, TierPolicy, AdmissionRejected
 
 __all__ = [
     "AccessLevel", "UserRole", "SubscriptionTier", "Permission",
-    "DocumentMetadata", "DocumentVersion", "APIResponse", "PaginatedResponse"
+    "DocumentMetadata", "DocumentVersion", "APIResponse", "PaginatedResponse",
+    "TempWorkspace", "TempWorkspaceManager", "TempQuotaExceeded",
+    "MetricsRegistry", "metrics", "SharedMemoryCache",
+    "FairScheduler", "TierPolicy", "AdmissionRejected"
 ]
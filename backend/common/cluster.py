@@ -0,0 +1,478 @@
+"""
+Cluster mode: routing each document's requests to the node that owns it on a consistent-hash ring.
+"""
+import bisect
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from common.metrics import metrics
+
+# Header marking a request already routed by a node, which is always served where it lands
+FORWARDED_HEADER = b"x-pdf-editor-forwarded"
+
+# Header telling which node served a request
+NODE_HEADER = b"x-pdf-editor-node"
+
+# Headers that only apply to a single connection and are not proxied
+HOP_BY_HOP_HEADERS = {
+    b"connection", b"keep-alive", b"proxy-authenticate", b"proxy-authorization",
+    b"te", b"trailer", b"transfer-encoding", b"upgrade", b"host"
+}
+
+# Paths of document resources; the ID is the routing key
+DOCUMENT_PATH = re.compile(r"^/api/documents/([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})(?:/|$)")
+
+# Age after which the announcement of a node that stopped without leaving is removed
+STALE_ANNOUNCEMENT_SECONDS = 24 * 60 * 60
+
+# Largest JSON body read to find the document of a request that has it nowhere else
+MAX_ROUTING_BODY_BYTES = 64 * 1024
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent-hash ring of nodes.
+
+    Each node is placed at ``vnodes`` points of the ring and owns the keys
+    hashing up to each of them, so keys are spread evenly and adding or
+    removing a node only moves about 1/N of the keys, to or from that node.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = 128):
+        """
+        Initialize the ring.
+
+        Args:
+            nodes: Initial nodes
+            vnodes: Number of points of each node on the ring
+        """
+        self.vnodes = vnodes
+        self._points: List[int] = []
+        self._owners: List[str] = []
+        self._nodes: set = set()
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self) -> List[str]:
+        """Get the nodes of the ring, sorted."""
+        return sorted(self._nodes)
+
+    def add(self, node: str) -> None:
+        """
+        Add a node to the ring.
+
+        Args:
+            node: Node to add
+        """
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for replica in range(self.vnodes):
+            point = _hash(f"{node}#{replica}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node: str) -> None:
+        """
+        Remove a node from the ring.
+
+        Args:
+            node: Node to remove
+        """
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        kept = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != node]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def owner(self, key: str) -> Optional[str]:
+        """
+        Get the node owning a key.
+
+        Args:
+            key: Key to look up
+
+        Returns:
+            Owning node, or None if the ring is empty
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+
+class ClusterMembership:
+    """
+    Membership of the nodes sharing a storage directory.
+
+    Every node announces its URL in a registry directory on the shared
+    storage and refreshes the announcement on each heartbeat. Nodes whose
+    announcement has not been refreshed within ``expiry_seconds`` are
+    considered gone, so the ring rebalances when a node joins, leaves on
+    shutdown, or stops responding. Workers of one node announce the same URL
+    and share its place on the ring.
+    """
+
+    def __init__(
+        self,
+        registry_dir: str,
+        node_url: str,
+        heartbeat_seconds: float = 2.0,
+        expiry_seconds: Optional[float] = None,
+        vnodes: int = 128
+    ):
+        """
+        Initialize the membership.
+
+        Args:
+            registry_dir: Shared directory holding the node announcements
+            node_url: Base URL other nodes reach this node at
+            heartbeat_seconds: Interval between announcements
+            expiry_seconds: Optional age after which a node is considered gone,
+                defaults to three heartbeats
+            vnodes: Number of points of each node on the ring
+        """
+        self.registry_dir = registry_dir
+        self.node_url = node_url.rstrip("/")
+        self.heartbeat_seconds = heartbeat_seconds
+        self.expiry_seconds = expiry_seconds if expiry_seconds is not None else 3 * heartbeat_seconds
+        self.vnodes = vnodes
+        os.makedirs(registry_dir, exist_ok=True)
+        self._path = os.path.join(registry_dir, f"{hashlib.sha1(self.node_url.encode('utf-8')).hexdigest()}.json")
+        # Replaced as a whole, so readers never see a ring being changed
+        self.ring = HashRing([self.node_url], vnodes)
+        self._stop_event = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+
+    def announce(self) -> None:
+        """Announce this node, joining the ring or refreshing its place."""
+        partial_path = f"{self._path}.{uuid.uuid4().hex}.tmp"
+        with open(partial_path, 'w') as f:
+            json.dump({"url": self.node_url, "heartbeat_at": time.time()}, f)
+        os.replace(partial_path, self._path)
+
+    def refresh(self) -> List[str]:
+        """
+        Rebuild the ring from the live announcements.
+
+        Returns:
+            URLs of the live nodes
+        """
+        cutoff = time.time() - self.expiry_seconds
+        nodes = {self.node_url}
+        for entry in os.scandir(self.registry_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, 'r') as f:
+                    announcement = json.load(f)
+            except (OSError, ValueError):
+                # Removed, or being replaced
+                continue
+            if announcement["heartbeat_at"] >= cutoff:
+                nodes.add(announcement["url"])
+            elif announcement["heartbeat_at"] < cutoff - STALE_ANNOUNCEMENT_SECONDS:
+                # Left by a node that crashed long ago
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+        if nodes != set(self.ring.nodes):
+            self.ring = HashRing(nodes, self.vnodes)
+            metrics.inc("cluster_rebalances_total", 1, "Changes of the cluster's nodes")
+        metrics.set_gauge("cluster_nodes", len(nodes), "Live nodes of the cluster")
+        return sorted(nodes)
+
+    def owner(self, key: str) -> str:
+        """
+        Get the URL of the node owning a key.
+
+        Args:
+            key: Routing key, e.g. a document ID
+
+        Returns:
+            Base URL of the owning node
+        """
+        return self.ring.owner(key) or self.node_url
+
+    def leave(self) -> None:
+        """Withdraw this node's announcement so the others rebalance at once."""
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def start(self) -> None:
+        """Join the cluster and start the heartbeat thread if it is not already running."""
+        if self._worker and self._worker.is_alive():
+            return
+
+        self.announce()
+        self.refresh()
+        self._stop_event.clear()
+        self._worker = threading.Thread(target=self._heartbeat_loop, name="cluster-heartbeat", daemon=True)
+        self._worker.start()
+
+    def stop(self) -> None:
+        """Stop the heartbeat thread and leave the cluster."""
+        self._stop_event.set()
+        if self._worker:
+            self._worker.join(timeout=5)
+            self._worker = None
+        # Other workers of this node announce it again on their next heartbeat
+        self.leave()
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stop_event.wait(self.heartbeat_seconds):
+            try:
+                self.announce()
+                self.refresh()
+            except Exception:
+                # Keep the last ring; retry on the next heartbeat
+                pass
+
+
+class ClusterRouter:
+    """
+    Sends requests for a document to the node owning it.
+
+    Requests are either proxied to the owner or redirected to it. Every node
+    can serve every document from the shared storage, so routing only
+    improves the hit rates of per-process caches: a request is served where
+    it landed when its owner cannot be reached, and requests that were
+    already routed once are never routed again.
+    """
+
+    def __init__(self, membership: ClusterMembership, mode: str = "proxy", timeout: float = 60.0):
+        """
+        Initialize the router.
+
+        Args:
+            membership: Membership of the cluster
+            mode: "proxy" to forward requests, or "redirect" to answer with a 307
+            timeout: Timeout of proxied requests, in seconds
+        """
+        if mode not in ("proxy", "redirect"):
+            raise ValueError(f"Unknown cluster routing mode {mode}")
+
+        self.membership = membership
+        self.mode = mode
+        self.timeout = timeout
+        self._client = None
+
+    async def close(self) -> None:
+        """Close the connections to the other nodes."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def routing_key(self, scope: Dict[str, Any], receive: Callable[[], Awaitable[Dict[str, Any]]]) -> Tuple[Optional[str], Optional[bytes]]:
+        """
+        Find the document a request is about.
+
+        The document ID is taken from the path, then the ``document_id``
+        query parameter, then the ``document_id`` field of a small JSON body.
+
+        Args:
+            scope: ASGI scope of the request
+            receive: ASGI receive channel of the request
+
+        Returns:
+            Tuple of the document ID, or None if the request is not about one,
+            and the body if it had to be read
+        """
+        match = DOCUMENT_PATH.match(scope["path"])
+        if match:
+            return match.group(1), None
+
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        if query.get("document_id"):
+            return query["document_id"][0], None
+
+        headers = dict(scope["headers"])
+        if not (
+            scope["method"] in ("POST", "PUT", "DELETE")
+            and headers.get(b"content-type", b"").startswith(b"application/json")
+            and 0 < int(headers.get(b"content-length", b"0") or 0) <= MAX_ROUTING_BODY_BYTES
+        ):
+            return None, None
+
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(chunks)
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return None, body
+        document_id = payload.get("document_id") if isinstance(payload, dict) else None
+        return (document_id if isinstance(document_id, str) else None), body
+
+    async def redirect(self, owner: str, scope: Dict[str, Any], send) -> None:
+        """Answer with a redirect to the owner, keeping the method and body."""
+        location = owner + scope.get("root_path", "") + scope["path"]
+        if scope.get("query_string"):
+            location += "?" + scope["query_string"].decode("latin-1")
+        await send({
+            "type": "http.response.start",
+            "status": 307,
+            "headers": [(b"location", location.encode("latin-1")), (b"content-length", b"0"), (NODE_HEADER, self.membership.node_url.encode("latin-1"))]
+        })
+        await send({"type": "http.response.body", "body": b""})
+
+    async def proxy(self, owner: str, scope: Dict[str, Any], receive, send, body: Optional[bytes]) -> bool:
+        """
+        Forward a request to the owner and relay its response.
+
+        Args:
+            owner: Base URL of the owning node
+            scope: ASGI scope of the request
+            receive: ASGI receive channel of the request
+            send: ASGI send channel of the response
+            body: Body already read from the request, if any
+
+        Returns:
+            True if the request was forwarded or answered with an error; False
+            if no connection to the owner could be made before any of the
+            request was consumed, so it can still be served locally
+        """
+        import httpx
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+
+        started = False
+
+        async def request_body():
+            nonlocal started
+            started = True
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                yield message.get("body", b"")
+                if not message.get("more_body"):
+                    return
+
+        url = owner + scope.get("root_path", "") + scope["path"]
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode("latin-1")
+        headers = [(name, value) for name, value in scope["headers"] if name.lower() not in HOP_BY_HOP_HEADERS]
+        headers.append((FORWARDED_HEADER, self.membership.node_url.encode("latin-1")))
+
+        if body is None:
+            request_headers = dict(scope["headers"])
+            if int(request_headers.get(b"content-length", b"0") or 0) > 0 or b"transfer-encoding" in request_headers:
+                body = request_body()
+        request = self._client.build_request(scope["method"], url, headers=headers, content=body)
+        try:
+            response = await self._client.send(request, stream=True)
+        except httpx.TransportError as e:
+            metrics.inc("cluster_proxy_errors_total", 1, "Requests whose owning node could not be reached")
+            if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) and not started:
+                return False
+            # Either the body is gone or the owner may already have received the
+            # request, so serving it here could run it twice
+            detail = f"Node {owner} failed: {str(e) or type(e).__name__}"
+            await send({
+                "type": "http.response.start",
+                "status": 504 if isinstance(e, httpx.TimeoutException) else 502,
+                "headers": [(b"content-type", b"application/json"), (NODE_HEADER, self.membership.node_url.encode("latin-1"))]
+            })
+            await send({
+                "type": "http.response.body",
+                "body": json.dumps({"success": False, "message": detail, "errors": [{"detail": detail}]}).encode("utf-8")
+            })
+            return True
+
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [(name, value) for name, value in response.headers.raw if name.lower() not in HOP_BY_HOP_HEADERS]
+            })
+            async for chunk in response.aiter_raw():
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await response.aclose()
+        return True
+
+
+class ClusterRoutingMiddleware:
+    """
+    ASGI middleware routing document requests through a ``ClusterRouter``.
+    """
+
+    def __init__(self, app, router: ClusterRouter):
+        """
+        Initialize the middleware.
+
+        Args:
+            app: ASGI application
+            router: Router of the cluster
+        """
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        node_url = self.router.membership.node_url
+        key, body = (None, None) if FORWARDED_HEADER in dict(scope["headers"]) else await self.router.routing_key(scope, receive)
+        owner = self.router.membership.owner(key) if key else node_url
+
+        if owner != node_url:
+            started = time.perf_counter()
+            if self.router.mode == "redirect":
+                await self.router.redirect(owner, scope, send)
+                metrics.inc("cluster_requests_total", 1, "Requests by where they were routed", route="redirected")
+                return
+            if await self.router.proxy(owner, scope, receive, send, body):
+                metrics.inc("cluster_requests_total", 1, "Requests by where they were routed", route="proxied")
+                metrics.observe("cluster_proxy_seconds", time.perf_counter() - started, "Duration of requests proxied to their owning node")
+                return
+            route = "fallback"
+        else:
+            route = "local"
+        metrics.inc("cluster_requests_total", 1, "Requests by where they were routed", route=route)
+
+        if body is not None:
+            replayed = False
+
+            async def receive_body():
+                nonlocal replayed
+                if not replayed:
+                    replayed = True
+                    return {"type": "http.request", "body": body, "more_body": False}
+                return await receive()
+        else:
+            receive_body = receive
+
+        async def send_with_node(message):
+            if message["type"] == "http.response.start":
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [(NODE_HEADER, node_url.encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive_body, send_with_node)
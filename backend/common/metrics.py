@@ -0,0 +1,159 @@
+"""
+In-process metrics registry exposed in the Prometheus text format.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+# Metric key: name plus sorted label pairs
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class MetricsRegistry:
+    """
+    Thread-safe collection of gauges, counters and summaries.
+
+    Summaries keep a count, a sum and the maximum observed value, which is
+    enough for rates and averages without per-observation storage.
+    """
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._lock = threading.Lock()
+        self._types: Dict[str, str] = {}
+        self._help: Dict[str, str] = {}
+        self._values: Dict[MetricKey, float] = {}
+        self._summaries: Dict[MetricKey, List[float]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, str]) -> MetricKey:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def _declare(self, name: str, metric_type: str, description: str) -> None:
+        self._types.setdefault(name, metric_type)
+        if description:
+            self._help.setdefault(name, description)
+
+    def set_gauge(self, name: str, value: float, description: str = "", **labels) -> None:
+        """
+        Set a gauge to a value.
+
+        Args:
+            name: Metric name
+            value: New value
+            description: Optional help text
+            **labels: Metric labels
+        """
+        with self._lock:
+            self._declare(name, "gauge", description)
+            self._values[self._key(name, labels)] = float(value)
+
+    def inc(self, name: str, amount: float = 1.0, description: str = "", **labels) -> None:
+        """
+        Increase a counter.
+
+        Args:
+            name: Metric name
+            amount: Amount to add
+            description: Optional help text
+            **labels: Metric labels
+        """
+        with self._lock:
+            self._declare(name, "counter", description)
+            key = self._key(name, labels)
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def observe(self, name: str, value: float, description: str = "", **labels) -> None:
+        """
+        Record an observation in a summary.
+
+        Args:
+            name: Metric name
+            value: Observed value
+            description: Optional help text
+            **labels: Metric labels
+        """
+        with self._lock:
+            self._declare(name, "summary", description)
+            key = self._key(name, labels)
+            summary = self._summaries.setdefault(key, [0.0, 0.0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    @contextmanager
+    def timer(self, name: str, description: str = "", **labels) -> Iterator[None]:
+        """
+        Context manager observing the duration of its block in seconds.
+
+        Args:
+            name: Summary metric name
+            description: Optional help text
+            **labels: Metric labels
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, description, **labels)
+
+    def get(self, name: str, **labels) -> float:
+        """
+        Get the current value of a gauge or counter.
+
+        Args:
+            name: Metric name
+            **labels: Metric labels
+
+        Returns:
+            The value, or 0 if it was never set
+        """
+        with self._lock:
+            return self._values.get(self._key(name, labels), 0.0)
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            Metrics text
+        """
+        with self._lock:
+            values = dict(self._values)
+            summaries = {key: list(value) for key, value in self._summaries.items()}
+            types = dict(self._types)
+            descriptions = dict(self._help)
+
+        lines = []
+        for name in sorted(types):
+            if name in descriptions:
+                lines.append(f"# HELP {name} {descriptions[name]}")
+            lines.append(f"# TYPE {name} {types[name]}")
+
+            if types[name] == "summary":
+                for (metric, labels), (count, total, maximum) in sorted(summaries.items()):
+                    if metric != name:
+                        continue
+                    lines.append(f"{name}_count{_format_labels(labels)} {count:g}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+                    lines.append(f"{name}_max{_format_labels(labels)} {maximum:.6f}")
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value:.6g}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(key, value.replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+# Process-wide registry
+metrics = MetricsRegistry()
@@ -0,0 +1,141 @@
+"""
+Pre-fork supervisor running several uvicorn workers on one shared socket.
+"""
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from typing import Callable, Dict, Optional
+
+# Minimum time between restarts of a crashing worker slot
+RESTART_BACKOFF_SECONDS = 1.0
+
+
+class PreforkSupervisor:
+    """
+    Loads the application once, then forks workers that share it copy-on-write.
+
+    Everything imported and built before the fork, such as the PDF libraries,
+    fonts and cached overlays, is shared by the workers instead of being
+    loaded again in each of them. Startup hooks still run in every worker, so
+    threads and connections are created after the fork. Workers that exit
+    unexpectedly are restarted.
+    """
+
+    def __init__(
+        self,
+        app,
+        host: str = "0.0.0.0",
+        port: int = 8000,
+        workers: int = 2,
+        preload: Optional[Callable[[], None]] = None,
+        log_level: str = "info"
+    ):
+        """
+        Initialize the supervisor.
+
+        Args:
+            app: ASGI application built in the supervisor process
+            host: Address to bind
+            port: Port to bind
+            workers: Number of worker processes
+            preload: Optional function loading shared resources before forking
+            log_level: Uvicorn log level for the workers
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.preload = preload
+        self.log_level = log_level
+
+        self._children: Dict[int, int] = {}
+        self._stopping = False
+
+    def _bind(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET6 if ":" in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(2048)
+        sock.set_inheritable(True)
+        return sock
+
+    def _spawn(self, slot: int, sock: socket.socket) -> None:
+        pid = os.fork()
+        if pid:
+            self._children[pid] = slot
+            return
+
+        # Worker process
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        code = 0
+        try:
+            import uvicorn
+
+            config = uvicorn.Config(self.app, log_level=self.log_level, lifespan="on")
+            uvicorn.Server(config).run(sockets=[sock])
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _handle_stop(self, signum, frame) -> None:
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> int:
+        """
+        Preload, fork the workers and supervise them until stopped.
+
+        Returns:
+            Process exit code
+        """
+        # Fail in the supervisor rather than in every worker if uvicorn is missing
+        import uvicorn  # noqa: F401
+
+        if self.preload:
+            self.preload()
+
+        # Move everything loaded so far out of the collector's reach, so that
+        # collections in the workers do not touch and un-share those pages
+        gc.collect()
+        gc.freeze()
+
+        sock = self._bind()
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        for slot in range(self.workers):
+            self._spawn(slot, sock)
+
+        last_restart: Dict[int, float] = {}
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            slot = self._children.pop(pid, None)
+            if slot is None or self._stopping:
+                continue
+
+            print(f"Worker {pid} exited with status {status}, restarting", file=sys.stderr)
+            delay = RESTART_BACKOFF_SECONDS - (time.monotonic() - last_restart.get(slot, 0.0))
+            if delay > 0:
+                time.sleep(delay)
+            last_restart[slot] = time.monotonic()
+            self._spawn(slot, sock)
+
+        sock.close()
+        return 0
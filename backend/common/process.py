@@ -0,0 +1,25 @@
+"""
+Process helpers shared by the services.
+"""
+import os
+
+
+def pid_alive(pid: int) -> bool:
+    """
+    Check whether a process with the given ID is still running.
+
+    Args:
+        pid: Process ID to check
+
+    Returns:
+        True if the process exists
+    """
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
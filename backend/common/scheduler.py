@@ -0,0 +1,513 @@
+"""
+Tier-aware admission control and weighted fair scheduling of PDF work.
+"""
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, NamedTuple, Optional
+
+from common.metrics import metrics
+from common.models import SubscriptionTier
+
+# Per-tenant state older than the scheduler's virtual clock is dropped once
+# this many tenants are tracked
+TENANT_STATE_LIMIT = 4096
+
+
+class TierPolicy(NamedTuple):
+    """Scheduling policy of a subscription tier."""
+    # Share of the node each tenant of the tier gets relative to other tenants
+    weight: float
+    # Operations of the tier running at once on this node
+    max_concurrency: int
+    # Pages a single tenant may process per minute
+    pages_per_minute: float
+    # Sustained request rate per tenant at the routes
+    requests_per_second: float
+    # Requests a tenant may make above the sustained rate
+    burst: int
+    # Operations a single tenant may have waiting
+    max_queued: int
+
+
+TIER_POLICIES: Dict[SubscriptionTier, TierPolicy] = {
+    SubscriptionTier.FREE: TierPolicy(
+        weight=1, max_concurrency=2, pages_per_minute=600, requests_per_second=2, burst=10, max_queued=20
+    ),
+    SubscriptionTier.BASIC: TierPolicy(
+        weight=2, max_concurrency=4, pages_per_minute=3000, requests_per_second=5, burst=20, max_queued=50
+    ),
+    SubscriptionTier.PREMIUM: TierPolicy(
+        weight=4, max_concurrency=8, pages_per_minute=12000, requests_per_second=10, burst=50, max_queued=100
+    ),
+    SubscriptionTier.ENTERPRISE: TierPolicy(
+        weight=8, max_concurrency=16, pages_per_minute=60000, requests_per_second=50, burst=200, max_queued=500
+    ),
+}
+
+
+class AdmissionRejected(Exception):
+    """Raised when a tenant's request or operation is not admitted."""
+
+    def __init__(self, tenant_id: str, tier: SubscriptionTier, reason: str, retry_after: float, message: str):
+        super().__init__(message)
+        self.tenant_id = tenant_id
+        self.tier = tier
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Structured form of the error for API responses."""
+        return {
+            "error": "admission_rejected",
+            "reason": self.reason,
+            "tier": self.tier.value,
+            "retry_after": round(self.retry_after, 3),
+            "message": str(self)
+        }
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at a fixed rate."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float = 1.0, now: Optional[float] = None) -> float:
+        """
+        Take tokens if enough are available.
+
+        Args:
+            amount: Number of tokens to take
+            now: Optional current monotonic time
+
+        Returns:
+            0 if the tokens were taken, otherwise the seconds until they are available
+        """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def charge(self, amount: float, now: float) -> None:
+        """Take tokens unconditionally, going into debt if necessary."""
+        self._refill(now)
+        self.tokens -= amount
+
+    def debt_seconds(self, now: float) -> float:
+        """Seconds until the bucket is out of debt."""
+        self._refill(now)
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Ticket:
+    """An operation waiting for, or holding, a scheduler slot."""
+
+    __slots__ = (
+        "tenant_id", "tier", "pages", "start", "finish", "enqueued", "granted", "event", "loop", "future", "callback"
+    )
+
+    def __init__(self, tenant_id: str, tier: SubscriptionTier, pages: int, start: float, finish: float):
+        self.tenant_id = tenant_id
+        self.tier = tier
+        self.pages = pages
+        self.start = start
+        self.finish = finish
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.event = threading.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.future: Optional[asyncio.Future] = None
+        self.callback: Optional[Callable[[], None]] = None
+
+    def grant(self) -> None:
+        self.granted = True
+        self.event.set()
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+        if self.callback is not None:
+            self.callback()
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class FairScheduler:
+    """
+    Admits and orders PDF work so that tenants share a node fairly.
+
+    Work runs in a fixed number of slots. Waiting operations are queued per
+    tenant and dispatched in weighted fair queuing order: each operation is
+    tagged with a virtual finish time that grows with its page count divided
+    by the weight of the tenant's tier. A tenant submitting hundreds of
+    operations therefore only delays its own queue, while other tenants keep
+    receiving slots in proportion to their weight.
+
+    Each tier is also capped in concurrent operations on the node, each
+    tenant in pages processed per minute, and each tenant in requests per
+    second at the routes. Queues are bounded per tenant; requests beyond
+    the rate or queue limits are rejected with ``AdmissionRejected``.
+    State is per process.
+    """
+
+    def __init__(
+        self,
+        slots: int = 4,
+        policies: Optional[Dict[SubscriptionTier, TierPolicy]] = None,
+        tenant_tiers: Optional[Dict[str, SubscriptionTier]] = None,
+        default_tier: SubscriptionTier = SubscriptionTier.FREE
+    ):
+        """
+        Initialize the scheduler.
+
+        Args:
+            slots: Number of operations running at once on this node
+            policies: Optional policy per subscription tier, defaults to ``TIER_POLICIES``
+            tenant_tiers: Optional subscription tier per tenant ID
+            default_tier: Tier of tenants not listed in ``tenant_tiers``
+        """
+        self.slots = slots
+        self.policies = dict(policies or TIER_POLICIES)
+        self.tenant_tiers = dict(tenant_tiers or {})
+        self.default_tier = default_tier
+
+        self._lock = threading.Lock()
+        self._queues: Dict[str, Deque[_Ticket]] = {}
+        self._last_finish: Dict[str, float] = {}
+        self._page_buckets: Dict[str, TokenBucket] = {}
+        self._request_buckets: Dict[str, TokenBucket] = {}
+        self._virtual_time = 0.0
+        self._running_total = 0
+        self._running = {tier: 0 for tier in SubscriptionTier}
+        self._queued = {tier: 0 for tier in SubscriptionTier}
+        self._timer: Optional[threading.Timer] = None
+        self._timer_due = 0.0
+        # Runs submitted callables; created on first use so that forked workers get their own threads
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @classmethod
+    def from_config(
+        cls,
+        slots: int,
+        policies: Optional[str] = None,
+        tenant_tiers: Optional[str] = None,
+        default_tier: SubscriptionTier = SubscriptionTier.FREE
+    ) -> "FairScheduler":
+        """
+        Create a scheduler from JSON configuration strings.
+
+        Args:
+            slots: Number of operations running at once on this node
+            policies: Optional JSON mapping tier names to policy fields overriding the defaults,
+                e.g. ``{"free": {"max_concurrency": 1}}``
+            tenant_tiers: Optional JSON mapping tenant IDs to tier names
+            default_tier: Tier of tenants not listed in ``tenant_tiers``
+
+        Returns:
+            The configured scheduler
+        """
+        tier_policies = dict(TIER_POLICIES)
+        for tier, fields in json.loads(policies or "{}").items():
+            tier = SubscriptionTier(tier)
+            tier_policies[tier] = tier_policies[tier]._replace(**fields)
+
+        tiers = {tenant_id: SubscriptionTier(tier) for tenant_id, tier in json.loads(tenant_tiers or "{}").items()}
+        return cls(slots, tier_policies, tiers, default_tier)
+
+    def tier_of(self, tenant_id: Optional[str]) -> SubscriptionTier:
+        """
+        Get the subscription tier of a tenant.
+
+        Args:
+            tenant_id: ID of the tenant
+
+        Returns:
+            The tenant's tier
+        """
+        return self.tenant_tiers.get(tenant_id, self.default_tier)
+
+    def check_rate(self, tenant_id: str) -> None:
+        """
+        Count a request against a tenant's rate limit.
+
+        Args:
+            tenant_id: ID of the tenant making the request
+
+        Raises:
+            AdmissionRejected: If the tenant exceeded its request rate
+        """
+        tier = self.tier_of(tenant_id)
+        policy = self.policies[tier]
+        with self._lock:
+            bucket = self._request_buckets.get(tenant_id)
+            if bucket is None:
+                bucket = self._request_buckets[tenant_id] = TokenBucket(policy.requests_per_second, policy.burst)
+            retry_after = bucket.take()
+
+        if retry_after:
+            metrics.inc("scheduler_rejected_total", 1, "Requests and operations not admitted", tier=tier.value, reason="rate")
+            raise AdmissionRejected(
+                tenant_id, tier, "rate", retry_after,
+                f"Request rate limit of {policy.requests_per_second:g}/s exceeded"
+            )
+
+    def _enqueue(self, tenant_id: str, pages: int, bounded: bool = True, callback: Optional[Callable] = None) -> _Ticket:
+        tier = self.tier_of(tenant_id)
+        policy = self.policies[tier]
+        pages = max(1, pages)
+        with self._lock:
+            queue = self._queues.get(tenant_id)
+            if bounded and queue is not None and len(queue) >= policy.max_queued:
+                metrics.inc("scheduler_rejected_total", 1, "Requests and operations not admitted", tier=tier.value, reason="queue")
+                raise AdmissionRejected(
+                    tenant_id, tier, "queue", 1.0,
+                    f"Too many operations waiting, at most {policy.max_queued} are queued per tenant"
+                )
+
+            start = max(self._virtual_time, self._last_finish.get(tenant_id, 0.0))
+            ticket = _Ticket(tenant_id, tier, pages, start, start + pages / policy.weight)
+            if callback is not None:
+                ticket.callback = lambda: self._executor.submit(callback, ticket)
+            self._last_finish[tenant_id] = ticket.finish
+            if queue is None:
+                queue = self._queues[tenant_id] = deque()
+            queue.append(ticket)
+            self._queued[tier] += 1
+
+            self._dispatch_locked()
+            self._update_gauges_locked(tier)
+        return ticket
+
+    def _dispatch_locked(self) -> None:
+        """Grant free slots to the eligible operations with the earliest finish tags."""
+        now = time.monotonic()
+        retry_at = None
+        while self._running_total < self.slots and self._queues:
+            best = None
+            for tenant_id, queue in self._queues.items():
+                ticket = queue[0]
+                if self._running[ticket.tier] >= self.policies[ticket.tier].max_concurrency:
+                    continue
+                bucket = self._page_buckets.get(tenant_id)
+                wait = bucket.debt_seconds(now) if bucket else 0.0
+                if wait:
+                    retry_at = min(retry_at or now + wait, now + wait)
+                    continue
+                if best is None or ticket.finish < best.finish:
+                    best = ticket
+            if best is None:
+                break
+
+            queue = self._queues[best.tenant_id]
+            queue.popleft()
+            if not queue:
+                del self._queues[best.tenant_id]
+
+            policy = self.policies[best.tier]
+            bucket = self._page_buckets.get(best.tenant_id)
+            if bucket is None:
+                bucket = self._page_buckets[best.tenant_id] = TokenBucket(
+                    policy.pages_per_minute / 60.0, policy.pages_per_minute
+                )
+            bucket.charge(best.pages, now)
+
+            self._virtual_time = max(self._virtual_time, best.start)
+            self._running_total += 1
+            self._running[best.tier] += 1
+            self._queued[best.tier] -= 1
+            best.grant()
+
+            tier = best.tier.value
+            metrics.observe("scheduler_queue_wait_seconds", now - best.enqueued, "Time operations waited for a slot", tier=tier)
+            metrics.inc("scheduler_pages_total", best.pages, "Pages admitted for processing", tier=tier)
+            self._update_gauges_locked(best.tier)
+
+        if retry_at is not None and self._queues:
+            self._wake_at_locked(retry_at)
+
+    def _wake_at_locked(self, due: float) -> None:
+        """Dispatch again once throttled tenants have earned their pages back."""
+        if self._timer is not None and self._timer.is_alive() and self._timer_due <= due:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(0.0, due - time.monotonic()), self._on_timer)
+        self._timer.daemon = True
+        self._timer_due = due
+        self._timer.start()
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._dispatch_locked()
+
+    def _update_gauges_locked(self, tier: SubscriptionTier) -> None:
+        metrics.set_gauge("scheduler_queue_depth", self._queued[tier], "Operations waiting for a slot", tier=tier.value)
+        metrics.set_gauge("scheduler_running", self._running[tier], "Operations holding a slot", tier=tier.value)
+
+    def _release(self, ticket: _Ticket) -> None:
+        """Free a granted slot, or withdraw a ticket that is still waiting."""
+        with self._lock:
+            if ticket.granted:
+                self._running_total -= 1
+                self._running[ticket.tier] -= 1
+            else:
+                queue = self._queues.get(ticket.tenant_id)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    self._queued[ticket.tier] -= 1
+                    if not queue:
+                        del self._queues[ticket.tenant_id]
+
+            self._dispatch_locked()
+            self._update_gauges_locked(ticket.tier)
+            if len(self._last_finish) > TENANT_STATE_LIMIT:
+                self._prune_locked()
+
+    def _prune_locked(self) -> None:
+        """Forget idle tenants whose state no longer affects scheduling."""
+        now = time.monotonic()
+        for tenant_id, finish in list(self._last_finish.items()):
+            if finish <= self._virtual_time and tenant_id not in self._queues:
+                del self._last_finish[tenant_id]
+        for buckets in (self._page_buckets, self._request_buckets):
+            for tenant_id, bucket in list(buckets.items()):
+                if bucket.full(now):
+                    del buckets[tenant_id]
+
+    @contextmanager
+    def slot(self, tenant_id: str, pages: int = 1, timeout: Optional[float] = None) -> Iterator[SubscriptionTier]:
+        """
+        Hold a slot for a blocking operation, waiting in the tenant's queue.
+
+        Args:
+            tenant_id: ID of the tenant the operation is billed to
+            pages: Number of pages the operation processes
+            timeout: Optional maximum time to wait for the slot
+
+        Yields:
+            The tenant's subscription tier
+
+        Raises:
+            AdmissionRejected: If the tenant's queue is full or the wait timed out
+        """
+        ticket = self._enqueue(tenant_id, pages)
+        try:
+            if not ticket.event.wait(timeout):
+                metrics.inc("scheduler_rejected_total", 1, "Requests and operations not admitted", tier=ticket.tier.value, reason="timeout")
+                raise AdmissionRejected(tenant_id, ticket.tier, "timeout", 1.0, f"No slot available within {timeout:g} s")
+            yield ticket.tier
+        finally:
+            self._release(ticket)
+
+    @asynccontextmanager
+    async def aslot(self, tenant_id: str, pages: int = 1) -> AsyncIterator[SubscriptionTier]:
+        """
+        Hold a slot from async code, waiting without occupying a thread.
+
+        Args:
+            tenant_id: ID of the tenant the operation is billed to
+            pages: Number of pages the operation processes
+
+        Yields:
+            The tenant's subscription tier
+
+        Raises:
+            AdmissionRejected: If the tenant's queue is full
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        ticket = self._enqueue_async(tenant_id, pages, loop, future)
+        try:
+            await future
+            yield ticket.tier
+        finally:
+            self._release(ticket)
+
+    def _enqueue_async(self, tenant_id: str, pages: int, loop: asyncio.AbstractEventLoop, future: asyncio.Future) -> _Ticket:
+        ticket = self._enqueue(tenant_id, pages)
+        with self._lock:
+            ticket.loop = loop
+            ticket.future = future
+            if ticket.granted:
+                future.set_result(None)
+        return ticket
+
+    def submit(self, tenant_id: str, pages: int, fn: Callable[..., Any], *args, bounded: bool = False) -> None:
+        """
+        Run a callable in a slot of a tenant once it is its turn, without blocking the caller.
+
+        Background work is not bound by the tenant's queue limit unless
+        ``bounded`` is set, so it is delayed rather than dropped.
+
+        Args:
+            tenant_id: ID of the tenant the work is billed to
+            pages: Number of pages the work processes
+            fn: Callable to run in a scheduler thread
+            *args: Arguments of the callable
+            bounded: Whether the tenant's queue limit applies
+
+        Raises:
+            AdmissionRejected: If ``bounded`` is set and the tenant's queue is full
+        """
+        def run(ticket: _Ticket) -> None:
+            try:
+                fn(*args)
+            finally:
+                self._release(ticket)
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="scheduler")
+        self._enqueue(tenant_id, pages, bounded, run)
+
+    def close(self) -> None:
+        """Drop waiting background work and stop the scheduler threads after their current job."""
+        with self._lock:
+            for queue in self._queues.values():
+                for ticket in [ticket for ticket in queue if ticket.callback is not None]:
+                    queue.remove(ticket)
+                    self._queued[ticket.tier] -= 1
+            self._queues = {tenant_id: queue for tenant_id, queue in self._queues.items() if queue}
+            if self._timer is not None:
+                self._timer.cancel()
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the current queue and slot usage per tier.
+
+        Returns:
+            Slots, running and queued operations per tier
+        """
+        with self._lock:
+            return {
+                "slots": self.slots,
+                "running": self._running_total,
+                "tiers": {
+                    tier.value: {"running": self._running[tier], "queued": self._queued[tier]}
+                    for tier in SubscriptionTier
+                }
+            }
@@ -0,0 +1,110 @@
+"""
+Fixed-size cache in anonymous shared memory, visible to every forked worker.
+"""
+import hashlib
+import mmap
+import struct
+from typing import Optional
+
+from common.metrics import metrics
+
+# Slot header: key digest, value length and checksum of both and the value
+SLOT_HEADER = struct.Struct("<16sI8s")
+
+
+class SharedMemoryCache:
+    """
+    Direct-mapped byte cache shared between a process and the workers it forks.
+
+    The memory is an anonymous shared mapping, so it must be created before the
+    workers are forked. Each key hashes to a single fixed-size slot and a newer
+    entry simply evicts whatever occupied the slot. Values larger than a slot
+    are not cached.
+
+    Slots are not locked, so a worker killed mid-write can never block the
+    others. Every slot carries a checksum instead; a slot read while it is
+    being written, or left half written, fails the check and is a miss.
+    """
+
+    def __init__(self, size_bytes: int = 64 * 1024 * 1024, slot_size: int = 64 * 1024):
+        """
+        Initialize the cache.
+
+        Args:
+            size_bytes: Total size of the shared mapping
+            slot_size: Size of a single slot, including its header
+        """
+        if slot_size <= SLOT_HEADER.size:
+            raise ValueError("Slot size must be larger than the slot header")
+
+        self.slot_size = slot_size
+        self.slots = max(1, size_bytes // slot_size)
+        self.max_value_size = slot_size - SLOT_HEADER.size
+        self._memory = mmap.mmap(-1, self.slots * slot_size)
+
+    def _locate(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        slot = int.from_bytes(digest[:8], "little") % self.slots
+        return digest, slot * self.slot_size
+
+    @staticmethod
+    def _checksum(digest: bytes, value: bytes) -> bytes:
+        checksum = hashlib.blake2b(digest, digest_size=8)
+        checksum.update(len(value).to_bytes(4, "little"))
+        checksum.update(value)
+        return checksum.digest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get a cached value.
+
+        Args:
+            key: Cache key
+
+        Returns:
+            The value, or None on a miss
+        """
+        digest, offset = self._locate(key)
+        stored_digest, length, checksum = SLOT_HEADER.unpack_from(self._memory, offset)
+        value = None
+        if stored_digest == digest and length <= self.max_value_size:
+            start = offset + SLOT_HEADER.size
+            value = self._memory[start:start + length]
+            if self._checksum(digest, value) != checksum:
+                # Torn by a concurrent or interrupted write
+                value = None
+
+        metrics.inc("shared_cache_requests_total", 1, "Shared cache lookups", result="hit" if value is not None else "miss")
+        return value
+
+    def set(self, key: str, value: bytes) -> bool:
+        """
+        Cache a value, evicting the entry that occupied its slot.
+
+        Args:
+            key: Cache key
+            value: Bytes to cache
+
+        Returns:
+            True if the value was cached, False if it is too large
+        """
+        if len(value) > self.max_value_size:
+            return False
+
+        digest, offset = self._locate(key)
+        start = offset + SLOT_HEADER.size
+        self._memory[start:start + len(value)] = value
+        SLOT_HEADER.pack_into(self._memory, offset, digest, len(value), self._checksum(digest, value))
+        return True
+
+    def delete(self, key: str) -> None:
+        """
+        Remove a value if it is cached.
+
+        Args:
+            key: Cache key
+        """
+        digest, offset = self._locate(key)
+        stored_digest, _, _ = SLOT_HEADER.unpack_from(self._memory, offset)
+        if stored_digest == digest:
+            SLOT_HEADER.pack_into(self._memory, offset, b"\0" * 16, 0, b"\0" * 8)
@@ -0,0 +1,322 @@
+"""
+Scoped temporary workspaces with guaranteed cleanup, quotas and orphan sweeping.
+"""
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, TextIO
+
+from common.process import pid_alive
+
+# Size of the chunks used when copying uploads into a workspace
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Prefix of every workspace directory, used by the sweeper to recognise them
+WORKSPACE_PREFIX = "ws-"
+
+# File inside every workspace that its owner holds an flock on while it is in use
+LOCK_FILE = ".lock"
+
+
+class TempQuotaExceeded(ValueError):
+    """Raised when a workspace grows beyond its per-request quota."""
+
+
+class TempWorkspace:
+    """A private temporary directory that is removed as a whole on close."""
+
+    def __init__(self, root_dir: str, quota_bytes: int, spool_threshold: int, lock_file: Optional[TextIO] = None):
+        """
+        Initialize the workspace.
+
+        Args:
+            root_dir: Directory owned exclusively by this workspace
+            quota_bytes: Maximum number of bytes the workspace may hold
+            spool_threshold: Uploads up to this size are kept in memory
+            lock_file: Optional locked file marking the workspace as in use until it is closed
+        """
+        self.root_dir = root_dir
+        self.lock_file = lock_file
+        self.quota_bytes = quota_bytes
+        self.spool_threshold = spool_threshold
+        self.used_bytes = 0
+        self._closed = False
+        self._open_files = []
+
+    def path(self, suffix: str = "", prefix: str = "") -> str:
+        """
+        Reserve a unique file path inside the workspace.
+
+        Args:
+            suffix: Optional file name suffix, e.g. ".pdf"
+            prefix: Optional file name prefix
+
+        Returns:
+            Path to a file that does not exist yet
+        """
+        return os.path.join(self.root_dir, f"{prefix}{uuid.uuid4()}{suffix}")
+
+    def charge(self, nbytes: int) -> None:
+        """
+        Account bytes against the quota.
+
+        Args:
+            nbytes: Number of bytes written to the workspace
+
+        Raises:
+            TempQuotaExceeded: If the quota would be exceeded
+        """
+        if self.used_bytes + nbytes > self.quota_bytes:
+            raise TempQuotaExceeded(
+                f"Temporary storage quota of {self.quota_bytes} bytes exceeded"
+            )
+        self.used_bytes += nbytes
+
+    def account(self, file_path: str) -> str:
+        """
+        Charge an output file written into the workspace against the quota.
+
+        Args:
+            file_path: Path of the file to account for
+
+        Returns:
+            The same path, for chaining
+        """
+        self.charge(os.path.getsize(file_path))
+        return file_path
+
+    def spool(self) -> BinaryIO:
+        """
+        Create a buffer that stays in memory until it outgrows the spool threshold.
+
+        Returns:
+            A binary file object that is closed together with the workspace
+        """
+        buffer = tempfile.SpooledTemporaryFile(max_size=self.spool_threshold, dir=self.root_dir)
+        self._open_files.append(buffer)
+        return buffer
+
+    def save_upload(self, upload_file) -> BinaryIO:
+        """
+        Copy an uploaded file into the workspace.
+
+        Small uploads stay in memory, larger ones spill to an anonymous file in
+        the workspace directory. The quota is enforced while copying so that an
+        oversized upload is rejected before it is fully written.
+
+        Args:
+            upload_file: FastAPI ``UploadFile`` to copy
+
+        Returns:
+            A binary file object positioned at the start of the content
+        """
+        buffer = self.spool()
+        try:
+            while True:
+                chunk = upload_file.file.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.charge(len(chunk))
+                buffer.write(chunk)
+        finally:
+            upload_file.file.close()
+
+        buffer.seek(0)
+        return buffer
+
+    def close(self) -> None:
+        """Close open buffers and remove the workspace directory."""
+        if self._closed:
+            return
+        self._closed = True
+
+        for buffer in self._open_files:
+            try:
+                buffer.close()
+            except Exception:
+                pass
+        self._open_files = []
+
+        shutil.rmtree(self.root_dir, ignore_errors=True)
+        if self.lock_file:
+            self.lock_file.close()
+
+    def __enter__(self) -> "TempWorkspace":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class TempWorkspaceManager:
+    """Hands out scoped workspaces under a shared base directory and sweeps orphans."""
+
+    def __init__(
+        self,
+        base_dir: str,
+        quota_bytes: int = 512 * 1024 * 1024,
+        spool_threshold: int = 8 * 1024 * 1024,
+        max_age_seconds: int = 6 * 60 * 60,
+        sweep_interval_seconds: int = 10 * 60
+    ):
+        """
+        Initialize the workspace manager.
+
+        Args:
+            base_dir: Directory under which workspaces are created
+            quota_bytes: Default per-workspace quota
+            spool_threshold: Default in-memory threshold for spooled buffers
+            max_age_seconds: Age after which leftover entries not known to be in use are considered orphaned
+            sweep_interval_seconds: Interval between background sweeps
+        """
+        self.base_dir = base_dir
+        self.quota_bytes = quota_bytes
+        self.spool_threshold = spool_threshold
+        self.max_age_seconds = max_age_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+        os.makedirs(base_dir, exist_ok=True)
+
+        self._stop_event = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+
+    def create(self, quota_bytes: Optional[int] = None) -> TempWorkspace:
+        """
+        Create a new workspace. The caller is responsible for closing it.
+
+        Args:
+            quota_bytes: Optional quota overriding the manager default
+
+        Returns:
+            The new workspace
+        """
+        root_dir = os.path.join(self.base_dir, f"{WORKSPACE_PREFIX}{os.getpid()}-{uuid.uuid4()}")
+        os.makedirs(root_dir)
+        lock_file = open(os.path.join(root_dir, LOCK_FILE), 'a')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return TempWorkspace(
+            root_dir,
+            quota_bytes if quota_bytes is not None else self.quota_bytes,
+            self.spool_threshold,
+            lock_file=lock_file
+        )
+
+    @contextmanager
+    def workspace(self, quota_bytes: Optional[int] = None) -> Iterator[TempWorkspace]:
+        """
+        Context manager yielding a workspace that is removed on exit, even on error.
+
+        Args:
+            quota_bytes: Optional quota overriding the manager default
+        """
+        workspace = self.create(quota_bytes)
+        try:
+            yield workspace
+        finally:
+            workspace.close()
+
+    def sweep(self) -> int:
+        """
+        Remove orphaned workspaces and stray files from the base directory.
+
+        A workspace is orphaned once its lock is no longer held, i.e. it was
+        not closed by the process that created it, however old it is.
+        Workspaces without a lock file, left by older code, are orphaned when
+        their process is gone or they are older than ``max_age_seconds``.
+        Loose files left by older code are removed once they exceed the same age.
+
+        Returns:
+            Number of entries removed
+        """
+        removed = 0
+        now = time.time()
+
+        try:
+            entries = list(os.scandir(self.base_dir))
+        except FileNotFoundError:
+            return 0
+
+        for entry in entries:
+            try:
+                age = now - entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+
+            if entry.is_dir(follow_symlinks=False) and entry.name.startswith(WORKSPACE_PREFIX):
+                if self._remove_abandoned(entry.path, entry.name, age):
+                    removed += 1
+                continue
+
+            if age <= self.max_age_seconds:
+                continue
+
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+            removed += 1
+
+        return removed
+
+    def _remove_abandoned(self, path: str, name: str, age: float) -> bool:
+        """Remove a workspace directory if its owner no longer uses it."""
+        try:
+            fd = os.open(os.path.join(path, LOCK_FILE), os.O_RDONLY)
+        except FileNotFoundError:
+            # Left by older code, or still being created by its owner
+            if pid_alive(_workspace_pid(name)) and age <= self.max_age_seconds:
+                return False
+            shutil.rmtree(path, ignore_errors=True)
+            return True
+
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Still in use
+                return False
+            shutil.rmtree(path, ignore_errors=True)
+            return True
+        finally:
+            os.close(fd)
+
+    def start_sweeper(self) -> None:
+        """Start the background sweeper thread if it is not already running."""
+        if self._sweeper and self._sweeper.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="temp-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self) -> None:
+        """Stop the background sweeper thread."""
+        self._stop_event.set()
+        if self._sweeper:
+            self._sweeper.join(timeout=5)
+            self._sweeper = None
+
+    def _sweep_loop(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.sweep()
+            except Exception:
+                # Sweeping is best effort; try again on the next interval
+                pass
+            self._stop_event.wait(self.sweep_interval_seconds)
+
+
+def _workspace_pid(name: str) -> int:
+    """Extract the creating process ID from a workspace directory name."""
+    try:
+        return int(name[len(WORKSPACE_PREFIX):].split("-", 1)[0])
+    except ValueError:
+        return -1
+
@@ -2,5 +2,11 @@
 Initialize the Document Service package.
 """
 from document_service.document_manager import DocumentManager
+from document_service.storage import (
+    StorageBackend, LocalStorageBackend, S3StorageBackend, ShardedLayout
+)
 
-__all__ = ["DocumentManager"]
+__all__ = [
+    "DocumentManager",
+    "StorageBackend", "LocalStorageBackend", "S3StorageBackend", "ShardedLayout"
+]
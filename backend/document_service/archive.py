@@ -0,0 +1,279 @@
+"""
+Compressed archive tier for rarely read version files, with a local restore cache.
+"""
+import fcntl
+import hashlib
+import importlib.util
+import lzma
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional
+
+from common.metrics import metrics
+from document_service.storage import StorageBackend
+
+# File extension of archived blobs by codec
+CODEC_EXTENSIONS = {"zstd": "zst", "xz": "xz"}
+
+# Default compression level by codec
+DEFAULT_LEVELS = {"zstd": 19, "xz": 6}
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Number of lock files restores of different archives are spread across
+RESTORE_LOCK_STRIPES = 64
+
+# Restored files recently restored or read are not evicted, so that a path
+# handed out to a request is still there when the response opens it
+EVICTION_GRACE_SECONDS = 10 * 60
+
+
+def default_codec() -> str:
+    """Get the best available codec: zstd if the zstandard package is installed, xz otherwise."""
+    return "zstd" if importlib.util.find_spec("zstandard") is not None else "xz"
+
+
+def _compress(codec: str, level: int, source: BinaryIO, destination: BinaryIO) -> None:
+    if codec == "zstd":
+        import zstandard
+        zstandard.ZstdCompressor(level=level).copy_stream(source, destination)
+    elif codec == "xz":
+        with lzma.open(destination, "wb", preset=level) as compressed:
+            shutil.copyfileobj(source, compressed, COPY_BUFFER_SIZE)
+    else:
+        raise ValueError(f"Unknown archive codec {codec}")
+
+
+def _decompress(codec: str, source: BinaryIO, destination: BinaryIO) -> str:
+    """Decompress a stream and return the SHA-256 of the output."""
+    digest = hashlib.sha256()
+    if codec == "zstd":
+        import zstandard
+        reader = zstandard.ZstdDecompressor().stream_reader(source)
+    elif codec == "xz":
+        reader = lzma.open(source, "rb")
+    else:
+        raise ValueError(f"Unknown archive codec {codec}")
+
+    with reader:
+        while True:
+            chunk = reader.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            destination.write(chunk)
+    return digest.hexdigest()
+
+
+class ArchiveTier:
+    """
+    Holds compressed copies of version files in a separate, cheaper store.
+
+    The archive is any ``StorageBackend``, e.g. a local directory on a
+    separate mount or an S3-compatible bucket. Archived versions are restored
+    on read into a local cache of bounded size, from which the least recently
+    used files are evicted once they have not been used for a grace period.
+    """
+
+    def __init__(
+        self,
+        backend: StorageBackend,
+        cache_dir: str,
+        cache_bytes: int = 256 * 1024 * 1024,
+        codec: Optional[str] = None,
+        level: Optional[int] = None,
+        grace_seconds: float = EVICTION_GRACE_SECONDS
+    ):
+        """
+        Initialize the archive tier.
+
+        Args:
+            backend: Store holding the compressed blobs
+            cache_dir: Directory holding restored versions
+            cache_bytes: Maximum size of the restore cache
+            codec: Optional codec of new archives, "zstd" or "xz"; defaults to the best available
+            level: Optional compression level, defaults to a high level of the codec
+            grace_seconds: Time a restored file is kept after its last use, even
+                if the cache is over its size
+        """
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.cache_bytes = cache_bytes
+        self.codec = codec or default_codec()
+        if self.codec not in CODEC_EXTENSIONS:
+            raise ValueError(f"Unknown archive codec {self.codec}")
+        self.level = DEFAULT_LEVELS[self.codec] if level is None else level
+        self.grace_seconds = grace_seconds
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock_dir = os.path.join(cache_dir, ".locks")
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def archive(self, key: str, source_path: str) -> Dict[str, Any]:
+        """
+        Store a compressed copy of a version file.
+
+        Args:
+            key: Storage key of the version in the hot store
+            source_path: Path to the version file
+
+        Returns:
+            Archive record to keep in the version's metadata
+        """
+        archive_key = f"{key}.{CODEC_EXTENSIONS[self.codec]}"
+        partial_path = os.path.join(self.cache_dir, f".{uuid.uuid4().hex}.archive")
+        try:
+            with open(source_path, 'rb') as source, open(partial_path, 'wb') as destination:
+                _compress(self.codec, self.level, source, destination)
+            blob = self.backend.move_file(archive_key, partial_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.unlink(partial_path)
+
+        return {
+            "storage_key": archive_key,
+            "codec": self.codec,
+            "size": blob.size,
+            "archived_at": datetime.utcnow().isoformat()
+        }
+
+    def _cache_path(self, archive_key: str) -> str:
+        return os.path.join(self.cache_dir, f"{hashlib.sha1(archive_key.encode('utf-8')).hexdigest()}.pdf")
+
+    @contextmanager
+    def _locked(self, purpose: str, cache_path: str, operation: int = fcntl.LOCK_EX) -> Iterator[bool]:
+        """
+        Hold a lock on a restored file, across all workers.
+
+        Locks are striped across a fixed set of lock files per purpose, so that
+        their number stays constant however many archives are restored.
+        Restores are serialized by the "restore" locks; the "use" locks keep a
+        file from being evicted while it is handed out.
+
+        Args:
+            purpose: "restore" or "use"
+            cache_path: Path of the restored file
+            operation: Lock operation, e.g. fcntl.LOCK_SH or fcntl.LOCK_EX | fcntl.LOCK_NB
+
+        Yields:
+            Whether the lock was acquired; only False for non-blocking operations
+        """
+        stripe = int(os.path.basename(cache_path)[:4], 16) % RESTORE_LOCK_STRIPES
+        with open(os.path.join(self.lock_dir, f"{purpose}-{stripe:02d}.lock"), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), operation)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _touch(self, cache_path: str) -> bool:
+        """Mark a restored file as recently used, if it exists."""
+        with self._locked("use", cache_path, fcntl.LOCK_SH):
+            try:
+                os.utime(cache_path)
+                return True
+            except FileNotFoundError:
+                return False
+
+    def restore(self, version: Dict[str, Any]) -> str:
+        """
+        Get a local path holding an archived version's content.
+
+        Args:
+            version: Version metadata with an "archive" record
+
+        Returns:
+            Path to the restored version file
+
+        Raises:
+            ValueError: If the archive is missing or does not match the version
+        """
+        record = version["archive"]
+        cache_path = self._cache_path(record["storage_key"])
+        if self._touch(cache_path):
+            metrics.inc("archive_restore_total", 1, "Reads of archived versions", result="cached")
+            return cache_path
+
+        with self._locked("restore", cache_path):
+            if self._touch(cache_path):
+                # Restored by another worker in the meantime
+                return cache_path
+
+            started = time.perf_counter()
+            partial_path = f"{cache_path}.{uuid.uuid4().hex}.part"
+            try:
+                with open(self.backend.open_path(record["storage_key"]), 'rb') as source, open(partial_path, 'wb') as destination:
+                    sha256 = _decompress(record["codec"], source, destination)
+                if version.get("sha256") and sha256 != version["sha256"]:
+                    raise ValueError(f"Archived version {version['version_id']} is corrupt")
+                os.replace(partial_path, cache_path)
+            except (OSError, lzma.LZMAError) as e:
+                raise ValueError(f"Error restoring archived version {version['version_id']}: {str(e)}")
+            finally:
+                if os.path.exists(partial_path):
+                    os.unlink(partial_path)
+
+        metrics.inc("archive_restore_total", 1, "Reads of archived versions", result="restored")
+        metrics.observe("archive_restore_seconds", time.perf_counter() - started, "Time spent restoring archived versions")
+        self._evict(keep=cache_path)
+        return cache_path
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """
+        Remove the least recently used restored files until the cache fits its size.
+
+        Files used within the grace period are kept, since a request may have
+        been handed their path without having opened them yet.
+        """
+        cutoff = time.time() - self.grace_seconds
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".pdf"):
+                continue
+            try:
+                stat_result = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat_result.st_mtime, stat_result.st_size, entry.path))
+            total += stat_result.st_size
+
+        for mtime, size, path in sorted(entries):
+            if total <= self.cache_bytes or mtime > cutoff:
+                break
+            if path == keep:
+                continue
+            # Files being handed out are skipped rather than waited for
+            with self._locked("use", path, fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+                try:
+                    if not locked or os.stat(path).st_mtime > cutoff:
+                        continue
+                    # Open files stay readable until closed
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+        metrics.set_gauge("archive_restore_cache_bytes", total, "Size of the restore cache of archived versions")
+
+    def delete_keys(self, keys: List[str]) -> None:
+        """
+        Remove archived blobs and their restored copies.
+
+        Args:
+            keys: Archive storage keys
+        """
+        if not keys:
+            return
+        self.backend.delete_keys(keys)
+        for key in keys:
+            try:
+                os.unlink(self._cache_path(key))
+            except FileNotFoundError:
+                pass
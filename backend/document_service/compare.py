@@ -0,0 +1,128 @@
+"""
+Version comparison - page-level diffs driven by stored page fingerprints.
+"""
+import difflib
+from typing import Any, Dict, List, Optional
+
+from common.models import SubscriptionTier
+from document_service.document_manager import DocumentManager
+
+# Number of unchanged lines shown around each text change
+DIFF_CONTEXT_LINES = 3
+
+
+def _page_key(fingerprint: Dict[str, Any]) -> tuple:
+    return fingerprint["content"], fingerprint["text"], tuple(fingerprint["images"])
+
+
+def _page_changes(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, bool]:
+    return {
+        "content": old["content"] != new["content"],
+        "text": old["text"] != new["text"],
+        "images": old["images"] != new["images"]
+    }
+
+
+def diff_versions(
+    manager: DocumentManager,
+    document_id: str,
+    from_version_id: str,
+    to_version_id: str,
+    context_lines: Optional[int] = None,
+    sandbox=None,
+    tier: SubscriptionTier = SubscriptionTier.FREE
+) -> Dict[str, Any]:
+    """
+    Compare two versions of a document page by page.
+
+    Pages are matched on their stored fingerprints, so unchanged, inserted and
+    removed pages are found without parsing either file. Text is extracted
+    and diffed only for pages whose text fingerprint differs.
+
+    Args:
+        manager: Document manager holding the document
+        document_id: ID of the document
+        from_version_id: ID of the older version
+        to_version_id: ID of the newer version
+        context_lines: Optional number of context lines in text diffs
+        sandbox: Optional ``PDFSandbox`` text extraction runs in
+        tier: Subscription tier whose sandbox limits apply
+
+    Returns:
+        Summary counts and the list of added, removed and changed pages, with
+        1-based page numbers
+    """
+    from pdf_service.pdf_processor import PDFProcessor
+
+    extract_text = PDFProcessor.extract_text
+    if sandbox:
+        def extract_text(file_path: str, pages: List[int]) -> Dict[int, str]:
+            return sandbox.run("extract_text", file_path, pages, tier=tier)
+
+    if context_lines is None:
+        context_lines = DIFF_CONTEXT_LINES
+
+    old_pages = manager.get_page_fingerprints(document_id, from_version_id)
+    new_pages = manager.get_page_fingerprints(document_id, to_version_id)
+
+    matcher = difflib.SequenceMatcher(
+        None,
+        [_page_key(page) for page in old_pages],
+        [_page_key(page) for page in new_pages],
+        autojunk=False
+    )
+
+    pages: List[Dict[str, Any]] = []
+    summary = {"unchanged": 0, "changed": 0, "added": 0, "removed": 0}
+    text_pairs = []
+
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag == "equal":
+            summary["unchanged"] += old_end - old_start
+            continue
+
+        # Pages replaced in place are paired up and compared; any surplus on
+        # either side counts as removed or added
+        paired = min(old_end - old_start, new_end - new_start) if tag == "replace" else 0
+        for offset in range(paired):
+            old_index, new_index = old_start + offset, new_start + offset
+            changes = _page_changes(old_pages[old_index], new_pages[new_index])
+            entry = {"status": "changed", "from_page": old_index + 1, "to_page": new_index + 1, "changes": changes}
+            if changes["text"]:
+                text_pairs.append((entry, old_index + 1, new_index + 1))
+            pages.append(entry)
+            summary["changed"] += 1
+
+        for old_index in range(old_start + paired, old_end):
+            pages.append({"status": "removed", "from_page": old_index + 1, "to_page": None})
+            summary["removed"] += 1
+
+        for new_index in range(new_start + paired, new_end):
+            pages.append({"status": "added", "from_page": None, "to_page": new_index + 1})
+            summary["added"] += 1
+
+    if text_pairs:
+        _, _, old_path = manager.resolve_version(document_id, from_version_id)
+        _, _, new_path = manager.resolve_version(document_id, to_version_id)
+        old_text = extract_text(old_path, [old_page for _, old_page, _ in text_pairs])
+        new_text = extract_text(new_path, [new_page for _, _, new_page in text_pairs])
+
+        for entry, old_page, new_page in text_pairs:
+            entry["text_diff"] = list(difflib.unified_diff(
+                old_text.get(old_page, "").splitlines(),
+                new_text.get(new_page, "").splitlines(),
+                fromfile=f"{from_version_id}#page={old_page}",
+                tofile=f"{to_version_id}#page={new_page}",
+                n=context_lines,
+                lineterm=""
+            ))
+
+    return {
+        "document_id": document_id,
+        "from_version": from_version_id,
+        "to_version": to_version_id,
+        "from_page_count": len(old_pages),
+        "to_page_count": len(new_pages),
+        "summary": summary,
+        "pages": pages
+    }
@@ -1,114 +1,1055 @@
 """
 Document Management Service - Core functionality for document storage and retrieval.
 """
+import io
 import os
+import gzip
+import shutil
+import tempfile
 import uuid
-from typing import List, Dict, Any, Optional
+import hashlib
+import fcntl
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, BinaryIO, TextIO, Union, Iterator, Tuple, Callable
 from datetime import datetime
 import json
 
+from common.metrics import metrics
 from common.models import DocumentMetadata, DocumentVersion, Permission, AccessLevel
+from common.shared_cache import SharedMemoryCache
+from document_service.storage import StorageBackend, LocalStorageBackend, ShardedLayout, StoredBlob
+from document_service.archive import ArchiveTier
+
+# Number of lock files that document locks are striped across
+LOCK_STRIPES = 256
+
+# Number of threads used for parallel metadata reads in batches
+BATCH_IO_WORKERS = 16
+
+# Version fields referring to derived blobs stored next to the version
+VERSION_ARTIFACTS = ("page_index", "text_index", "form_schema", "thumbnail")
+
+# Versions smaller than this are not worth pre-compressing
+PRECOMPRESS_MIN_SIZE = 64 * 1024
+
+# Pre-compressed representations are only kept below this size ratio
+PRECOMPRESS_MAX_RATIO = 0.9
+
+# Compressed output is buffered in memory up to this size
+PRECOMPRESS_SPOOL_SIZE = 8 * 1024 * 1024
 
 
 class DocumentManager:
     """Core document management functionality."""
     
-    def __init__(self, storage_dir: str):
+    def __init__(
+        self,
+        storage_dir: str,
+        backend: Optional[StorageBackend] = None,
+        layout: Optional[ShardedLayout] = None,
+        precompress: bool = False,
+        shared_cache: Optional[SharedMemoryCache] = None,
+        archive: Optional[ArchiveTier] = None
+    ):
         """
         Initialize the document manager.
         
         Args:
             storage_dir: Directory where documents will be stored
+            backend: Optional blob store for version files, defaults to local disk under storage_dir
+            layout: Optional sharded key layout, defaults to two levels of hash prefixes
+            precompress: Whether to store gzip representations of new versions for downloads
+            shared_cache: Optional cache shared between workers for raw metadata reads
+            archive: Optional compressed tier that old versions are moved to
         """
         self.storage_dir = storage_dir
+        self.precompress = precompress
+        self.shared_cache = shared_cache
+        self.archive = archive
+        self._version_listeners: List[Callable[[str, str], None]] = []
+        self._change_listeners: List[Callable[[List[Dict[str, Any]], List[str]], None]] = []
+        self._event_listeners: List[Callable[[List[Dict[str, Any]]], None]] = []
+        self._purge_listeners: List[Callable[[str], None]] = []
         os.makedirs(storage_dir, exist_ok=True)
         
+        self.backend = backend or LocalStorageBackend(storage_dir)
+        self.layout = layout or ShardedLayout()
+        
         # Create metadata directory
         self.metadata_dir = os.path.join(storage_dir, "metadata")
         os.makedirs(self.metadata_dir, exist_ok=True)
+        
+        # Create lock directory used to serialize metadata updates across workers
+        self.lock_dir = os.path.join(self.metadata_dir, ".locks")
+        os.makedirs(self.lock_dir, exist_ok=True)
+        
+        # Create journal directory used to make batch updates atomic
+        self.journal_dir = os.path.join(self.metadata_dir, ".journal")
+        os.makedirs(self.journal_dir, exist_ok=True)
+        
+        # Create trash directory holding deleted documents and versions until
+        # the garbage collector removes their blobs
+        self.trash_dir = os.path.join(self.metadata_dir, ".trash")
+        os.makedirs(self.trash_dir, exist_ok=True)
+        
+        # Create reference directory recording the documents that share a blob,
+        # e.g. the instances of a template
+        self.refs_dir = os.path.join(self.metadata_dir, ".refs")
+        os.makedirs(self.refs_dir, exist_ok=True)
+    
+    def _lock_stripe(self, document_id: str) -> int:
+        """Get the lock stripe a document belongs to."""
+        return int(hashlib.sha1(document_id.encode("utf-8")).hexdigest()[:4], 16) % LOCK_STRIPES
+    
+    @contextmanager
+    def _lock_documents(self, document_ids: List[str]) -> Iterator[None]:
+        """
+        Hold exclusive locks on the metadata of several documents.
+        
+        Locks are striped across a fixed set of lock files so that the number of
+        files stays constant regardless of how many documents exist. Stripes are
+        always acquired in ascending order so concurrent batches cannot deadlock.
+        
+        Args:
+            document_ids: IDs of the documents to lock
+        """
+        stripes = sorted({self._lock_stripe(document_id) for document_id in document_ids})
+        lock_files = []
+        try:
+            for stripe in stripes:
+                lock_file = open(os.path.join(self.lock_dir, f"{stripe:03d}.lock"), 'a')
+                lock_files.append(lock_file)
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            
+            # Finish any batch interrupted by a crash before reading metadata
+            self._recover_journals()
+            yield
+        finally:
+            for lock_file in reversed(lock_files):
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                lock_file.close()
+    
+    def _lock_document(self, document_id: str):
+        """
+        Hold an exclusive lock on a document's metadata.
+        
+        Args:
+            document_id: ID of the document to lock
+        """
+        return self._lock_documents([document_id])
+    
+    def _legacy_metadata_path(self, document_id: str) -> str:
+        """Get the pre-sharding metadata path of a document."""
+        return os.path.join(self.metadata_dir, f"{document_id}.json")
+    
+    def _find_metadata_path(self, document_id: str) -> Optional[str]:
+        """
+        Locate a document's metadata file.
+        
+        The sharded location is checked first; documents that have not been
+        migrated yet are still found at their legacy flat location.
+        
+        Args:
+            document_id: ID of the document
+            
+        Returns:
+            Path to the metadata file, or None if the document does not exist
+        """
+        for path in (self.layout.metadata_path(self.metadata_dir, document_id), self._legacy_metadata_path(document_id)):
+            if os.path.exists(path):
+                return path
+        return None
+    
+    def _save_metadata(self, metadata: Dict[str, Any]) -> None:
+        """
+        Atomically write document metadata to its sharded location.
+        
+        Args:
+            metadata: Document metadata to save
+        """
+        partial_path, metadata_path = self._stage_metadata(metadata)
+        os.replace(partial_path, metadata_path)
+        
+        # Drop the legacy copy once the sharded one is in place
+        self._remove_file(self._legacy_metadata_path(metadata["id"]))
+        self._notify_changed([metadata], [])
+    
+    def _stage_metadata(self, metadata: Dict[str, Any]) -> Tuple[str, str]:
+        """
+        Write document metadata next to its final location without replacing it.
+        
+        Args:
+            metadata: Document metadata to stage
+            
+        Returns:
+            Tuple of the staged file path and the final metadata path
+        """
+        metadata_path = self.layout.metadata_path(self.metadata_dir, metadata["id"])
+        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+        
+        partial_path = f"{metadata_path}.{uuid.uuid4().hex}.tmp"
+        with open(partial_path, 'w') as f:
+            json.dump(metadata, f, indent=2)
+        return partial_path, metadata_path
+    
+    @staticmethod
+    def _remove_file(path: str) -> None:
+        """Remove a file if it exists."""
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    
+    def _commit_batch(
+        self,
+        updated: List[Dict[str, Any]],
+        deleted: List[str],
+        trashed: Optional[List[Dict[str, Any]]] = None
+    ) -> None:
+        """
+        Atomically apply metadata changes to many documents.
+        
+        All new metadata is staged first, then a journal describing the changes
+        is made durable, and only then are the files switched over. A crash
+        before the journal is written leaves everything untouched; a crash after
+        it is rolled forward by the next writer. The journal is flocked until it
+        is applied, which tells its writer's death apart from a batch in
+        progress. The caller must hold the locks of every affected document.
+        
+        Args:
+            updated: Metadata of documents to save
+            deleted: IDs of documents whose metadata is removed
+            trashed: Optional trash entries recording the blobs to remove
+        """
+        operations = []
+        journal_file = None
+        try:
+            for metadata in updated:
+                partial_path, metadata_path = self._stage_metadata(metadata)
+                operations.append({"op": "replace", "source": partial_path, "path": metadata_path})
+                operations.append({"op": "remove", "path": self._legacy_metadata_path(metadata["id"])})
+            
+            for entry in trashed or []:
+                entry_path = self._trash_path(entry["id"])
+                partial_path = f"{entry_path}.{uuid.uuid4().hex}.tmp"
+                with open(partial_path, 'w') as f:
+                    json.dump(entry, f)
+                operations.append({"op": "replace", "source": partial_path, "path": entry_path})
+            
+            for document_id in deleted:
+                for path in (self.layout.metadata_path(self.metadata_dir, document_id), self._legacy_metadata_path(document_id)):
+                    operations.append({"op": "remove", "path": path})
+            
+            # Created last, since recovery waits for locked journals
+            journal_path, journal_file = self._create_journal()
+            json.dump(operations, journal_file)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+            os.replace(f"{journal_path}.tmp", journal_path)
+        except Exception:
+            for operation in operations:
+                if operation["op"] == "replace":
+                    self._remove_file(operation["source"])
+            if journal_file:
+                self._remove_file(f"{journal_path}.tmp")
+                journal_file.close()
+            raise
+        
+        # Closing the journal releases its lock once it is removed
+        with journal_file:
+            self._apply_journal(journal_path)
+        self._notify_changed(updated, deleted)
+    
+    def _create_journal(self) -> Tuple[str, TextIO]:
+        """
+        Create a batch journal, locked for as long as it is open.
+        
+        Returns:
+            Path the journal is committed to, and the open partial journal file
+        """
+        while True:
+            journal_path = os.path.join(self.journal_dir, f"{uuid.uuid4().hex}.json")
+            journal_file = open(f"{journal_path}.tmp", 'w')
+            fcntl.flock(journal_file.fileno(), fcntl.LOCK_EX)
+            if os.fstat(journal_file.fileno()).st_nlink:
+                return journal_path, journal_file
+            # Taken for an abandoned journal and removed by recovery before it was locked
+            journal_file.close()
+    
+    def _apply_journal(self, journal_path: str) -> None:
+        """
+        Apply the operations recorded in a batch journal, then remove it.
+        
+        Applying a journal twice is harmless, which makes recovery idempotent.
+        
+        Args:
+            journal_path: Path to the journal file
+        """
+        with open(journal_path, 'r') as f:
+            operations = json.load(f)
+        
+        for operation in operations:
+            if operation["op"] == "replace":
+                try:
+                    os.replace(operation["source"], operation["path"])
+                except FileNotFoundError:
+                    # Already applied
+                    pass
+            else:
+                self._remove_file(operation["path"])
+        
+        self._remove_file(journal_path)
+    
+    def _recover_journals(self) -> None:
+        """
+        Roll forward batches whose process died after their journal was written.
+        
+        A journal's writer holds its flock until the journal is applied and
+        removed, so getting the lock while the journal still exists means the
+        writer died. Writers only hold it while switching files, so waiting for
+        it is short, and leaves no batch half-applied behind a reader.
+        """
+        for filename in os.listdir(self.journal_dir):
+            journal_path = os.path.join(self.journal_dir, filename)
+            try:
+                journal_file = open(journal_path, 'r')
+            except FileNotFoundError:
+                # Applied in the meantime
+                continue
+            with journal_file:
+                fcntl.flock(journal_file.fileno(), fcntl.LOCK_EX)
+                if not os.fstat(journal_file.fileno()).st_nlink:
+                    # Applied by its writer or recovered by another worker
+                    continue
+                if filename.endswith(".tmp"):
+                    # The batch never committed
+                    self._remove_file(journal_path)
+                    continue
+                self._apply_journal(journal_path)
+    
+    def _trash_path(self, entry_id: str) -> str:
+        return os.path.join(self.trash_dir, f"{entry_id}.json")
+    
+    @staticmethod
+    def version_keys(version: Dict[str, Any]) -> List[str]:
+        """
+        List the storage keys of a version and of the blobs derived from it.
+        
+        Args:
+            version: Version metadata
+            
+        Returns:
+            Storage keys
+        """
+        keys = [version["storage_key"]]
+        keys.extend(encoded["storage_key"] for encoded in version.get("encodings", {}).values())
+        for field in VERSION_ARTIFACTS:
+            if version.get(field):
+                keys.append(version[field]["storage_key"])
+        # Hot copies of an archived version not removed yet
+        for key in (version.get("archive") or {}).get("hot_keys", []):
+            if key not in keys:
+                keys.append(key)
+        return keys
+    
+    @staticmethod
+    def archive_keys(version: Dict[str, Any]) -> List[str]:
+        """
+        List the archive tier keys of a version.
+        
+        Args:
+            version: Version metadata
+            
+        Returns:
+            Storage keys in the archive tier
+        """
+        return [version["archive"]["storage_key"]] if version.get("archive") else []
+    
+    def _document_trash_entry(self, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the trash entry of a deleted document, kept until its blobs are removed."""
+        prefixes = [metadata["storage_key"]]
+        if metadata["storage_key"] != metadata["id"]:
+            # Blobs left at the legacy location
+            prefixes.append(metadata["id"])
+        # Blobs shared with other documents, e.g. those of the template an
+        # instance was created from, live outside the document's prefixes
+        keys = [
+            key
+            for version in metadata["versions"]
+            for key in self.version_keys(version)
+            if not any(key.startswith(f"{prefix}/") for prefix in prefixes)
+        ]
+        return {
+            "id": f"document-{metadata['id']}",
+            "kind": "document",
+            "document_id": metadata["id"],
+            "owner_id": metadata["owner_id"],
+            "prefixes": prefixes,
+            "keys": keys,
+            "archive_keys": [key for version in metadata["versions"] for key in self.archive_keys(version)],
+            "size": sum(version.get("size", 0) for version in metadata["versions"]),
+            "deleted_at": datetime.utcnow().isoformat(),
+            "purging": False,
+            "metadata": metadata
+        }
+    
+    def iter_trash(self) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over the trash entries of deleted documents and pruned versions.
+        
+        Yields:
+            Trash entries
+        """
+        for filename in sorted(os.listdir(self.trash_dir)):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.trash_dir, filename), 'r') as f:
+                    yield json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+    
+    def save_trash_entry(self, entry: Dict[str, Any]) -> None:
+        """
+        Atomically replace a trash entry, e.g. to record purge progress.
+        
+        Args:
+            entry: Trash entry to save
+        """
+        entry_path = self._trash_path(entry["id"])
+        partial_path = f"{entry_path}.{uuid.uuid4().hex}.tmp"
+        with open(partial_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(partial_path, entry_path)
+    
+    def claim_trash_entry(self, entry_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Mark a trash entry as being purged, after which it can no longer be restored.
+        
+        Entries of documents that are live again, left behind by an
+        interrupted restore, are discarded instead.
+        
+        Args:
+            entry_id: ID of the entry
+            
+        Returns:
+            The claimed entry, or None if there is nothing left to purge
+        """
+        entry_path = self._trash_path(entry_id)
+        try:
+            with open(entry_path, 'r') as f:
+                document_id = json.load(f)["document_id"]
+        except FileNotFoundError:
+            return None
+        
+        with self._lock_document(document_id):
+            try:
+                with open(entry_path, 'r') as f:
+                    entry = json.load(f)
+            except FileNotFoundError:
+                return None
+            if entry["kind"] == "document" and self._find_metadata_path(document_id):
+                self._remove_file(entry_path)
+                return None
+            if not entry["purging"]:
+                entry["purging"] = True
+                self.save_trash_entry(entry)
+            if entry["kind"] == "document":
+                # Also repeated for entries claimed by an interrupted pass
+                self._notify_purged(document_id)
+        
+        return entry
+    
+    def remove_trash_entry(self, entry_id: str) -> None:
+        """
+        Remove a trash entry once its blobs are gone.
+        
+        Args:
+            entry_id: ID of the entry
+        """
+        self._remove_file(self._trash_path(entry_id))
+    
+    def _ref_path(self, key: str) -> str:
+        return os.path.join(self.refs_dir, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.json")
+    
+    def _save_refs(self, refs: Dict[str, Any]) -> None:
+        ref_path = self._ref_path(refs["key"])
+        partial_path = f"{ref_path}.{uuid.uuid4().hex}.tmp"
+        with open(partial_path, 'w') as f:
+            json.dump(refs, f)
+        os.replace(partial_path, ref_path)
+    
+    @staticmethod
+    def _blob_lock_id(key: str) -> str:
+        """Get the lock ID guarding the references of a blob."""
+        return f"blob:{key}"
+    
+    def _load_refs(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._ref_path(key), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+    
+    def _add_blob_ref(self, key: str, owner_document_id: str, document_id: str) -> None:
+        """
+        Record that a document shares a blob. The caller holds the blob's lock.
+        
+        Args:
+            key: Storage key of the blob
+            owner_document_id: Document currently holding the blob
+            document_id: Document starting to share it
+        """
+        refs = self._load_refs(key) or {"key": key, "holders": [owner_document_id]}
+        refs["holders"].append(document_id)
+        self._save_refs(refs)
+    
+    def blob_holders(self, key: str) -> List[str]:
+        """
+        List the documents sharing a blob.
+        
+        Args:
+            key: Storage key of the blob
+            
+        Returns:
+            IDs of the documents holding the blob, or an empty list if the
+            blob belongs to a single document
+        """
+        refs = self._load_refs(key)
+        return refs["holders"] if refs else []
+    
+    def release_blob(self, key: str, document_id: str) -> bool:
+        """
+        Drop a document's reference to a blob before the blob is removed.
+        
+        Args:
+            key: Storage key of the blob
+            document_id: Document that no longer holds the blob
+            
+        Returns:
+            True if no other document holds the blob, so it can be removed
+        """
+        if not os.path.exists(self._ref_path(key)):
+            return True
+        
+        with self._lock_documents([self._blob_lock_id(key)]):
+            refs = self._load_refs(key)
+            if refs is None:
+                return True
+            if document_id in refs["holders"]:
+                refs["holders"].remove(document_id)
+            if refs["holders"]:
+                self._save_refs(refs)
+                return False
+            self._remove_file(self._ref_path(key))
+        return True
+    
+    def _iter_metadata_paths(self) -> Iterator[str]:
+        """Iterate over every metadata file, sharded and legacy."""
+        for dirpath, dirnames, filenames in os.walk(self.metadata_dir):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                if filename.endswith(".json"):
+                    yield os.path.join(dirpath, filename)
+    
+    def _version_path(self, version: Dict[str, Any]) -> str:
+        """
+        Get a local path holding a version's content.
+        
+        Args:
+            version: Version metadata
+            
+        Returns:
+            Path to the version file
+        """
+        if version.get("tier") == "archive":
+            if self.archive is None:
+                raise ValueError(f"Version {version['version_id']} is archived, but no archive tier is configured")
+            return self.archive.restore(version)
+        
+        try:
+            return self.backend.open_path(version["storage_key"])
+        except ValueError:
+            raise ValueError(f"Version file not found for version {version['version_id']}")
+    
+    def _precompress(self, version_key: str, version_path: str, size: int) -> Dict[str, Dict[str, Any]]:
+        """
+        Store a gzip representation of a version for compressed downloads.
+        
+        The representation is only kept when it saves a meaningful amount of
+        space; most PDFs already use compressed streams.
+        
+        Args:
+            version_key: Storage key of the version
+            version_path: Local path to the version file
+            size: Size of the version file in bytes
+            
+        Returns:
+            Mapping of content encodings to their storage key and size
+        """
+        if not self.precompress or size < PRECOMPRESS_MIN_SIZE:
+            return {}
+        
+        with tempfile.SpooledTemporaryFile(max_size=PRECOMPRESS_SPOOL_SIZE) as buffer:
+            with open(version_path, 'rb') as src, gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as dst:
+                shutil.copyfileobj(src, dst)
+            
+            if buffer.tell() > size * PRECOMPRESS_MAX_RATIO:
+                return {}
+            
+            buffer.seek(0)
+            encoded_key = f"{version_key}.gz"
+            encoded = self.backend.put_file(encoded_key, buffer)
+        
+        return {"gzip": {"storage_key": encoded_key, "size": encoded.size}}
+    
+    def _index_pages(self, version_key: str, version_path: str) -> Dict[str, Any]:
+        """
+        Store per-page fingerprints of a version next to it.
+        
+        The fingerprints are kept in a separate blob so that document metadata
+        stays small regardless of page count.
+        
+        Args:
+            version_key: Storage key of the version
+            version_path: Local path to the version file
+            
+        Returns:
+            Reference to the stored page index with its storage key and page count
+        """
+        from pdf_service.pdf_processor import PDFProcessor
+        return self._store_page_index(version_key, PDFProcessor.page_fingerprints(version_path))
+    
+    def _store_page_index(self, version_key: str, fingerprints: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Write page fingerprints next to a version and return the reference to them."""
+        index_key = f"{version_key}.pages.json"
+        self.backend.put_file(index_key, io.BytesIO(json.dumps(fingerprints, separators=(",", ":")).encode("utf-8")))
+        return {"storage_key": index_key, "page_count": len(fingerprints)}
+    
+    def get_recognized_text(self, version: Dict[str, Any]) -> Dict[int, str]:
+        """
+        Get the text that OCR recognized for pages of a version without a text layer.
+        
+        Args:
+            version: Version metadata
+            
+        Returns:
+            Recognized text by page number; empty if no page was recognized
+        """
+        text_index = version.get("text_index") or {}
+        if not text_index.get("ocr_pages"):
+            return {}
+        
+        try:
+            with open(self.backend.open_path(text_index["storage_key"]), 'r') as f:
+                text = json.load(f)
+        except (ValueError, FileNotFoundError):
+            return {}
+        return {page: text[str(page)] for page in text_index["ocr_pages"] if str(page) in text}
+    
+    def get_page_fingerprints(self, document_id: str, version_id: str) -> List[Dict[str, Any]]:
+        """
+        Get the per-page fingerprints of a document version.
+        
+        Versions stored before fingerprints were introduced are indexed on
+        first use and the result is kept for later comparisons.
+        
+        Args:
+            document_id: ID of the document
+            version_id: ID of the version
+            
+        Returns:
+            List of page fingerprints in page order
+        """
+        from pdf_service.pdf_processor import PDFProcessor
+        metadata, version, version_path = self.resolve_version(document_id, version_id)
+        
+        page_index = version.get("page_index")
+        if page_index:
+            try:
+                with open(self.backend.open_path(page_index["storage_key"]), 'r') as f:
+                    return json.load(f)
+            except (ValueError, FileNotFoundError):
+                pass
+        
+        fingerprints = PDFProcessor.page_fingerprints(version_path)
+        page_index = self._store_page_index(version["storage_key"], fingerprints)
+        with self._lock_document(document_id):
+            metadata = self.get_document(document_id)
+            for v in metadata["versions"]:
+                if v["version_id"] == version_id:
+                    v["page_index"] = page_index
+                    self._save_metadata(metadata)
+                    break
+        
+        return fingerprints
+    
+    def _store_version_file(
+        self,
+        version_key: str,
+        file_path: Union[str, BinaryIO],
+        move: bool,
+        sha256: Optional[str]
+    ) -> StoredBlob:
+        """Store a version file, adopting it without a copy when it is moved."""
+        if move:
+            return self.backend.move_file(version_key, file_path, sha256)
+        return self.backend.put_file(version_key, file_path)
+    
+    @staticmethod
+    def _check_pdf_header(version_path: str) -> None:
+        """
+        Cheaply reject files that are not PDFs before accepting an upload.
+        
+        Raises:
+            ValueError: If no PDF header is found at the start of the file
+        """
+        with open(version_path, 'rb') as f:
+            if b"%PDF-" not in f.read(1024):
+                raise ValueError("File is not a PDF document")
+    
+    @staticmethod
+    def _pending_enrichment(version_id: str) -> Dict[str, Any]:
+        return {
+            "status": "pending",
+            "version_id": version_id,
+            "errors": [],
+            "updated_at": datetime.utcnow().isoformat()
+        }
+    
+    def add_version_listener(self, listener: Callable[[str, str], None]) -> None:
+        """
+        Register a function called with the document and version ID of every stored version.
+        
+        Args:
+            listener: Function to call once the version's metadata is saved
+        """
+        self._version_listeners.append(listener)
+    
+    def _notify_version_stored(self, document_id: str, version_id: str) -> None:
+        for listener in self._version_listeners:
+            listener(document_id, version_id)
+    
+    def add_change_listener(self, listener: Callable[[List[Dict[str, Any]], List[str]], None]) -> None:
+        """
+        Register a function called after every metadata change.
+        
+        The listener receives the saved metadata and the IDs of removed
+        documents. It runs while the documents are still locked, so changes
+        of one document reach it in order. Changes rolled forward from a
+        batch journal after a crash are not reported.
+        
+        Args:
+            listener: Function to call with the updated metadata and deleted IDs
+        """
+        self._change_listeners.append(listener)
+    
+    def _notify_changed(self, updated: List[Dict[str, Any]], deleted: List[str]) -> None:
+        for listener in self._change_listeners:
+            listener(updated, deleted)
+    
+    def add_purge_listener(self, listener: Callable[[str], None]) -> None:
+        """
+        Register a function called when a deleted document can no longer be restored.
+        
+        Deleted documents stay restorable in the trash for a while, so state
+        kept beside their metadata must only be dropped once the garbage
+        collector claims their trash entry. The listener runs while the
+        document is locked, and may be called again for the same document if
+        a purge was interrupted.
+        
+        Args:
+            listener: Function to call with the ID of the purged document
+        """
+        self._purge_listeners.append(listener)
+    
+    def _notify_purged(self, document_id: str) -> None:
+        for listener in self._purge_listeners:
+            listener(document_id)
+    
+    def add_event_listener(self, listener: Callable[[List[Dict[str, Any]]], None]) -> None:
+        """
+        Register a function called with document events.
+        
+        Events are "created", "updated", "version_added",
+        "permissions_changed" and "deleted". Each carries the document's
+        owner and permissions at the time, so receivers can check access
+        without reading metadata, and permission changes also carry the
+        previous permissions.
+        
+        Args:
+            listener: Function to call with a list of events
+        """
+        self._event_listeners.append(listener)
+    
+    @staticmethod
+    def _document_event(
+        event_type: str,
+        metadata: Dict[str, Any],
+        version_id: Optional[str] = None,
+        previous_permissions: Optional[List[Dict[str, Any]]] = None
+    ) -> Dict[str, Any]:
+        event = {
+            "type": event_type,
+            "document_id": metadata["id"],
+            "version_id": version_id,
+            "name": metadata.get("name"),
+            "folder_id": metadata.get("folder_id"),
+            "owner_id": metadata["owner_id"],
+            "permissions": metadata.get("permissions", []),
+            "at": datetime.utcnow().isoformat()
+        }
+        if previous_permissions is not None:
+            event["previous_permissions"] = previous_permissions
+        return event
+    
+    def _notify_events(self, events: List[Dict[str, Any]]) -> None:
+        if not events:
+            return
+        for listener in self._event_listeners:
+            listener(events)
     
-    def create_document(self, file_path: str, name: str, owner_id: str, folder_id: Optional[str] = None) -> str:
+    def apply_enrichment(
+        self,
+        document_id: str,
+        version_id: str,
+        version_fields: Dict[str, Any],
+        document_fields: Dict[str, Any],
+        status: str,
+        errors: Optional[List[str]] = None
+    ) -> None:
+        """
+        Record the results of enriching a version.
+        
+        Version fields are always stored; document-level fields and the
+        enrichment status only change if the version is still the latest one.
+        
+        Args:
+            document_id: ID of the document
+            version_id: ID of the enriched version
+            version_fields: Fields to set on the version record
+            document_fields: Fields to set in the document's "metadata" section
+            status: Enrichment status, "complete" or "failed"
+            errors: Optional messages of enrichment steps that failed
+        """
+        with self._lock_document(document_id):
+            metadata = self.get_document(document_id)
+            
+            version = next((v for v in metadata["versions"] if v["version_id"] == version_id), None)
+            if version is None:
+                return
+            version.update(version_fields)
+            
+            if metadata["versions"][-1]["version_id"] == version_id:
+                metadata["metadata"].update(document_fields)
+                metadata["enrichment"] = {
+                    "status": status,
+                    "version_id": version_id,
+                    "errors": errors or [],
+                    "updated_at": datetime.utcnow().isoformat()
+                }
+            
+            self._save_metadata(metadata)
+            self._notify_events([self._document_event("updated", metadata, version_id)])
+    
+    def create_document(
+        self,
+        file_path: Union[str, BinaryIO],
+        name: str,
+        owner_id: str,
+        folder_id: Optional[str] = None,
+        move: bool = False,
+        sha256: Optional[str] = None,
+        document_id: Optional[str] = None,
+        version_id: Optional[str] = None
+    ) -> str:
         """
         Create a new document from a file.
         
         Args:
-            file_path: Path to the file to create document from
+            file_path: Path to the file to create document from, or an open binary file object
             name: Name of the document
             owner_id: ID of the document owner
             folder_id: Optional ID of the folder to place the document in
+            move: Whether ``file_path`` is moved into the store instead of copied
+            sha256: Optional known SHA-256 digest of a moved file
+            document_id: Optional ID generated by the caller, e.g. to retry a creation idempotently
+            version_id: Optional ID of the initial version generated by the caller
             
         Returns:
             ID of the created document
         """
         # Generate a unique ID for the document
-        document_id = str(uuid.uuid4())
-        
-        # Create document directory
-        document_dir = os.path.join(self.storage_dir, document_id)
-        os.makedirs(document_dir, exist_ok=True)
+        document_id = document_id or str(uuid.uuid4())
         
-        # Create versions directory
-        versions_dir = os.path.join(document_dir, "versions")
-        os.makedirs(versions_dir, exist_ok=True)
+        # Documents live under a tenant partition and hash-prefixed shards
+        document_key = self.layout.document_prefix(owner_id, document_id)
         
         # Create initial version
-        version_id = str(uuid.uuid4())
-        version_path = os.path.join(versions_dir, f"{version_id}.pdf")
+        version_id = version_id or str(uuid.uuid4())
+        version_key = self.layout.version_key(owner_id, document_id, version_id)
         
-        # Copy the file to the version path
-        with open(file_path, 'rb') as src, open(version_path, 'wb') as dst:
-            dst.write(src.read())
+        # The blob is stored and the metadata saved under the document's lock,
+        # so the storage checker never takes the new blob for an orphan
+        with self._lock_document(document_id):
+            # Store the file, removing the partially created document if it is
+            # not a PDF. Everything else is derived later by the enrichment pipeline.
+            try:
+                blob = self._store_version_file(version_key, file_path, move, sha256)
+                self._check_pdf_header(self.backend.open_path(version_key))
+            except Exception:
+                self.backend.delete_prefix(document_key)
+                raise
+            
+            metadata = {
+                "id": document_id,
+                "name": name,
+                "owner_id": owner_id,
+                "folder_id": folder_id,
+                "size": blob.size,
+                "content_type": "application/pdf",
+                "storage_key": document_key,
+                "is_template": False,
+                "metadata": {
+                    "page_count": 0,
+                    "has_form": False,
+                    "is_encrypted": False,
+                    "title": None,
+                    "author": None,
+                    "creation_date": None,
+                    "modification_date": None,
+                    "keywords": []
+                },
+                "enrichment": self._pending_enrichment(version_id),
+                "permissions": [
+                    {
+                        "user_id": owner_id,
+                        "access_level": "manage"
+                    }
+                ],
+                "versions": [
+                    {
+                        "version_id": version_id,
+                        "storage_key": version_key,
+                        "size": blob.size,
+                        "sha256": blob.sha256,
+                        "encodings": {},
+                        "page_index": None,
+                        "created_at": datetime.utcnow().isoformat(),
+                        "created_by": owner_id,
+                        "comment": "Initial version"
+                    }
+                ],
+                "created_at": datetime.utcnow().isoformat(),
+                "updated_at": datetime.utcnow().isoformat()
+            }
+            
+            # Save metadata
+            self._save_metadata(metadata)
+            self._notify_events([self._document_event("created", metadata, version_id)])
         
-        # Get file size
-        file_size = os.path.getsize(version_path)
+        self._notify_version_stored(document_id, version_id)
         
-        # Create document metadata
-        from pdf_service.pdf_processor import PDFProcessor
-        pdf_info = PDFProcessor.get_pdf_info(version_path)
-        
-        metadata = {
-            "id": document_id,
-            "name": name,
-            "owner_id": owner_id,
-            "folder_id": folder_id,
-            "size": file_size,
-            "content_type": "application/pdf",
-            "storage_key": document_id,
-            "is_template": False,
-            "metadata": {
-                "page_count": pdf_info.get("page_count", 0),
-                "has_form": pdf_info.get("has_form", False),
-                "is_encrypted": pdf_info.get("is_encrypted", False),
-                "author": pdf_info.get("metadata", {}).get("author"),
-                "creation_date": pdf_info.get("metadata", {}).get("creation_date"),
-                "modification_date": pdf_info.get("metadata", {}).get("modification_date"),
-                "keywords": []
-            },
-            "permissions": [
-                {
-                    "user_id": owner_id,
-                    "access_level": "manage"
+        return document_id
+    
+    def instantiate_template(
+        self,
+        template_id: str,
+        name: str,
+        owner_id: str,
+        folder_id: Optional[str] = None
+    ) -> str:
+        """
+        Create a new document from the latest version of a template.
+        
+        The first version of the new document references the template's
+        blobs copy-on-write: the PDF, its compressed encodings and the derived
+        page index, text, form schema and thumbnail are shared rather than
+        copied, so no bytes are written however large the template is. Edits
+        create new versions of their own; the shared blobs are only removed
+        once no document holds them any more.
+        
+        Args:
+            template_id: ID of the template document
+            name: Name of the new document
+            owner_id: ID of the new document's owner
+            folder_id: Optional ID of the folder to place the document in
+            
+        Returns:
+            ID of the created document
+            
+        Raises:
+            ValueError: If the document is not a template or is still being enriched
+        """
+        document_id = str(uuid.uuid4())
+        version_id = str(uuid.uuid4())
+        
+        while True:
+            # The blob locks depend on the template's latest version, which
+            # can change until the template itself is locked
+            keys = self.version_keys(self.get_document(template_id)["versions"][-1])
+            with self._lock_documents([template_id] + [self._blob_lock_id(key) for key in keys]):
+                template = self.get_document(template_id)
+                source = template["versions"][-1]
+                if self.version_keys(source) != keys:
+                    continue
+                
+                if not template.get("is_template"):
+                    raise ValueError(f"Document {template_id} is not a template")
+                enrichment = template.get("enrichment") or {"status": "complete", "errors": []}
+                if enrichment["status"] == "pending":
+                    raise ValueError(f"Template {template_id} is still being processed")
+                
+                # References are recorded before the document exists, so a
+                # crash in between can only keep a blob, never lose one
+                for key in keys:
+                    self._add_blob_ref(key, template_id, document_id)
+                
+                now = datetime.utcnow().isoformat()
+                version = {
+                    field: value
+                    for field, value in source.items()
+                    if field not in ("version_id", "created_at", "created_by", "comment")
                 }
-            ],
-            "versions": [
-                {
+                version.update({
                     "version_id": version_id,
-                    "storage_key": f"{document_id}/versions/{version_id}.pdf",
-                    "created_at": datetime.utcnow().isoformat(),
+                    "source": {"document_id": template_id, "version_id": source["version_id"]},
+                    "created_at": now,
                     "created_by": owner_id,
-                    "comment": "Initial version"
+                    "comment": f"Created from template {template['name']}"
+                })
+                metadata = {
+                    "id": document_id,
+                    "name": name,
+                    "owner_id": owner_id,
+                    "folder_id": folder_id,
+                    "size": source.get("size", template.get("size", 0)),
+                    "content_type": template.get("content_type", "application/pdf"),
+                    "storage_key": self.layout.document_prefix(owner_id, document_id),
+                    "is_template": False,
+                    "template_id": template_id,
+                    "metadata": dict(template["metadata"]),
+                    # Derived data is shared with the template, nothing is left to enrich
+                    "enrichment": {
+                        "status": enrichment["status"],
+                        "version_id": version_id,
+                        "errors": enrichment.get("errors", []),
+                        "updated_at": now
+                    },
+                    "permissions": [
+                        {
+                            "user_id": owner_id,
+                            "access_level": "manage"
+                        }
+                    ],
+                    "versions": [version],
+                    "created_at": now,
+                    "updated_at": now
                 }
-            ],
-            "created_at": datetime.utcnow().isoformat(),
-            "updated_at": datetime.utcnow().isoformat()
-        }
-        
-        # Save metadata
-        metadata_path = os.path.join(self.metadata_dir, f"{document_id}.json")
-        with open(metadata_path, 'w') as f:
-            json.dump(metadata, f, indent=2)
-        
-        return document_id
+                self._save_metadata(metadata)
+                self._notify_events([self._document_event("created", metadata, version_id)])
+                return document_id
     
     def get_document(self, document_id: str) -> Dict[str, Any]:
         """
@@ -120,12 +1061,29 @@ class DocumentManager:
         Returns:
             Document metadata
         """
-        metadata_path = os.path.join(self.metadata_dir, f"{document_id}.json")
-        if not os.path.exists(metadata_path):
+        metadata_path = self._find_metadata_path(document_id)
+        if not metadata_path:
             raise ValueError(f"Document {document_id} not found")
         
-        with open(metadata_path, 'r') as f:
-            return json.load(f)
+        if not self.shared_cache:
+            with open(metadata_path, 'r') as f:
+                return json.load(f)
+        
+        # Files are only ever replaced, never rewritten in place, so the inode,
+        # mtime and size identify one exact content across all workers. They
+        # are taken from the open file, so the key always describes the bytes read.
+        try:
+            f = open(metadata_path, 'rb')
+        except FileNotFoundError:
+            raise ValueError(f"Document {document_id} not found")
+        with f:
+            stat_result = os.fstat(f.fileno())
+            cache_key = f"metadata:{metadata_path}:{stat_result.st_ino}:{stat_result.st_mtime_ns}:{stat_result.st_size}"
+            raw = self.shared_cache.get(cache_key)
+            if raw is None:
+                raw = f.read()
+                self.shared_cache.set(cache_key, raw)
+        return json.loads(raw)
     
     def update_document(self, document_id: str, updates: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -138,9 +1096,27 @@ class DocumentManager:
         Returns:
             Updated document metadata
         """
-        metadata = self.get_document(document_id)
+        with self._lock_document(document_id):
+            metadata = self.get_document(document_id)
+            
+            # Apply updates
+            self._apply_updates(metadata, updates)
+            
+            # Save updated metadata
+            self._save_metadata(metadata)
+            self._notify_events([self._document_event("updated", metadata)])
+        
+        return metadata
+    
+    @staticmethod
+    def _apply_updates(metadata: Dict[str, Any], updates: Dict[str, Any]) -> None:
+        """
+        Apply updatable fields to document metadata in place.
         
-        # Apply updates
+        Args:
+            metadata: Document metadata to modify
+            updates: Dictionary of updates to apply
+        """
         for key, value in updates.items():
             if key in ["id", "owner_id", "storage_key", "versions", "created_at"]:
                 # These fields cannot be updated
@@ -155,39 +1131,174 @@ class DocumentManager:
         
         # Update the updated_at timestamp
         metadata["updated_at"] = datetime.utcnow().isoformat()
-        
-        # Save updated metadata
-        metadata_path = os.path.join(self.metadata_dir, f"{document_id}.json")
-        with open(metadata_path, 'w') as f:
-            json.dump(metadata, f, indent=2)
-        
-        return metadata
     
     def delete_document(self, document_id: str) -> bool:
         """
         Delete a document.
         
+        The document disappears at once, but its blobs are only removed later,
+        in batches, by the garbage collector. Until then it can be restored.
+        
         Args:
             document_id: ID of the document
             
         Returns:
             True if the document was deleted, False otherwise
         """
-        metadata_path = os.path.join(self.metadata_dir, f"{document_id}.json")
-        if not os.path.exists(metadata_path):
-            raise ValueError(f"Document {document_id} not found")
+        with self._lock_document(document_id):
+            metadata = self.get_document(document_id)
+            self._commit_batch([], [document_id], [self._document_trash_entry(metadata)])
+            self._notify_events([self._document_event("deleted", metadata)])
+        
+        return True
+    
+    def restore_document(self, document_id: str) -> Dict[str, Any]:
+        """
+        Restore a deleted document whose blobs have not been removed yet.
+        
+        Args:
+            document_id: ID of the document
+            
+        Returns:
+            Metadata of the restored document
+            
+        Raises:
+            ValueError: If the document is not in the trash or is already being purged
+        """
+        entry_path = self._trash_path(f"document-{document_id}")
+        with self._lock_document(document_id):
+            try:
+                with open(entry_path, 'r') as f:
+                    entry = json.load(f)
+            except FileNotFoundError:
+                raise ValueError(f"Deleted document {document_id} not found")
+            if entry["purging"]:
+                raise ValueError(f"Document {document_id} is already being purged")
+            if self._find_metadata_path(document_id):
+                raise ValueError(f"Document {document_id} already exists")
+            
+            metadata = entry["metadata"]
+            metadata["updated_at"] = datetime.utcnow().isoformat()
+            self._commit_batch([metadata], [])
+            self._notify_events([self._document_event("created", metadata, metadata["versions"][-1]["version_id"])])
+            # A crash before this point leaves a stale entry the collector
+            # discards, since the document is live again
+            self._remove_file(entry_path)
+        
+        return metadata
+    
+    def prune_versions(self, document_id: str, keep: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]) -> List[str]:
+        """
+        Remove versions of a document that a retention policy no longer keeps.
         
-        # Delete metadata file
-        os.unlink(metadata_path)
+        The versions are removed from the metadata at once; their blobs are
+        recorded in the trash for the garbage collector. The latest version is
+        always kept.
         
-        # Delete document directory
-        document_dir = os.path.join(self.storage_dir, document_id)
-        if os.path.exists(document_dir):
-            import shutil
-            shutil.rmtree(document_dir)
+        Args:
+            document_id: ID of the document
+            keep: Function selecting the versions to keep from the version list
+            
+        Returns:
+            IDs of the removed versions
+        """
+        with self._lock_document(document_id):
+            metadata = self.get_document(document_id)
+            versions = metadata["versions"]
+            kept_ids = {version["version_id"] for version in keep(versions)}
+            if versions:
+                kept_ids.add(versions[-1]["version_id"])
+            
+            removed = [version for version in versions if version["version_id"] not in kept_ids]
+            if not removed:
+                return []
+            
+            metadata["versions"] = [version for version in versions if version["version_id"] in kept_ids]
+            metadata["updated_at"] = datetime.utcnow().isoformat()
+            entry = {
+                "id": f"versions-{uuid.uuid4().hex}",
+                "kind": "versions",
+                "document_id": document_id,
+                "owner_id": metadata["owner_id"],
+                "prefixes": [],
+                "keys": [key for version in removed for key in self.version_keys(version)],
+                "archive_keys": [key for version in removed for key in self.archive_keys(version)],
+                "size": sum(version.get("size", 0) for version in removed),
+                "deleted_at": datetime.utcnow().isoformat(),
+                "purging": True,
+                "version_ids": [version["version_id"] for version in removed]
+            }
+            self._commit_batch([metadata], [], [entry])
+            self._notify_events([self._document_event("updated", metadata)])
+        
+        return entry["version_ids"]
+    
+    def archive_version(self, document_id: str, version_id: str, record: Dict[str, Any]) -> bool:
+        """
+        Switch a version to its archived copy.
+        
+        Reads are served from the archive from then on. The hot copies, and
+        any precompressed encodings, are recorded in the archive record until
+        ``release_hot_copies`` removes them, so that reads which resolved the
+        hot path just before the switch can finish.
+        
+        Args:
+            document_id: ID of the document
+            version_id: ID of the version
+            record: Archive record returned by ``ArchiveTier.archive``
+            
+        Returns:
+            True if the version was switched, False if it no longer exists,
+            is the latest version or is already archived
+        """
+        with self._lock_document(document_id):
+            try:
+                metadata = self.get_document(document_id)
+            except ValueError:
+                return False
+            
+            version = next((v for v in metadata["versions"] if v["version_id"] == version_id), None)
+            if version is None or version is metadata["versions"][-1] or version.get("tier") == "archive":
+                return False
+            
+            record = dict(record)
+            record["hot_keys"] = [version["storage_key"]] + [encoded["storage_key"] for encoded in version.get("encodings", {}).values()]
+            version["archive"] = record
+            version["tier"] = "archive"
+            version["encodings"] = {}
+            self._save_metadata(metadata)
         
         return True
     
+    def release_hot_copies(self, document_id: str, version_id: str) -> List[str]:
+        """
+        Remove the hot copies of an archived version.
+        
+        Args:
+            document_id: ID of the document
+            version_id: ID of the archived version
+            
+        Returns:
+            Removed storage keys
+        """
+        with self._lock_document(document_id):
+            try:
+                metadata = self.get_document(document_id)
+            except ValueError:
+                return []
+            
+            version = next((v for v in metadata["versions"] if v["version_id"] == version_id), None)
+            if version is None or not (version.get("archive") or {}).get("hot_keys"):
+                return []
+            
+            keys = version["archive"]["hot_keys"]
+            # Removed before the record is updated, so a crash only repeats the removal
+            self.backend.delete_keys(keys)
+            version["archive"]["hot_keys"] = []
+            self._save_metadata(metadata)
+        
+        return keys
+    
     def list_documents(self, owner_id: Optional[str] = None, folder_id: Optional[str] = None) -> List[Dict[str, Any]]:
         """
         List documents.
@@ -201,34 +1312,76 @@ class DocumentManager:
         """
         documents = []
         
-        for filename in os.listdir(self.metadata_dir):
-            if filename.endswith(".json"):
-                with open(os.path.join(self.metadata_dir, filename), 'r') as f:
-                    metadata = json.load(f)
-                
-                # Apply filters
-                if owner_id and metadata.get("owner_id") != owner_id:
+        # Files are read in parallel, which keeps full scans such as index
+        # rebuilds bound by the disk rather than by the latency of each read
+        with ThreadPoolExecutor(max_workers=BATCH_IO_WORKERS) as executor:
+            loaded = executor.map(self._read_metadata_file, self._iter_metadata_paths())
+            loaded = [metadata for metadata in loaded if metadata is not None]
+        
+        for metadata in loaded:
+            # Apply filters
+            if owner_id and metadata.get("owner_id") != owner_id:
+                continue
+            
+            if folder_id:
+                if folder_id == "root" and metadata.get("folder_id") is not None:
                     continue
-                
-                if folder_id:
-                    if folder_id == "root" and metadata.get("folder_id") is not None:
-                        continue
-                    elif folder_id != "root" and metadata.get("folder_id") != folder_id:
-                        continue
-                
-                documents.append(metadata)
+                elif folder_id != "root" and metadata.get("folder_id") != folder_id:
+                    continue
+            
+            documents.append(metadata)
         
         return documents
     
-    def add_document_version(self, document_id: str, file_path: str, user_id: str, comment: Optional[str] = None) -> str:
+    @staticmethod
+    def _read_metadata_file(metadata_path: str) -> Optional[Dict[str, Any]]:
+        """Read a metadata file found while scanning, or None if it is gone or corrupt."""
+        try:
+            with open(metadata_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # Moved or deleted while listing
+            return None
+        except ValueError:
+            # Reported and repaired by the storage checker
+            metrics.inc("metadata_corrupt_reads_total", 1, "Metadata files skipped because they could not be parsed")
+            return None
+    
+    def get_documents(self, document_ids: List[str]) -> List[Dict[str, Any]]:
+        """
+        Read the metadata of many documents in parallel.
+        
+        Args:
+            document_ids: IDs of the documents
+            
+        Returns:
+            Metadata of the documents that exist, in the given order
+        """
+        with ThreadPoolExecutor(max_workers=BATCH_IO_WORKERS) as executor:
+            loaded = list(executor.map(self._try_get_document, document_ids))
+        return [metadata for metadata in loaded if metadata is not None]
+    
+    def add_document_version(
+        self,
+        document_id: str,
+        file_path: Union[str, BinaryIO],
+        user_id: str,
+        comment: Optional[str] = None,
+        move: bool = False,
+        sha256: Optional[str] = None,
+        version_id: Optional[str] = None
+    ) -> str:
         """
         Add a new version to a document.
         
         Args:
             document_id: ID of the document
-            file_path: Path to the file to add as a new version
+            file_path: Path to the file to add as a new version, or an open binary file object
             user_id: ID of the user adding the version
             comment: Optional comment about the version
+            move: Whether ``file_path`` is moved into the store instead of copied
+            sha256: Optional known SHA-256 digest of a moved file
+            version_id: Optional ID generated by the caller, e.g. to retry an upload idempotently
             
         Returns:
             ID of the created version
@@ -236,79 +1389,114 @@ class DocumentManager:
         metadata = self.get_document(document_id)
         
         # Create version ID
-        version_id = str(uuid.uuid4())
-        
-        # Ensure versions directory exists
-        versions_dir = os.path.join(self.storage_dir, document_id, "versions")
-        os.makedirs(versions_dir, exist_ok=True)
-        
-        # Copy the file to the version path
-        version_path = os.path.join(versions_dir, f"{version_id}.pdf")
-        with open(file_path, 'rb') as src, open(version_path, 'wb') as dst:
-            dst.write(src.read())
-        
-        # Get file size
-        file_size = os.path.getsize(version_path)
+        version_id = version_id or str(uuid.uuid4())
+        version_key = self.layout.version_key(metadata["owner_id"], document_id, version_id)
         
-        # Update document metadata
-        from pdf_service.pdf_processor import PDFProcessor
-        pdf_info = PDFProcessor.get_pdf_info(version_path)
+        # Store the file outside the metadata lock, it may take a while
+        try:
+            blob = self._store_version_file(version_key, file_path, move, sha256)
+            self._check_pdf_header(self.backend.open_path(version_key))
+        except Exception:
+            self.backend.delete(version_key)
+            raise
         
         # Create version metadata
         version_metadata = {
             "version_id": version_id,
-            "storage_key": f"{document_id}/versions/{version_id}.pdf",
+            "storage_key": version_key,
+            "size": blob.size,
+            "sha256": blob.sha256,
+            "encodings": {},
+            "page_index": None,
             "created_at": datetime.utcnow().isoformat(),
             "created_by": user_id,
             "comment": comment or "New version"
         }
         
-        # Add version to metadata
-        metadata["versions"].append(version_metadata)
-        
-        # Update document metadata
-        metadata["size"] = file_size
-        metadata["metadata"]["page_count"] = pdf_info.get("page_count", 0)
-        metadata["metadata"]["has_form"] = pdf_info.get("has_form", False)
-        metadata["metadata"]["is_encrypted"] = pdf_info.get("is_encrypted", False)
-        metadata["updated_at"] = datetime.utcnow().isoformat()
+        with self._lock_document(document_id):
+            # Re-read so concurrent updates are not lost
+            metadata = self.get_document(document_id)
+            
+            # Add version to metadata
+            metadata["versions"].append(version_metadata)
+            
+            # Update document metadata
+            metadata["size"] = blob.size
+            metadata["enrichment"] = self._pending_enrichment(version_id)
+            metadata["updated_at"] = datetime.utcnow().isoformat()
+            
+            # Save updated metadata
+            self._save_metadata(metadata)
+            self._notify_events([self._document_event("version_added", metadata, version_id)])
         
-        # Save updated metadata
-        metadata_path = os.path.join(self.metadata_dir, f"{document_id}.json")
-        with open(metadata_path, 'w') as f:
-            json.dump(metadata, f, indent=2)
+        self._notify_version_stored(document_id, version_id)
         
         return version_id
     
-    def get_document_version(self, document_id: str, version_id: str) -> str:
+    def resolve_version(self, document_id: str, version_id: Optional[str] = None) -> Tuple[Dict[str, Any], Dict[str, Any], str]:
         """
-        Get the file path for a specific document version.
+        Resolve a document version to its file with a single metadata read.
         
         Args:
             document_id: ID of the document
-            version_id: ID of the version
+            version_id: Optional ID of the version, defaults to the latest version
             
         Returns:
-            Path to the version file
+            Tuple of document metadata, version metadata and path to the version file
         """
         metadata = self.get_document(document_id)
         
-        # Find the version
-        version = None
-        for v in metadata["versions"]:
-            if v["version_id"] == version_id:
-                version = v
-                break
+        if version_id:
+            # Find the version
+            version = None
+            for v in metadata["versions"]:
+                if v["version_id"] == version_id:
+                    version = v
+                    break
+            
+            if not version:
+                raise ValueError(f"Version {version_id} not found for document {document_id}")
+        else:
+            if not metadata["versions"]:
+                raise ValueError(f"No versions found for document {document_id}")
+            
+            # Get the latest version
+            version = metadata["versions"][-1]
         
-        if not version:
-            raise ValueError(f"Version {version_id} not found for document {document_id}")
+        return metadata, version, self._version_path(version)
+    
+    def get_encoded_version_path(self, version: Dict[str, Any], encoding: str) -> Optional[str]:
+        """
+        Get the path of a pre-compressed representation of a version, if one exists.
         
-        # Get the version file path
-        version_path = os.path.join(self.storage_dir, document_id, "versions", f"{version_id}.pdf")
-        if not os.path.exists(version_path):
-            raise ValueError(f"Version file not found for version {version_id}")
+        Args:
+            version: Version metadata
+            encoding: Content encoding, e.g. "gzip"
+            
+        Returns:
+            Path to the encoded file, or None if the version has no such representation
+        """
+        encoded = (version.get("encodings") or {}).get(encoding)
+        if not encoded:
+            return None
         
-        return version_path
+        try:
+            return self.backend.open_path(encoded["storage_key"])
+        except ValueError:
+            return None
+    
+    def get_document_version(self, document_id: str, version_id: str) -> str:
+        """
+        Get the file path for a specific document version.
+        
+        Args:
+            document_id: ID of the document
+            version_id: ID of the version
+            
+        Returns:
+            Path to the version file
+        """
+        return self.resolve_version(document_id, version_id)[2]
     
     def get_latest_version(self, document_id: str) -> str:
         """
@@ -320,20 +1508,7 @@ class DocumentManager:
         Returns:
             Path to the latest version file
         """
-        metadata = self.get_document(document_id)
-        
-        if not metadata["versions"]:
-            raise ValueError(f"No versions found for document {document_id}")
-        
-        # Get the latest version
-        latest_version = metadata["versions"][-1]
-        
-        # Get the version file path
-        version_path = os.path.join(self.storage_dir, document_id, "versions", f"{latest_version['version_id']}.pdf")
-        if not os.path.exists(version_path):
-            raise ValueError(f"Version file not found for latest version")
-        
-        return version_path
+        return self.resolve_version(document_id)[2]
     
     def update_permissions(self, document_id: str, permissions: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
@@ -346,18 +1521,21 @@ class DocumentManager:
         Returns:
             Updated document metadata
         """
-        metadata = self.get_document(document_id)
-        
-        # Update permissions
-        metadata["permissions"] = permissions
-        
-        # Update the updated_at timestamp
-        metadata["updated_at"] = datetime.utcnow().isoformat()
-        
-        # Save updated metadata
-        metadata_path = os.path.join(self.metadata_dir, f"{document_id}.json")
-        with open(metadata_path, 'w') as f:
-            json.dump(metadata, f, indent=2)
+        with self._lock_document(document_id):
+            metadata = self.get_document(document_id)
+            previous_permissions = metadata["permissions"]
+            
+            # Update permissions
+            metadata["permissions"] = permissions
+            
+            # Update the updated_at timestamp
+            metadata["updated_at"] = datetime.utcnow().isoformat()
+            
+            # Save updated metadata
+            self._save_metadata(metadata)
+            self._notify_events([
+                self._document_event("permissions_changed", metadata, previous_permissions=previous_permissions)
+            ])
         
         return metadata
     
@@ -373,8 +1551,21 @@ class DocumentManager:
         Returns:
             True if the user has the required permission, False otherwise
         """
-        metadata = self.get_document(document_id)
+        return self._has_permission(self.get_document(document_id), user_id, required_level)
+    
+    @staticmethod
+    def _has_permission(metadata: Dict[str, Any], user_id: str, required_level: AccessLevel) -> bool:
+        """
+        Check a user's access level against already loaded document metadata.
         
+        Args:
+            metadata: Document metadata
+            user_id: ID of the user
+            required_level: Required access level
+            
+        Returns:
+            True if the user has the required permission, False otherwise
+        """
         # Check if user is the owner
         if metadata["owner_id"] == user_id:
             return True
@@ -395,3 +1586,204 @@ class DocumentManager:
                     return True
         
         return False
+    
+    def select_documents(
+        self,
+        document_ids: Optional[List[str]] = None,
+        owner_id: Optional[str] = None,
+        folder_id: Optional[str] = None
+    ) -> List[str]:
+        """
+        Resolve a batch selection to document IDs.
+        
+        Args:
+            document_ids: Optional explicit list of document IDs
+            owner_id: Optional ID of the owner to filter by
+            folder_id: Optional ID of the folder to filter by
+            
+        Returns:
+            De-duplicated document IDs, in request order for explicit lists
+        """
+        if document_ids is not None:
+            return list(dict.fromkeys(document_ids))
+        
+        if not owner_id and not folder_id:
+            raise ValueError("A batch operation requires document IDs or a filter")
+        
+        return [document["id"] for document in self.list_documents(owner_id, folder_id)]
+    
+    def _batch(
+        self,
+        document_ids: List[str],
+        apply: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]],
+        user_id: Optional[str] = None,
+        required_level: AccessLevel = AccessLevel.EDIT,
+        delete: bool = False,
+        atomic: bool = False,
+        event_type: str = "updated"
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Run an operation over many documents in a single metadata transaction.
+        
+        Every affected document is locked, its metadata read in parallel and the
+        acting user's permission checked against the already loaded metadata.
+        The resulting changes are committed together through the batch journal.
+        
+        Args:
+            document_ids: IDs of the documents to operate on
+            apply: Function mutating one document's metadata in place
+            user_id: Optional acting user whose permission is checked
+            required_level: Access level the acting user needs on each document
+            delete: Whether the operation removes the documents
+            atomic: Whether any item failure aborts the whole batch
+            event_type: Event emitted for each processed document unless it is deleted
+            
+        Returns:
+            Tuple of per-item results and the metadata of successfully processed documents
+        """
+        results = []
+        processed = []
+        previous_permissions = {}
+        
+        with self._lock_documents(document_ids):
+            with ThreadPoolExecutor(max_workers=BATCH_IO_WORKERS) as executor:
+                loaded = list(executor.map(self._try_get_document, document_ids))
+            
+            for document_id, metadata in zip(document_ids, loaded):
+                if metadata is None:
+                    results.append({"document_id": document_id, "success": False, "error": f"Document {document_id} not found"})
+                    continue
+                
+                if user_id and not self._has_permission(metadata, user_id, required_level):
+                    results.append({"document_id": document_id, "success": False, "error": "Permission denied"})
+                    continue
+                
+                previous_permissions[document_id] = list(metadata["permissions"])
+                try:
+                    apply(metadata)
+                except Exception as e:
+                    results.append({"document_id": document_id, "success": False, "error": str(e)})
+                    continue
+                
+                if not delete:
+                    metadata["updated_at"] = datetime.utcnow().isoformat()
+                results.append({"document_id": document_id, "success": True, "error": None})
+                processed.append(metadata)
+            
+            if atomic and len(processed) != len(document_ids):
+                for result in results:
+                    if result["success"]:
+                        result["success"] = False
+                        result["error"] = "Batch aborted"
+                return results, []
+            
+            if processed and delete:
+                self._commit_batch(
+                    [],
+                    [metadata["id"] for metadata in processed],
+                    [self._document_trash_entry(metadata) for metadata in processed]
+                )
+            elif processed:
+                self._commit_batch(processed, [])
+            
+            self._notify_events([
+                self._document_event("deleted", metadata)
+                if delete else
+                self._document_event(
+                    event_type,
+                    metadata,
+                    previous_permissions=previous_permissions[metadata["id"]] if event_type == "permissions_changed" else None
+                )
+                for metadata in processed
+            ])
+        
+        return results, processed
+    
+    def _try_get_document(self, document_id: str) -> Optional[Dict[str, Any]]:
+        """Get document metadata, or None if the document does not exist."""
+        try:
+            return self.get_document(document_id)
+        except ValueError:
+            return None
+    
+    def batch_delete(self, document_ids: List[str], user_id: Optional[str] = None, atomic: bool = False) -> List[Dict[str, Any]]:
+        """
+        Delete many documents.
+        
+        Metadata is moved to the trash in one transaction; blobs are removed
+        later by the garbage collector.
+        
+        Args:
+            document_ids: IDs of the documents to delete
+            user_id: Optional acting user, who needs manage access
+            atomic: Whether any item failure aborts the whole batch
+            
+        Returns:
+            Per-item results
+        """
+        results, _ = self._batch(
+            document_ids,
+            lambda metadata: None,
+            user_id=user_id,
+            required_level=AccessLevel.MANAGE,
+            delete=True,
+            atomic=atomic
+        )
+        return results
+    
+    def batch_move(self, document_ids: List[str], folder_id: Optional[str], user_id: Optional[str] = None, atomic: bool = False) -> List[Dict[str, Any]]:
+        """
+        Move many documents into a folder.
+        
+        Args:
+            document_ids: IDs of the documents to move
+            folder_id: ID of the destination folder, or None for the root
+            user_id: Optional acting user, who needs edit access
+            atomic: Whether any item failure aborts the whole batch
+            
+        Returns:
+            Per-item results
+        """
+        def move(metadata: Dict[str, Any]) -> None:
+            metadata["folder_id"] = folder_id
+        
+        return self._batch(document_ids, move, user_id=user_id, required_level=AccessLevel.EDIT, atomic=atomic)[0]
+    
+    def batch_update_permissions(
+        self,
+        document_ids: List[str],
+        grant: Optional[List[Dict[str, Any]]] = None,
+        revoke: Optional[List[str]] = None,
+        user_id: Optional[str] = None,
+        atomic: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        Grant and revoke permissions on many documents.
+        
+        Args:
+            document_ids: IDs of the documents to update
+            grant: Permission objects to add, replacing existing entries for the same user
+            revoke: IDs of users whose permissions are removed
+            user_id: Optional acting user, who needs manage access
+            atomic: Whether any item failure aborts the whole batch
+            
+        Returns:
+            Per-item results
+        """
+        # Resolve the permission changes once for the whole batch
+        granted = {permission["user_id"]: {"user_id": permission["user_id"], "access_level": AccessLevel(permission["access_level"]).value} for permission in grant or []}
+        removed = set(revoke or []) | set(granted)
+        
+        def update(metadata: Dict[str, Any]) -> None:
+            permissions = [permission for permission in metadata["permissions"] if permission["user_id"] not in removed]
+            permissions.extend(granted.values())
+            metadata["permissions"] = permissions
+        
+        return self._batch(
+            document_ids,
+            update,
+            user_id=user_id,
+            required_level=AccessLevel.MANAGE,
+            atomic=atomic,
+            event_type="permissions_changed"
+        )[0]
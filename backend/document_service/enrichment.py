@@ -0,0 +1,335 @@
+"""
+Background enrichment of stored document versions.
+"""
+import importlib.util
+import io
+import json
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from common.metrics import metrics
+from common.models import SubscriptionTier
+from document_service.document_manager import DocumentManager
+
+# Largest edge of generated thumbnails, in pixels
+THUMBNAIL_SIZE = 256
+
+
+class EnrichmentPipeline:
+    """
+    Derives page count, document info, form schema, text, thumbnails and page
+    fingerprints for new versions after the upload has returned.
+
+    Jobs are queued in memory and processed by worker threads, or by a
+    ``FairScheduler`` in fair order across document owners. The queue is
+    not persistent; versions left pending by a restart are picked up again by
+    ``resume_pending``. Enriching a version twice is harmless.
+    """
+
+    def __init__(
+        self,
+        manager: DocumentManager,
+        workers: int = 2,
+        thumbnails: bool = True,
+        sandbox=None,
+        tier: SubscriptionTier = SubscriptionTier.FREE,
+        scheduler=None,
+        ocr=None
+    ):
+        """
+        Initialize the pipeline and subscribe it to newly stored versions.
+
+        Args:
+            manager: Document manager whose versions are enriched
+            workers: Number of worker threads
+            thumbnails: Whether to render first-page thumbnails when a renderer is available
+            sandbox: Optional ``PDFSandbox`` the PDF operations run in
+            tier: Subscription tier whose sandbox limits apply when there is no scheduler
+            scheduler: Optional ``FairScheduler`` that runs the jobs in slots of the document
+                owners instead of the worker threads
+            ocr: Optional ``OCREngine`` recognizing the text of pages without a text layer
+        """
+        self.manager = manager
+        self.workers = workers
+        self.thumbnails = thumbnails
+        self.sandbox = sandbox
+        self.tier = tier
+        self.scheduler = scheduler
+        self.ocr = ocr
+
+        self._queue: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        # Jobs handed to the scheduler and not finished yet
+        self._scheduled = 0
+        self._scheduled_lock = threading.Lock()
+        manager.add_version_listener(self.submit)
+
+    def submit(self, document_id: str, version_id: str) -> None:
+        """
+        Queue a version for enrichment.
+
+        Args:
+            document_id: ID of the document
+            version_id: ID of the version
+        """
+        if self.scheduler:
+            try:
+                document = self.manager.get_document(document_id)
+            except ValueError:
+                return
+            self._track_scheduled(1)
+            # Versions of existing documents are weighed by the previous page count
+            self.scheduler.submit(
+                document["owner_id"],
+                document["metadata"].get("page_count") or 1,
+                self._run_job,
+                document_id,
+                version_id
+            )
+            return
+
+        self._queue.put((document_id, version_id))
+        metrics.set_gauge("enrichment_queue_depth", self._queue.qsize(), "Versions waiting to be enriched")
+
+    def _track_scheduled(self, delta: int) -> None:
+        with self._scheduled_lock:
+            self._scheduled += delta
+            metrics.set_gauge("enrichment_queue_depth", self._scheduled, "Versions waiting to be enriched")
+
+    def _call(self, tier: SubscriptionTier, operation: str, *args) -> Any:
+        """Run a PDFProcessor operation, in the sandbox when one is configured."""
+        if self.sandbox:
+            return self.sandbox.run(operation, *args, tier=tier)
+
+        from pdf_service.pdf_processor import PDFProcessor
+        return getattr(PDFProcessor, operation)(*args)
+
+    def enrich(self, document_id: str, version_id: str) -> str:
+        """
+        Enrich a single version synchronously.
+
+        Args:
+            document_id: ID of the document
+            version_id: ID of the version
+
+        Returns:
+            Resulting enrichment status, "complete" or "failed"
+        """
+        try:
+            metadata, version, version_path = self.manager.resolve_version(document_id, version_id)
+        except ValueError:
+            # The document or version was deleted in the meantime
+            return "failed"
+
+        tier = self.scheduler.tier_of(metadata["owner_id"]) if self.scheduler else self.tier
+        version_key = version["storage_key"]
+        version_fields: Dict[str, Any] = {}
+        document_fields: Dict[str, Any] = {}
+        errors: List[str] = []
+
+        with metrics.timer("enrichment_seconds", "Time spent enriching a version"):
+            try:
+                pdf_info = self._call(tier, "get_pdf_info", version_path)
+            except ValueError as e:
+                self.manager.apply_enrichment(document_id, version_id, {}, {}, "failed", [str(e)])
+                metrics.inc("enrichment_total", 1, "Enriched versions", status="failed")
+                return "failed"
+
+            document_info = pdf_info["document_info"]
+            document_fields = {
+                "page_count": pdf_info["page_count"],
+                "has_form": pdf_info["has_form"],
+                "is_encrypted": pdf_info["is_encrypted"],
+                "title": document_info["title"],
+                "author": document_info["author"],
+                "creation_date": document_info["creation_date"],
+                "modification_date": document_info["modification_date"],
+                "keywords": document_info["keywords"]
+            }
+
+            # The remaining steps are independent, except that OCR reuses the
+            # page fingerprints; a failing one is recorded without discarding the others
+            fingerprints: List[Dict[str, Any]] = []
+
+            def store_page_index() -> Dict[str, Any]:
+                fingerprints.extend(self._call(tier, "page_fingerprints", version_path))
+                return self.manager._store_page_index(version_key, fingerprints)
+
+            steps = [
+                ("encodings", lambda: self.manager._precompress(version_key, version_path, version["size"])),
+                ("page_index", store_page_index),
+                ("text_index", lambda: self._store_text(version_key, version_path, tier, fingerprints)),
+            ]
+            if pdf_info["has_form"]:
+                steps.append(("form_schema", lambda: self._store_form_schema(version_key, version_path, tier)))
+            if self.thumbnails:
+                steps.append(("thumbnail", lambda: self._store_thumbnail(version_key, version_path, tier)))
+
+            for field, step in steps:
+                try:
+                    version_fields[field] = step()
+                except ImportError:
+                    # Optional renderer not installed
+                    continue
+                except Exception as e:
+                    errors.append(f"{field}: {str(e)}")
+
+        self.manager.apply_enrichment(document_id, version_id, version_fields, document_fields, "complete", errors)
+        metrics.inc("enrichment_total", 1, "Enriched versions", status="complete")
+        return "complete"
+
+    def _store_json(self, key: str, value: Any) -> Dict[str, Any]:
+        blob = self.manager.backend.put_file(key, io.BytesIO(json.dumps(value, separators=(",", ":")).encode("utf-8")))
+        return {"storage_key": key, "size": blob.size}
+
+    def _store_text(
+        self,
+        version_key: str,
+        version_path: str,
+        tier: SubscriptionTier,
+        fingerprints: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        text = self._call(tier, "extract_text", version_path)
+
+        # Scanned pages get their text from OCR; without the dependencies they stay empty
+        recognized: Dict[int, Dict[str, Any]] = {}
+        ocr_error = None
+        if self.ocr and fingerprints:
+            try:
+                recognized = self.ocr.recognize_missing(version_path, text, fingerprints)
+            except ImportError:
+                pass
+            except ValueError as e:
+                # The extracted text is still worth keeping
+                ocr_error = str(e)
+            for page, result in recognized.items():
+                text[page] = result["text"]
+
+        reference = self._store_json(f"{version_key}.text.json", {str(page): content for page, content in text.items()})
+        if recognized:
+            reference["ocr_pages"] = sorted(recognized)
+        if ocr_error:
+            reference["ocr_error"] = ocr_error
+        return reference
+
+    def _store_form_schema(self, version_key: str, version_path: str, tier: SubscriptionTier) -> Dict[str, Any]:
+        fields = self._call(tier, "get_form_fields", version_path)
+        schema = {name: {"name": field["name"], "type": field["type"]} for name, field in fields.items()}
+        reference = self._store_json(f"{version_key}.form.json", schema)
+        reference["field_count"] = len(schema)
+        return reference
+
+    def _store_thumbnail(self, version_key: str, version_path: str, tier: SubscriptionTier) -> Dict[str, Any]:
+        if importlib.util.find_spec("pypdfium2") is None:
+            raise ImportError("pypdfium2 is not installed")
+
+        image = self._call(tier, "render_thumbnail", version_path, THUMBNAIL_SIZE)
+        key = f"{version_key}.thumb.png"
+        blob = self.manager.backend.put_file(key, io.BytesIO(image))
+        return {"storage_key": key, "size": blob.size, "content_type": "image/png"}
+
+    def resume_pending(self, min_age_seconds: float = 60.0) -> int:
+        """
+        Queue versions whose enrichment was interrupted, e.g. by a restart.
+
+        Args:
+            min_age_seconds: Only resume jobs pending at least this long, so that
+                jobs queued by other live workers are left to them
+
+        Returns:
+            Number of versions queued
+        """
+        cutoff = (datetime.utcnow() - timedelta(seconds=min_age_seconds)).isoformat()
+        queued = 0
+        for metadata_path in list(self.manager._iter_metadata_paths()):
+            try:
+                with open(metadata_path, 'r') as f:
+                    metadata = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+
+            enrichment = metadata.get("enrichment")
+            if enrichment and enrichment["status"] == "pending" and enrichment["updated_at"] <= cutoff:
+                self.submit(metadata["id"], enrichment["version_id"])
+                queued += 1
+        return queued
+
+    def start(self, resume_after_seconds: Optional[float] = 60.0) -> None:
+        """
+        Start the worker threads.
+
+        Args:
+            resume_after_seconds: If set, also queue versions pending for at least
+                this long, from a background thread
+        """
+        if self._threads:
+            return
+
+        for index in range(0 if self.scheduler else self.workers):
+            thread = threading.Thread(target=self._work, name=f"enrichment-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        if resume_after_seconds is not None:
+            threading.Thread(
+                target=self.resume_pending,
+                args=(resume_after_seconds,),
+                name="enrichment-resume",
+                daemon=True
+            ).start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """
+        Stop the worker threads after their current job.
+
+        Args:
+            timeout: Time to wait for each thread
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+    def wait_idle(self, timeout: float = 30.0) -> bool:
+        """
+        Wait until every queued job has been processed.
+
+        Args:
+            timeout: Maximum time to wait
+
+        Returns:
+            True if the queue drained in time
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks or self._scheduled:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _run_job(self, document_id: str, version_id: str) -> None:
+        try:
+            self.enrich(document_id, version_id)
+        except Exception:
+            # A failed job leaves the version pending for resume_pending
+            metrics.inc("enrichment_errors_total", 1, "Enrichment jobs that raised")
+        finally:
+            self._track_scheduled(-1)
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self.enrich(*job)
+            except Exception:
+                # A failed job leaves the version pending for resume_pending
+                metrics.inc("enrichment_errors_total", 1, "Enrichment jobs that raised")
+            finally:
+                self._queue.task_done()
+                metrics.set_gauge("enrichment_queue_depth", self._queue.qsize(), "Versions waiting to be enriched")
@@ -0,0 +1,391 @@
+"""
+Document change events, recorded in a log shared by every worker and streamed to clients.
+"""
+import asyncio
+import fcntl
+import json
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import anyio
+
+from common.metrics import metrics
+from common.models import AccessLevel
+from document_service.document_manager import DocumentManager
+
+# Kinds of events emitted by the document manager
+EVENT_TYPES = ("created", "updated", "version_added", "permissions_changed", "deleted")
+
+# Fields of an event sent to clients; access control lists stay on the server
+PUBLIC_FIELDS = ("seq", "type", "document_id", "version_id", "name", "folder_id", "at")
+
+# Bytes read from a segment at a time by one subscriber
+READ_CHUNK_BYTES = 64 * 1024
+
+
+class CursorExpired(Exception):
+    """Raised when a resume cursor points before the oldest retained event."""
+
+
+class EventLog:
+    """
+    Append-only log of document events.
+
+    Every worker appends to and reads from the same files, so a client sees
+    changes made through any worker. Events are numbered by a sequence that
+    clients resume from after a reconnect. The log is split into segments
+    named after their first sequence number; the oldest are removed once more
+    than ``retained_segments`` exist, after which clients resuming from an
+    older cursor are told to reload instead.
+
+    Each subscriber reads the log at its own pace, so a slow client never
+    makes the server buffer events for it; it only falls behind, and is reset
+    if it falls behind the retained log. Subscribers read and lock files in
+    worker threads, never on the event loop.
+    """
+
+    def __init__(
+        self,
+        events_dir: str,
+        segment_bytes: int = 4 * 1024 * 1024,
+        retained_segments: int = 8,
+        poll_interval: float = 0.2
+    ):
+        """
+        Initialize the event log.
+
+        Args:
+            events_dir: Directory holding the log segments
+            segment_bytes: Size after which a new segment is started
+            retained_segments: Number of segments kept
+            poll_interval: Interval at which appends by other workers are noticed
+        """
+        self.events_dir = events_dir
+        self.segment_bytes = segment_bytes
+        self.retained_segments = max(retained_segments, 2)
+        self.poll_interval = poll_interval
+        os.makedirs(events_dir, exist_ok=True)
+        self._lock_path = os.path.join(events_dir, ".lock")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._changed: Optional[asyncio.Event] = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._subscribers = 0
+
+    def _segments(self) -> List[int]:
+        """List the first sequence numbers of the segments, oldest first."""
+        return sorted(int(name[:-4]) for name in os.listdir(self.events_dir) if name.endswith(".log"))
+
+    def _segment_path(self, first_seq: int) -> str:
+        return os.path.join(self.events_dir, f"{first_seq:012d}.log")
+
+    def _last_seq(self, first_seq: int) -> int:
+        """Get the sequence number of the last event in a segment."""
+        with open(self._segment_path(first_seq), 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - READ_CHUNK_BYTES))
+            lines = f.read().rstrip(b"\n").rsplit(b"\n", 1)
+        if not size or not lines[-1]:
+            return first_seq - 1
+        return json.loads(lines[-1])["seq"]
+
+    def append(self, events: List[Dict[str, Any]]) -> None:
+        """
+        Append events, numbering them.
+
+        Args:
+            events: Events to append; their "seq" field is set
+        """
+        if not events:
+            return
+
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                segments = self._segments()
+                if not segments:
+                    first_seq = next_seq = 1
+                else:
+                    first_seq = segments[-1]
+                    next_seq = self._last_seq(first_seq) + 1
+                    if os.path.getsize(self._segment_path(first_seq)) >= self.segment_bytes:
+                        first_seq = next_seq
+                        for old_seq in segments[:len(segments) + 1 - self.retained_segments]:
+                            os.remove(self._segment_path(old_seq))
+
+                lines = []
+                for offset, event in enumerate(events):
+                    event["seq"] = next_seq + offset
+                    lines.append(json.dumps(event, separators=(",", ":")))
+                # One write, so readers never see a batch half written after a newline
+                fd = os.open(self._segment_path(first_seq), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, ("\n".join(lines) + "\n").encode("utf-8"))
+                finally:
+                    os.close(fd)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._signal)
+            except RuntimeError:
+                # The loop has been closed
+                self._loop = None
+
+    def record(self, events: List[Dict[str, Any]]) -> None:
+        """
+        Append events emitted by the document manager.
+
+        The change they describe is already saved, so a failure to record
+        them is counted rather than raised.
+
+        Args:
+            events: Events to append
+        """
+        try:
+            self.append(events)
+        except (OSError, ValueError):
+            metrics.inc("document_events_dropped_total", len(events), "Document events that could not be recorded")
+            return
+        for event in events:
+            metrics.inc("document_events_total", 1, "Document events recorded", type=event["type"])
+
+    def head(self) -> int:
+        """
+        Get the sequence number of the latest event.
+
+        Returns:
+            Sequence number, or 0 if the log is empty
+        """
+        segments = self._segments()
+        return self._last_seq(segments[-1]) if segments else 0
+
+    def _tail(self) -> Tuple[int, int]:
+        """Get the position following the latest event."""
+        with open(self._lock_path, 'a') as lock_file:
+            # Appends are whole writes under the lock, so the size is an event boundary
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH)
+            try:
+                segments = self._segments()
+                if not segments:
+                    return 1, 0
+                return segments[-1], os.path.getsize(self._segment_path(segments[-1]))
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _locate(self, cursor: int) -> Tuple[int, int]:
+        """
+        Find where the events following a cursor start.
+
+        Args:
+            cursor: Sequence number of the last event the client has seen
+
+        Returns:
+            Tuple of the segment's first sequence number and a byte offset
+
+        Raises:
+            CursorExpired: If events following the cursor are no longer retained
+        """
+        segments = self._segments()
+        if not segments:
+            if cursor > 0:
+                raise CursorExpired(f"Cursor {cursor} is ahead of the event log")
+            return 1, 0
+        if cursor + 1 < segments[0]:
+            raise CursorExpired(f"Events after {cursor} are no longer retained")
+        if cursor > self._last_seq(segments[-1]):
+            # E.g. from before the log was reset
+            raise CursorExpired(f"Cursor {cursor} is ahead of the event log")
+
+        first_seq = max(seq for seq in segments if seq <= cursor + 1)
+        offset = 0
+        try:
+            with open(self._segment_path(first_seq), 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n") or json.loads(line)["seq"] > cursor:
+                        break
+                    offset += len(line)
+        except FileNotFoundError:
+            raise CursorExpired(f"Events after {cursor} are no longer retained")
+        return first_seq, offset
+
+    def _read(self, position: Tuple[int, int]) -> Tuple[List[Dict[str, Any]], Tuple[int, int]]:
+        """
+        Read the complete events available at a position.
+
+        Args:
+            position: Segment and byte offset to read from
+
+        Returns:
+            Tuple of the events read and the position following them
+
+        Raises:
+            CursorExpired: If the segment has been removed
+        """
+        first_seq, offset = position
+        try:
+            with open(self._segment_path(first_seq), 'rb') as f:
+                f.seek(offset)
+                data = f.read(READ_CHUNK_BYTES)
+                if len(data) == READ_CHUNK_BYTES and b"\n" not in data:
+                    # A single event larger than a chunk
+                    data += f.readline()
+        except FileNotFoundError:
+            if any(seq > first_seq for seq in self._segments()):
+                raise CursorExpired("The subscriber fell behind the retained event log")
+            # Not created yet
+            return [], position
+
+        end = data.rfind(b"\n") + 1
+        if end:
+            events = [json.loads(line) for line in data[:end].splitlines()]
+            return events, (first_seq, offset + end)
+
+        if not data:
+            # Segments are complete once a newer one exists
+            newer = [seq for seq in self._segments() if seq > first_seq]
+            if newer:
+                return [], (newer[0], 0)
+        return [], position
+
+    def _state(self) -> Optional[Tuple[int, int]]:
+        """Get the latest segment and its size, which change with every append."""
+        try:
+            segments = self._segments()
+            return (segments[-1], os.path.getsize(self._segment_path(segments[-1]))) if segments else None
+        except (OSError, IndexError):
+            return None
+
+    def _signal(self) -> None:
+        if self._changed is not None:
+            changed, self._changed = self._changed, asyncio.Event()
+            changed.set()
+
+    async def _watch(self) -> None:
+        """Notice appends by other workers and wake the subscribers of this one."""
+        last_state = None
+        while self._subscribers > 0:
+            state = await anyio.to_thread.run_sync(self._state)
+            if state != last_state:
+                last_state = state
+                self._signal()
+            await asyncio.sleep(self.poll_interval)
+        self._watcher = None
+
+    def _change_token(self) -> asyncio.Event:
+        """Get the event set on the next append; taken before reading so none is missed."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._changed = asyncio.Event()
+            self._watcher = None
+        if self._watcher is None:
+            self._watcher = loop.create_task(self._watch())
+        return self._changed
+
+    @staticmethod
+    def visible_to(event: Dict[str, Any], user_id: str) -> bool:
+        """
+        Check whether a user may see an event.
+
+        Access is checked against the permissions the document had when the
+        event was emitted, by the same rule as ``DocumentManager.check_permission``.
+        Users who lost access through a permission change still see that change.
+
+        Args:
+            event: Event as recorded
+            user_id: ID of the user
+
+        Returns:
+            True if the user has view access
+        """
+        acl = {"owner_id": event["owner_id"], "permissions": event["permissions"]}
+        if DocumentManager._has_permission(acl, user_id, AccessLevel.VIEW):
+            return True
+        previous = event.get("previous_permissions")
+        if previous is not None:
+            return DocumentManager._has_permission({"owner_id": event["owner_id"], "permissions": previous}, user_id, AccessLevel.VIEW)
+        return False
+
+    @staticmethod
+    def public_event(event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+        """
+        Get the fields of an event sent to a user.
+
+        Args:
+            event: Event as recorded
+            user_id: ID of the receiving user
+
+        Returns:
+            Event fields; permission changes also tell whether the user still has access
+        """
+        public = {field: event.get(field) for field in PUBLIC_FIELDS}
+        if event["type"] == "permissions_changed":
+            acl = {"owner_id": event["owner_id"], "permissions": event["permissions"]}
+            public["has_access"] = DocumentManager._has_permission(acl, user_id, AccessLevel.VIEW)
+        return public
+
+    async def subscribe(
+        self,
+        user_id: str,
+        cursor: Optional[int] = None,
+        heartbeat_seconds: float = 15.0
+    ) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """
+        Stream the events a user may see.
+
+        Args:
+            user_id: ID of the subscribing user
+            cursor: Sequence number of the last event seen, or None to only
+                receive new events
+            heartbeat_seconds: Idle time after which None is yielded, so the
+                caller can send a keep-alive and notice closed connections
+
+        Yields:
+            Public events, a "reset" event if the cursor is no longer
+            retained, or None after an idle period
+        """
+        self._subscribers += 1
+        loop = asyncio.get_running_loop()
+        run_sync = anyio.to_thread.run_sync
+        try:
+            try:
+                if cursor is None:
+                    position = await run_sync(self._tail)
+                else:
+                    position = await run_sync(self._locate, cursor)
+            except CursorExpired:
+                metrics.inc("document_event_resets_total", 1, "Event subscribers told to reload")
+                yield {"seq": await run_sync(self.head), "type": "reset"}
+                position = await run_sync(self._tail)
+
+            last_sent = loop.time()
+            while True:
+                changed = self._change_token()
+                try:
+                    events, position = await run_sync(self._read, position)
+                except CursorExpired:
+                    metrics.inc("document_event_resets_total", 1, "Event subscribers told to reload")
+                    yield {"seq": await run_sync(self.head), "type": "reset"}
+                    position = await run_sync(self._tail)
+                    continue
+
+                for event in events:
+                    if self.visible_to(event, user_id):
+                        yield self.public_event(event, user_id)
+                        last_sent = loop.time()
+
+                if loop.time() - last_sent >= heartbeat_seconds:
+                    # Also sent while busy with events this user may not see
+                    yield None
+                    last_sent = loop.time()
+                if events:
+                    continue
+
+                try:
+                    await asyncio.wait_for(changed.wait(), max(0.0, heartbeat_seconds - (loop.time() - last_sent)))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._subscribers -= 1
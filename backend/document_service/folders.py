@@ -0,0 +1,487 @@
+"""
+Folder hierarchy with a materialized-path index of folders and documents.
+"""
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from common.metrics import metrics
+from document_service.document_manager import DocumentManager
+
+# Folder ID used by document filters for documents outside any folder
+ROOT_FOLDER = "root"
+
+# Longest accepted folder name
+MAX_NAME_LENGTH = 255
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    id TEXT PRIMARY KEY,
+    owner_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    parent_id TEXT,
+    path TEXT NOT NULL,
+    document_count INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0,
+    page_count INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS folders_path ON folders (path);
+CREATE UNIQUE INDEX IF NOT EXISTS folders_name ON folders (owner_id, IFNULL(parent_id, ''), name);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent_id);
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    owner_id TEXT NOT NULL,
+    folder_id TEXT,
+    size INTEGER NOT NULL,
+    page_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_folder ON documents (folder_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class FolderNotFound(ValueError):
+    """Raised when a folder does not exist."""
+
+
+class FolderConflict(ValueError):
+    """Raised when a folder operation conflicts with the hierarchy."""
+
+
+def _subtree_range(path: str) -> Tuple[str, str]:
+    """Bounds of the paths strictly below a folder path, for an index range scan."""
+    # Every descendant path starts with "<path>", and "0" sorts right after "/"
+    return path, path[:-1] + "0"
+
+
+class FolderIndex:
+    """
+    Folders and the placement of documents in them, kept in a SQLite index.
+
+    Each folder stores its materialized path, the IDs of its ancestors and
+    itself, e.g. ``/<clients>/<acme>/``, so a whole subtree is one range scan.
+    Document counts, sizes and page counts include every subfolder and are
+    updated incrementally: a document change adjusts the folder's ancestors
+    only. Moving a folder rewrites the paths of its subtree in the index;
+    documents keep their folder and their metadata files are not touched.
+
+    The index follows document metadata through a change listener on the
+    document manager and is rebuilt from the metadata when it is first
+    created or after an update could not be applied.
+    """
+
+    def __init__(self, manager: DocumentManager, db_path: Optional[str] = None):
+        """
+        Initialize the index, building it from the document metadata if needed.
+
+        Args:
+            manager: Document manager whose documents are indexed
+            db_path: Optional path of the SQLite database, defaults to a file
+                next to the metadata
+        """
+        self.manager = manager
+        self.db_path = db_path or os.path.join(manager.metadata_dir, ".index", "folders.sqlite3")
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._local = threading.local()
+
+        # Creating the schema is idempotent and commits on its own
+        self._connection().executescript(SCHEMA)
+        with self._transaction() as db:
+            built = db.execute("SELECT value FROM meta WHERE key = 'built'").fetchone()
+            if not built or built[0] != "1":
+                self._rebuild(db)
+
+        manager.add_change_listener(self.documents_changed)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get the connection of the current thread, opening a new one in forked processes."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run a block in a write transaction, serialized across processes."""
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _folder_row(self, db: sqlite3.Connection, folder_id: str) -> sqlite3.Row:
+        row = db.execute("SELECT * FROM folders WHERE id = ?", (folder_id,)).fetchone()
+        if row is None:
+            raise FolderNotFound(f"Folder {folder_id} not found")
+        return row
+
+    def _folder_dict(self, db: sqlite3.Connection, row: sqlite3.Row) -> Dict[str, Any]:
+        """Convert a folder row, resolving its path of names."""
+        ancestor_ids = row["path"].strip("/").split("/")
+        names = dict(db.execute(
+            f"SELECT id, name FROM folders WHERE id IN ({','.join('?' * len(ancestor_ids))})",
+            ancestor_ids
+        ).fetchall())
+        return {
+            "id": row["id"],
+            "name": row["name"],
+            "owner_id": row["owner_id"],
+            "parent_id": row["parent_id"],
+            "path": "/" + "/".join(names.get(ancestor_id, "") for ancestor_id in ancestor_ids),
+            "document_count": row["document_count"],
+            "size": row["size"],
+            "page_count": row["page_count"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"]
+        }
+
+    @staticmethod
+    def _validate_name(name: str) -> str:
+        name = name.strip()
+        if not name or "/" in name or len(name) > MAX_NAME_LENGTH:
+            raise ValueError(f"Invalid folder name: {name!r}")
+        return name
+
+    def _check_name_free(self, db: sqlite3.Connection, owner_id: str, parent_id: Optional[str], name: str) -> None:
+        taken = db.execute(
+            "SELECT id FROM folders WHERE owner_id = ? AND IFNULL(parent_id, '') = ? AND name = ?",
+            (owner_id, parent_id or "", name)
+        ).fetchone()
+        if taken:
+            raise FolderConflict(f"Folder {name} already exists")
+
+    def _adjust(self, db: sqlite3.Connection, path: str, documents: int, size: int, pages: int) -> None:
+        """Add document totals to a folder and all its ancestors."""
+        ancestor_ids = path.strip("/").split("/")
+        db.execute(
+            f"UPDATE folders SET document_count = document_count + ?, size = size + ?, page_count = page_count + ? "
+            f"WHERE id IN ({','.join('?' * len(ancestor_ids))})",
+            [documents, size, pages, *ancestor_ids]
+        )
+
+    def _adjust_folder(self, db: sqlite3.Connection, folder_id: Optional[str], documents: int, size: int, pages: int) -> None:
+        if not folder_id:
+            return
+        row = db.execute("SELECT path FROM folders WHERE id = ?", (folder_id,)).fetchone()
+        if row:
+            # Documents may name folders that do not exist in the index
+            self._adjust(db, row["path"], documents, size, pages)
+
+    @staticmethod
+    def _document_row(metadata: Dict[str, Any]) -> Tuple[str, Optional[str], int, int]:
+        return (
+            metadata["owner_id"],
+            metadata.get("folder_id"),
+            metadata.get("size") or 0,
+            (metadata.get("metadata") or {}).get("page_count") or 0
+        )
+
+    def create_folder(self, name: str, owner_id: str, parent_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Create a folder.
+
+        Args:
+            name: Name of the folder, unique among its siblings
+            owner_id: ID of the owner
+            parent_id: Optional ID of the parent folder, defaults to the root
+
+        Returns:
+            The new folder
+        """
+        name = self._validate_name(name)
+        folder_id = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
+
+        with self._transaction() as db:
+            parent_path = self._folder_row(db, parent_id)["path"] if parent_id else "/"
+            self._check_name_free(db, owner_id, parent_id, name)
+            db.execute(
+                "INSERT INTO folders (id, owner_id, name, parent_id, path, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (folder_id, owner_id, name, parent_id, f"{parent_path}{folder_id}/", now, now)
+            )
+            return self._folder_dict(db, self._folder_row(db, folder_id))
+
+    def get_folder(self, folder_id: str) -> Dict[str, Any]:
+        """
+        Get a folder with its path and the totals of its subtree.
+
+        Args:
+            folder_id: ID of the folder
+
+        Returns:
+            The folder
+        """
+        db = self._connection()
+        return self._folder_dict(db, self._folder_row(db, folder_id))
+
+    def resolve_path(self, owner_id: str, path: str) -> Dict[str, Any]:
+        """
+        Find a folder of an owner by its path of names, e.g. ``/Clients/Acme``.
+
+        Args:
+            owner_id: ID of the owner
+            path: Slash-separated folder names
+
+        Returns:
+            The folder
+        """
+        db = self._connection()
+        parent_id = None
+        row = None
+        for name in [part for part in path.split("/") if part]:
+            row = db.execute(
+                "SELECT * FROM folders WHERE owner_id = ? AND IFNULL(parent_id, '') = ? AND name = ?",
+                (owner_id, parent_id or "", name)
+            ).fetchone()
+            if row is None:
+                raise FolderNotFound(f"Folder {path} not found")
+            parent_id = row["id"]
+        if row is None:
+            raise FolderNotFound("The root is not a folder")
+        return self._folder_dict(db, row)
+
+    def list_folders(self, owner_id: str, parent_id: Optional[str] = None, recursive: bool = False) -> List[Dict[str, Any]]:
+        """
+        List the subfolders of a folder.
+
+        Args:
+            owner_id: ID of the owner
+            parent_id: Optional ID of the parent folder, defaults to the root
+            recursive: Whether to list the whole subtree instead of the direct children
+
+        Returns:
+            Folders ordered by path
+        """
+        db = self._connection()
+        if recursive and parent_id:
+            low, high = _subtree_range(self._folder_row(db, parent_id)["path"])
+            rows = db.execute(
+                "SELECT * FROM folders WHERE path > ? AND path < ? AND owner_id = ? ORDER BY path",
+                (low, high, owner_id)
+            ).fetchall()
+        elif recursive:
+            rows = db.execute("SELECT * FROM folders WHERE owner_id = ? ORDER BY path", (owner_id,)).fetchall()
+        else:
+            rows = db.execute(
+                "SELECT * FROM folders WHERE owner_id = ? AND IFNULL(parent_id, '') = ? ORDER BY name",
+                (owner_id, parent_id or "")
+            ).fetchall()
+        return [self._folder_dict(db, row) for row in rows]
+
+    def rename_folder(self, folder_id: str, name: str) -> Dict[str, Any]:
+        """
+        Rename a folder.
+
+        Args:
+            folder_id: ID of the folder
+            name: New name, unique among its siblings
+
+        Returns:
+            The renamed folder
+        """
+        name = self._validate_name(name)
+        with self._transaction() as db:
+            row = self._folder_row(db, folder_id)
+            if row["name"] != name:
+                self._check_name_free(db, row["owner_id"], row["parent_id"], name)
+                db.execute(
+                    "UPDATE folders SET name = ?, updated_at = ? WHERE id = ?",
+                    (name, datetime.utcnow().isoformat(), folder_id)
+                )
+            return self._folder_dict(db, self._folder_row(db, folder_id))
+
+    def move_folder(self, folder_id: str, parent_id: Optional[str]) -> Dict[str, Any]:
+        """
+        Move a folder and its whole subtree under another parent.
+
+        Only the index is updated; the documents in the subtree keep their folder.
+
+        Args:
+            folder_id: ID of the folder to move
+            parent_id: ID of the new parent folder, or None for the root
+
+        Returns:
+            The moved folder
+        """
+        with self._transaction() as db:
+            row = self._folder_row(db, folder_id)
+            old_path = row["path"]
+            parent_path = "/"
+            if parent_id:
+                parent_path = self._folder_row(db, parent_id)["path"]
+                if parent_path.startswith(old_path):
+                    raise FolderConflict("A folder cannot be moved into its own subtree")
+            if row["parent_id"] == parent_id:
+                return self._folder_dict(db, row)
+            self._check_name_free(db, row["owner_id"], parent_id, row["name"])
+
+            # Totals leave the old ancestors and join the new ones
+            old_parent_path = old_path[:-len(folder_id) - 1]
+            totals = (row["document_count"], row["size"], row["page_count"])
+            if old_parent_path != "/":
+                self._adjust(db, old_parent_path, *(-total for total in totals))
+            if parent_path != "/":
+                self._adjust(db, parent_path, *totals)
+
+            new_path = f"{parent_path}{folder_id}/"
+            low, high = _subtree_range(old_path)
+            db.execute(
+                "UPDATE folders SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?",
+                (new_path, len(old_path) + 1, low, high)
+            )
+            db.execute(
+                "UPDATE folders SET parent_id = ?, updated_at = ? WHERE id = ?",
+                (parent_id, datetime.utcnow().isoformat(), folder_id)
+            )
+            metrics.inc("folder_moves_total", 1, "Folder subtrees moved")
+            return self._folder_dict(db, self._folder_row(db, folder_id))
+
+    def delete_folder(self, folder_id: str) -> None:
+        """
+        Delete an empty folder.
+
+        Args:
+            folder_id: ID of the folder
+
+        Raises:
+            FolderConflict: If the folder still contains documents or folders
+        """
+        with self._transaction() as db:
+            self._folder_row(db, folder_id)
+            if db.execute("SELECT 1 FROM folders WHERE parent_id = ? LIMIT 1", (folder_id,)).fetchone() or \
+                    db.execute("SELECT 1 FROM documents WHERE folder_id = ? LIMIT 1", (folder_id,)).fetchone():
+                raise FolderConflict(f"Folder {folder_id} is not empty")
+            db.execute("DELETE FROM folders WHERE id = ?", (folder_id,))
+
+    def document_ids(
+        self,
+        folder_id: Optional[str],
+        recursive: bool = False,
+        owner_id: Optional[str] = None
+    ) -> List[str]:
+        """
+        Get the IDs of the documents in a folder.
+
+        Args:
+            folder_id: ID of the folder, or ``ROOT_FOLDER`` for documents outside any folder
+            recursive: Whether to include the documents of every subfolder
+            owner_id: Optional ID of the owner to filter by
+
+        Returns:
+            Document IDs
+        """
+        db = self._connection()
+        owner_filter = " AND documents.owner_id = ?" if owner_id else ""
+        owner_args = [owner_id] if owner_id else []
+
+        if folder_id in (None, ROOT_FOLDER):
+            if recursive:
+                query = "SELECT id FROM documents WHERE 1 = 1"
+                args = []
+            else:
+                query = "SELECT id FROM documents WHERE folder_id IS NULL"
+                args = []
+        elif recursive:
+            low, high = _subtree_range(self._folder_row(db, folder_id)["path"])
+            query = (
+                "SELECT documents.id FROM documents JOIN folders ON folders.id = documents.folder_id "
+                "WHERE folders.path >= ? AND folders.path < ?"
+            )
+            args = [low, high]
+        else:
+            query = "SELECT id FROM documents WHERE folder_id = ?"
+            args = [folder_id]
+        return [row[0] for row in db.execute(query + owner_filter, args + owner_args).fetchall()]
+
+    def documents_changed(self, updated: List[Dict[str, Any]], deleted: List[str]) -> None:
+        """
+        Apply document metadata changes to the index; registered as a change listener.
+
+        Args:
+            updated: Saved document metadata
+            deleted: IDs of removed documents
+        """
+        db = self._connection()
+        try:
+            # Most metadata writes leave the indexed fields alone and need no write transaction
+            changed = []
+            for metadata in updated:
+                row = db.execute(
+                    "SELECT owner_id, folder_id, size, page_count FROM documents WHERE id = ?",
+                    (metadata["id"],)
+                ).fetchone()
+                if row is None or tuple(row) != self._document_row(metadata):
+                    changed.append(metadata)
+            if not changed and not deleted:
+                return
+
+            with self._transaction() as db:
+                for metadata in changed:
+                    self._remove_document(db, metadata["id"])
+                    owner_id, folder_id, size, pages = self._document_row(metadata)
+                    db.execute(
+                        "INSERT INTO documents (id, owner_id, folder_id, size, page_count) VALUES (?, ?, ?, ?, ?)",
+                        (metadata["id"], owner_id, folder_id, size, pages)
+                    )
+                    self._adjust_folder(db, folder_id, 1, size, pages)
+                for document_id in deleted:
+                    self._remove_document(db, document_id)
+        except sqlite3.Error:
+            # The metadata change already happened; have the next start rebuild the index
+            metrics.inc("folder_index_errors_total", 1, "Document changes the folder index failed to apply")
+            try:
+                db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '0')")
+            except sqlite3.Error:
+                pass
+
+    def _remove_document(self, db: sqlite3.Connection, document_id: str) -> None:
+        row = db.execute("SELECT folder_id, size, page_count FROM documents WHERE id = ?", (document_id,)).fetchone()
+        if row is None:
+            return
+        self._adjust_folder(db, row["folder_id"], -1, -row["size"], -row["page_count"])
+        db.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+
+    def rebuild(self) -> int:
+        """
+        Rebuild the document index and all folder totals from the document metadata.
+
+        Returns:
+            Number of indexed documents
+        """
+        with self._transaction() as db:
+            return self._rebuild(db)
+
+    def _rebuild(self, db: sqlite3.Connection) -> int:
+        db.execute("DELETE FROM documents")
+        db.execute("UPDATE folders SET document_count = 0, size = 0, page_count = 0")
+        indexed = set()
+        for metadata in self.manager.list_documents():
+            if metadata["id"] in indexed:
+                # Found at both its legacy and its sharded location during a migration
+                continue
+            owner_id, folder_id, size, pages = self._document_row(metadata)
+            db.execute(
+                "INSERT INTO documents (id, owner_id, folder_id, size, page_count) VALUES (?, ?, ?, ?, ?)",
+                (metadata["id"], owner_id, folder_id, size, pages)
+            )
+            self._adjust_folder(db, folder_id, 1, size, pages)
+            indexed.add(metadata["id"])
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '1')")
+        return len(indexed)
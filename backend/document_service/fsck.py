@@ -0,0 +1,707 @@
+"""
+Parallel consistency check and repair of document storage.
+
+Usage:
+    python -m document_service.fsck --storage-dir /var/lib/pdf_editor [--repair] [--verify-hashes] [--resume]
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from common.metrics import metrics
+from document_service.document_manager import DocumentManager, BATCH_IO_WORKERS, VERSION_ARTIFACTS
+from document_service.folders import FolderIndex
+
+# Kinds of issues reported by the checker
+ISSUE_KINDS = (
+    "corrupt_metadata",    # Metadata file that is not valid JSON
+    "invalid_metadata",    # Metadata file missing required fields
+    "misplaced_metadata",  # Metadata file named after another document
+    "duplicate_metadata",  # Legacy metadata file left next to its sharded copy
+    "stale_temp_file",     # Partial metadata write left by a crashed process
+    "missing_version",     # Version whose file is gone
+    "hash_mismatch",       # Version whose file does not match its SHA-256
+    "size_mismatch",       # Version whose recorded size is wrong
+    "missing_artifact",    # Encoding or derived file of a version that is gone
+    "orphaned_blobs",      # Blobs that no document or trash entry refers to
+)
+
+# Issues that lose a version; repairing them removes the version
+LOST_VERSION_KINDS = ("missing_version", "hash_mismatch")
+
+# Age after which a partial metadata write is considered abandoned
+STALE_TEMP_SECONDS = 60 * 60
+
+# Age below which an unreferenced blob may belong to a document still being created
+ORPHAN_GRACE_SECONDS = 24 * 60 * 60
+
+# Minimum interval between progress updates of the state file
+PROGRESS_INTERVAL_SECONDS = 1.0
+
+# Number of issues kept in the state file for progress reports
+ISSUE_SAMPLE_SIZE = 100
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class CheckInProgress(Exception):
+    """Raised when another process is already checking the storage."""
+
+
+def _write_json(path: str, value: Dict[str, Any]) -> None:
+    partial_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(partial_path, 'w') as f:
+        json.dump(value, f)
+    os.replace(partial_path, path)
+
+
+class StorageChecker:
+    """
+    Checks document metadata and blobs against each other, in parallel.
+
+    A run has two phases. The metadata phase reads every metadata file and
+    checks that it parses, that its version files exist with the recorded
+    size, and optionally their SHA-256. The blob phase lists the document
+    blobs and reports those that no document or trash entry refers to. Each
+    phase is split into units, one per top-level shard, that are checked by a
+    pool of threads; a unit's result is saved as soon as it is done, so an
+    interrupted run resumes from the units it had not finished.
+
+    Repairs never delete data. Unreadable metadata and unreferenced blobs are
+    moved into quarantine; versions whose file is gone or corrupt are removed
+    from their document, which falls back to its latest intact version, and
+    their records are kept in quarantine too.
+    """
+
+    def __init__(self, manager: DocumentManager, folder_index: Optional[FolderIndex] = None, workers: int = BATCH_IO_WORKERS):
+        """
+        Initialize the checker.
+
+        Args:
+            manager: Document manager whose storage is checked
+            folder_index: Optional folder index rebuilt on request
+            workers: Number of units checked in parallel
+        """
+        self.manager = manager
+        self.folder_index = folder_index
+        self.workers = max(1, workers)
+        self.state_dir = os.path.join(manager.metadata_dir, ".fsck")
+        self.quarantine_dir = os.path.join(manager.metadata_dir, ".quarantine")
+        os.makedirs(self.state_dir, exist_ok=True)
+        self._state_path = os.path.join(self.state_dir, "state.json")
+        self._lock_path = os.path.join(self.state_dir, ".lock")
+        self._state_lock = threading.Lock()
+
+    # Run control
+
+    def _acquire(self):
+        lock_file = open(self._lock_path, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise CheckInProgress("A storage check is already running")
+        return lock_file
+
+    @staticmethod
+    def _release(lock_file) -> None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+
+    def status(self) -> Optional[Dict[str, Any]]:
+        """
+        Get the progress of the current or last run.
+
+        Returns:
+            State of the run, or None if the storage was never checked
+        """
+        try:
+            with open(self._state_path, 'r') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if state["status"] == "running":
+            try:
+                self._release(self._acquire())
+                # Nobody holds the lock, so the process running it died
+                state["status"] = "interrupted"
+            except CheckInProgress:
+                pass
+        return state
+
+    def run(self, repair: bool = False, verify_hashes: bool = False, rebuild_index: bool = False, resume: bool = False) -> Dict[str, Any]:
+        """
+        Check the storage.
+
+        Args:
+            repair: Repair or quarantine what is found
+            verify_hashes: Also check the SHA-256 of every version file
+            rebuild_index: Rebuild the folder index from the metadata afterwards
+            resume: Continue an unfinished run with its options instead of starting over
+
+        Returns:
+            Final state of the run with every issue found
+
+        Raises:
+            CheckInProgress: If another process is checking the storage
+        """
+        lock_file = self._acquire()
+        try:
+            return self._execute(self._begin(repair, verify_hashes, rebuild_index, resume))
+        finally:
+            self._release(lock_file)
+
+    def start(self, repair: bool = False, verify_hashes: bool = False, rebuild_index: bool = False, resume: bool = False) -> None:
+        """
+        Start a run in a background thread; see ``run`` and ``status``.
+
+        Raises:
+            CheckInProgress: If another process is checking the storage
+        """
+        lock_file = self._acquire()
+        try:
+            # Reported as running before this returns
+            state = self._begin(repair, verify_hashes, rebuild_index, resume)
+        except BaseException:
+            self._release(lock_file)
+            raise
+
+        def target():
+            try:
+                self._execute(state)
+            except Exception:
+                # Recorded in the state file
+                pass
+            finally:
+                self._release(lock_file)
+
+        threading.Thread(target=target, name="storage-check", daemon=True).start()
+
+    def _begin(self, repair: bool, verify_hashes: bool, rebuild_index: bool, resume: bool) -> Dict[str, Any]:
+        """Start a new run, or pick up the unfinished one when resuming."""
+        state = self.status() if resume else None
+        if state is None or state["status"] == "completed":
+            state = {
+                "run_id": f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}",
+                "options": {"repair": repair, "verify_hashes": verify_hashes, "rebuild_index": rebuild_index},
+                "started_at": datetime.utcnow().isoformat()
+            }
+            self._remove_old_runs(state["run_id"])
+        state.update({"status": "running", "phase": "metadata", "error": None, "finished_at": None})
+        self._state = state
+        self._last_saved = 0.0
+        self._update(force=True)
+        return state
+
+    def _execute(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        run_dir = os.path.join(self.state_dir, state["run_id"])
+        os.makedirs(run_dir, exist_ok=True)
+        options = state["options"]
+
+        try:
+            # Roll forward interrupted batches first, so they are not reported
+            with self.manager._lock_documents([]):
+                pass
+
+            metadata_results = self._run_phase(
+                "metadata", run_dir, self._metadata_units(),
+                lambda unit: self._check_metadata_unit(unit, state["run_id"], options)
+            )
+            prefixes, keys = self._references(metadata_results)
+            quarantined = self._quarantined_documents()
+
+            self._update(phase="blobs")
+            blob_results = self._run_phase(
+                "blobs", run_dir, [f"{shard:02x}" for shard in range(256)],
+                lambda unit: self._check_blob_unit(unit, state["run_id"], options, prefixes, keys, quarantined)
+            )
+
+            if options["rebuild_index"] and self.folder_index is not None:
+                self._update(phase="index")
+                started = time.perf_counter()
+                indexed = self.folder_index.rebuild()
+                state["index"] = {"documents": indexed, "seconds": round(time.perf_counter() - started, 3)}
+
+            issues = [issue for result in metadata_results + blob_results for issue in result["issues"]]
+            state["finished_at"] = datetime.utcnow().isoformat()
+            self._update(status="completed", phase=None, force=True)
+        except Exception as e:
+            self._update(status="failed", error=str(e), force=True)
+            raise
+
+        for kind, count in state["stats"]["issues_by_kind"].items():
+            metrics.inc("fsck_issues_total", count, "Storage inconsistencies found by the checker", kind=kind)
+        return dict(state, issues=issues)
+
+    def _remove_old_runs(self, run_id: str) -> None:
+        for entry in os.scandir(self.state_dir):
+            if entry.is_dir() and entry.name != run_id:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    # Progress
+
+    def _update(self, force: bool = False, result: Optional[Dict[str, Any]] = None, **fields) -> None:
+        """Record progress, saving the state file at most once per interval."""
+        with self._state_lock:
+            state = self._state
+            state.update(fields)
+            if result is not None:
+                stats = state["stats"]
+                for name, value in result["stats"].items():
+                    stats[name] = stats.get(name, 0) + value
+                for issue in result["issues"]:
+                    stats["issues_by_kind"][issue["kind"]] = stats["issues_by_kind"].get(issue["kind"], 0) + 1
+                    if len(state["issues_sample"]) < ISSUE_SAMPLE_SIZE:
+                        state["issues_sample"].append(issue)
+                state["units"][result["phase"]]["done"] += 1
+
+            now = time.monotonic()
+            if force or now - self._last_saved >= PROGRESS_INTERVAL_SECONDS:
+                state["updated_at"] = datetime.utcnow().isoformat()
+                _write_json(self._state_path, state)
+                self._last_saved = now
+
+    def _run_phase(self, phase: str, run_dir: str, units: List[str], check) -> List[Dict[str, Any]]:
+        """
+        Check the units of a phase in parallel, skipping those a previous attempt finished.
+
+        Returns:
+            Results of every unit of the phase
+        """
+        results = []
+        pending = []
+        for unit in units:
+            result_path = os.path.join(run_dir, f"{phase}-{unit or 'legacy'}.json")
+            try:
+                with open(result_path, 'r') as f:
+                    results.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                pending.append((unit, result_path))
+
+        with self._state_lock:
+            if phase == "metadata":
+                # Totals are recomputed from the saved results when resuming
+                self._state["stats"] = {"issues_by_kind": {}}
+                self._state["issues_sample"] = []
+                self._state["units"] = {}
+            self._state["units"][phase] = {"total": len(units), "done": 0}
+        for result in results:
+            self._update(result=result)
+        self._update(force=True)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(check, unit): (unit, result_path) for unit, result_path in pending}
+            for future in as_completed(futures):
+                unit, result_path = futures[future]
+                result = future.result()
+                result["phase"] = phase
+                _write_json(result_path, result)
+                results.append(result)
+                self._update(result=result)
+        return results
+
+    # Metadata phase
+
+    def _metadata_units(self) -> List[str]:
+        """List the top-level metadata shards, with "" standing for legacy files."""
+        units = [""]
+        for entry in os.scandir(self.manager.metadata_dir):
+            if entry.is_dir() and not entry.name.startswith("."):
+                units.append(entry.name)
+        return sorted(units)
+
+    def _unit_files(self, unit: str) -> Iterator[str]:
+        root = os.path.join(self.manager.metadata_dir, unit) if unit else self.manager.metadata_dir
+        if not unit:
+            for entry in os.scandir(root):
+                if entry.is_file():
+                    yield entry.path
+            return
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                yield os.path.join(dirpath, filename)
+
+    def _check_metadata_unit(self, unit: str, run_id: str, options: Dict[str, bool]) -> Dict[str, Any]:
+        result = {
+            "unit": unit,
+            "stats": {"documents": 0, "versions": 0, "bytes_hashed": 0, "repaired": 0},
+            "issues": [],
+            # Blobs referenced by the documents, for the blob phase
+            "prefixes": [],
+            "keys": []
+        }
+        stale_before = time.time() - STALE_TEMP_SECONDS
+        for path in self._unit_files(unit):
+            if path.endswith(".tmp"):
+                try:
+                    if os.path.getmtime(path) < stale_before:
+                        self._issue(result, "stale_temp_file", path=path, repair=options["repair"] and self._remove(path))
+                except FileNotFoundError:
+                    pass
+            elif path.endswith(".json"):
+                self._check_metadata_file(path, result, run_id, options)
+        return result
+
+    @staticmethod
+    def _issue(result: Dict[str, Any], kind: str, repair: Optional[str] = None, **fields) -> None:
+        issue = {"kind": kind}
+        issue.update(fields)
+        issue["repaired"] = repair or None
+        result["issues"].append(issue)
+        if repair:
+            result["stats"]["repaired"] += 1
+
+    @staticmethod
+    def _remove(path: str) -> str:
+        DocumentManager._remove_file(path)
+        return "removed"
+
+    @staticmethod
+    def _invalid_fields(metadata: Any) -> List[str]:
+        """List the required fields a parsed metadata file lacks."""
+        if not isinstance(metadata, dict):
+            return ["id", "owner_id", "storage_key", "versions"]
+        missing = [field for field in ("id", "owner_id", "storage_key") if not isinstance(metadata.get(field), str)]
+        versions = metadata.get("versions")
+        if (
+            not isinstance(versions, list)
+            or not versions
+            or not all(isinstance(version, dict) and version.get("version_id") and version.get("storage_key") for version in versions)
+        ):
+            missing.append("versions")
+        return missing
+
+    def _check_metadata_file(self, path: str, result: Dict[str, Any], run_id: str, options: Dict[str, bool]) -> None:
+        document_id = os.path.basename(path)[:-len(".json")]
+        sharded_path = self.manager.layout.metadata_path(self.manager.metadata_dir, document_id)
+        if path != sharded_path and os.path.exists(sharded_path):
+            # The sharded copy is the one read; saving a document removes the legacy one
+            self._issue(result, "duplicate_metadata", repair=options["repair"] and self._remove(path), document_id=document_id, path=path)
+            return
+
+        try:
+            with open(path, 'r') as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            # Deleted or moved while checking
+            return
+        except ValueError as e:
+            repair = options["repair"] and self._quarantine_metadata(document_id, path, run_id)
+            self._issue(result, "corrupt_metadata", repair=repair, document_id=document_id, path=path, detail=str(e))
+            return
+
+        missing = self._invalid_fields(metadata)
+        if missing:
+            repair = options["repair"] and self._quarantine_metadata(document_id, path, run_id)
+            self._issue(result, "invalid_metadata", repair=repair, document_id=document_id, path=path, detail=f"Missing {', '.join(missing)}")
+            return
+        if metadata["id"] != document_id:
+            # Not found under either ID; needs a person to tell which is right
+            self._issue(result, "misplaced_metadata", document_id=document_id, path=path, detail=f"Holds document {metadata['id']}")
+            return
+
+        result["stats"]["documents"] += 1
+        result["stats"]["versions"] += len(metadata["versions"])
+        result["prefixes"].append(metadata["storage_key"])
+        if metadata["storage_key"] != metadata["id"]:
+            # Blobs left at the legacy location
+            result["prefixes"].append(metadata["id"])
+        for version in metadata["versions"]:
+            for key in self.manager.version_keys(version):
+                if not key.startswith(f"{metadata['storage_key']}/"):
+                    # Shared with another document, e.g. a template's
+                    result["keys"].append(key)
+
+        problems = self._check_versions(metadata, options["verify_hashes"], result["stats"])
+        if not problems:
+            return
+        repairs = self._repair_versions(document_id, problems, run_id) if options["repair"] else {}
+        for problem in problems:
+            self._issue(result, repair=repairs.get((problem["version_id"], problem.get("field"))), document_id=document_id, **problem)
+
+    def _hash(self, key: str) -> str:
+        digest = hashlib.sha256()
+        with open(self.manager.backend.open_path(key), 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _check_versions(self, metadata: Dict[str, Any], verify_hashes: bool, stats: Dict[str, int]) -> List[Dict[str, Any]]:
+        """
+        Check the files of a document's versions.
+
+        Returns:
+            Problems found, each with its kind and version ID
+        """
+        backend = self.manager.backend
+        problems = []
+        for version in metadata["versions"]:
+            version_id = version["version_id"]
+            if version.get("tier") == "archive":
+                archive = self.manager.archive
+                if archive is not None and not archive.backend.exists(version["archive"]["storage_key"]):
+                    problems.append({"kind": "missing_version", "version_id": version_id, "key": version["archive"]["storage_key"]})
+                continue
+
+            key = version["storage_key"]
+            try:
+                size = backend.size(key)
+            except (OSError, ValueError):
+                problems.append({"kind": "missing_version", "version_id": version_id, "key": key})
+                continue
+
+            recorded_size = version.get("size")
+            size_differs = recorded_size is not None and size != recorded_size
+            if size_differs or (verify_hashes and version.get("sha256")):
+                if not version.get("sha256"):
+                    # Cannot tell whether the file or the record is wrong
+                    problems.append({"kind": "size_mismatch", "version_id": version_id, "key": key, "size": size, "detail": "No SHA-256 recorded"})
+                    continue
+                try:
+                    sha256 = self._hash(key)
+                except (OSError, ValueError):
+                    problems.append({"kind": "missing_version", "version_id": version_id, "key": key})
+                    continue
+                stats["bytes_hashed"] += size
+                if sha256 != version["sha256"]:
+                    problems.append({"kind": "hash_mismatch", "version_id": version_id, "key": key, "sha256": sha256})
+                    continue
+                if size_differs:
+                    problems.append({"kind": "size_mismatch", "version_id": version_id, "key": key, "size": size})
+
+            derived = [(f"encodings.{name}", encoded["storage_key"]) for name, encoded in (version.get("encodings") or {}).items()]
+            derived.extend((field, version[field]["storage_key"]) for field in VERSION_ARTIFACTS if version.get(field))
+            for field, derived_key in derived:
+                if not backend.exists(derived_key):
+                    problems.append({"kind": "missing_artifact", "version_id": version_id, "key": derived_key, "field": field})
+        return problems
+
+    def _quarantine_path(self, run_id: str, name: str) -> str:
+        quarantine_dir = os.path.join(self.quarantine_dir, run_id)
+        os.makedirs(quarantine_dir, exist_ok=True)
+        return os.path.join(quarantine_dir, name)
+
+    def _quarantine_metadata(self, document_id: str, path: str, run_id: str) -> Optional[str]:
+        """Move an unreadable metadata file into quarantine, dropping the document from the indexes."""
+        with self.manager._lock_document(document_id):
+            try:
+                os.replace(path, self._quarantine_path(run_id, f"{document_id}.json"))
+            except FileNotFoundError:
+                return None
+        self.manager._notify_changed([], [document_id])
+        return "quarantined"
+
+    def _repair_versions(self, document_id: str, problems: List[Dict[str, Any]], run_id: str) -> Dict[Tuple[str, Optional[str]], str]:
+        """
+        Repair the versions of a document, checking them again under its lock.
+
+        Returns:
+            Repair applied to each problem, by version ID and field
+        """
+        flagged = {problem["version_id"] for problem in problems}
+        with self.manager._lock_document(document_id):
+            try:
+                metadata = self.manager.get_document(document_id)
+            except ValueError:
+                return {}
+            versions = [version for version in metadata["versions"] if version["version_id"] in flagged]
+            current = self._check_versions(dict(metadata, versions=versions), verify_hashes=False, stats={"bytes_hashed": 0})
+            # Corruption found by hashing is not checked again
+            current.extend(problem for problem in problems if problem["kind"] == "hash_mismatch")
+
+            repairs = {}
+            lost = set()
+            by_id = {version["version_id"]: version for version in metadata["versions"]}
+            for problem in current:
+                version = by_id[problem["version_id"]]
+                if problem["kind"] in LOST_VERSION_KINDS:
+                    lost.add(problem["version_id"])
+                    repairs[(problem["version_id"], None)] = "version_removed"
+                elif problem["kind"] == "size_mismatch" and "detail" not in problem:
+                    version["size"] = problem["size"]
+                    repairs[(problem["version_id"], None)] = "size_corrected"
+                elif problem["kind"] == "missing_artifact":
+                    field = problem["field"]
+                    if field.startswith("encodings."):
+                        version["encodings"].pop(field[len("encodings."):], None)
+                    else:
+                        # Served without it, like a version not enriched yet
+                        version[field] = None
+                    repairs[(problem["version_id"], field)] = "reference_removed"
+            if not repairs:
+                return {}
+
+            removed = [version for version in metadata["versions"] if version["version_id"] in lost]
+            metadata["versions"] = [version for version in metadata["versions"] if version["version_id"] not in lost]
+            if removed:
+                _write_json(self._quarantine_path(run_id, f"{document_id}.versions.json"), {"document_id": document_id, "versions": removed})
+            corrupt = {problem["version_id"] for problem in current if problem["kind"] == "hash_mismatch"}
+            for version in removed:
+                if version["version_id"] in corrupt:
+                    self._quarantine_blob(version["storage_key"], run_id)
+
+            if not metadata["versions"]:
+                # Nothing intact is left; keep the metadata for a person to look at
+                _write_json(self._quarantine_path(run_id, f"{document_id}.json"), metadata)
+                self.manager._commit_batch([], [document_id])
+                event = self.manager._document_event("deleted", metadata)
+            else:
+                metadata["size"] = metadata["versions"][-1].get("size", metadata.get("size"))
+                metadata["updated_at"] = datetime.utcnow().isoformat()
+                self.manager._commit_batch([metadata], [])
+                event = self.manager._document_event("updated", metadata)
+        self.manager._notify_events([event])
+        return repairs
+
+    def _quarantine_blob(self, key: str, run_id: str) -> bool:
+        """Move a blob below the quarantine prefix of the run."""
+        backend = self.manager.backend
+        try:
+            backend.move_file(f"quarantine/{run_id}/{key}", backend.open_path(key))
+        except (OSError, ValueError):
+            # Removed in the meantime
+            return False
+        backend.delete(key)
+        return True
+
+    # Blob phase
+
+    def _references(self, results: List[Dict[str, Any]]) -> Tuple[Set[str], Set[str]]:
+        """Collect the prefixes and keys referenced by documents and trash entries."""
+        prefixes: Set[str] = set()
+        keys: Set[str] = set()
+        for result in results:
+            prefixes.update(result["prefixes"])
+            keys.update(result["keys"])
+        for entry in self.manager.iter_trash():
+            prefixes.update(entry.get("prefixes") or [])
+            keys.update(entry.get("keys") or [])
+        return prefixes, keys
+
+    def _quarantined_documents(self) -> Set[str]:
+        """List the documents whose metadata is in quarantine; their blobs stay where they are."""
+        quarantined = set()
+        if not os.path.isdir(self.quarantine_dir):
+            return quarantined
+        for run in os.scandir(self.quarantine_dir):
+            if run.is_dir():
+                quarantined.update(
+                    name[:-len(".json")] for name in os.listdir(run.path)
+                    if name.endswith(".json") and not name.endswith(".versions.json")
+                )
+        return quarantined
+
+    def _written_before(self, key: str, cutoff: float) -> bool:
+        try:
+            return self.manager.backend.modified(key) < cutoff
+        except (OSError, ValueError):
+            # Removed in the meantime
+            return False
+
+    def _document_exists(self, document_id: str) -> bool:
+        """Check whether a document has metadata or a trash entry; the caller holds its lock."""
+        return bool(
+            self.manager._find_metadata_path(document_id)
+            or os.path.exists(self.manager._trash_path(f"document-{document_id}"))
+        )
+
+    def _check_blob_unit(
+        self,
+        shard: str,
+        run_id: str,
+        options: Dict[str, bool],
+        prefixes: Set[str],
+        keys: Set[str],
+        quarantined: Set[str]
+    ) -> Dict[str, Any]:
+        result = {"unit": shard, "stats": {"blobs": 0, "repaired": 0}, "issues": []}
+        # documents/<tenant shard>/<tenant>/<document shards>.../<document_id>
+        depth = self.manager.layout.depth + 4
+        orphans: Dict[str, List[str]] = {}
+        for key in self.manager.backend.list_keys(f"documents/{shard}"):
+            result["stats"]["blobs"] += 1
+            if key in keys:
+                continue
+            parts = key.split("/")
+            if any("/".join(parts[:length]) in prefixes for length in range(1, len(parts))):
+                continue
+            orphans.setdefault("/".join(parts[:depth]), []).append(key)
+
+        if not orphans:
+            return result
+
+        # Documents created or deleted while checking are not orphans
+        trashed_prefixes, trashed_keys = self._references([])
+        written_before = time.time() - ORPHAN_GRACE_SECONDS
+        for prefix, orphaned_keys in sorted(orphans.items()):
+            document_id = prefix.rsplit("/", 1)[-1]
+            if self.manager._find_metadata_path(document_id) or prefix in trashed_prefixes or document_id in quarantined:
+                continue
+            orphaned_keys = [key for key in orphaned_keys if key not in trashed_keys and self._written_before(key, written_before)]
+            if not orphaned_keys:
+                continue
+
+            size = 0
+            for key in orphaned_keys:
+                try:
+                    size += self.manager.backend.size(key)
+                except (OSError, ValueError):
+                    pass
+            repair = None
+            if options["repair"]:
+                # Documents hold their lock from storing their first blob until
+                # their metadata is saved, so this sees any creation in progress
+                with self.manager._lock_document(document_id):
+                    if self._document_exists(document_id):
+                        continue
+                    moved = sum(self._quarantine_blob(key, run_id) for key in orphaned_keys)
+                    repair = "quarantined" if moved else None
+            self._issue(result, "orphaned_blobs", repair=repair, document_id=document_id, prefix=prefix, keys=len(orphaned_keys), size=size)
+        return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Check document storage for inconsistencies")
+    parser.add_argument("--storage-dir", required=True, help="Root storage directory")
+    parser.add_argument("--repair", action="store_true", help="Repair or quarantine what is found")
+    parser.add_argument("--verify-hashes", action="store_true", help="Check the SHA-256 of every version file")
+    parser.add_argument("--rebuild-index", action="store_true", help="Rebuild the folder index afterwards")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run")
+    parser.add_argument("--workers", type=int, default=BATCH_IO_WORKERS, help="Number of shards checked in parallel")
+    parser.add_argument("--status", action="store_true", help="Only print the progress of the current or last run")
+    args = parser.parse_args(argv)
+
+    manager = DocumentManager(args.storage_dir)
+    checker = StorageChecker(manager, FolderIndex(manager), workers=args.workers)
+    if args.status:
+        print(json.dumps(checker.status()))
+        return 0
+
+    try:
+        report = checker.run(repair=args.repair, verify_hashes=args.verify_hashes, rebuild_index=args.rebuild_index, resume=args.resume)
+    except CheckInProgress as e:
+        print(str(e), file=sys.stderr)
+        return 2
+
+    for issue in report.pop("issues"):
+        print(json.dumps(issue))
+    report.pop("issues_sample", None)
+    print(json.dumps(report))
+    unrepaired = sum(report["stats"]["issues_by_kind"].values()) - report["stats"]["repaired"]
+    return 1 if unrepaired else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""
+Response helpers for serving stored document versions and document metadata.
+"""
+import gzip
+import json
+import os
+import stat
+from typing import Any, Dict, List, Mapping, Optional
+
+import anyio
+from fastapi.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON bodies smaller than this are sent uncompressed
+COMPRESS_MIN_BYTES = 1024
+
+# Compression level for JSON bodies, favouring speed over ratio
+COMPRESS_LEVEL = 5
+
+
+class ZeroCopyFileResponse(FileResponse):
+    """
+    File response that lets the ASGI server send the file without copying it
+    through Python when the server supports it.
+
+    Servers advertising the ``http.response.pathsend`` or
+    ``http.response.zerocopy`` ASGI extensions hand the file to the kernel
+    (sendfile). Other servers fall back to reading the file in large chunks.
+    """
+
+    chunk_size = 1024 * 1024
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        extensions = scope.get("extensions") or {}
+        if self.send_header_only or not (
+            "http.response.pathsend" in extensions or "http.response.zerocopy" in extensions
+        ):
+            await super().__call__(scope, receive, send)
+            return
+
+        if self.stat_result is None:
+            try:
+                stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError:
+                raise RuntimeError(f"File at path {self.path} does not exist.")
+            if not stat.S_ISREG(stat_result.st_mode):
+                raise RuntimeError(f"File at path {self.path} is not a file.")
+            self.set_stat_headers(stat_result)
+
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+
+        if "http.response.pathsend" in extensions:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+        else:
+            with open(self.path, "rb") as file:
+                await send({"type": "http.response.zerocopy", "file": file, "more_body": False})
+
+        if self.background is not None:
+            await self.background()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Check an If-None-Match header against an entity tag.
+
+    Args:
+        if_none_match: Value of the If-None-Match request header
+        etag: Quoted entity tag of the current representation
+
+    Returns:
+        True if the client already holds the representation
+    """
+    if not if_none_match:
+        return False
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    """
+    Check whether an Accept-Encoding header allows a content encoding.
+
+    Args:
+        accept_encoding: Value of the Accept-Encoding request header
+        encoding: Content encoding to check, e.g. "gzip"
+
+    Returns:
+        True if the encoding is acceptable to the client
+    """
+    if not accept_encoding:
+        return False
+
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip().lower() != encoding:
+            continue
+        params = params.replace(" ", "")
+        return params not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def dump_json(content: Any) -> bytes:
+    """
+    Serialize content to compact JSON, with orjson when it is installed.
+
+    Args:
+        content: JSON-compatible content
+
+    Returns:
+        UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response that skips response model validation and encoding.
+
+    The content is serialized in one step by ``dump_json`` and gzip-compressed
+    when it is large enough and the client accepts it. Routes returning large
+    metadata documents use it instead of going through ``APIResponse``.
+    """
+
+    media_type = "application/json"
+
+    def __init__(
+        self,
+        content: Any,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        accept_encoding: Optional[str] = None
+    ):
+        """
+        Initialize the response.
+
+        Args:
+            content: JSON-compatible content
+            status_code: HTTP status code
+            headers: Optional additional headers
+            accept_encoding: Accept-Encoding request header; None disables compression
+        """
+        super().__init__(content, status_code, headers)
+        self.headers["Vary"] = "Accept-Encoding"
+        if len(self.body) >= COMPRESS_MIN_BYTES and accepts_encoding(accept_encoding, "gzip"):
+            self.body = gzip.compress(self.body, compresslevel=COMPRESS_LEVEL, mtime=0)
+            self.headers["Content-Encoding"] = "gzip"
+            self.headers["Content-Length"] = str(len(self.body))
+
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """
+    Parse a comma-separated field selection, e.g. ``id,name,metadata.page_count``.
+
+    Args:
+        fields: Value of the ``fields`` query parameter
+
+    Returns:
+        Selected field paths, or None if no selection was given
+    """
+    if not fields:
+        return None
+    selected = [field.strip() for field in fields.split(",") if field.strip()]
+    return selected or None
+
+
+def select_fields(item: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+    """
+    Project a dict onto selected fields; dotted paths select nested fields.
+
+    Fields that do not exist are left out.
+
+    Args:
+        item: Dict to project
+        fields: Field paths to keep
+
+    Returns:
+        The projected dict
+    """
+    result: Dict[str, Any] = {}
+    for field in fields:
+        name, _, rest = field.partition(".")
+        if name not in item:
+            continue
+        if not rest:
+            result[name] = item[name]
+        elif isinstance(item[name], dict) and result.get(name) is not item[name]:
+            # Not selected as a whole already
+            nested = select_fields(item[name], [rest])
+            if nested:
+                result.setdefault(name, {}).update(nested)
+    return result
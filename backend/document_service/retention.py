@@ -0,0 +1,282 @@
+"""
+Version retention policies and background garbage collection of deleted blobs.
+"""
+import fcntl
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from common.metrics import metrics
+from common.models import SubscriptionTier
+from document_service.document_manager import DocumentManager
+
+
+class RetentionPolicy(NamedTuple):
+    """Versions of a document kept by retention; the latest version is always kept."""
+    keep_last: int
+    keep_daily_days: int
+
+    def select(self, versions: List[Dict[str, Any]], now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """
+        Select the versions to keep.
+
+        The newest ``keep_last`` versions are kept, plus the newest version of
+        each UTC day within the last ``keep_daily_days`` days.
+
+        Args:
+            versions: Versions of a document, oldest first
+            now: Optional reference time, defaults to the current time
+
+        Returns:
+            Versions to keep, oldest first
+        """
+        kept_ids = {version["version_id"] for version in versions[-self.keep_last:]} if self.keep_last > 0 else set()
+
+        cutoff = ((now or datetime.utcnow()) - timedelta(days=self.keep_daily_days)).isoformat()
+        newest_of_day: Dict[str, str] = {}
+        for version in versions:
+            if version["created_at"] >= cutoff:
+                newest_of_day[version["created_at"][:10]] = version["version_id"]
+        kept_ids.update(newest_of_day.values())
+
+        return [version for version in versions if version["version_id"] in kept_ids]
+
+
+# Retention per subscription tier
+TIER_RETENTION: Dict[SubscriptionTier, RetentionPolicy] = {
+    SubscriptionTier.FREE: RetentionPolicy(keep_last=5, keep_daily_days=7),
+    SubscriptionTier.BASIC: RetentionPolicy(keep_last=10, keep_daily_days=30),
+    SubscriptionTier.PREMIUM: RetentionPolicy(keep_last=25, keep_daily_days=90),
+    SubscriptionTier.ENTERPRISE: RetentionPolicy(keep_last=50, keep_daily_days=365),
+}
+
+
+class GarbageCollector:
+    """
+    Enforces version retention and removes the blobs of deleted documents and
+    pruned versions.
+
+    Deleting a document or pruning a version only moves its metadata to the
+    trash, so requests never wait on blob storage. A background pass later
+    removes the blobs in batches, using bulk deletes where the backend has
+    them. Deleted documents stay restorable for a grace period; pruned
+    versions are removed on the next pass. Blobs shared with other documents
+    are only removed by the pass that releases their last holder. Only one
+    process runs a pass at a time; the others skip it.
+    """
+
+    def __init__(
+        self,
+        manager: DocumentManager,
+        policies: Optional[Dict[SubscriptionTier, RetentionPolicy]] = None,
+        tier_of: Optional[Callable[[str], SubscriptionTier]] = None,
+        retention_enabled: bool = False,
+        grace_seconds: int = 7 * 24 * 60 * 60,
+        batch_size: int = 100,
+        interval_seconds: int = 15 * 60
+    ):
+        """
+        Initialize the garbage collector.
+
+        Args:
+            manager: Document manager whose trash is collected
+            policies: Optional retention per subscription tier, defaults to ``TIER_RETENTION``
+            tier_of: Optional function mapping a document owner to a tier
+            retention_enabled: Whether passes prune versions beyond the retention policy
+            grace_seconds: Time during which deleted documents can be restored
+            batch_size: Number of trash entries removed per storage call
+            interval_seconds: Interval between background passes
+        """
+        self.manager = manager
+        self.policies = dict(policies or TIER_RETENTION)
+        self.tier_of = tier_of or (lambda owner_id: SubscriptionTier.FREE)
+        self.retention_enabled = retention_enabled
+        self.grace_seconds = grace_seconds
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self._lock_path = os.path.join(manager.lock_dir, "gc.lock")
+        self._stop_event = threading.Event()
+        self._collector: Optional[threading.Thread] = None
+
+    @staticmethod
+    def parse_policies(config: Optional[str]) -> Dict[SubscriptionTier, RetentionPolicy]:
+        """
+        Build retention policies from a JSON configuration string.
+
+        The configuration maps tier names to policy fields, e.g.
+        ``{"free": {"keep_last": 3}, "enterprise": {"keep_daily_days": 730}}``.
+
+        Args:
+            config: Optional JSON configuration overriding the defaults
+
+        Returns:
+            Retention per subscription tier
+        """
+        policies = dict(TIER_RETENTION)
+        if config:
+            for tier, fields in json.loads(config).items():
+                tier = SubscriptionTier(tier)
+                policies[tier] = policies[tier]._replace(**fields)
+        return policies
+
+    def collect(self) -> Dict[str, int]:
+        """
+        Run one pass: enforce retention, then remove the blobs of the trash.
+
+        Returns:
+            Number of pruned versions, purged trash entries and reclaimed
+            bytes, or an empty dict if another process is running a pass
+        """
+        with open(self._lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return {}
+
+            try:
+                with metrics.timer("gc_pass_seconds", "Duration of garbage collection passes"):
+                    pruned = self.enforce_retention() if self.retention_enabled else 0
+                    purged, reclaimed = self.purge_trash()
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+        return {"pruned_versions": pruned, "purged_entries": purged, "reclaimed_bytes": reclaimed}
+
+    def enforce_retention(self) -> int:
+        """
+        Prune the versions of every document beyond its owner's retention policy.
+
+        Returns:
+            Number of pruned versions
+        """
+        now = datetime.utcnow()
+        pruned = 0
+        for metadata in self.manager.list_documents():
+            policy = self.policies[self.tier_of(metadata["owner_id"])]
+            if len(metadata["versions"]) <= max(policy.keep_last, 1):
+                continue
+
+            try:
+                removed = self.manager.prune_versions(metadata["id"], lambda versions: policy.select(versions, now))
+            except ValueError:
+                # Deleted since it was listed
+                continue
+            pruned += len(removed)
+
+        if pruned:
+            metrics.inc("gc_pruned_versions_total", pruned, "Versions removed by retention policies")
+        return pruned
+
+    def purge_trash(self) -> Tuple[int, int]:
+        """
+        Remove the blobs of trash entries that are due, in batches.
+
+        Returns:
+            Number of purged entries and reclaimed bytes
+        """
+        cutoff = (datetime.utcnow() - timedelta(seconds=self.grace_seconds)).isoformat()
+        due = []
+        pending_entries = 0
+        pending_bytes = 0
+        for entry in self.manager.iter_trash():
+            if entry["kind"] == "document" and not entry["purging"] and entry["deleted_at"] > cutoff:
+                pending_entries += 1
+                pending_bytes += entry["size"]
+                continue
+            due.append(entry["id"])
+
+        purged = 0
+        reclaimed = 0
+        for start in range(0, len(due), self.batch_size):
+            entries = [self.manager.claim_trash_entry(entry_id) for entry_id in due[start:start + self.batch_size]]
+            entries = [entry for entry in entries if entry]
+            reclaimed += self._purge_batch(entries)
+            purged += len(entries)
+
+        metrics.set_gauge("gc_trash_entries", pending_entries, "Deleted documents still restorable")
+        metrics.set_gauge("gc_trash_bytes", pending_bytes, "Size of deleted documents still restorable")
+        return purged, reclaimed
+
+    def _purge_batch(self, entries: List[Dict[str, Any]]) -> int:
+        backend = self.manager.backend
+        reclaimed = 0
+        retained = set()
+        for kind in ("document", "versions"):
+            keys = []
+            for entry in entries:
+                if entry["kind"] != kind:
+                    continue
+                candidates = list(entry["keys"])
+                for prefix in entry["prefixes"]:
+                    candidates.extend(backend.list_keys(prefix))
+                for key in candidates:
+                    # Blobs other documents still share, e.g. those of a
+                    # template with live instances, are kept
+                    if self.manager.release_blob(key, entry["document_id"]):
+                        keys.append(key)
+                    else:
+                        retained.add(entry["id"])
+                        metrics.inc("gc_shared_keys_kept_total", 1, "Storage keys kept because other documents share them", kind=kind)
+            if not keys:
+                continue
+
+            size = 0
+            for key in keys:
+                try:
+                    size += backend.size(key)
+                except (OSError, ValueError):
+                    # Already gone, e.g. removed by an interrupted earlier pass
+                    continue
+            backend.delete_keys(keys)
+
+            reclaimed += size
+            metrics.inc("gc_reclaimed_bytes_total", size, "Bytes freed by garbage collection", kind=kind)
+            metrics.inc("gc_deleted_keys_total", len(keys), "Storage keys removed by garbage collection", kind=kind)
+
+        archive_keys = [key for entry in entries for key in entry.get("archive_keys", [])]
+        if archive_keys and self.manager.archive:
+            size = 0
+            for key in archive_keys:
+                try:
+                    size += self.manager.archive.backend.size(key)
+                except (OSError, ValueError):
+                    continue
+            self.manager.archive.delete_keys(archive_keys)
+            reclaimed += size
+            metrics.inc("gc_reclaimed_bytes_total", size, "Bytes freed by garbage collection", kind="archive")
+            metrics.inc("gc_deleted_keys_total", len(archive_keys), "Storage keys removed by garbage collection", kind="archive")
+
+        for entry in entries:
+            if entry["id"] not in retained:
+                for prefix in entry["prefixes"]:
+                    # Removes what is left of the prefix, e.g. empty directories
+                    backend.delete_prefix(prefix)
+            self.manager.remove_trash_entry(entry["id"])
+        return reclaimed
+
+    def start(self) -> None:
+        """Start the background collector thread if it is not already running."""
+        if self._collector and self._collector.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._collector = threading.Thread(target=self._collect_loop, name="garbage-collector", daemon=True)
+        self._collector.start()
+
+    def stop(self) -> None:
+        """Stop the background collector thread."""
+        self._stop_event.set()
+        if self._collector:
+            self._collector.join(timeout=5)
+            self._collector = None
+
+    def _collect_loop(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.collect()
+            except Exception:
+                # Collection is best effort; try again on the next interval
+                pass
+            self._stop_event.wait(self.interval_seconds)
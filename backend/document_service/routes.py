@@ -1,43 +1,353 @@
 """
 FastAPI routes for the Document Management Service.
 """
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, BackgroundTasks, Query
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, BackgroundTasks, Query, Request, Header, WebSocket
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+import asyncio
 import os
 import tempfile
 import uuid
 import shutil
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, BinaryIO, Callable
 import json
+import math
+from pydantic import BaseModel, Field
 
 from document_service.document_manager import DocumentManager
-from common.models import APIResponse, AccessLevel
+from document_service.compare import diff_versions
+from document_service.enrichment import EnrichmentPipeline
+from document_service.uploads import UploadManager, UploadNotFound, UploadConflict, MAX_CHUNK_SIZE
+from document_service.retention import GarbageCollector
+from document_service.folders import FolderIndex, FolderNotFound, FolderConflict
+from document_service.events import EventLog
+from document_service.archive import ArchiveTier
+from document_service.tiering import ColdStorageTiering
+from document_service.fsck import StorageChecker, CheckInProgress
+from document_service.storage import create_storage_backend
+from document_service.responses import (
+    ZeroCopyFileResponse, FastJSONResponse, etag_matches, accepts_encoding, parse_fields, select_fields
+)
+from common.models import APIResponse, AccessLevel, Permission, SubscriptionTier
+from common.temp_workspace import TempWorkspaceManager
+from common.shared_cache import SharedMemoryCache
+from common.scheduler import FairScheduler, AdmissionRejected
+from pdf_service.sandbox import PDFSandbox
+from pdf_service.ocr import OCREngine
 
 router = APIRouter(prefix="/api/documents", tags=["Document Management"])
 
+
+# Models for batch requests
+class DocumentFilter(BaseModel):
+    owner_id: Optional[str] = None
+    folder_id: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    document_ids: Optional[List[str]] = Field(None, description="Documents to operate on")
+    filter: Optional[DocumentFilter] = Field(None, description="Filter selecting the documents when no IDs are given")
+    user_id: Optional[str] = Field(None, description="Acting user whose permissions are checked")
+    atomic: bool = Field(False, description="Abort the whole batch if any item fails")
+
+class BatchMoveRequest(BatchRequest):
+    folder_id: Optional[str] = Field(None, description="Destination folder, or null for the root")
+
+class BatchPermissionsRequest(BatchRequest):
+    grant: List[Permission] = Field(default_factory=list, description="Permissions to add or replace")
+    revoke: List[str] = Field(default_factory=list, description="Users whose permissions are removed")
+
+# Model for resumable uploads
+class UploadCreateRequest(BaseModel):
+    size: int = Field(..., gt=0, description="Total size of the file in bytes")
+    owner_id: str = Field(..., description="Uploading user, and owner of a new document")
+    name: Optional[str] = Field(None, description="Name of the new document")
+    folder_id: Optional[str] = Field(None, description="Folder of the new document")
+    document_id: Optional[str] = Field(None, description="Document the upload becomes a new version of")
+    comment: Optional[str] = Field(None, description="Comment of the new version")
+    chunk_size: Optional[int] = Field(None, description="Size of every chunk but the last, in bytes")
+    sha256: Optional[str] = Field(None, description="SHA-256 of the whole file, verified on commit")
+
+# Models for folders
+class FolderCreateRequest(BaseModel):
+    name: str = Field(..., description="Name of the folder, unique among its siblings")
+    owner_id: str = Field(..., description="Owner of the folder")
+    parent_id: Optional[str] = Field(None, description="Parent folder, or null for the root")
+
+class FolderRenameRequest(BaseModel):
+    name: str = Field(..., description="New name of the folder")
+
+class FolderMoveRequest(BaseModel):
+    parent_id: Optional[str] = Field(None, description="New parent folder, or null for the root")
+
+# Model for text recognition
+class OCRRequest(BaseModel):
+    version_id: Optional[str] = Field(None, description="Version to recognize, defaults to the latest")
+    user_id: Optional[str] = Field(None, description="User the new version is attributed to")
+    text_layer: bool = Field(False, description="Save the text as an invisible layer in a new version")
+
+# Model for storage checks
+class StorageCheckRequest(BaseModel):
+    repair: bool = Field(False, description="Repair or quarantine what is found")
+    verify_hashes: bool = Field(False, description="Check the SHA-256 of every version file")
+    rebuild_index: bool = Field(False, description="Rebuild the folder index from the metadata afterwards")
+    resume: bool = Field(False, description="Continue an interrupted check with its options")
+
+# Model for creating documents from templates
+class InstantiateRequest(BaseModel):
+    name: str = Field(..., description="Name of the new document")
+    owner_id: str = Field(..., description="Owner of the new document")
+    folder_id: Optional[str] = Field(None, description="Folder of the new document")
+
 # Initialize document manager
 STORAGE_DIR = os.path.join(tempfile.gettempdir(), "pdf_editor_storage")
-document_manager = DocumentManager(STORAGE_DIR)
+STORAGE_BACKEND = os.environ.get("PDF_EDITOR_STORAGE_BACKEND", "local")
+
+# Optional cache shared by all workers forked from this process; 0 disables it
+SHARED_CACHE_MB = int(os.environ.get("PDF_EDITOR_SHARED_CACHE_MB", "0"))
+shared_cache = SharedMemoryCache(SHARED_CACHE_MB * 1024 * 1024) if SHARED_CACHE_MB > 0 else None
+
+# Versions older than a threshold can be compressed into an archive tier, a
+# local directory (ideally on a separate, cheaper mount) or an S3 bucket, and
+# are restored on read into a bounded cache on the fast disk
+ARCHIVE_BACKEND = os.environ.get("PDF_EDITOR_ARCHIVE_BACKEND", "")
+ARCHIVE_DIR = os.environ.get("PDF_EDITOR_ARCHIVE_DIR", os.path.join(STORAGE_DIR, "archive"))
+ARCHIVE_AFTER_DAYS = float(os.environ.get("PDF_EDITOR_ARCHIVE_AFTER_DAYS", "30"))
+RESTORE_CACHE_BYTES = int(os.environ.get("PDF_EDITOR_RESTORE_CACHE_MB", "256")) * 1024 * 1024
+TIERING_INTERVAL_SECONDS = int(os.environ.get("PDF_EDITOR_TIERING_INTERVAL_MINUTES", "60")) * 60
+archive_tier = ArchiveTier(
+    create_storage_backend(
+        ARCHIVE_BACKEND,
+        ARCHIVE_DIR,
+        bucket=os.environ.get("PDF_EDITOR_ARCHIVE_BUCKET"),
+        endpoint_url=os.environ.get("PDF_EDITOR_ARCHIVE_ENDPOINT")
+    ),
+    os.path.join(STORAGE_DIR, "restore_cache"),
+    cache_bytes=RESTORE_CACHE_BYTES,
+    codec=os.environ.get("PDF_EDITOR_ARCHIVE_CODEC") or None
+) if ARCHIVE_BACKEND else None
+
+document_manager = DocumentManager(
+    STORAGE_DIR,
+    backend=create_storage_backend(
+        STORAGE_BACKEND,
+        STORAGE_DIR,
+        bucket=os.environ.get("PDF_EDITOR_S3_BUCKET"),
+        endpoint_url=os.environ.get("PDF_EDITOR_S3_ENDPOINT")
+    ),
+    precompress=os.environ.get("PDF_EDITOR_PRECOMPRESS_DOWNLOADS", "false").lower() == "true",
+    shared_cache=shared_cache,
+    archive=archive_tier
+)
+tiering = ColdStorageTiering(
+    document_manager,
+    min_age_days=ARCHIVE_AFTER_DAYS,
+    interval_seconds=TIERING_INTERVAL_SECONDS
+) if archive_tier else None
+
+# Folders and the documents in them are indexed for recursive queries
+folder_index = FolderIndex(document_manager)
+
+# Metadata and blobs are checked against each other on request, one shard per
+# thread; the progress is shared by every worker through the storage
+FSCK_WORKERS = int(os.environ.get("PDF_EDITOR_FSCK_WORKERS", "16"))
+storage_checker = StorageChecker(document_manager, folder_index, workers=FSCK_WORKERS)
+
+# Document changes are recorded in a log shared by every worker and streamed
+# to clients, who resume from the last event they saw after a reconnect
+EVENT_SEGMENT_BYTES = int(os.environ.get("PDF_EDITOR_EVENT_SEGMENT_MB", "4")) * 1024 * 1024
+EVENT_RETAINED_SEGMENTS = int(os.environ.get("PDF_EDITOR_EVENT_SEGMENTS", "8"))
+EVENT_HEARTBEAT_SECONDS = float(os.environ.get("PDF_EDITOR_EVENT_HEARTBEAT_SECONDS", "15"))
+event_log = EventLog(
+    os.path.join(document_manager.metadata_dir, ".events"),
+    segment_bytes=EVENT_SEGMENT_BYTES,
+    retained_segments=EVENT_RETAINED_SEGMENTS
+)
+document_manager.add_event_listener(event_log.record)
+
+# PDF operations on uploaded files run in resource-limited processes. Limits
+# per tier and operation can be overridden with a JSON document
+pdf_sandbox = PDFSandbox.from_config(
+    os.environ.get("PDF_EDITOR_SANDBOX", "true").lower() == "true",
+    os.environ.get("PDF_EDITOR_SANDBOX_LIMITS")
+)
+
+# PDF work is scheduled fairly across document owners, weighted by their
+# subscription tier. Tiers are assigned per user ID until users are stored;
+# everyone else gets the default tier
+DEFAULT_TIER = SubscriptionTier(os.environ.get("PDF_EDITOR_DEFAULT_TIER", "free"))
+SCHEDULER_SLOTS = int(os.environ.get("PDF_EDITOR_SCHEDULER_SLOTS", str(os.cpu_count() or 2)))
+scheduler = FairScheduler.from_config(
+    SCHEDULER_SLOTS,
+    os.environ.get("PDF_EDITOR_TIER_POLICIES"),
+    os.environ.get("PDF_EDITOR_TENANT_TIERS"),
+    DEFAULT_TIER
+)
+
+# Pages without a text layer can be recognized with Tesseract, in a pool of
+# processes. Results are cached by page fingerprint in the storage backend
+OCR_ENABLED = os.environ.get("PDF_EDITOR_OCR", "false").lower() == "true"
+ocr_engine = OCREngine(
+    document_manager.backend,
+    workers=int(os.environ.get("PDF_EDITOR_OCR_WORKERS", str(os.cpu_count() or 2))),
+    language=os.environ.get("PDF_EDITOR_OCR_LANGUAGE", "eng"),
+    dpi=int(os.environ.get("PDF_EDITOR_OCR_DPI", "300")),
+    tesseract_cmd=os.environ.get("PDF_EDITOR_TESSERACT_CMD", "tesseract")
+)
+
+# Page count, document info, text, form schema, thumbnails and fingerprints are
+# derived in the background so uploads return as soon as the file is stored
+ENRICHMENT_WORKERS = int(os.environ.get("PDF_EDITOR_ENRICHMENT_WORKERS", "2"))
+enrichment = EnrichmentPipeline(
+    document_manager,
+    workers=ENRICHMENT_WORKERS,
+    sandbox=pdf_sandbox,
+    tier=DEFAULT_TIER,
+    scheduler=scheduler,
+    ocr=ocr_engine if OCR_ENABLED else None
+)
+
+# Large files can be uploaded in resumable chunks and committed without a copy
+UPLOAD_MAX_BYTES = int(os.environ.get("PDF_EDITOR_UPLOAD_MAX_MB", "4096")) * 1024 * 1024
+UPLOAD_TTL_SECONDS = int(os.environ.get("PDF_EDITOR_UPLOAD_TTL_HOURS", "24")) * 60 * 60
+upload_manager = UploadManager(document_manager, max_size=UPLOAD_MAX_BYTES, ttl_seconds=UPLOAD_TTL_SECONDS)
+
+# Deleted documents stay restorable for a grace period before the garbage
+# collector removes their blobs. Pruning versions by retention policy is opt-in;
+# policies per tier can be overridden with a JSON document
+TRASH_RETENTION_SECONDS = int(os.environ.get("PDF_EDITOR_TRASH_RETENTION_HOURS", "168")) * 60 * 60
+GC_INTERVAL_SECONDS = int(os.environ.get("PDF_EDITOR_GC_INTERVAL_MINUTES", "15")) * 60
+garbage_collector = GarbageCollector(
+    document_manager,
+    policies=GarbageCollector.parse_policies(os.environ.get("PDF_EDITOR_RETENTION_POLICIES")),
+    tier_of=scheduler.tier_of,
+    retention_enabled=os.environ.get("PDF_EDITOR_RETENTION_ENABLED", "false").lower() == "true",
+    grace_seconds=TRASH_RETENTION_SECONDS,
+    interval_seconds=GC_INTERVAL_SECONDS
+)
 
-# Temporary storage for uploaded files
+# Caching policy for downloads
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+# Metadata responses are gzip-compressed for clients that accept it
+COMPRESS_RESPONSES = os.environ.get("PDF_EDITOR_COMPRESS_RESPONSES", "true").lower() == "true"
+
+# Fields left out of document listings unless selected with ?fields=
+LISTING_OMITTED_FIELDS = ("versions", "permissions")
+
+# Temporary storage for uploaded files and processing outputs
 TEMP_DIR = os.path.join(tempfile.gettempdir(), "pdf_editor")
-os.makedirs(TEMP_DIR, exist_ok=True)
+TEMP_QUOTA_BYTES = int(os.environ.get("PDF_EDITOR_TEMP_QUOTA_MB", "512")) * 1024 * 1024
+TEMP_SPOOL_THRESHOLD = int(os.environ.get("PDF_EDITOR_TEMP_SPOOL_MB", "8")) * 1024 * 1024
+temp_workspaces = TempWorkspaceManager(
+    TEMP_DIR,
+    quota_bytes=TEMP_QUOTA_BYTES,
+    spool_threshold=TEMP_SPOOL_THRESHOLD
+)
+
+
+@router.on_event("startup")
+async def start_temp_sweeper():
+    """Remove workspaces orphaned by crashed workers and keep sweeping in the background."""
+    temp_workspaces.sweep()
+    temp_workspaces.start_sweeper()
+
+
+@router.on_event("shutdown")
+async def stop_temp_sweeper():
+    """Stop the background temp sweeper."""
+    temp_workspaces.stop_sweeper()
+
+
+@router.on_event("startup")
+async def start_upload_sweeper():
+    """Remove expired upload sessions and keep sweeping in the background."""
+    upload_manager.start_sweeper()
+
+
+@router.on_event("shutdown")
+async def stop_upload_sweeper():
+    """Stop the background upload sweeper."""
+    upload_manager.stop_sweeper()
+
+
+@router.on_event("startup")
+async def start_garbage_collector():
+    """Start enforcing retention and removing the blobs of deleted documents in the background."""
+    garbage_collector.start()
+
+
+@router.on_event("shutdown")
+async def stop_garbage_collector():
+    """Stop the background garbage collector."""
+    garbage_collector.stop()
+
+
+@router.on_event("startup")
+async def start_tiering():
+    """Start moving old versions to the archive tier in the background, if one is configured."""
+    if tiering:
+        tiering.start()
+
+
+@router.on_event("shutdown")
+async def stop_tiering():
+    """Stop the background tiering."""
+    if tiering:
+        tiering.stop()
+
+
+@router.on_event("startup")
+async def start_enrichment():
+    """Start enriching new versions and resume versions left pending by a restart."""
+    enrichment.start()
+
+
+@router.on_event("shutdown")
+async def stop_enrichment():
+    """Stop the enrichment workers."""
+    enrichment.stop()
+    scheduler.close()
+    ocr_engine.close()
 
 
-def save_upload_file_temp(upload_file: UploadFile) -> str:
-    """Save an upload file to a temporary location."""
+def rejection_error(e: AdmissionRejected) -> HTTPException:
+    """
+    Convert an admission rejection into a 429 response.
+
+    Args:
+        e: The rejection
+
+    Returns:
+        HTTP exception carrying the structured error and a Retry-After header
+    """
+    return HTTPException(
+        status_code=429,
+        detail=e.to_dict(),
+        headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+    )
+
+
+def enforce_rate_limit(tenant_id: str) -> None:
+    """
+    Count a request against a tenant's rate limit.
+
+    Args:
+        tenant_id: ID of the user the request is billed to
+
+    Raises:
+        HTTPException: 429 if the tenant exceeded its request rate
+    """
     try:
-        # Create a unique filename
-        filename = f"{uuid.uuid4()}_{upload_file.filename}"
-        temp_file = os.path.join(TEMP_DIR, filename)
-        
-        # Save the file
-        with open(temp_file, "wb") as buffer:
-            shutil.copyfileobj(upload_file.file, buffer)
-            
-        return temp_file
-    finally:
-        upload_file.file.close()
+        scheduler.check_rate(tenant_id)
+    except AdmissionRejected as e:
+        raise rejection_error(e)
+
+
+def store_upload(file: UploadFile, store: Callable[[BinaryIO], Any]) -> Any:
+    """Copy an upload into a workspace and pass it to a function storing it."""
+    with temp_workspaces.workspace() as workspace:
+        return store(workspace.save_upload(file))
 
 
 @router.post("", response_model=APIResponse)
@@ -50,17 +360,15 @@ async def create_document(
     """
     Create a new document from an uploaded file.
     """
+    enforce_rate_limit(owner_id)
     try:
-        temp_file = save_upload_file_temp(file)
-        
-        # Create document
-        document_id = document_manager.create_document(temp_file, name, owner_id, folder_id)
-        
-        # Clean up the temporary file
-        os.unlink(temp_file)
+        # Copying and storing the upload blocks, keep it off the event loop
+        document_id = await run_in_threadpool(
+            store_upload, file, lambda upload: document_manager.create_document(upload, name, owner_id, folder_id)
+        )
         
         # Get the created document
-        document = document_manager.get_document(document_id)
+        document = await run_in_threadpool(document_manager.get_document, document_id)
         
         return APIResponse(
             success=True,
@@ -75,42 +383,545 @@ async def create_document(
         )
 
 
+def _json_response(request: Request, message: str, data: Any) -> FastJSONResponse:
+    """Build a successful API response serialized on the fast path."""
+    return FastJSONResponse(
+        {"success": True, "message": message, "data": data, "errors": None},
+        accept_encoding=request.headers.get("accept-encoding") if COMPRESS_RESPONSES else None
+    )
+
+
+def _document_view(document: Dict[str, Any], fields: Optional[List[str]], listing: bool = False) -> Dict[str, Any]:
+    """
+    Shape document metadata for a response.
+    
+    Args:
+        document: Document metadata
+        fields: Optional selected field paths
+        listing: Whether the document is part of a listing, which leaves out
+            the version and permission lists unless they are selected
+        
+    Returns:
+        The document as returned to the client
+    """
+    if fields:
+        return select_fields({**document, "version_count": len(document["versions"])}, fields)
+    if listing:
+        view = {key: value for key, value in document.items() if key not in LISTING_OMITTED_FIELDS}
+        view["version_count"] = len(document["versions"])
+        return view
+    return document
+
+
 @router.get("", response_model=APIResponse)
 async def list_documents(
+    request: Request,
     owner_id: Optional[str] = Query(None),
-    folder_id: Optional[str] = Query(None)
+    folder_id: Optional[str] = Query(None),
+    recursive: bool = Query(False, description="Include the documents of every subfolder"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. id,name,metadata.page_count")
 ):
     """
     List documents, optionally filtered by owner or folder.
+    
+    Folder listings are served from the folder index, recursively with
+    ``recursive``. Versions and permissions are left out unless selected
+    with ``fields``; each document reports its ``version_count`` instead.
+    """
+    try:
+        if folder_id:
+            document_ids = folder_index.document_ids(folder_id, recursive, owner_id)
+            documents = await run_in_threadpool(document_manager.get_documents, document_ids)
+        else:
+            documents = document_manager.list_documents(owner_id)
+        selected = parse_fields(fields)
+        
+        return _json_response(
+            request,
+            "Documents retrieved successfully",
+            [_document_view(document, selected, listing=True) for document in documents]
+        )
+    except Exception as e:
+        return APIResponse(
+            success=False,
+            message=f"Error listing documents: {str(e)}",
+            errors=[{"detail": str(e)}]
+        )
+
+
+def _select_batch(request: BatchRequest) -> List[str]:
+    """Resolve the documents targeted by a batch request."""
+    selection = request.filter or DocumentFilter()
+    return document_manager.select_documents(request.document_ids, selection.owner_id, selection.folder_id)
+
+
+def _batch_response(operation: str, results: List[Dict[str, Any]]) -> APIResponse:
+    """Build the response for a batch operation from its per-item results."""
+    failed = sum(1 for result in results if not result["success"])
+    return APIResponse(
+        success=failed == 0,
+        message=f"Batch {operation}: {len(results) - failed} succeeded, {failed} failed",
+        data={
+            "results": results,
+            "succeeded": len(results) - failed,
+            "failed": failed
+        },
+        errors=[{"document_id": result["document_id"], "detail": result["error"]} for result in results if not result["success"]] or None
+    )
+
+
+@router.post("/batch/delete", response_model=APIResponse)
+async def batch_delete_documents(request: BatchRequest):
+    """
+    Delete many documents in one request.
+    """
+    try:
+        results = await run_in_threadpool(
+            document_manager.batch_delete, _select_batch(request), request.user_id, request.atomic
+        )
+        return _batch_response("delete", results)
+    except Exception as e:
+        return APIResponse(
+            success=False,
+            message=f"Error deleting documents: {str(e)}",
+            errors=[{"detail": str(e)}]
+        )
+
+
+@router.post("/batch/move", response_model=APIResponse)
+async def batch_move_documents(request: BatchMoveRequest):
+    """
+    Move many documents into a folder in one request.
+    """
+    try:
+        results = await run_in_threadpool(
+            document_manager.batch_move, _select_batch(request), request.folder_id, request.user_id, request.atomic
+        )
+        return _batch_response("move", results)
+    except Exception as e:
+        return APIResponse(
+            success=False,
+            message=f"Error moving documents: {str(e)}",
+            errors=[{"detail": str(e)}]
+        )
+
+
+@router.post("/batch/permissions", response_model=APIResponse)
+async def batch_update_document_permissions(request: BatchPermissionsRequest):
+    """
+    Grant and revoke permissions on many documents in one request.
+    """
+    try:
+        results = await run_in_threadpool(
+            document_manager.batch_update_permissions,
+            _select_batch(request),
+            [permission.model_dump() for permission in request.grant],
+            request.revoke,
+            request.user_id,
+            request.atomic
+        )
+        return _batch_response("permission update", results)
+    except Exception as e:
+        return APIResponse(
+            success=False,
+            message=f"Error updating document permissions: {str(e)}",
+            errors=[{"detail": str(e)}]
+        )
+
+
+def _upload_error(e: ValueError) -> HTTPException:
+    """Map an upload error to its HTTP status."""
+    if isinstance(e, UploadNotFound):
+        return HTTPException(status_code=404, detail=str(e))
+    if isinstance(e, UploadConflict):
+        return HTTPException(status_code=409, detail=str(e))
+    return HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/uploads", response_model=APIResponse)
+async def create_upload(
+    request: UploadCreateRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """
+    Start a resumable upload of a new document or a new version.
+    
+    Retrying with the same ``Idempotency-Key`` header returns the session
+    created by the first attempt.
+    """
+    enforce_rate_limit(request.owner_id)
+    try:
+        session = await run_in_threadpool(
+            upload_manager.create_session,
+            request.size,
+            request.owner_id,
+            name=request.name,
+            folder_id=request.folder_id,
+            document_id=request.document_id,
+            comment=request.comment,
+            chunk_size=request.chunk_size,
+            sha256=request.sha256,
+            idempotency_key=idempotency_key
+        )
+        
+        return APIResponse(
+            success=True,
+            message="Upload created successfully",
+            data=session
+        )
+    except ValueError as e:
+        raise _upload_error(e)
+
+
+@router.get("/uploads/{session_id}", response_model=APIResponse)
+async def get_upload(session_id: str):
+    """
+    Get the progress of an upload: the contiguous offset and the missing chunks.
+    """
+    try:
+        session = await run_in_threadpool(upload_manager.status, session_id)
+        
+        return APIResponse(
+            success=True,
+            message="Upload retrieved successfully",
+            data=session
+        )
+    except ValueError as e:
+        raise _upload_error(e)
+
+
+@router.put("/uploads/{session_id}/chunks/{index}", response_model=APIResponse)
+async def upload_chunk(
+    request: Request,
+    session_id: str,
+    index: int,
+    chunk_sha256: str = Header(..., alias="X-Chunk-SHA256", description="SHA-256 of the chunk")
+):
+    """
+    Upload one chunk of a resumable upload as the raw request body.
+    
+    Chunks may be sent in any order and in parallel. Resending a chunk that
+    was already stored is a no-op.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=413, detail=f"Chunks may be at most {MAX_CHUNK_SIZE} bytes")
+    
+    try:
+        data = await request.body()
+        chunk = await run_in_threadpool(upload_manager.write_chunk, session_id, index, data, chunk_sha256)
+        
+        return APIResponse(
+            success=True,
+            message="Chunk stored successfully",
+            data=chunk
+        )
+    except ValueError as e:
+        raise _upload_error(e)
+
+
+@router.post("/uploads/{session_id}/commit", response_model=APIResponse)
+async def commit_upload(session_id: str):
+    """
+    Commit a complete upload as a new document or version.
+    
+    Committing again returns the result of the first commit.
+    """
+    try:
+        result = await run_in_threadpool(upload_manager.commit, session_id)
+        document = document_manager.get_document(result["document_id"])
+        
+        return APIResponse(
+            success=True,
+            message="Upload committed successfully",
+            data={
+                "document": document,
+                "version_id": result["version_id"]
+            }
+        )
+    except ValueError as e:
+        raise _upload_error(e)
+
+
+@router.delete("/uploads/{session_id}", response_model=APIResponse)
+async def abort_upload(session_id: str):
+    """
+    Abort an upload and release its disk space.
+    """
+    try:
+        await run_in_threadpool(upload_manager.abort, session_id)
+        
+        return APIResponse(
+            success=True,
+            message="Upload aborted successfully"
+        )
+    except ValueError as e:
+        raise _upload_error(e)
+
+
+@router.get("/events", response_model=None)
+async def stream_events(
+    request: Request,
+    user_id: str,
+    cursor: Optional[int] = Query(None, ge=0, description="Sequence number of the last event seen")
+):
+    """
+    Stream changes to the documents a user can view as Server-Sent Events.
+    
+    Each event has its sequence number as event ID, so a reconnecting client
+    resumes where it left off through the ``Last-Event-ID`` header or
+    ``cursor``. Without either, only new changes are sent. A ``reset`` event
+    means changes were missed and the client should reload its documents.
+    Comments are sent as keep-alives while nothing changes.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        cursor = int(last_event_id)
+    
+    async def events():
+        async for event in event_log.subscribe(user_id, cursor, EVENT_HEARTBEAT_SECONDS):
+            if event is None:
+                yield b": keep-alive\n\n"
+            else:
+                yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8")
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.websocket("/events/ws")
+async def stream_events_websocket(websocket: WebSocket, user_id: str, cursor: Optional[int] = None):
+    """
+    Stream changes to the documents a user can view over a WebSocket.
+    
+    Sends the same events as ``GET /events`` as JSON messages, with
+    ``{"type": "heartbeat"}`` messages while nothing changes. Messages from
+    the client are ignored.
+    """
+    await websocket.accept()
+    
+    async def send_events():
+        async for event in event_log.subscribe(user_id, cursor, EVENT_HEARTBEAT_SECONDS):
+            await websocket.send_json(event or {"type": "heartbeat"})
+    
+    async def wait_for_disconnect():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    
+    tasks = [asyncio.ensure_future(send_events()), asyncio.ensure_future(wait_for_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@router.post("/admin/fsck", response_model=APIResponse)
+async def start_storage_check(request: StorageCheckRequest):
+    """
+    Start checking the storage for inconsistencies in the background.
+    
+    Poll ``GET /admin/fsck`` for progress. With ``resume``, an interrupted
+    check continues from the shards it had not finished.
     """
     try:
-        documents = document_manager.list_documents(owner_id, folder_id)
+        storage_checker.start(request.repair, request.verify_hashes, request.rebuild_index, request.resume)
         
         return APIResponse(
             success=True,
-            message="Documents retrieved successfully",
-            data=documents
+            message="Storage check started",
+            data=request.model_dump()
         )
+    except CheckInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         return APIResponse(
             success=False,
-            message=f"Error listing documents: {str(e)}",
+            message=f"Error starting storage check: {str(e)}",
+            errors=[{"detail": str(e)}]
+        )
+
+
+@router.get("/admin/fsck", response_model=APIResponse)
+async def get_storage_check():
+    """
+    Get the progress of the current or last storage check.
+    """
+    try:
+        status = storage_checker.status()
+        if status is None:
+            raise HTTPException(status_code=404, detail="The storage has not been checked yet")
+        
+        return APIResponse(
+            success=True,
+            message="Storage check retrieved successfully",
+            data=status
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        return APIResponse(
+            success=False,
+            message=f"Error retrieving storage check: {str(e)}",
             errors=[{"detail": str(e)}]
         )
 
 
+def _folder_error(e: ValueError) -> HTTPException:
+    """Map a folder error to its HTTP status."""
+    if isinstance(e, FolderNotFound):
+        return HTTPException(status_code=404, detail=str(e))
+    if isinstance(e, FolderConflict):
+        return HTTPException(status_code=409, detail=str(e))
+    return HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/folders", response_model=APIResponse)
+async def create_folder(request: FolderCreateRequest):
+    """
+    Create a folder.
+    """
+    try:
+        folder = await run_in_threadpool(folder_index.create_folder, request.name, request.owner_id, request.parent_id)
+        
+        return APIResponse(
+            success=True,
+            message="Folder created successfully",
+            data=folder
+        )
+    except ValueError as e:
+        raise _folder_error(e)
+
+
+@router.get("/folders", response_model=APIResponse)
+async def list_folders(
+    owner_id: str = Query(...),
+    parent_id: Optional[str] = Query(None, description="Parent folder, defaults to the root"),
+    recursive: bool = Query(False, description="List the whole subtree instead of the direct children")
+):
+    """
+    List the subfolders of a folder, with the document totals of each subtree.
+    """
+    try:
+        folders = folder_index.list_folders(owner_id, parent_id, recursive)
+        
+        return APIResponse(
+            success=True,
+            message="Folders retrieved successfully",
+            data=folders
+        )
+    except ValueError as e:
+        raise _folder_error(e)
+
+
+@router.get("/folders/by-path", response_model=APIResponse)
+async def get_folder_by_path(
+    owner_id: str = Query(...),
+    path: str = Query(..., description="Folder names separated by slashes, e.g. /Clients/Acme")
+):
+    """
+    Find a folder by its path of names.
+    """
+    try:
+        folder = folder_index.resolve_path(owner_id, path)
+        
+        return APIResponse(
+            success=True,
+            message="Folder retrieved successfully",
+            data=folder
+        )
+    except ValueError as e:
+        raise _folder_error(e)
+
+
+@router.get("/folders/{folder_id}", response_model=APIResponse)
+async def get_folder(folder_id: str):
+    """
+    Get a folder with its path and the document count, size and page count of its subtree.
+    """
+    try:
+        folder = folder_index.get_folder(folder_id)
+        
+        return APIResponse(
+            success=True,
+            message="Folder retrieved successfully",
+            data=folder
+        )
+    except ValueError as e:
+        raise _folder_error(e)
+
+
+@router.put("/folders/{folder_id}", response_model=APIResponse)
+async def rename_folder(folder_id: str, request: FolderRenameRequest):
+    """
+    Rename a folder.
+    """
+    try:
+        folder = await run_in_threadpool(folder_index.rename_folder, folder_id, request.name)
+        
+        return APIResponse(
+            success=True,
+            message="Folder renamed successfully",
+            data=folder
+        )
+    except ValueError as e:
+        raise _folder_error(e)
+
+
+@router.post("/folders/{folder_id}/move", response_model=APIResponse)
+async def move_folder(folder_id: str, request: FolderMoveRequest):
+    """
+    Move a folder and everything below it under another parent.
+    
+    Only the folder index changes; no document is rewritten.
+    """
+    try:
+        folder = await run_in_threadpool(folder_index.move_folder, folder_id, request.parent_id)
+        
+        return APIResponse(
+            success=True,
+            message="Folder moved successfully",
+            data=folder
+        )
+    except ValueError as e:
+        raise _folder_error(e)
+
+
+@router.delete("/folders/{folder_id}", response_model=APIResponse)
+async def delete_folder(folder_id: str):
+    """
+    Delete an empty folder.
+    """
+    try:
+        await run_in_threadpool(folder_index.delete_folder, folder_id)
+        
+        return APIResponse(
+            success=True,
+            message="Folder deleted successfully"
+        )
+    except ValueError as e:
+        raise _folder_error(e)
+
+
 @router.get("/{document_id}", response_model=APIResponse)
-async def get_document(document_id: str):
+async def get_document(
+    request: Request,
+    document_id: str,
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. id,name,versions")
+):
     """
     Get document metadata by ID.
     """
     try:
         document = document_manager.get_document(document_id)
         
-        return APIResponse(
-            success=True,
-            message="Document retrieved successfully",
-            data=document
+        return _json_response(
+            request,
+            "Document retrieved successfully",
+            _document_view(document, parse_fields(fields))
         )
     except Exception as e:
         return APIResponse(
@@ -129,7 +940,7 @@ async def update_document(
     Update document metadata.
     """
     try:
-        updated_document = document_manager.update_document(document_id, updates)
+        updated_document = await run_in_threadpool(document_manager.update_document, document_id, updates)
         
         return APIResponse(
             success=True,
@@ -148,9 +959,11 @@ async def update_document(
 async def delete_document(document_id: str):
     """
     Delete a document.
+    
+    The document can be restored until the trash retention period has passed.
     """
     try:
-        document_manager.delete_document(document_id)
+        await run_in_threadpool(document_manager.delete_document, document_id)
         
         return APIResponse(
             success=True,
@@ -164,29 +977,177 @@ async def delete_document(document_id: str):
         )
 
 
+@router.post("/{document_id}/restore", response_model=APIResponse)
+async def restore_document(document_id: str):
+    """
+    Restore a deleted document whose blobs have not been removed yet.
+    """
+    try:
+        document = await run_in_threadpool(document_manager.restore_document, document_id)
+        
+        return APIResponse(
+            success=True,
+            message="Document restored successfully",
+            data=document
+        )
+    except Exception as e:
+        return APIResponse(
+            success=False,
+            message=f"Error restoring document: {str(e)}",
+            errors=[{"detail": str(e)}]
+        )
+
+
+@router.post("/{template_id}/instantiate", response_model=APIResponse)
+async def instantiate_template(template_id: str, request: InstantiateRequest):
+    """
+    Create a new document from a template.
+    
+    The new document shares the template's file, form schema and thumbnail
+    until it is edited, so this takes constant time and no extra storage.
+    """
+    enforce_rate_limit(request.owner_id)
+    try:
+        document_id = await run_in_threadpool(
+            document_manager.instantiate_template,
+            template_id,
+            request.name,
+            request.owner_id,
+            request.folder_id
+        )
+        document = await run_in_threadpool(document_manager.get_document, document_id)
+        
+        return APIResponse(
+            success=True,
+            message="Document created from template successfully",
+            data=document
+        )
+    except Exception as e:
+        return APIResponse(
+            success=False,
+            message=f"Error creating document from template: {str(e)}",
+            errors=[{"detail": str(e)}]
+        )
+
+
+def _recognize_version(
+    document: Dict[str, Any],
+    version: Dict[str, Any],
+    version_path: str,
+    request: OCRRequest,
+    tier: SubscriptionTier
+) -> Dict[str, Any]:
+    """Recognize the pages of a version without a text layer, optionally saving a text layer."""
+    text = pdf_sandbox.run("extract_text", version_path, tier=tier)
+    fingerprints = document_manager.get_page_fingerprints(document["id"], version["version_id"])
+    recognized = ocr_engine.recognize_missing(version_path, text, fingerprints)
+    
+    result = {
+        "version_id": version["version_id"],
+        "ocr_pages": sorted(recognized),
+        "pages": {str(page): recognized[page]["text"] if page in recognized else content for page, content in text.items()},
+        "new_version_id": None
+    }
+    if request.text_layer and recognized:
+        with temp_workspaces.workspace() as workspace:
+            output_path = workspace.path(suffix=".pdf")
+            pdf_sandbox.run("add_text_layer", version_path, recognized, output_path, tier=tier)
+            workspace.account(output_path)
+            result["new_version_id"] = document_manager.add_document_version(
+                document["id"],
+                output_path,
+                request.user_id or document["owner_id"],
+                comment="OCR text layer",
+                move=True
+            )
+    return result
+
+
+@router.post("/{document_id}/ocr", response_model=APIResponse)
+async def recognize_document(document_id: str, request: OCRRequest):
+    """
+    Recognize the text of pages without a text layer.
+    
+    Pages recognized before, in this or any other version, are not processed
+    again. With ``text_layer`` the text is also written into the PDF as an
+    invisible, selectable layer and saved as a new version.
+    """
+    try:
+        document, version, version_path = await run_in_threadpool(document_manager.resolve_version, document_id, request.version_id)
+        enforce_rate_limit(document["owner_id"])
+        
+        async with scheduler.aslot(document["owner_id"], document["metadata"].get("page_count") or 1) as tier:
+            result = await run_in_threadpool(_recognize_version, document, version, version_path, request, tier)
+        
+        return APIResponse(
+            success=True,
+            message="Document text recognized successfully",
+            data=result
+        )
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise rejection_error(e)
+    except ImportError as e:
+        return APIResponse(
+            success=False,
+            message="Text recognition is not available",
+            errors=[{"detail": str(e)}]
+        )
+    except Exception as e:
+        return APIResponse(
+            success=False,
+            message=f"Error recognizing document text: {str(e)}",
+            errors=[{"detail": str(e)}]
+        )
+
+
 @router.get("/{document_id}/download", response_model=None)
 async def download_document(
-    background_tasks: BackgroundTasks,
+    request: Request,
     document_id: str,
     version_id: Optional[str] = Query(None)
 ):
     """
     Download a document, optionally specifying a version.
+    
+    Versions are immutable, so the ETag is derived from the version content hash.
+    Version-pinned URLs may be cached forever; the latest-version URL must be
+    revalidated, which costs a single metadata read and a 304 when unchanged.
     """
     try:
-        # Get document metadata
-        document = document_manager.get_document(document_id)
+        # Resolve the document and version with a single metadata read; archived
+        # versions are restored first, which may take a while
+        document, version, file_path = await run_in_threadpool(document_manager.resolve_version, document_id, version_id)
         
-        # Get the file path
-        if version_id:
-            file_path = document_manager.get_document_version(document_id, version_id)
-        else:
-            file_path = document_manager.get_latest_version(document_id)
+        # Pick a pre-compressed representation when the client accepts it
+        content_encoding = None
+        if accepts_encoding(request.headers.get("accept-encoding"), "gzip"):
+            encoded_path = await run_in_threadpool(document_manager.get_encoded_version_path, version, "gzip")
+            if encoded_path:
+                file_path = encoded_path
+                content_encoding = "gzip"
+        
+        version_tag = version.get("sha256") or version["version_id"]
+        etag = f'"{version_tag}-{content_encoding}"' if content_encoding else f'"{version_tag}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if version_id else REVALIDATE_CACHE_CONTROL,
+            "Vary": "Accept-Encoding"
+        }
+        
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
         
-        return FileResponse(
+        return ZeroCopyFileResponse(
             file_path,
             filename=f"{document['name']}.pdf",
-            media_type="application/pdf"
+            media_type="application/pdf",
+            headers=headers,
+            method=request.method
         )
     except Exception as e:
         return APIResponse(
@@ -196,6 +1157,55 @@ async def download_document(
         )
 
 
+def _read_thumbnail(storage_key: str) -> bytes:
+    """Read a thumbnail, keeping it in the cache shared by all workers since thumbnails are small and hot."""
+    content = shared_cache.get(storage_key) if shared_cache else None
+    if content is None:
+        with open(document_manager.backend.open_path(storage_key), 'rb') as f:
+            content = f.read()
+        if shared_cache:
+            shared_cache.set(storage_key, content)
+    return content
+
+
+@router.get("/{document_id}/thumbnail", response_model=None)
+async def get_document_thumbnail(
+    request: Request,
+    document_id: str,
+    version_id: Optional[str] = Query(None)
+):
+    """
+    Get the first-page thumbnail of a document version.
+    
+    Thumbnails are produced by the enrichment pipeline; until then, or when no
+    renderer is installed, a 404 is returned.
+    """
+    try:
+        document, version, _ = await run_in_threadpool(document_manager.resolve_version, document_id, version_id)
+        thumbnail = version.get("thumbnail")
+        if not thumbnail:
+            raise HTTPException(status_code=404, detail="Thumbnail not available")
+        
+        etag = f'"{version.get("sha256") or version["version_id"]}-thumb"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if version_id else REVALIDATE_CACHE_CONTROL
+        }
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        
+        content = await run_in_threadpool(_read_thumbnail, thumbnail["storage_key"])
+        return Response(content=content, media_type=thumbnail["content_type"], headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        return APIResponse(
+            success=False,
+            message=f"Error getting thumbnail: {str(e)}",
+            errors=[{"detail": str(e)}]
+        )
+
+
 @router.post("/{document_id}/versions", response_model=APIResponse)
 async def add_document_version(
     document_id: str,
@@ -206,17 +1216,14 @@ async def add_document_version(
     """
     Add a new version to a document.
     """
+    enforce_rate_limit(user_id)
     try:
-        temp_file = save_upload_file_temp(file)
-        
-        # Add version
-        version_id = document_manager.add_document_version(document_id, temp_file, user_id, comment)
-        
-        # Clean up the temporary file
-        os.unlink(temp_file)
+        version_id = await run_in_threadpool(
+            store_upload, file, lambda upload: document_manager.add_document_version(document_id, upload, user_id, comment)
+        )
         
         # Get the updated document
-        document = document_manager.get_document(document_id)
+        document = await run_in_threadpool(document_manager.get_document, document_id)
         
         return APIResponse(
             success=True,
@@ -235,22 +1242,62 @@ async def add_document_version(
 
 
 @router.get("/{document_id}/versions", response_model=APIResponse)
-async def list_document_versions(document_id: str):
+async def list_document_versions(
+    request: Request,
+    document_id: str,
+    fields: Optional[str] = Query(None, description="Comma-separated version fields to return, e.g. version_id,created_at")
+):
     """
     List all versions of a document.
     """
     try:
         document = document_manager.get_document(document_id)
+        selected = parse_fields(fields)
+        versions = document["versions"]
+        if selected:
+            versions = [select_fields(version, selected) for version in versions]
+        
+        return _json_response(request, "Document versions retrieved successfully", versions)
+    except Exception as e:
+        return APIResponse(
+            success=False,
+            message=f"Error listing document versions: {str(e)}",
+            errors=[{"detail": str(e)}]
+        )
+
+
+@router.get("/{document_id}/versions/{from_version_id}/diff/{to_version_id}", response_model=APIResponse)
+async def diff_document_versions(
+    document_id: str,
+    from_version_id: str,
+    to_version_id: str,
+    context: Optional[int] = Query(None, ge=0, le=100, description="Context lines around text changes")
+):
+    """
+    Compare two versions of a document page by page.
+    """
+    try:
+        document = document_manager.get_document(document_id)
+        enforce_rate_limit(document["owner_id"])
+        
+        async with scheduler.aslot(document["owner_id"], document["metadata"].get("page_count") or 1) as tier:
+            diff = await run_in_threadpool(
+                diff_versions, document_manager, document_id, from_version_id, to_version_id, context, pdf_sandbox, tier
+            )
         
         return APIResponse(
             success=True,
-            message="Document versions retrieved successfully",
-            data=document["versions"]
+            message="Document versions compared successfully",
+            data=diff
         )
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise rejection_error(e)
     except Exception as e:
         return APIResponse(
             success=False,
-            message=f"Error listing document versions: {str(e)}",
+            message=f"Error comparing document versions: {str(e)}",
             errors=[{"detail": str(e)}]
         )
 
@@ -264,7 +1311,7 @@ async def update_document_permissions(
     Update document permissions.
     """
     try:
-        updated_document = document_manager.update_permissions(document_id, permissions)
+        updated_document = await run_in_threadpool(document_manager.update_permissions, document_id, permissions)
         
         return APIResponse(
             success=True,
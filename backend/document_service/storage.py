@@ -0,0 +1,484 @@
+"""
+Storage backends and the sharded key layout used by the Document Service.
+"""
+import errno
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from abc import ABC, abstractmethod
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Union
+
+# Owner IDs matching this pattern are used verbatim as tenant directory names
+_SAFE_TENANT = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+# Size of the chunks used when copying into the store
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class StoredBlob(NamedTuple):
+    """Result of storing a file."""
+    size: int
+    sha256: str
+
+
+def _copy_with_digest(source: Union[str, BinaryIO], destination: BinaryIO) -> StoredBlob:
+    """Copy a path or binary file object into a destination, hashing it on the way."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as src:
+            return _copy_with_digest(src, destination)
+
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = source.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        destination.write(chunk)
+        size += len(chunk)
+    return StoredBlob(size, digest.hexdigest())
+
+
+class ShardedLayout:
+    """
+    Maps documents to hash-prefixed, tenant-partitioned storage keys.
+
+    Blobs live under ``documents/<tenant shard>/<tenant>/<doc shard>.../<document_id>``
+    and metadata under ``<doc shard>.../<document_id>.json``. Each shard level is
+    a two-character hex prefix, so a directory never holds more than 256
+    subdirectories and leaf directories stay small as the corpus grows.
+    """
+
+    def __init__(self, depth: int = 2):
+        """
+        Initialize the layout.
+
+        Args:
+            depth: Number of two-character hash prefixes used for document shards
+        """
+        self.depth = depth
+
+    @staticmethod
+    def _digest(value: str) -> str:
+        return hashlib.sha1(value.encode("utf-8")).hexdigest()
+
+    def shard(self, value: str, depth: Optional[int] = None) -> List[str]:
+        """
+        Compute the hash-prefix directories for a value.
+
+        Args:
+            value: Value to shard, e.g. a document ID
+            depth: Optional number of levels overriding the layout default
+
+        Returns:
+            List of two-character hex prefixes
+        """
+        digest = self._digest(value)
+        levels = self.depth if depth is None else depth
+        return [digest[i * 2:i * 2 + 2] for i in range(levels)]
+
+    def tenant(self, owner_id: str) -> str:
+        """
+        Get the partition name for an owner.
+
+        Args:
+            owner_id: ID of the document owner
+
+        Returns:
+            Directory-safe tenant name
+        """
+        if _SAFE_TENANT.match(owner_id) and owner_id not in (".", ".."):
+            return owner_id
+        return self._digest(owner_id)
+
+    def document_prefix(self, owner_id: str, document_id: str) -> str:
+        """
+        Get the storage key prefix under which a document's blobs live.
+
+        Args:
+            owner_id: ID of the document owner
+            document_id: ID of the document
+
+        Returns:
+            Storage key prefix without a trailing slash
+        """
+        tenant = self.tenant(owner_id)
+        parts = ["documents", self.shard(tenant, 1)[0], tenant]
+        parts.extend(self.shard(document_id))
+        parts.append(document_id)
+        return "/".join(parts)
+
+    def version_key(self, owner_id: str, document_id: str, version_id: str) -> str:
+        """
+        Get the storage key of a document version.
+
+        Args:
+            owner_id: ID of the document owner
+            document_id: ID of the document
+            version_id: ID of the version
+
+        Returns:
+            Storage key of the version file
+        """
+        return f"{self.document_prefix(owner_id, document_id)}/versions/{version_id}.pdf"
+
+    def metadata_path(self, metadata_dir: str, document_id: str) -> str:
+        """
+        Get the sharded metadata file path of a document.
+
+        Metadata is sharded by document ID only, so it can be found without
+        knowing the owner.
+
+        Args:
+            metadata_dir: Root metadata directory
+            document_id: ID of the document
+
+        Returns:
+            Path to the metadata JSON file
+        """
+        return os.path.join(metadata_dir, *self.shard(document_id), f"{document_id}.json")
+
+
+class StorageBackend(ABC):
+    """Interface for blob stores holding document version files."""
+
+    @abstractmethod
+    def put_file(self, key: str, source: Union[str, BinaryIO]) -> StoredBlob:
+        """
+        Store a file under a key, replacing any existing content atomically.
+
+        Args:
+            key: Storage key
+            source: Path to the source file, or an open binary file object
+
+        Returns:
+            Size and SHA-256 digest of the stored content
+        """
+
+    def move_file(self, key: str, path: str, sha256: Optional[str] = None) -> StoredBlob:
+        """
+        Store a local file under a key, taking ownership of the file.
+
+        Backends that can adopt the file in place do so instead of copying it.
+
+        Args:
+            key: Storage key
+            path: Path to a file the caller no longer needs
+            sha256: Optional known SHA-256 digest of the file, saving a pass over it
+
+        Returns:
+            Size and SHA-256 digest of the stored content
+        """
+        blob = self.put_file(key, path)
+        os.unlink(path)
+        return blob
+
+    @abstractmethod
+    def open_path(self, key: str) -> str:
+        """
+        Get a local filesystem path holding the content of a key.
+
+        Args:
+            key: Storage key
+
+        Returns:
+            Path that can be opened for reading
+
+        Raises:
+            ValueError: If the key does not exist
+        """
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        """Check whether a key exists."""
+
+    @abstractmethod
+    def size(self, key: str) -> int:
+        """Get the size in bytes of a key."""
+
+    @abstractmethod
+    def modified(self, key: str) -> float:
+        """Get the time a key was last written, as a Unix timestamp."""
+
+    @abstractmethod
+    def copy(self, source_key: str, destination_key: str) -> None:
+        """Copy the content of one key to another."""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """Delete a key if it exists."""
+
+    @abstractmethod
+    def delete_prefix(self, prefix: str) -> None:
+        """Delete every key below a prefix."""
+
+    def delete_keys(self, keys: List[str]) -> None:
+        """
+        Delete many keys, ignoring those that do not exist.
+
+        Backends with a bulk delete operation use it instead of one call per key.
+
+        Args:
+            keys: Storage keys to delete
+        """
+        for key in keys:
+            self.delete(key)
+
+    @abstractmethod
+    def list_keys(self, prefix: str = "") -> Iterator[str]:
+        """Iterate over every key below a prefix."""
+
+
+class LocalStorageBackend(StorageBackend):
+    """Stores blobs as files below a root directory."""
+
+    def __init__(self, root_dir: str):
+        """
+        Initialize the backend.
+
+        Args:
+            root_dir: Directory under which keys are stored
+        """
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        """
+        Get the filesystem path of a key.
+
+        Args:
+            key: Storage key
+
+        Returns:
+            Absolute path for the key
+        """
+        path = os.path.normpath(os.path.join(self.root_dir, *key.split("/")))
+        if os.path.commonpath([path, os.path.normpath(self.root_dir)]) != os.path.normpath(self.root_dir):
+            raise ValueError(f"Invalid storage key {key}")
+        return path
+
+    def put_file(self, key: str, source: Union[str, BinaryIO]) -> StoredBlob:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Unique per writer, so concurrent writes of a key cannot mix their bytes
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            with open(partial_path, "wb") as dst:
+                blob = _copy_with_digest(source, dst)
+                # Make the bytes durable before the key becomes visible
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(partial_path, path)
+        except Exception:
+            if os.path.exists(partial_path):
+                os.unlink(partial_path)
+            raise
+
+        return blob
+
+    def move_file(self, key: str, path: str, sha256: Optional[str] = None) -> StoredBlob:
+        destination = self.path(key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        with open(path, "rb") as f:
+            if sha256 is None:
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                sha256 = digest.hexdigest()
+            size = os.fstat(f.fileno()).st_size
+            os.fsync(f.fileno())
+
+        try:
+            os.replace(path, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Different filesystem, fall back to copying
+            return super().move_file(key, path)
+        return StoredBlob(size, sha256)
+
+    def open_path(self, key: str) -> str:
+        path = self.path(key)
+        if not os.path.exists(path):
+            raise ValueError(f"Storage key {key} not found")
+        return path
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self.open_path(key))
+
+    def modified(self, key: str) -> float:
+        return os.path.getmtime(self.open_path(key))
+
+    def copy(self, source_key: str, destination_key: str) -> None:
+        self.put_file(destination_key, self.open_path(source_key))
+
+    def delete(self, key: str) -> None:
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_prefix(self, prefix: str) -> None:
+        path = self.path(prefix)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.unlink(path)
+
+    def list_keys(self, prefix: str = "") -> Iterator[str]:
+        base = self.path(prefix) if prefix else self.root_dir
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                if filename.endswith(".part"):
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                yield os.path.relpath(full_path, self.root_dir).replace(os.sep, "/")
+
+
+class S3StorageBackend(StorageBackend):
+    """
+    Stores blobs in an S3-compatible bucket.
+
+    Pointing ``endpoint_url`` at a local MinIO (or any other S3-compatible
+    server) gives a local stand-in for production object storage. PDF libraries
+    need real files, so reads are served from a local cache directory that is
+    filled on first access and on write.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        cache_dir: str,
+        endpoint_url: Optional[str] = None,
+        client=None
+    ):
+        """
+        Initialize the backend.
+
+        Args:
+            bucket: Name of the bucket holding the blobs
+            cache_dir: Local directory used to cache downloaded blobs
+            endpoint_url: Optional endpoint of an S3-compatible server
+            client: Optional preconfigured boto3 S3 client
+        """
+        if client is None:
+            import boto3
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+
+        self.bucket = bucket
+        self.client = client
+        self.cache = LocalStorageBackend(cache_dir)
+
+    def put_file(self, key: str, source: Union[str, BinaryIO]) -> StoredBlob:
+        blob = self.cache.put_file(key, source)
+        self.client.upload_file(self.cache.path(key), self.bucket, key)
+        return blob
+
+    def move_file(self, key: str, path: str, sha256: Optional[str] = None) -> StoredBlob:
+        blob = self.cache.move_file(key, path, sha256)
+        self.client.upload_file(self.cache.path(key), self.bucket, key)
+        return blob
+
+    def open_path(self, key: str) -> str:
+        if self.cache.exists(key):
+            return self.cache.path(key)
+
+        path = self.cache.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Workers missing the same key each download it to their own partial
+        # file; whichever finishes last replaces an identical copy
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            self.client.download_file(self.bucket, key, partial_path)
+        except Exception as e:
+            if os.path.exists(partial_path):
+                os.unlink(partial_path)
+            raise ValueError(f"Storage key {key} not found: {str(e)}")
+        os.replace(partial_path, path)
+        return path
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except Exception:
+            return False
+
+    def size(self, key: str) -> int:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)["ContentLength"]
+        except Exception as e:
+            raise ValueError(f"Storage key {key} not found: {str(e)}")
+
+    def modified(self, key: str) -> float:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)["LastModified"].timestamp()
+        except Exception as e:
+            raise ValueError(f"Storage key {key} not found: {str(e)}")
+
+    def copy(self, source_key: str, destination_key: str) -> None:
+        self.client.copy_object(
+            Bucket=self.bucket,
+            Key=destination_key,
+            CopySource={"Bucket": self.bucket, "Key": source_key}
+        )
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+        self.cache.delete(key)
+
+    def delete_keys(self, keys: List[str]) -> None:
+        for start in range(0, len(keys), 1000):
+            batch = keys[start:start + 1000]
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": [{"Key": key} for key in batch]})
+            for key in batch:
+                self.cache.delete(key)
+
+    def delete_prefix(self, prefix: str) -> None:
+        batch = []
+        for key in self.list_keys(prefix):
+            batch.append({"Key": key})
+            if len(batch) == 1000:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": batch})
+                batch = []
+        if batch:
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": batch})
+        self.cache.delete_prefix(prefix)
+
+    def list_keys(self, prefix: str = "") -> Iterator[str]:
+        if prefix and not prefix.endswith("/"):
+            prefix = f"{prefix}/"
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"]
+
+
+def create_storage_backend(kind: str, storage_dir: str, **options) -> StorageBackend:
+    """
+    Create a storage backend by name.
+
+    Args:
+        kind: Either "local" or "s3"
+        storage_dir: Root storage directory; the S3 backend keeps its cache below it
+        options: Backend specific options, e.g. ``bucket`` and ``endpoint_url`` for S3
+
+    Returns:
+        The configured storage backend
+    """
+    if kind == "local":
+        return LocalStorageBackend(storage_dir)
+    if kind == "s3":
+        return S3StorageBackend(
+            bucket=options["bucket"],
+            cache_dir=os.path.join(storage_dir, "cache"),
+            endpoint_url=options.get("endpoint_url")
+        )
+    raise ValueError(f"Unknown storage backend {kind}")
@@ -0,0 +1,304 @@
+"""
+Online migration of document trees into the current sharded storage layout.
+
+Usage:
+    python -m document_service.storage_migration --storage-dir /var/lib/pdf_editor
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from document_service.document_manager import DocumentManager, VERSION_ARTIFACTS
+from document_service.storage import LocalStorageBackend
+
+
+class StorageMigrator:
+    """
+    Moves documents whose blobs or metadata are not where the current layout
+    expects them, without taking the service offline.
+
+    Each document is migrated copy-first: its blobs are copied to their new
+    keys, then the metadata is switched over under the document lock, and the
+    old blobs are only removed after a grace period so that requests which
+    resolved the old paths just before the switch can still finish.
+
+    The old keys of a document are recorded in a journal before its metadata
+    is switched, so removals cut short by a crash are finished by the next run.
+    """
+
+    def __init__(self, manager: DocumentManager, grace_seconds: float = 30.0, throttle_seconds: float = 0.0):
+        """
+        Initialize the migrator.
+
+        Args:
+            manager: Document manager whose storage is migrated
+            grace_seconds: Delay before old blobs are removed
+            throttle_seconds: Pause between documents to limit I/O pressure
+        """
+        self.manager = manager
+        self.grace_seconds = grace_seconds
+        self.throttle_seconds = throttle_seconds
+        self.journal_path = os.path.join(manager.metadata_dir, ".migration", "pending_removal.jsonl")
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+
+    def _target_keys(self, metadata: Dict[str, Any]) -> Tuple[str, Dict[str, str]]:
+        """
+        Compute where a document's blobs belong in the current layout.
+
+        Args:
+            metadata: Document metadata
+
+        Returns:
+            Tuple of the new document prefix and a mapping from old to new keys
+        """
+        old_prefix = metadata["storage_key"]
+        new_prefix = self.manager.layout.document_prefix(metadata["owner_id"], metadata["id"])
+        if old_prefix == new_prefix:
+            return new_prefix, {}
+
+        moves = {}
+        for key in self.manager.backend.list_keys(old_prefix):
+            if self.manager.blob_holders(key):
+                # Other documents reference the blob where it is
+                continue
+            moves[key] = new_prefix + key[len(old_prefix):]
+        return new_prefix, moves
+
+    def needs_migration(self, metadata_path: str, metadata: Dict[str, Any]) -> bool:
+        """
+        Check whether a document is not laid out as the current layout expects.
+
+        Args:
+            metadata_path: Path the metadata was read from
+            metadata: Document metadata
+
+        Returns:
+            True if the document should be migrated
+        """
+        expected_path = self.manager.layout.metadata_path(self.manager.metadata_dir, metadata["id"])
+        expected_prefix = self.manager.layout.document_prefix(metadata["owner_id"], metadata["id"])
+        return metadata_path != expected_path or metadata["storage_key"] != expected_prefix
+
+    def migrate_document(self, document_id: str) -> List[str]:
+        """
+        Migrate a single document.
+
+        Args:
+            document_id: ID of the document
+
+        Returns:
+            Old keys, recorded for removal once the grace period has passed
+        """
+        backend = self.manager.backend
+
+        # Copy blobs without holding the lock
+        metadata = self.manager.get_document(document_id)
+        new_prefix, moves = self._target_keys(metadata)
+        for old_key, new_key in moves.items():
+            backend.copy(old_key, new_key)
+
+        with self.manager._lock_document(document_id):
+            metadata = self.manager.get_document(document_id)
+            new_prefix, current_moves = self._target_keys(metadata)
+
+            # Pick up anything written after the first copy pass
+            for old_key, new_key in current_moves.items():
+                if old_key not in moves or not backend.exists(new_key):
+                    backend.copy(old_key, new_key)
+
+            for version in metadata["versions"]:
+                if version["storage_key"] in current_moves:
+                    version["storage_key"] = current_moves[version["storage_key"]]
+                for encoded in (version.get("encodings") or {}).values():
+                    if encoded["storage_key"] in current_moves:
+                        encoded["storage_key"] = current_moves[encoded["storage_key"]]
+                for field in VERSION_ARTIFACTS:
+                    artifact = version.get(field)
+                    if artifact and artifact["storage_key"] in current_moves:
+                        artifact["storage_key"] = current_moves[artifact["storage_key"]]
+            if current_moves:
+                self._record_pending(document_id, metadata["storage_key"], list(current_moves))
+            metadata["storage_key"] = new_prefix
+
+            self.manager._save_metadata(metadata)
+
+        return list(current_moves)
+
+    def _record_pending(self, document_id: str, old_prefix: str, keys: List[str]) -> None:
+        """Durably record old keys to remove, before the metadata that frees them is saved."""
+        line = json.dumps({"document_id": document_id, "old_prefix": old_prefix, "keys": keys}, separators=(",", ":"))
+        with open(self.journal_path, 'a') as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _storage_key(self, document_id: str) -> Optional[str]:
+        """Get a document's current prefix, also while it is in the trash."""
+        try:
+            return self.manager.get_document(document_id)["storage_key"]
+        except ValueError:
+            pass
+        try:
+            with open(self.manager._trash_path(f"document-{document_id}"), 'r') as f:
+                return json.load(f)["metadata"]["storage_key"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def remove_pending(self) -> int:
+        """
+        Remove the old keys recorded in the journal once the grace period has passed.
+
+        Returns:
+            Number of removed keys
+        """
+        try:
+            with open(self.journal_path, 'r') as f:
+                lines = f.readlines()
+            recorded_at = os.path.getmtime(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+        remaining = recorded_at + self.grace_seconds - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+        removed = 0
+        for line in lines:
+            if not line.endswith("\n"):
+                # Cut short by a crash before the metadata was switched
+                continue
+            entry = json.loads(line)
+            if self._storage_key(entry["document_id"]) == entry["old_prefix"]:
+                # The metadata was never switched, the old keys are still in use
+                continue
+            for key in entry["keys"]:
+                self.manager.backend.delete(key)
+                removed += 1
+            self._prune_prefix(entry["old_prefix"])
+
+        os.unlink(self.journal_path)
+        return removed
+
+    def _prune_prefix(self, prefix: str) -> None:
+        """Remove the directories left empty by moving a document prefix away."""
+        backend = self.manager.backend
+        if not isinstance(backend, LocalStorageBackend):
+            return
+
+        root_dir = os.path.normpath(backend.root_dir)
+        metadata_dir = os.path.normpath(self.manager.metadata_dir)
+        path = backend.path(prefix)
+        if path == root_dir or os.path.commonpath([path, metadata_dir]) == metadata_dir:
+            return
+
+        for dirpath, _, _ in os.walk(path, topdown=False):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+
+        parent = os.path.dirname(path)
+        # Runtime directories must survive even when they happen to be empty
+        while parent not in (root_dir, metadata_dir) and not os.path.basename(parent).startswith("."):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    def run(self, dry_run: bool = False, limit: Optional[int] = None) -> Dict[str, int]:
+        """
+        Migrate every document that is not in the current layout.
+
+        Args:
+            dry_run: Only count documents that would be migrated
+            limit: Optional maximum number of documents to migrate
+
+        Returns:
+            Counts of scanned, migrated and failed documents
+        """
+        stats = {"scanned": 0, "migrated": 0, "failed": 0, "removed_keys": 0}
+        if not dry_run:
+            # Finish the removals of a run interrupted during its grace period
+            stats["removed_keys"] += self.remove_pending()
+
+        for metadata_path in list(self.manager._iter_metadata_paths()):
+            if limit is not None and stats["migrated"] >= limit:
+                break
+
+            try:
+                with open(metadata_path, 'r') as f:
+                    metadata = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+
+            stats["scanned"] += 1
+            if not self.needs_migration(metadata_path, metadata):
+                continue
+
+            if dry_run:
+                stats["migrated"] += 1
+                continue
+
+            try:
+                self.migrate_document(metadata["id"])
+                stats["migrated"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"Error migrating document {metadata['id']}: {str(e)}", file=sys.stderr)
+
+            if self.throttle_seconds:
+                time.sleep(self.throttle_seconds)
+
+        if not dry_run:
+            stats["removed_keys"] += self.remove_pending()
+
+        return stats
+
+
+def directory_report(root_dir: str) -> Dict[str, Any]:
+    """
+    Report directory fan-out below a root directory.
+
+    Args:
+        root_dir: Directory to inspect
+
+    Returns:
+        Number of directories, and the largest directory with its entry count
+    """
+    report = {"directories": 0, "max_entries": 0, "max_entries_path": None}
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        report["directories"] += 1
+        entries = len(dirnames) + len(filenames)
+        if entries > report["max_entries"]:
+            report["max_entries"] = entries
+            report["max_entries_path"] = dirpath
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Migrate document storage into the sharded layout")
+    parser.add_argument("--storage-dir", required=True, help="Root storage directory")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be migrated")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of documents to migrate")
+    parser.add_argument("--grace", type=float, default=30.0, help="Seconds to wait before removing old blobs")
+    parser.add_argument("--throttle", type=float, default=0.0, help="Seconds to pause between documents")
+    parser.add_argument("--report", action="store_true", help="Print directory fan-out after migrating")
+    args = parser.parse_args(argv)
+
+    manager = DocumentManager(args.storage_dir)
+    migrator = StorageMigrator(manager, grace_seconds=args.grace, throttle_seconds=args.throttle)
+    stats = migrator.run(dry_run=args.dry_run, limit=args.limit)
+    print(json.dumps(stats))
+
+    if args.report:
+        print(json.dumps(directory_report(args.storage_dir)))
+
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+"""
+Background tiering of old versions into the compressed archive tier.
+"""
+import fcntl
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from common.metrics import metrics
+from document_service.document_manager import DocumentManager
+
+
+class ColdStorageTiering:
+    """
+    Moves versions that are rarely read out of the hot store.
+
+    A pass compresses every version older than ``min_age_days`` into the
+    manager's archive tier, except the latest version of each document and
+    blobs shared with other documents. Reads switch to the archive at once;
+    the hot copies are removed by a later pass, once no read that resolved
+    them before the switch can still be running. Only one process runs a pass
+    at a time; the others skip it.
+    """
+
+    def __init__(
+        self,
+        manager: DocumentManager,
+        min_age_days: float = 30,
+        grace_seconds: int = 10 * 60,
+        interval_seconds: int = 60 * 60,
+        batch_size: Optional[int] = None
+    ):
+        """
+        Initialize the tiering.
+
+        Args:
+            manager: Document manager with an archive tier
+            min_age_days: Age after which non-latest versions are archived
+            grace_seconds: Delay between archiving a version and removing its hot copies
+            interval_seconds: Interval between background passes
+            batch_size: Optional maximum number of versions archived per pass
+        """
+        if manager.archive is None:
+            raise ValueError("Tiering requires a document manager with an archive tier")
+
+        self.manager = manager
+        self.min_age_days = min_age_days
+        self.grace_seconds = grace_seconds
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self._lock_path = os.path.join(manager.lock_dir, "tiering.lock")
+        self._stop_event = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+
+    def run_pass(self) -> Dict[str, int]:
+        """
+        Archive old versions and remove hot copies whose grace period has passed.
+
+        Returns:
+            Number of archived versions, hot bytes archived, archive bytes
+            written and hot bytes freed, or an empty dict if another process
+            is running a pass
+        """
+        with open(self._lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return {}
+
+            try:
+                with metrics.timer("tiering_pass_seconds", "Duration of cold storage tiering passes"):
+                    return self._run_pass()
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _run_pass(self) -> Dict[str, int]:
+        now = datetime.utcnow()
+        archive_cutoff = (now - timedelta(days=self.min_age_days)).isoformat()
+        release_cutoff = (now - timedelta(seconds=self.grace_seconds)).isoformat()
+        stats = {"archived_versions": 0, "archived_bytes": 0, "archive_bytes": 0, "freed_bytes": 0}
+        hot_bytes = 0
+        archived_bytes = 0
+
+        for metadata in self.manager.list_documents():
+            for version in metadata["versions"]:
+                record = version.get("archive")
+                if version.get("tier") == "archive":
+                    archived_bytes += version.get("size", 0)
+                    if record.get("hot_keys") and record["archived_at"] <= release_cutoff:
+                        freed = self._hot_size(record["hot_keys"])
+                        if self.manager.release_hot_copies(metadata["id"], version["version_id"]):
+                            stats["freed_bytes"] += freed
+                    continue
+
+                hot_bytes += version.get("size", 0)
+                if (
+                    version is metadata["versions"][-1]
+                    or version["created_at"] > archive_cutoff
+                    or (self.batch_size is not None and stats["archived_versions"] >= self.batch_size)
+                    # Shared with other documents, e.g. a template's instances
+                    or self.manager.blob_holders(version["storage_key"])
+                ):
+                    continue
+
+                try:
+                    record = self.manager.archive.archive(version["storage_key"], self.manager.backend.open_path(version["storage_key"]))
+                except (OSError, ValueError):
+                    # Removed in the meantime; retried on the next pass otherwise
+                    continue
+                if not self.manager.archive_version(metadata["id"], version["version_id"], record):
+                    self.manager.archive.delete_keys([record["storage_key"]])
+                    continue
+
+                stats["archived_versions"] += 1
+                stats["archived_bytes"] += version.get("size", 0)
+                stats["archive_bytes"] += record["size"]
+                hot_bytes -= version.get("size", 0)
+                archived_bytes += version.get("size", 0)
+
+        metrics.inc("tiering_archived_versions_total", stats["archived_versions"], "Versions moved to the archive tier")
+        metrics.inc("tiering_archived_bytes_total", stats["archived_bytes"], "Uncompressed bytes moved to the archive tier")
+        metrics.inc("tiering_archive_bytes_total", stats["archive_bytes"], "Compressed bytes written to the archive tier")
+        metrics.inc("tiering_freed_bytes_total", stats["freed_bytes"], "Hot store bytes freed by tiering")
+        metrics.set_gauge("tiering_hot_version_bytes", hot_bytes, "Size of versions in the hot store")
+        metrics.set_gauge("tiering_archived_version_bytes", archived_bytes, "Uncompressed size of archived versions")
+        return stats
+
+    def _hot_size(self, keys) -> int:
+        size = 0
+        for key in keys:
+            try:
+                size += self.manager.backend.size(key)
+            except (OSError, ValueError):
+                continue
+        return size
+
+    def start(self) -> None:
+        """Start the background tiering thread if it is not already running."""
+        if self._worker and self._worker.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._worker = threading.Thread(target=self._tiering_loop, name="cold-storage-tiering", daemon=True)
+        self._worker.start()
+
+    def stop(self) -> None:
+        """Stop the background tiering thread."""
+        self._stop_event.set()
+        if self._worker:
+            self._worker.join(timeout=5)
+            self._worker = None
+
+    def _tiering_loop(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.run_pass()
+            except Exception:
+                # Tiering is best effort; try again on the next interval
+                pass
+            self._stop_event.wait(self.interval_seconds)
@@ -0,0 +1,509 @@
+"""
+Resumable chunked uploads committed straight into the document store.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+from document_service.document_manager import DocumentManager
+
+# Name of the file chunks are assembled in; the suffix keeps it out of key listings
+DATA_FILE = "data.part"
+
+# Hard link to the assembled file that a commit moves into the store
+COMMIT_FILE = "data.commit"
+
+# Chunk sizes accepted when creating a session; only the last chunk may be smaller
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Number of missing chunk indexes listed in a status response
+MAX_MISSING_LISTED = 1000
+
+# Size of the reads used to hash an assembled file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadNotFound(ValueError):
+    """Raised when an upload session does not exist or has expired."""
+
+
+class UploadConflict(ValueError):
+    """Raised when a request conflicts with the state of an upload session."""
+
+
+class UploadManager:
+    """
+    Keeps resumable upload sessions and commits them as documents or versions.
+
+    A session reserves a file of the announced size below the storage
+    directory. Chunks of a fixed size are written at their offset, so they can
+    arrive in any order and in parallel, from any worker process. Each chunk
+    is verified against its SHA-256 checksum and recorded in a marker file
+    once it is durable, so a failed transfer only resends the missing chunks.
+    Committing moves the assembled file into the store without copying it.
+
+    Retries are safe throughout: creating a session with an idempotency key
+    returns the session created by the first attempt, resending a chunk is a
+    no-op, and committing twice returns the first commit's result.
+    """
+
+    def __init__(
+        self,
+        document_manager: DocumentManager,
+        max_size: int = 4 * 1024 * 1024 * 1024,
+        ttl_seconds: int = 24 * 60 * 60,
+        sweep_interval_seconds: int = 30 * 60
+    ):
+        """
+        Initialize the upload manager.
+
+        Args:
+            document_manager: Document manager committed uploads are stored in
+            max_size: Largest accepted upload in bytes
+            ttl_seconds: Time after which sessions, committed or not, are removed
+            sweep_interval_seconds: Interval between background sweeps
+        """
+        self.document_manager = document_manager
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+        # Sessions live next to the stored blobs so that committing is a rename
+        self.upload_dir = os.path.join(document_manager.storage_dir, "uploads")
+        self.key_dir = os.path.join(self.upload_dir, ".keys")
+        os.makedirs(self.key_dir, exist_ok=True)
+
+        self._stop_event = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+
+    def _session_dir(self, session_id: str) -> str:
+        try:
+            uuid.UUID(session_id)
+        except ValueError:
+            raise UploadNotFound(f"Upload {session_id} not found")
+        return os.path.join(self.upload_dir, *self.document_manager.layout.shard(session_id), session_id)
+
+    def _load(self, session_id: str) -> Dict[str, Any]:
+        try:
+            with open(os.path.join(self._session_dir(session_id), "session.json"), 'r') as f:
+                session = json.load(f)
+        except FileNotFoundError:
+            raise UploadNotFound(f"Upload {session_id} not found")
+
+        if session["expires_at"] < datetime.utcnow().isoformat():
+            raise UploadNotFound(f"Upload {session_id} has expired")
+        return session
+
+    def _save(self, session: Dict[str, Any]) -> None:
+        session_path = os.path.join(self._session_dir(session["id"]), "session.json")
+        temp_path = f"{session_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(session, f, indent=2)
+        os.replace(temp_path, session_path)
+
+    @contextmanager
+    def _locked(self, session_id: str) -> Iterator[None]:
+        """Hold an exclusive lock on a session across worker processes."""
+        with open(os.path.join(self._session_dir(session_id), "lock"), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _key_path(self, owner_id: str, idempotency_key: str) -> str:
+        digest = hashlib.blake2b(f"{owner_id}\0{idempotency_key}".encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.key_dir, f"{digest}.json")
+
+    def create_session(
+        self,
+        size: int,
+        owner_id: str,
+        name: Optional[str] = None,
+        folder_id: Optional[str] = None,
+        document_id: Optional[str] = None,
+        comment: Optional[str] = None,
+        chunk_size: Optional[int] = None,
+        sha256: Optional[str] = None,
+        idempotency_key: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Create an upload session for a new document or a new version.
+
+        Args:
+            size: Total size of the file in bytes
+            owner_id: ID of the uploading user; owner of a new document
+            name: Name of the new document; required unless ``document_id`` is given
+            folder_id: Optional folder of the new document
+            document_id: Optional ID of the document the upload becomes a version of
+            comment: Optional comment of the new version
+            chunk_size: Optional chunk size in bytes
+            sha256: Optional SHA-256 digest of the whole file, verified on commit
+            idempotency_key: Optional client key; repeating a request with the same key
+                returns the same session
+
+        Returns:
+            Status of the session
+
+        Raises:
+            UploadConflict: If the idempotency key was used for a different upload
+            ValueError: If the parameters are invalid
+        """
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        if size <= 0 or size > self.max_size:
+            raise ValueError(f"Upload size must be between 1 and {self.max_size} bytes")
+        if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError(f"Chunk size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE} bytes")
+        if document_id:
+            # Fail early rather than on commit
+            self.document_manager.get_document(document_id)
+        elif not name:
+            raise ValueError("A name is required for a new document")
+
+        target = {
+            "owner_id": owner_id,
+            "name": name,
+            "folder_id": folder_id,
+            "document_id": document_id,
+            "comment": comment,
+            "size": size,
+            "chunk_size": chunk_size,
+            "sha256": sha256.lower() if sha256 else None
+        }
+        fingerprint = hashlib.sha256(json.dumps(target, sort_keys=True).encode("utf-8")).hexdigest()
+
+        if idempotency_key:
+            existing = self._session_for_key(owner_id, idempotency_key, fingerprint)
+            if existing:
+                return existing
+
+        now = datetime.utcnow()
+        session = {
+            "id": str(uuid.uuid4()),
+            **target,
+            "chunk_count": -(-size // chunk_size),
+            "status": "open",
+            "result": None,
+            "created_at": now.isoformat(),
+            "expires_at": (now + timedelta(seconds=self.ttl_seconds)).isoformat()
+        }
+
+        session_dir = self._session_dir(session["id"])
+        os.makedirs(os.path.join(session_dir, "chunks"))
+        # Reserve the file up front; chunks are written into it at their offset
+        with open(os.path.join(session_dir, DATA_FILE), 'wb') as f:
+            f.truncate(size)
+        self._save(session)
+
+        if idempotency_key:
+            # Publish the key atomically; if another request won the race, use its session
+            key_path = self._key_path(owner_id, idempotency_key)
+            temp_path = f"{key_path}.{session['id']}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump({"session_id": session["id"], "fingerprint": fingerprint}, f)
+            try:
+                os.link(temp_path, key_path)
+            except FileExistsError:
+                shutil.rmtree(session_dir, ignore_errors=True)
+                return self._session_for_key(owner_id, idempotency_key, fingerprint)
+            finally:
+                os.unlink(temp_path)
+
+        return self.status(session["id"])
+
+    def _session_for_key(self, owner_id: str, idempotency_key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Find the session created with an idempotency key, if it is still alive."""
+        key_path = self._key_path(owner_id, idempotency_key)
+        try:
+            with open(key_path, 'r') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if entry["fingerprint"] != fingerprint:
+            raise UploadConflict("Idempotency key was already used for a different upload")
+        try:
+            return self.status(entry["session_id"])
+        except UploadNotFound:
+            # The session expired; the key may be reused
+            os.unlink(key_path)
+            return None
+
+    def _received(self, session_id: str) -> List[int]:
+        chunk_dir = os.path.join(self._session_dir(session_id), "chunks")
+        try:
+            names = os.listdir(chunk_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-5]) for name in names if name.endswith(".json"))
+
+    def status(self, session_id: str) -> Dict[str, Any]:
+        """
+        Get the progress of an upload session.
+
+        Args:
+            session_id: ID of the session
+
+        Returns:
+            Session parameters, the contiguous offset received so far, the missing
+            chunk indexes and, once committed, the commit result
+        """
+        session = self._load(session_id)
+        if session["status"] == "committed":
+            received = list(range(session["chunk_count"]))
+        else:
+            received = self._received(session_id)
+
+        received_set = set(received)
+        missing = [index for index in range(session["chunk_count"]) if index not in received_set]
+        contiguous = missing[0] if missing else session["chunk_count"]
+
+        return {
+            "session_id": session["id"],
+            "status": session["status"],
+            "document_id": session["document_id"],
+            "size": session["size"],
+            "chunk_size": session["chunk_size"],
+            "chunk_count": session["chunk_count"],
+            "received_chunks": len(received),
+            "offset": min(session["size"], contiguous * session["chunk_size"]),
+            "missing_chunks": missing[:MAX_MISSING_LISTED],
+            "expires_at": session["expires_at"],
+            "result": session["result"] if session["status"] == "committed" else None
+        }
+
+    def write_chunk(self, session_id: str, index: int, data: bytes, sha256: str) -> Dict[str, Any]:
+        """
+        Store one chunk of an upload.
+
+        Args:
+            session_id: ID of the session
+            index: Zero-based index of the chunk
+            data: Content of the chunk
+            sha256: Hex SHA-256 digest of the chunk as computed by the client
+
+        Returns:
+            Index, size and digest of the stored chunk
+
+        Raises:
+            UploadNotFound: If the session does not exist
+            UploadConflict: If the session was already committed, or a different
+                chunk was already stored at this index
+            ValueError: If the chunk has the wrong size or does not match its checksum
+        """
+        session = self._load(session_id)
+        if session["status"] != "open":
+            raise UploadConflict(f"Upload {session_id} is already {session['status']}")
+        if not 0 <= index < session["chunk_count"]:
+            raise ValueError(f"Chunk index must be between 0 and {session['chunk_count'] - 1}")
+
+        offset = index * session["chunk_size"]
+        expected_size = min(session["chunk_size"], session["size"] - offset)
+        if len(data) != expected_size:
+            raise ValueError(f"Chunk {index} must be {expected_size} bytes, got {len(data)}")
+
+        digest = hashlib.sha256(data).hexdigest()
+        if digest != sha256.lower():
+            raise ValueError(f"Checksum mismatch for chunk {index}")
+
+        session_dir = self._session_dir(session_id)
+        marker_path = os.path.join(session_dir, "chunks", f"{index}.json")
+        chunk = {"index": index, "size": len(data), "sha256": digest}
+        try:
+            with open(marker_path, 'r') as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            stored = None
+        if stored:
+            if stored["sha256"] != digest:
+                raise UploadConflict(f"A different chunk {index} was already uploaded")
+            return chunk
+
+        fd = os.open(os.path.join(session_dir, DATA_FILE), os.O_WRONLY)
+        try:
+            written = 0
+            view = memoryview(data)
+            while written < len(data):
+                written += os.pwrite(fd, view[written:], offset + written)
+            # The marker must never point at data that could still be lost
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+
+        temp_path = f"{marker_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(chunk, f)
+        os.replace(temp_path, marker_path)
+        return chunk
+
+    def commit(self, session_id: str) -> Dict[str, Any]:
+        """
+        Commit a complete upload as a new document or version.
+
+        The assembled file is moved into the document store, not copied.
+        Committing an already committed session returns the same result.
+
+        The document and version IDs are chosen and saved with the session
+        before anything is stored, and a hard link to the file is moved rather
+        than the file itself. A commit interrupted at any point, e.g. by a
+        crash, is therefore completed by the next attempt with the same IDs.
+
+        Args:
+            session_id: ID of the session
+
+        Returns:
+            Mapping with "document_id" and "version_id"
+
+        Raises:
+            UploadNotFound: If the session does not exist
+            UploadConflict: If chunks are missing
+            ValueError: If the file does not match the announced digest or is not a PDF
+        """
+        with self._locked(session_id):
+            session = self._load(session_id)
+            if session["status"] == "committed":
+                return session["result"]
+            if session["status"] == "committing" and self._stored(session["result"]):
+                # Stored by an attempt that stopped before recording it
+                return self._finish(session)
+
+            missing = session["chunk_count"] - len(self._received(session_id))
+            if missing:
+                raise UploadConflict(f"Upload {session_id} is incomplete, {missing} chunks are missing")
+
+            session_dir = self._session_dir(session_id)
+            data_path = os.path.join(session_dir, DATA_FILE)
+            self.document_manager._check_pdf_header(data_path)
+
+            digest = hashlib.sha256()
+            with open(data_path, 'rb') as f:
+                for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(block)
+            sha256 = digest.hexdigest()
+            if session["sha256"] and session["sha256"] != sha256:
+                raise ValueError("Checksum mismatch for the assembled file")
+
+            if session["status"] == "open":
+                session["status"] = "committing"
+                session["result"] = {
+                    "document_id": session["document_id"] or str(uuid.uuid4()),
+                    "version_id": str(uuid.uuid4())
+                }
+                self._save(session)
+
+            commit_path = os.path.join(session_dir, COMMIT_FILE)
+            if os.path.exists(commit_path):
+                os.unlink(commit_path)
+            os.link(data_path, commit_path)
+
+            document_id = session["result"]["document_id"]
+            version_id = session["result"]["version_id"]
+            if session["document_id"]:
+                self.document_manager.add_document_version(
+                    document_id, commit_path, session["owner_id"], session["comment"],
+                    move=True, sha256=sha256, version_id=version_id
+                )
+            else:
+                self.document_manager.create_document(
+                    commit_path, session["name"], session["owner_id"], session["folder_id"],
+                    move=True, sha256=sha256, document_id=document_id, version_id=version_id
+                )
+            return self._finish(session)
+
+    def _stored(self, result: Dict[str, str]) -> bool:
+        """Check whether the document version a commit was to create exists."""
+        try:
+            document = self.document_manager.get_document(result["document_id"])
+        except ValueError:
+            return False
+        return any(version["version_id"] == result["version_id"] for version in document["versions"])
+
+    def _finish(self, session: Dict[str, Any]) -> Dict[str, str]:
+        """Record a session as committed and release the files it no longer needs."""
+        session["status"] = "committed"
+        self._save(session)
+
+        session_dir = self._session_dir(session["id"])
+        shutil.rmtree(os.path.join(session_dir, "chunks"), ignore_errors=True)
+        for name in (DATA_FILE, COMMIT_FILE):
+            try:
+                os.unlink(os.path.join(session_dir, name))
+            except FileNotFoundError:
+                pass
+        return session["result"]
+
+    def abort(self, session_id: str) -> None:
+        """
+        Abort an upload session and release its disk space.
+
+        Args:
+            session_id: ID of the session
+        """
+        self._load(session_id)
+        with self._locked(session_id):
+            shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+    def sweep(self) -> int:
+        """
+        Remove expired sessions and the idempotency keys pointing to them.
+
+        Returns:
+            Number of sessions removed
+        """
+        removed = 0
+        now = datetime.utcnow().isoformat()
+        for dirpath, dirnames, filenames in os.walk(self.upload_dir):
+            if "session.json" not in filenames:
+                continue
+            dirnames[:] = []
+            try:
+                with open(os.path.join(dirpath, "session.json"), 'r') as f:
+                    expired = json.load(f)["expires_at"] < now
+            except (FileNotFoundError, json.JSONDecodeError, KeyError):
+                expired = True
+            if expired:
+                shutil.rmtree(dirpath, ignore_errors=True)
+                removed += 1
+
+        cutoff = time.time() - self.ttl_seconds
+        for entry in os.scandir(self.key_dir):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+        return removed
+
+    def start_sweeper(self) -> None:
+        """Start the background sweeper thread if it is not already running."""
+        if self._sweeper and self._sweeper.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="upload-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self) -> None:
+        """Stop the background sweeper thread."""
+        self._stop_event.set()
+        if self._sweeper:
+            self._sweeper.join(timeout=5)
+            self._sweeper = None
+
+    def _sweep_loop(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.sweep()
+            except Exception:
+                # Sweeping is best effort; try again on the next interval
+                pass
+            self._stop_event.wait(self.sweep_interval_seconds)
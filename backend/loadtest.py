@@ -0,0 +1,721 @@
+"""
+HTTP load test of the application under a mixed workload.
+
+Starts the app on a free local port with its own temporary storage, seeds
+documents, then replays a weighted mix of uploads, listings, reads,
+downloads and processing operations at a fixed request rate. Reports
+latency percentiles, error rates and status codes per endpoint, plus the
+CPU time and memory of the server processes.
+
+Runs with the same seed, mix and rate produce the same request sequence, so
+reports of different commits can be compared; ``--baseline`` does that and
+fails when an endpoint got slower or less reliable than allowed.
+
+Usage:
+    python loadtest.py --rps 50 --duration 60 --output report.json
+    python loadtest.py --mix "download=5,list=2,pipeline=1" --workers 4
+    python loadtest.py --baseline main.json --max-regression 0.2
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+# Relative frequency of each operation in the default mix
+DEFAULT_MIX = {
+    "upload": 1.0,
+    "add_version": 0.5,
+    "list": 3.0,
+    "get": 3.0,
+    "download": 4.0,
+    "info": 2.0,
+    "text": 1.0,
+    "pipeline": 1.0,
+}
+
+# Operations of a traffic mix, each issued by ``LoadTest._op_<name>``
+OPERATIONS = tuple(DEFAULT_MIX)
+
+# Server settings applied unless overridden with --env; the default tier's
+# rate limits would otherwise turn most of the load into 429 responses
+DEFAULT_SERVER_ENV = {
+    "PDF_EDITOR_DEFAULT_TIER": "enterprise",
+}
+
+# Latency percentiles reported per endpoint
+PERCENTILES = (50, 90, 99)
+
+# Interval between samples of the server's resource use
+SAMPLE_INTERVAL_SECONDS = 0.5
+
+
+def make_pdf(pages: int, label: str) -> bytes:
+    """
+    Build a small text PDF used as upload payload.
+
+    Args:
+        pages: Number of pages
+        label: Text drawn on every page, so payloads differ
+
+    Returns:
+        PDF bytes
+    """
+    from reportlab.pdfgen import canvas
+
+    buffer = io.BytesIO()
+    # Fixed metadata keeps the bytes, and thus the work, identical across runs
+    pdf = canvas.Canvas(buffer, invariant=1)
+    for page in range(1, pages + 1):
+        pdf.drawString(72, 720, f"{label} - page {page}")
+        for line in range(30):
+            pdf.drawString(72, 690 - line * 20, f"Line {line + 1} of the load test fixture, page {page}.")
+        pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+def parse_mix(spec: Optional[str]) -> Dict[str, float]:
+    """
+    Parse a traffic mix such as ``"download=5,list=2,pipeline=1"``.
+
+    Args:
+        spec: Optional comma-separated weights, defaults to ``DEFAULT_MIX``
+
+    Returns:
+        Weight by operation
+
+    Raises:
+        ValueError: If an operation is unknown or no weight is positive
+    """
+    if not spec:
+        return dict(DEFAULT_MIX)
+
+    mix = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name!r}, expected one of {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    if not any(weight > 0 for weight in mix.values()):
+        raise ValueError("The traffic mix has no operation with a positive weight")
+    return mix
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Get a percentile of sorted values by the nearest-rank method."""
+    if not values:
+        return 0.0
+    rank = max(1, min(len(values), math.ceil(pct / 100 * len(values))))
+    return values[rank - 1]
+
+
+class ServerProcess:
+    """The application running in a child process on a local port."""
+
+    def __init__(self, workers: int, env: Dict[str, str]):
+        """
+        Initialize the server.
+
+        Args:
+            workers: Number of worker processes; more than one uses the prefork supervisor
+            env: Environment variables set for the server
+        """
+        self.workers = workers
+        self.env = env
+        self.storage_dir = tempfile.mkdtemp(prefix="pdf_editor_loadtest_")
+        self.port = self._free_port()
+        self.process: Optional[subprocess.Popen] = None
+
+    @staticmethod
+    def _free_port() -> int:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self, timeout: float = 60.0) -> None:
+        """
+        Start the server and wait until it answers health checks.
+
+        Args:
+            timeout: Maximum time to wait
+
+        Raises:
+            RuntimeError: If the server exits or does not become healthy in time
+        """
+        backend_dir = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ)
+        env.update(self.env)
+        # Storage lives under the temporary directory
+        env["TMPDIR"] = self.storage_dir
+        if self.workers > 1:
+            env.update({
+                "PDF_EDITOR_WORKERS": str(self.workers),
+                "PDF_EDITOR_HOST": "127.0.0.1",
+                "PDF_EDITOR_PORT": str(self.port),
+            })
+            command = [sys.executable, "main.py"]
+        else:
+            command = [
+                sys.executable, "-m", "uvicorn", "main:app",
+                "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning"
+            ]
+        self.process = subprocess.Popen(command, cwd=backend_dir, env=env)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with status {self.process.returncode}")
+            try:
+                if httpx.get(f"{self.base_url}/health", timeout=1.0).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"Server did not become healthy within {timeout} seconds")
+
+    def stop(self, keep_storage: bool = False) -> None:
+        """
+        Stop the server and remove its storage.
+
+        Args:
+            keep_storage: Whether to leave the storage directory in place
+        """
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if not keep_storage:
+            shutil.rmtree(self.storage_dir, ignore_errors=True)
+
+
+class ResourceSampler:
+    """
+    Samples the CPU time and resident memory of a process and its descendants.
+
+    Reads ``/proc``, so it only reports anything on Linux.
+    """
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.samples: List[Tuple[float, float, int, int]] = []
+
+    @staticmethod
+    def available() -> bool:
+        return os.path.isdir("/proc/self")
+
+    def _process_tree(self) -> Dict[int, List[str]]:
+        stats = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat", 'r') as f:
+                    raw = f.read()
+            except OSError:
+                continue
+            # The command name may contain spaces; fields follow its closing parenthesis
+            stats[int(entry)] = raw[raw.rindex(")") + 2:].split()
+
+        children: Dict[int, List[int]] = {}
+        for pid, fields in stats.items():
+            children.setdefault(int(fields[1]), []).append(pid)
+
+        tree = {}
+        pending = [self.pid]
+        while pending:
+            pid = pending.pop()
+            if pid in stats:
+                tree[pid] = stats[pid]
+                pending.extend(children.get(pid, []))
+        return tree
+
+    def sample(self) -> None:
+        """Record the current CPU time, resident memory and process count."""
+        tree = self._process_tree()
+        # utime and stime are fields 14 and 15 of stat, rss is field 24
+        cpu = sum(int(fields[11]) + int(fields[12]) for fields in tree.values()) / self.clock_ticks
+        rss = sum(int(fields[21]) for fields in tree.values()) * self.page_size
+        self.samples.append((time.monotonic(), cpu, rss, len(tree)))
+
+    async def run(self, stop: asyncio.Event) -> None:
+        """Sample periodically until stopped."""
+        while not stop.is_set():
+            self.sample()
+            try:
+                await asyncio.wait_for(stop.wait(), SAMPLE_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        self.sample()
+
+    def summary(self, since: float) -> Dict[str, Any]:
+        """
+        Summarize the samples taken after a point in time.
+
+        Args:
+            since: ``time.monotonic()`` value where measurement started
+
+        Returns:
+            CPU seconds and utilization, and mean and peak memory in MiB
+        """
+        samples = [sample for sample in self.samples if sample[0] >= since]
+        if len(samples) < 2:
+            return {}
+        elapsed = samples[-1][0] - samples[0][0]
+        # Processes that exited between samples take their CPU time with them,
+        # so the difference is a lower bound
+        cpu = max(0.0, samples[-1][1] - samples[0][1])
+        rss = [sample[2] for sample in samples]
+        return {
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent": round(100 * cpu / elapsed, 1) if elapsed else 0.0,
+            "rss_mean_mib": round(sum(rss) / len(rss) / 2 ** 20, 1),
+            "rss_peak_mib": round(max(rss) / 2 ** 20, 1),
+            "processes": max(sample[3] for sample in samples),
+        }
+
+
+class LoadTest:
+    """Replays a traffic mix against a running server at a fixed rate."""
+
+    def __init__(
+        self,
+        base_url: str,
+        mix: Dict[str, float],
+        rps: float,
+        duration: float,
+        warmup: float = 5.0,
+        seed: int = 1,
+        tenants: int = 4,
+        seed_documents: int = 20,
+        pages: int = 5,
+        max_in_flight: int = 256,
+        timeout: float = 30.0
+    ):
+        """
+        Initialize the load test.
+
+        Args:
+            base_url: URL of the server
+            mix: Weight by operation
+            rps: Target request rate
+            duration: Measured duration in seconds
+            warmup: Unmeasured time before the measurement, at the same rate
+            seed: Seed of the request sequence
+            tenants: Number of document owners the load is spread across
+            seed_documents: Documents uploaded before the run
+            pages: Pages per uploaded document
+            max_in_flight: Requests in flight above which new ones are dropped
+            timeout: Per-request timeout in seconds
+        """
+        self.base_url = base_url
+        self.mix = mix
+        self.rps = rps
+        self.duration = duration
+        self.warmup = warmup
+        self.seed = seed
+        self.tenants = [f"loadtest-{index}" for index in range(tenants)]
+        self.seed_documents = seed_documents
+        self.pages = pages
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.payloads = [make_pdf(pages, f"Load test document {index}") for index in range(8)]
+        self.documents: List[Tuple[str, str]] = []
+        self.results: Dict[str, List[Tuple[float, int, bool]]] = {name: [] for name in mix}
+        self.dropped = 0
+        self.measure_started: Optional[float] = None
+        self._in_flight = 0
+
+    async def seed_store(self, client: httpx.AsyncClient) -> None:
+        """Upload the documents the other operations work on."""
+        for index in range(self.seed_documents):
+            owner_id = self.tenants[index % len(self.tenants)]
+            response = await self._upload(client, owner_id, self.payloads[index % len(self.payloads)])
+            body = response.json()
+            if not body.get("success"):
+                raise RuntimeError(f"Seeding failed: {body.get('message')}")
+            self.documents.append((body["data"]["id"], owner_id))
+
+    async def _upload(self, client: httpx.AsyncClient, owner_id: str, payload: bytes) -> httpx.Response:
+        return await client.post(
+            "/api/documents",
+            files={"file": ("loadtest.pdf", payload, "application/pdf")},
+            data={"name": "loadtest.pdf", "owner_id": owner_id}
+        )
+
+    async def _op_upload(self, client: httpx.AsyncClient, rng: random.Random) -> httpx.Response:
+        owner_id = rng.choice(self.tenants)
+        response = await self._upload(client, owner_id, rng.choice(self.payloads))
+        if response.status_code == 200:
+            body = response.json()
+            if body.get("success"):
+                self.documents.append((body["data"]["id"], owner_id))
+        return response
+
+    async def _op_add_version(self, client: httpx.AsyncClient, rng: random.Random) -> httpx.Response:
+        document_id, owner_id = rng.choice(self.documents)
+        return await client.post(
+            f"/api/documents/{document_id}/versions",
+            files={"file": ("loadtest.pdf", rng.choice(self.payloads), "application/pdf")},
+            data={"user_id": owner_id, "comment": "Load test"}
+        )
+
+    async def _op_list(self, client: httpx.AsyncClient, rng: random.Random) -> httpx.Response:
+        return await client.get("/api/documents", params={"owner_id": rng.choice(self.tenants)})
+
+    async def _op_get(self, client: httpx.AsyncClient, rng: random.Random) -> httpx.Response:
+        return await client.get(f"/api/documents/{rng.choice(self.documents)[0]}")
+
+    async def _op_download(self, client: httpx.AsyncClient, rng: random.Random) -> httpx.Response:
+        return await client.get(f"/api/documents/{rng.choice(self.documents)[0]}/download")
+
+    async def _op_info(self, client: httpx.AsyncClient, rng: random.Random) -> httpx.Response:
+        return await client.post("/api/pdf/info", json={"document_id": rng.choice(self.documents)[0]})
+
+    async def _op_text(self, client: httpx.AsyncClient, rng: random.Random) -> httpx.Response:
+        return await client.get("/api/pdf/text/stream", params={"document_id": rng.choice(self.documents)[0]})
+
+    async def _op_pipeline(self, client: httpx.AsyncClient, rng: random.Random) -> httpx.Response:
+        return await client.post("/api/pdf/pipeline", json={
+            "document_id": rng.choice(self.documents)[0],
+            "operations": [
+                {"op": "rotate_pages", "rotations": {"1": 90}},
+                {"op": "add_watermark", "watermark_text": "LOAD TEST"},
+            ]
+        })
+
+    @staticmethod
+    def _succeeded(response: httpx.Response) -> bool:
+        if response.status_code >= 400:
+            return False
+        # Document routes report failures in the body of a 200 response
+        if response.headers.get("content-type", "").startswith("application/json"):
+            try:
+                body = response.json()
+            except ValueError:
+                return False
+            if isinstance(body, dict) and body.get("success") is False:
+                return False
+        return True
+
+    async def _issue(
+        self,
+        client: httpx.AsyncClient,
+        name: str,
+        rng: random.Random,
+        scheduled: float,
+        measured: bool
+    ) -> None:
+        operation: Callable = getattr(self, f"_op_{name}")
+        try:
+            response = await operation(client, rng)
+            status, ok = response.status_code, self._succeeded(response)
+        except httpx.TimeoutException:
+            status, ok = 0, False
+        except httpx.HTTPError:
+            status, ok = -1, False
+        finally:
+            self._in_flight -= 1
+        # Measured from the scheduled start, so time spent waiting on an
+        # overloaded client or server counts against the latency
+        if measured:
+            self.results[name].append((time.monotonic() - scheduled, status, ok))
+
+    async def run(self) -> Dict[str, Any]:
+        """
+        Seed the store, then replay the mix for the warm-up and measured durations.
+
+        Returns:
+            Report of the measured period
+        """
+        limits = httpx.Limits(max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=limits) as client:
+            await self.seed_store(client)
+
+            names = [name for name, weight in self.mix.items() if weight > 0]
+            weights = [self.mix[name] for name in names]
+            total = int((self.warmup + self.duration) * self.rps)
+            warmup_requests = int(self.warmup * self.rps)
+
+            tasks = []
+            started = time.monotonic()
+            self.measure_started = started + self.warmup
+            for index in range(total):
+                scheduled = started + index / self.rps
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                name = self.random.choices(names, weights)[0]
+                # Each request draws its documents from its own generator, so
+                # the sequence does not depend on response timing
+                rng = random.Random(self.random.getrandbits(64))
+                if self._in_flight >= self.max_in_flight:
+                    if index >= warmup_requests:
+                        self.dropped += 1
+                    continue
+                self._in_flight += 1
+                tasks.append(asyncio.create_task(
+                    self._issue(client, name, rng, scheduled, index >= warmup_requests)
+                ))
+            await asyncio.gather(*tasks)
+            elapsed = time.monotonic() - self.measure_started
+
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        """
+        Summarize the measured requests.
+
+        Args:
+            elapsed: Duration from the start of measurement until the last response
+
+        Returns:
+            Totals and per-endpoint latency, error and status statistics
+        """
+        endpoints = {}
+        all_latencies = []
+        errors = 0
+        for name, results in self.results.items():
+            if not results:
+                continue
+            latencies = sorted(latency for latency, _, _ in results)
+            failed = sum(1 for _, _, ok in results if not ok)
+            statuses: Dict[str, int] = {}
+            for _, status, _ in results:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            endpoints[name] = {
+                "requests": len(results),
+                "errors": failed,
+                "error_rate": round(failed / len(results), 4),
+                "mean_ms": round(1000 * sum(latencies) / len(latencies), 2),
+                **{f"p{pct}_ms": round(1000 * percentile(latencies, pct), 2) for pct in PERCENTILES},
+                "max_ms": round(1000 * latencies[-1], 2),
+                "statuses": statuses,
+            }
+            all_latencies.extend(latencies)
+            errors += failed
+
+        all_latencies.sort()
+        requests = len(all_latencies)
+        return {
+            "totals": {
+                "requests": requests,
+                "errors": errors,
+                "error_rate": round(errors / requests, 4) if requests else 0.0,
+                "dropped": self.dropped,
+                "target_rps": self.rps,
+                "achieved_rps": round(requests / elapsed, 2) if elapsed > 0 else 0.0,
+                **{f"p{pct}_ms": round(1000 * percentile(all_latencies, pct), 2) for pct in PERCENTILES},
+            },
+            "endpoints": endpoints,
+        }
+
+
+def git_commit() -> Optional[str]:
+    """Get the commit of the working tree, marked if it has local changes."""
+    try:
+        root = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True
+        ).stdout.strip()
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """
+    Compare a report with a baseline report.
+
+    An endpoint regresses if its p50 or p99 latency grew by more than the
+    allowed fraction, or its error rate grew by more than one percentage point.
+
+    Args:
+        report: Report of this run
+        baseline: Report of an earlier run
+        max_regression: Allowed relative latency increase, e.g. 0.2 for 20%
+
+    Returns:
+        Descriptions of the regressions found
+    """
+    regressions = []
+    if report["settings"] != baseline.get("settings"):
+        regressions.append("Settings differ from the baseline; the runs are not comparable")
+        return regressions
+
+    for name, stats in report["endpoints"].items():
+        before = baseline["endpoints"].get(name)
+        if not before:
+            continue
+        for field in ("p50_ms", "p99_ms"):
+            if before[field] > 0 and stats[field] > before[field] * (1 + max_regression):
+                regressions.append(
+                    f"{name}: {field} {before[field]} -> {stats[field]} "
+                    f"(+{100 * (stats[field] / before[field] - 1):.0f}%)"
+                )
+        if stats["error_rate"] > before["error_rate"] + 0.01:
+            regressions.append(f"{name}: error rate {before['error_rate']:.2%} -> {stats['error_rate']:.2%}")
+    return regressions
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    """Print a report as a table."""
+    columns = ("requests", "error_rate", "mean_ms") + tuple(f"p{pct}_ms" for pct in PERCENTILES) + ("max_ms",)
+    print(f"{'endpoint':<12}" + "".join(f"{column:>12}" for column in columns))
+    for name, stats in sorted(report["endpoints"].items()):
+        print(f"{name:<12}" + "".join(f"{stats[column]:>12}" for column in columns))
+
+    totals = report["totals"]
+    print(
+        f"\n{totals['requests']} requests, {totals['achieved_rps']}/s of {totals['target_rps']}/s, "
+        f"{totals['error_rate']:.2%} errors, {totals['dropped']} dropped, "
+        f"p50 {totals['p50_ms']} ms, p99 {totals['p99_ms']} ms"
+    )
+    server = report.get("server")
+    if server:
+        print(
+            f"Server: {server['cpu_percent']}% CPU ({server['cpu_seconds']} s), "
+            f"{server['rss_mean_mib']} MiB mean / {server['rss_peak_mib']} MiB peak RSS, "
+            f"{server['processes']} processes"
+        )
+
+
+async def _run(load_test: LoadTest, server: ServerProcess) -> Dict[str, Any]:
+    sampler = ResourceSampler(server.process.pid) if ResourceSampler.available() else None
+    stop = asyncio.Event()
+    sampling = asyncio.create_task(sampler.run(stop)) if sampler else None
+    try:
+        report = await load_test.run()
+    finally:
+        stop.set()
+        if sampling:
+            await sampling
+    report["server"] = sampler.summary(load_test.measure_started) if sampler else {}
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the application with a mixed workload.")
+    parser.add_argument("--rps", type=float, default=20.0, help="Target request rate")
+    parser.add_argument("--duration", type=float, default=30.0, help="Measured duration in seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Unmeasured warm-up in seconds")
+    parser.add_argument("--mix", help="Operation weights, e.g. 'download=5,list=2,pipeline=1'")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the request sequence")
+    parser.add_argument("--tenants", type=int, default=4, help="Number of document owners")
+    parser.add_argument("--seed-documents", type=int, default=20, help="Documents uploaded before the run")
+    parser.add_argument("--pages", type=int, default=5, help="Pages per uploaded document")
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="Concurrent requests before dropping")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Per-request timeout in seconds")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Server environment variable")
+    parser.add_argument("--url", help="Test an already running server instead of starting one")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed relative latency increase")
+    parser.add_argument("--keep-storage", action="store_true", help="Keep the server's storage directory")
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    env = dict(DEFAULT_SERVER_ENV)
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+
+    settings = {
+        "rps": args.rps,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "mix": mix,
+        "seed": args.seed,
+        "tenants": args.tenants,
+        "seed_documents": args.seed_documents,
+        "pages": args.pages,
+        "workers": args.workers,
+        "env": env,
+    }
+    load_test = LoadTest(
+        args.url or "",
+        mix,
+        args.rps,
+        args.duration,
+        warmup=args.warmup,
+        seed=args.seed,
+        tenants=args.tenants,
+        seed_documents=args.seed_documents,
+        pages=args.pages,
+        max_in_flight=args.max_in_flight,
+        timeout=args.timeout
+    )
+
+    if args.url:
+        report = asyncio.run(load_test.run())
+        report["server"] = {}
+    else:
+        server = ServerProcess(args.workers, env)
+        try:
+            server.start()
+            load_test.base_url = server.base_url
+            report = asyncio.run(_run(load_test, server))
+        finally:
+            server.stop(keep_storage=args.keep_storage)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": settings,
+        **report,
+    }
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.max_regression)
+        if regressions:
+            print(f"\nRegressions against {baseline.get('commit') or args.baseline}:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            return 1
+        print(f"\nNo regressions against {baseline.get('commit') or args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
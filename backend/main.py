@@ -1,55 +1,172 @@
 """
 Main application entry point for the PDF Editor SaaS backend.
 """
+import time
+
+# Measured before any other import so that the metrics include them
+_process_started = time.perf_counter()
+
 import os
+import threading
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-
-from pdf_service.routes import router as pdf_router
-
-# Create FastAPI app
-app = FastAPI(
-    title="PDF Editor SaaS API",
-    description="Backend API for PDF Editor SaaS application",
-    version="1.0.0"
-)
-
-# Configure CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # In production, replace with specific origins
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Include routers
-app.include_router(pdf_router)
-
-# Root endpoint
-@app.get("/")
-async def root():
-    return {"message": "Welcome to PDF Editor SaaS API"}
-
-# Health check endpoint
-@app.get("/health")
-async def health_check():
-    return {"status": "healthy"}
-
-# Global exception handler
-@app.exception_handler(Exception)
-async def global_exception_handler(request, exc):
-    if isinstance(exc, HTTPException):
-        return JSONResponse(
-            status_code=exc.status_code,
-            content={"success": False, "message": exc.detail, "errors": [{"detail": exc.detail}]}
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from common.metrics import metrics
+
+# When to import the PDF libraries: "lazy" on first use, "startup" before the
+# app reports ready, or "background" right after startup without blocking it
+PDF_WARMUP = os.environ.get("PDF_EDITOR_WARMUP", "background")
+
+# Cluster mode: the URL other nodes reach this node at, empty to run standalone.
+# Nodes sharing the storage find each other and route each document's requests
+# to one node, so its per-process caches stay hot
+CLUSTER_NODE_URL = os.environ.get("PDF_EDITOR_CLUSTER_NODE_URL", "")
+CLUSTER_ROUTING = os.environ.get("PDF_EDITOR_CLUSTER_ROUTING", "proxy")
+CLUSTER_HEARTBEAT_SECONDS = float(os.environ.get("PDF_EDITOR_CLUSTER_HEARTBEAT_SECONDS", "2"))
+
+
+def warm_up() -> None:
+    """Import the PDF libraries and record how long it took."""
+    from pdf_service.pdf_processor import PDFProcessor
+
+    with metrics.timer("app_warmup_seconds", "Time spent importing PDF libraries ahead of use"):
+        PDFProcessor.warm_up()
+
+
+def preload() -> None:
+    """Load the PDF libraries and static resources before workers are forked."""
+    from pdf_service.pdf_processor import PDFProcessor
+
+    warm_up()
+    PDFProcessor.preload_resources()
+
+
+def create_app() -> FastAPI:
+    """
+    Create the FastAPI application with every service router registered.
+
+    Returns:
+        The configured application
+    """
+    factory_started = time.perf_counter()
+
+    app = FastAPI(
+        title="PDF Editor SaaS API",
+        description="Backend API for PDF Editor SaaS application",
+        version="1.0.0"
+    )
+
+    if CLUSTER_NODE_URL:
+        from common.cluster import ClusterMembership, ClusterRouter, ClusterRoutingMiddleware
+        from document_service.routes import STORAGE_DIR
+
+        cluster_router = ClusterRouter(
+            ClusterMembership(
+                os.environ.get("PDF_EDITOR_CLUSTER_DIR", os.path.join(STORAGE_DIR, "cluster")),
+                CLUSTER_NODE_URL,
+                heartbeat_seconds=CLUSTER_HEARTBEAT_SECONDS
+            ),
+            mode=CLUSTER_ROUTING
         )
-    return JSONResponse(
-        status_code=500,
-        content={"success": False, "message": "Internal server error", "errors": [{"detail": str(exc)}]}
+        # Added before CORS, so redirects and proxied responses get its headers
+        app.add_middleware(ClusterRoutingMiddleware, router=cluster_router)
+
+        @app.on_event("startup")
+        async def join_cluster():
+            cluster_router.membership.start()
+
+        @app.on_event("shutdown")
+        async def leave_cluster():
+            cluster_router.membership.stop()
+            await cluster_router.close()
+
+    # Configure CORS
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # In production, replace with specific origins
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Include routers
+    from document_service.routes import router as document_router
+    from pdf_service.routes import router as pdf_router
+
+    app.include_router(document_router)
+    app.include_router(pdf_router)
+
+    metrics.set_gauge(
+        "app_import_seconds",
+        factory_started - _process_started,
+        "Time spent importing the application module"
+    )
+    metrics.set_gauge(
+        "app_factory_seconds",
+        time.perf_counter() - factory_started,
+        "Time spent importing service routers and building the application"
     )
 
+    @app.on_event("startup")
+    async def report_startup():
+        if PDF_WARMUP == "startup":
+            warm_up()
+        elif PDF_WARMUP == "background":
+            threading.Thread(target=warm_up, name="pdf-warmup", daemon=True).start()
+
+        metrics.set_gauge(
+            "app_startup_seconds",
+            time.perf_counter() - _process_started,
+            "Time from the first application import until it was ready to serve"
+        )
+
+    # Root endpoint
+    @app.get("/")
+    async def root():
+        return {"message": "Welcome to PDF Editor SaaS API"}
+
+    # Health check endpoint
+    @app.get("/health")
+    async def health_check():
+        return {"status": "healthy"}
+
+    # Metrics endpoint
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def get_metrics():
+        return metrics.render()
+
+    # Global exception handler
+    @app.exception_handler(Exception)
+    async def global_exception_handler(request, exc):
+        if isinstance(exc, HTTPException):
+            return JSONResponse(
+                status_code=exc.status_code,
+                content={"success": False, "message": exc.detail, "errors": [{"detail": exc.detail}]}
+            )
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "message": "Internal server error", "errors": [{"detail": str(exc)}]}
+        )
+
+    return app
+
+
+app = create_app()
+
 if __name__ == "__main__":
+    workers = int(os.environ.get("PDF_EDITOR_WORKERS", "1"))
+    if workers > 1:
+        from common.prefork import PreforkSupervisor
+
+        supervisor = PreforkSupervisor(
+            app,
+            host=os.environ.get("PDF_EDITOR_HOST", "0.0.0.0"),
+            port=int(os.environ.get("PDF_EDITOR_PORT", "8000")),
+            workers=workers,
+            preload=preload
+        )
+        raise SystemExit(supervisor.run())
+
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,619 @@
+"""
+Append-only annotation log - stores text, highlight and signature edits per document.
+"""
+import os
+import json
+import uuid
+import fcntl
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Iterator, Tuple, NamedTuple, FrozenSet
+
+from common.models import SubscriptionTier
+from common.scheduler import AdmissionRejected
+from common.temp_workspace import TempWorkspaceManager
+from document_service.document_manager import DocumentManager
+from pdf_service.image_store import ImageStore
+from pdf_service.sandbox import SandboxLimitExceeded
+
+# Kinds of elements stored in the log
+ELEMENT_KINDS = ("text", "highlight", "signature")
+
+# Number of documents whose replayed state is kept in memory
+STATE_CACHE_SIZE = 256
+
+
+class Replay(NamedTuple):
+    """State of a document's annotation log at a given offset."""
+
+    elements: Dict[str, List[Dict[str, Any]]]
+    pending_ops: int
+    offset: int
+    generation: int
+    inode: Optional[int]
+    images: FrozenSet[Tuple[str, str]]
+    # Version being flattened by the latest compaction, and the offset following its record
+    compacting: Optional[Tuple[str, int]]
+
+
+class AnnotationStore:
+    """
+    Records edit operations per document in an append-only JSON lines log.
+
+    Every edit appends one small record instead of rewriting the PDF. The
+    current state is obtained by replaying the log, incrementally from the last
+    replayed offset. Compaction flattens the pending elements into a new PDF
+    version and truncates the log to a single base record.
+    """
+
+    def __init__(
+        self,
+        document_manager: DocumentManager,
+        temp_workspaces: TempWorkspaceManager,
+        image_store: Optional[ImageStore] = None,
+        compact_after_ops: int = 500,
+        sandbox=None,
+        tier: SubscriptionTier = SubscriptionTier.FREE,
+        scheduler=None
+    ):
+        """
+        Initialize the annotation store.
+
+        Args:
+            document_manager: Document manager holding the documents being annotated
+            temp_workspaces: Workspace manager used for rendering flattened versions
+            image_store: Optional store resolving image IDs referenced by signature elements
+            compact_after_ops: Number of pending operations after which a document is compacted
+            sandbox: Optional ``PDFSandbox`` flattening runs in
+            tier: Subscription tier whose sandbox limits apply by default
+            scheduler: Optional ``FairScheduler`` background compactions wait for a slot in
+        """
+        self.document_manager = document_manager
+        self.temp_workspaces = temp_workspaces
+        self.image_store = image_store
+        self.sandbox = sandbox
+        self.tier = tier
+        self.scheduler = scheduler
+        self.compact_after_ops = compact_after_ops
+        self.log_dir = os.path.join(document_manager.storage_dir, "annotations")
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        self._cache: "OrderedDict[str, Tuple[int, int, Dict[str, Any]]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        # Documents edited since their last compaction, with the time of the last edit
+        self._dirty: Dict[str, float] = {}
+        self._stop_event = threading.Event()
+        self._compactor: Optional[threading.Thread] = None
+
+        # Logs of deleted documents are kept while the document can be restored
+        document_manager.add_purge_listener(self.purge)
+
+    def _log_path(self, document_id: str) -> str:
+        return os.path.join(self.log_dir, *self.document_manager.layout.shard(document_id), f"{document_id}.jsonl")
+
+    @contextmanager
+    def _locked_log(self, document_id: str) -> Iterator[str]:
+        """Hold an exclusive lock on a document's log file."""
+        log_path = self._log_path(document_id)
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        with open(f"{log_path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield log_path
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def _compaction_lock(self, document_id: str) -> Iterator[bool]:
+        """
+        Try to take a document's compaction lock without waiting.
+
+        The lock is held from replaying the log until the log is replaced, so
+        compactions of the same document never overlap, across processes too.
+
+        Yields:
+            Whether the lock was acquired; False if another compaction is in progress
+        """
+        log_path = self._log_path(document_id)
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        with open(f"{log_path}.compact.lock", 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _empty_state() -> Dict[str, Any]:
+        return {
+            "base_version_id": None,
+            "generation": 0,
+            "pending_ops": 0,
+            "elements": {kind: OrderedDict() for kind in ELEMENT_KINDS},
+            # Images referenced by any record since the base, including deleted elements
+            "images": set(),
+            "compacting": None
+        }
+
+    @staticmethod
+    def _apply(state: Dict[str, Any], record: Dict[str, Any]) -> None:
+        """Apply a single log record to a replayed state."""
+        op = record["op"]
+        if op == "base":
+            state["base_version_id"] = record["version_id"]
+            state["generation"] = record.get("generation", 0)
+            state["pending_ops"] = 0
+            for kind in ELEMENT_KINDS:
+                state["elements"][kind].clear()
+            state["images"].clear()
+            state["compacting"] = None
+            return
+        if op == "compacting":
+            # Positioned by the caller, which knows the offset
+            return
+
+        elements = state["elements"][record["kind"]]
+        if op == "add":
+            elements[record["id"]] = record["element"]
+        elif op == "update" and record["id"] in elements:
+            elements[record["id"]] = {**elements[record["id"]], **record["element"]}
+        elif op == "delete":
+            elements.pop(record["id"], None)
+
+        element = elements.get(record["id"])
+        if element and element.get("image_id"):
+            state["images"].add((element["image_user_id"], element["image_id"]))
+        state["pending_ops"] += 1
+
+    @staticmethod
+    def _log_generation(first_line: bytes) -> Tuple[int, Optional[str]]:
+        """Get the compaction generation and base version of a log from its first line."""
+        if not first_line.endswith(b"\n"):
+            return 0, None
+        record = json.loads(first_line)
+        if record["op"] != "base":
+            return 0, None
+        return record.get("generation", 0), record["version_id"]
+
+    def _replay(self, document_id: str) -> Replay:
+        """
+        Replay a document's log, reading only records appended since the last call.
+
+        The cached state is reused only if the log still has the same inode and
+        starts with the same base record, so a log rewritten by a compaction is
+        never mistaken for the one replayed before, even if its inode is reused.
+
+        Args:
+            document_id: ID of the document
+
+        Returns:
+            The replayed state, with a copy of the pending elements by kind
+        """
+        log_path = self._log_path(document_id)
+        try:
+            f = open(log_path, 'rb')
+        except FileNotFoundError:
+            return Replay({kind: [] for kind in ELEMENT_KINDS}, 0, 0, 0, None, frozenset(), None)
+
+        with f, self._cache_lock:
+            stat_result = os.fstat(f.fileno())
+            generation, base_version_id = self._log_generation(f.readline())
+
+            cached = self._cache.get(document_id)
+            if (
+                cached
+                and cached[0] == stat_result.st_ino
+                and cached[1] <= stat_result.st_size
+                and cached[2]["generation"] == generation
+                and cached[2]["base_version_id"] == base_version_id
+            ):
+                inode, offset, state = cached
+            else:
+                inode, offset, state = stat_result.st_ino, 0, self._empty_state()
+
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Record still being written
+                    break
+                record = json.loads(line)
+                self._apply(state, record)
+                offset += len(line)
+                if record["op"] == "compacting":
+                    state["compacting"] = (record["version_id"], offset)
+
+            self._cache[document_id] = (inode, offset, state)
+            self._cache.move_to_end(document_id)
+            while len(self._cache) > STATE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+            elements = {kind: [dict(element) for element in state["elements"][kind].values()] for kind in ELEMENT_KINDS}
+            return Replay(
+                elements, state["pending_ops"], offset, state["generation"], inode, frozenset(state["images"]), state["compacting"]
+            )
+
+    def _append(self, document_id: str, record: Dict[str, Any], image: Optional[Tuple[str, str]] = None) -> None:
+        """
+        Append a record to a document's log.
+
+        Args:
+            document_id: ID of the document
+            record: Log record
+            image: Optional user and image ID the record refers to; the reference
+                is recorded under the log lock so compaction cannot release it early
+
+        Raises:
+            KeyError: If the referenced image does not exist
+        """
+        with self._locked_log(document_id) as log_path:
+            if image and self.image_store:
+                self.image_store.add_reference(*image, document_id)
+            self._write_record(log_path, record)
+
+        self._dirty[document_id] = time.time()
+
+    @staticmethod
+    def _image_reference(element: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+        """Get the user and image ID an element places, if any."""
+        if element.get("image_id"):
+            return element["image_user_id"], element["image_id"]
+        return None
+
+    @staticmethod
+    def _write_record(log_path: str, record: Dict[str, Any]) -> int:
+        """
+        Append a record to a log in a single write; the caller holds the log lock.
+
+        Returns:
+            Length of the written line in bytes
+        """
+        record["at"] = datetime.utcnow().isoformat()
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        return len(line)
+
+    def add_element(self, document_id: str, kind: str, element: Dict[str, Any], user_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Add an element to a document.
+
+        Args:
+            document_id: ID of the document
+            kind: Kind of element, one of "text", "highlight" or "signature"
+            element: Element properties such as page, position and style
+            user_id: Optional ID of the user making the edit
+
+        Returns:
+            The stored element including its generated ID
+
+        Raises:
+            KeyError: If the element places an image that does not exist
+        """
+        # Make sure the document exists before recording edits against it
+        self.document_manager.get_document(document_id)
+
+        element_id = str(uuid.uuid4())
+        element = {**element, "id": element_id, "document_id": document_id}
+        self._append(
+            document_id,
+            {"op": "add", "kind": kind, "id": element_id, "element": element, "user_id": user_id},
+            self._image_reference(element)
+        )
+        return element
+
+    def update_element(self, document_id: str, kind: str, element_id: str, changes: Dict[str, Any], user_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Update an element of a document.
+
+        Args:
+            document_id: ID of the document
+            kind: Kind of element
+            element_id: ID of the element
+            changes: Element properties to change
+            user_id: Optional ID of the user making the edit
+
+        Returns:
+            The updated element
+        """
+        current = self.get_element(document_id, kind, element_id)
+        changes = {key: value for key, value in changes.items() if key not in ("id", "document_id")}
+        self._append(
+            document_id,
+            {"op": "update", "kind": kind, "id": element_id, "element": changes, "user_id": user_id},
+            self._image_reference({**current, **changes})
+        )
+        return {**current, **changes}
+
+    def delete_element(self, document_id: str, kind: str, element_id: str, user_id: Optional[str] = None) -> None:
+        """
+        Delete an element from a document.
+
+        Args:
+            document_id: ID of the document
+            kind: Kind of element
+            element_id: ID of the element
+            user_id: Optional ID of the user making the edit
+        """
+        self.get_element(document_id, kind, element_id)
+        self._append(document_id, {"op": "delete", "kind": kind, "id": element_id, "user_id": user_id})
+
+    def get_element(self, document_id: str, kind: str, element_id: str) -> Dict[str, Any]:
+        """
+        Get a single pending element.
+
+        Raises:
+            KeyError: If the element does not exist or was already flattened
+        """
+        for element in self._replay(document_id).elements[kind]:
+            if element["id"] == element_id:
+                return element
+        raise KeyError(f"{kind.capitalize()} element {element_id} not found in document {document_id}")
+
+    def get_elements(self, document_id: str) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Get every pending element of a document, grouped by kind.
+
+        Args:
+            document_id: ID of the document
+
+        Returns:
+            Mapping of element kinds to lists of elements
+        """
+        return self._replay(document_id).elements
+
+    def pending_ops(self, document_id: str) -> int:
+        """Get the number of operations recorded since the last compaction."""
+        return self._replay(document_id).pending_ops
+
+    def needs_compaction(self, document_id: str) -> bool:
+        """Check whether a document has accumulated enough operations to be compacted."""
+        return self.pending_ops(document_id) >= self.compact_after_ops
+
+    def compact_scheduled(self, document_id: str) -> Optional[str]:
+        """
+        Compact a document in a scheduler slot of its owner, as background compactions do.
+
+        Args:
+            document_id: ID of the document
+
+        Returns:
+            ID of the new version, or None if there was nothing to flatten
+        """
+        if not self.scheduler:
+            return self.compact(document_id)
+
+        document = self.document_manager.get_document(document_id)
+        with self.scheduler.slot(document["owner_id"], document["metadata"].get("page_count") or 1) as tier:
+            return self.compact(document_id, tier=tier)
+
+    def compact(
+        self,
+        document_id: str,
+        user_id: Optional[str] = None,
+        tier: Optional[SubscriptionTier] = None
+    ) -> Optional[str]:
+        """
+        Flatten pending elements into a new document version and truncate the log.
+
+        Edits recorded while the new version is being rendered are kept in the log.
+        Only one compaction of a document runs at a time; a call made while
+        another one is in progress does nothing.
+
+        Args:
+            document_id: ID of the document
+            user_id: Optional ID of the user the new version is attributed to
+            tier: Optional subscription tier whose sandbox limits apply to flattening
+
+        Returns:
+            ID of the new version, or None if there was nothing to flatten or the
+            document is already being compacted
+        """
+        with self._compaction_lock(document_id) as acquired:
+            if not acquired:
+                return None
+            return self._compact(document_id, user_id, tier)
+
+    def _compact(
+        self,
+        document_id: str,
+        user_id: Optional[str],
+        tier: Optional[SubscriptionTier]
+    ) -> Optional[str]:
+        """Compact a document while holding its compaction lock."""
+        from pdf_service.pdf_processor import PDFProcessor
+
+        with self._locked_log(document_id) as log_path:
+            replayed = self._replay(document_id)
+            if replayed.compacting and self._has_version(document_id, replayed.compacting[0]):
+                # Flattened by an attempt that stopped before rewriting the log
+                version_id, offset = replayed.compacting
+                self._rewrite_log(document_id, log_path, replayed, version_id, offset)
+                return version_id
+
+            if not replayed.pending_ops:
+                self._dirty.pop(document_id, None)
+                return None
+
+            # The version ID is recorded first, so that an interrupted attempt is
+            # recognised by the next one instead of flattening the elements twice
+            version_id = str(uuid.uuid4())
+            offset = replayed.offset + self._write_record(log_path, {"op": "compacting", "version_id": version_id})
+
+        # Resolve referenced images to their stored files. The log's references
+        # keep them from being deleted until this compaction has flattened them.
+        elements = replayed.elements
+        for element in elements["signature"]:
+            if element.get("image_id"):
+                element["image_path"] = self.image_store.path(element["image_user_id"], element["image_id"])
+
+        document = self.document_manager.get_document(document_id)
+        with self.temp_workspaces.workspace() as workspace:
+            output_path = workspace.path(suffix=".pdf")
+            source_path = self.document_manager.get_latest_version(document_id)
+            if self.sandbox:
+                self.sandbox.run("flatten_annotations", source_path, elements, output_path, tier=tier or self.tier)
+            else:
+                PDFProcessor.flatten_annotations(source_path, elements, output_path)
+            workspace.account(output_path)
+            self.document_manager.add_document_version(
+                document_id,
+                output_path,
+                user_id or document["owner_id"],
+                comment="Flattened annotations",
+                version_id=version_id
+            )
+
+        with self._locked_log(document_id) as log_path:
+            self._rewrite_log(document_id, log_path, replayed, version_id, offset)
+
+        return version_id
+
+    def _has_version(self, document_id: str, version_id: str) -> bool:
+        return any(version["version_id"] == version_id for version in self.document_manager.get_document(document_id)["versions"])
+
+    def _rewrite_log(self, document_id: str, log_path: str, replayed: Replay, version_id: str, offset: int) -> None:
+        """
+        Replace a log by a base record for a flattened version and the records following it.
+
+        The caller holds the log lock.
+
+        Args:
+            document_id: ID of the document
+            log_path: Path of the document's log
+            replayed: State of the log that was flattened
+            version_id: ID of the flattened version
+            offset: Offset following the compaction's record in the replayed log
+        """
+        # Keep records appended while the version was rendered. The offset
+        # is only meaningful in the log that was replayed.
+        with open(log_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_ino != replayed.inode:
+                raise RuntimeError(f"Annotation log of document {document_id} was replaced during compaction")
+            f.seek(offset)
+            tail = f.read()
+
+        base = {
+            "op": "base",
+            "version_id": version_id,
+            "generation": replayed.generation + 1,
+            "at": datetime.utcnow().isoformat()
+        }
+        partial_path = f"{log_path}.{uuid.uuid4().hex}.tmp"
+        with open(partial_path, 'wb') as f:
+            f.write((json.dumps(base, separators=(",", ":")) + "\n").encode("utf-8"))
+            f.write(tail)
+        os.replace(partial_path, log_path)
+
+        with self._cache_lock:
+            self._cache.pop(document_id, None)
+
+        # Images placed only by flattened records may be deleted again
+        self._release_images(document_id, replayed.images - self._replay(document_id).images)
+
+        if not tail:
+            self._dirty.pop(document_id, None)
+
+    def _release_images(self, document_id: str, images: FrozenSet[Tuple[str, str]]) -> None:
+        """Drop a document's references to images its log no longer places."""
+        if not self.image_store:
+            return
+        for image_user_id, image_id in images:
+            self.image_store.remove_reference(image_user_id, image_id, document_id)
+
+    def purge(self, document_id: str) -> None:
+        """
+        Remove the log of a purged document, releasing the images it places;
+        registered as a purge listener.
+
+        Args:
+            document_id: ID of the purged document
+        """
+        with self._locked_log(document_id) as log_path:
+            try:
+                images = self._replay(document_id).images
+            except ValueError:
+                # A damaged log cannot tell which images it places
+                images = frozenset()
+            if os.path.exists(log_path):
+                os.unlink(log_path)
+            self._release_images(document_id, images)
+        with self._cache_lock:
+            self._cache.pop(document_id, None)
+        self._dirty.pop(document_id, None)
+        for lock_path in (f"{log_path}.lock", f"{log_path}.compact.lock"):
+            try:
+                os.unlink(lock_path)
+            except FileNotFoundError:
+                pass
+
+    def compact_idle(self, idle_seconds: float) -> int:
+        """
+        Compact documents that have not been edited for a while.
+
+        Args:
+            idle_seconds: Minimum time since the last edit
+
+        Returns:
+            Number of documents compacted
+        """
+        compacted = 0
+        now = time.time()
+        for document_id, last_edit in list(self._dirty.items()):
+            if now - last_edit < idle_seconds:
+                continue
+            try:
+                if self.compact_scheduled(document_id):
+                    compacted += 1
+            except AdmissionRejected:
+                # The owner's queue is full; retried on the next pass
+                continue
+            except SandboxLimitExceeded:
+                # Too large to flatten within its limits; the edits stay in the
+                # log and the document is retried after its next edit
+                self._dirty.pop(document_id, None)
+            except ValueError:
+                # The document was deleted; its edits are kept in case it is
+                # restored, and its log is removed once it is purged
+                self._dirty.pop(document_id, None)
+        return compacted
+
+    def start_compactor(self, interval_seconds: float = 60.0, idle_seconds: float = 300.0) -> None:
+        """
+        Start a background thread that compacts documents once editing goes idle.
+
+        Args:
+            interval_seconds: Interval between compaction passes
+            idle_seconds: Time without edits after which a document is compacted
+        """
+        if self._compactor and self._compactor.is_alive():
+            return
+
+        def loop() -> None:
+            while not self._stop_event.wait(interval_seconds):
+                try:
+                    self.compact_idle(idle_seconds)
+                except Exception:
+                    # Compaction is retried on the next pass
+                    pass
+
+        self._stop_event.clear()
+        self._compactor = threading.Thread(target=loop, name="annotation-compactor", daemon=True)
+        self._compactor.start()
+
+    def stop_compactor(self) -> None:
+        """Stop the background compaction thread."""
+        self._stop_event.set()
+        if self._compactor:
+            self._compactor.join(timeout=5)
+            self._compactor = None
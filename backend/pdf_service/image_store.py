@@ -0,0 +1,258 @@
+"""
+Image resource store - deduplicated signature and stamp images per user.
+"""
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Any, List, BinaryIO, Optional, Iterator
+
+from document_service.storage import ShardedLayout
+
+# Image formats accepted for signatures and stamps
+ALLOWED_FORMATS = {"PNG": "png", "JPEG": "jpg", "GIF": "gif", "WEBP": "webp"}
+
+# Largest accepted image, in bytes
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+
+# Size of the chunks used when reading uploads
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class ImageInUse(ValueError):
+    """Raised when deleting an image that pending annotations still refer to."""
+
+
+class ImageStore:
+    """
+    Stores signature and stamp images once per user, keyed by content hash.
+
+    Images are uploaded as raw bytes and referred to by ID from annotations,
+    so repeated placements never carry the image payload again.
+    """
+
+    def __init__(self, storage_dir: str, layout: Optional[ShardedLayout] = None):
+        """
+        Initialize the image store.
+
+        Args:
+            storage_dir: Root storage directory; images are kept below it
+            layout: Optional sharded layout used to partition images by user
+        """
+        self.image_dir = os.path.join(storage_dir, "images")
+        self.layout = layout or ShardedLayout()
+        os.makedirs(self.image_dir, exist_ok=True)
+
+    def _user_dir(self, user_id: str) -> str:
+        tenant = self.layout.tenant(user_id)
+        return os.path.join(self.image_dir, self.layout.shard(tenant, 1)[0], tenant)
+
+    def _metadata_path(self, user_id: str, image_id: str) -> str:
+        return os.path.join(self._user_dir(user_id), f"{image_id}.json")
+
+    def _references_dir(self, user_id: str, image_id: str) -> str:
+        return os.path.join(self._user_dir(user_id), ".refs", image_id)
+
+    @contextmanager
+    def _locked_user(self, user_id: str) -> Iterator[str]:
+        """Hold an exclusive lock on a user's images."""
+        user_dir = self._user_dir(user_id)
+        os.makedirs(user_dir, exist_ok=True)
+        with open(os.path.join(user_dir, ".lock"), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield user_dir
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def save(self, source: BinaryIO, user_id: str, kind: str = "signature") -> Dict[str, Any]:
+        """
+        Store an image, returning the existing record if the user already uploaded it.
+
+        Args:
+            source: Binary file object with the image bytes
+            user_id: ID of the user owning the image
+            kind: Kind of image, e.g. "signature" or "stamp"
+
+        Returns:
+            Image metadata including its ID
+        """
+        from PIL import Image
+
+        user_dir = self._user_dir(user_id)
+        os.makedirs(user_dir, exist_ok=True)
+
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=user_dir, suffix=".part", delete=False) as partial:
+            partial_path = partial.name
+            try:
+                while True:
+                    chunk = source.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > MAX_IMAGE_SIZE:
+                        raise ValueError(f"Image exceeds the maximum size of {MAX_IMAGE_SIZE} bytes")
+                    digest.update(chunk)
+                    partial.write(chunk)
+            except Exception:
+                partial.close()
+                os.unlink(partial_path)
+                raise
+
+        image_id = digest.hexdigest()
+        try:
+            existing = self.get(user_id, image_id)
+            os.unlink(partial_path)
+            return existing
+        except KeyError:
+            pass
+
+        try:
+            with Image.open(partial_path) as image:
+                image_format = image.format
+                width, height = image.size
+            if image_format not in ALLOWED_FORMATS:
+                raise ValueError(f"Unsupported image format {image_format}")
+        except Exception as e:
+            os.unlink(partial_path)
+            raise ValueError(f"Invalid image: {str(e)}")
+
+        extension = ALLOWED_FORMATS[image_format]
+        os.replace(partial_path, os.path.join(user_dir, f"{image_id}.{extension}"))
+
+        metadata = {
+            "id": image_id,
+            "user_id": user_id,
+            "kind": kind,
+            "format": extension,
+            "content_type": Image.MIME.get(image_format, "application/octet-stream"),
+            "width": width,
+            "height": height,
+            "size": size,
+            "created_at": datetime.utcnow().isoformat()
+        }
+        metadata_path = self._metadata_path(user_id, image_id)
+        with open(f"{metadata_path}.tmp", 'w') as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(f"{metadata_path}.tmp", metadata_path)
+
+        return metadata
+
+    def get(self, user_id: str, image_id: str) -> Dict[str, Any]:
+        """
+        Get image metadata.
+
+        Raises:
+            KeyError: If the user has no such image
+        """
+        if not all(c in "0123456789abcdef" for c in image_id) or len(image_id) != 64:
+            raise KeyError(f"Image {image_id} not found")
+        try:
+            with open(self._metadata_path(user_id, image_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise KeyError(f"Image {image_id} not found")
+
+    def path(self, user_id: str, image_id: str) -> str:
+        """
+        Get the path of a stored image.
+
+        Raises:
+            KeyError: If the user has no such image
+        """
+        metadata = self.get(user_id, image_id)
+        return os.path.join(self._user_dir(user_id), f"{image_id}.{metadata['format']}")
+
+    def list(self, user_id: str, kind: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        List a user's images.
+
+        Args:
+            user_id: ID of the user
+            kind: Optional kind to filter by
+
+        Returns:
+            List of image metadata
+        """
+        user_dir = self._user_dir(user_id)
+        if not os.path.isdir(user_dir):
+            return []
+
+        images = []
+        for filename in os.listdir(user_dir):
+            if not filename.endswith(".json"):
+                continue
+            with open(os.path.join(user_dir, filename), 'r') as f:
+                metadata = json.load(f)
+            if kind and metadata.get("kind") != kind:
+                continue
+            images.append(metadata)
+        return images
+
+    def add_reference(self, user_id: str, image_id: str, document_id: str) -> None:
+        """
+        Record that pending annotations of a document refer to an image.
+
+        Args:
+            user_id: ID of the user owning the image
+            image_id: ID of the image
+            document_id: ID of the document whose annotation log refers to it
+
+        Raises:
+            KeyError: If the user has no such image
+        """
+        with self._locked_user(user_id):
+            self.get(user_id, image_id)
+            references_dir = self._references_dir(user_id, image_id)
+            os.makedirs(references_dir, exist_ok=True)
+            with open(os.path.join(references_dir, document_id), 'a'):
+                pass
+
+    def remove_reference(self, user_id: str, image_id: str, document_id: str) -> None:
+        """
+        Drop a document's reference to an image once its annotations were flattened.
+
+        Args:
+            user_id: ID of the user owning the image
+            image_id: ID of the image
+            document_id: ID of the document
+        """
+        with self._locked_user(user_id):
+            references_dir = self._references_dir(user_id, image_id)
+            try:
+                os.unlink(os.path.join(references_dir, document_id))
+                os.rmdir(references_dir)
+            except OSError:
+                # Already removed, or other documents still refer to the image
+                pass
+
+    def references(self, user_id: str, image_id: str) -> List[str]:
+        """Get the IDs of documents whose pending annotations refer to an image."""
+        try:
+            return sorted(os.listdir(self._references_dir(user_id, image_id)))
+        except FileNotFoundError:
+            return []
+
+    def delete(self, user_id: str, image_id: str) -> None:
+        """
+        Delete an image. Versions that already embed it are unaffected.
+
+        Raises:
+            KeyError: If the user has no such image
+            ImageInUse: If pending annotations of a document still refer to it
+        """
+        with self._locked_user(user_id):
+            image_path = self.path(user_id, image_id)
+            documents = self.references(user_id, image_id)
+            if documents:
+                raise ImageInUse(
+                    f"Image {image_id} is still placed in pending annotations of {len(documents)} document(s); "
+                    "compact them before deleting it"
+                )
+            os.unlink(self._metadata_path(user_id, image_id))
+            os.unlink(image_path)
@@ -0,0 +1,278 @@
+"""
+Optical character recognition of scanned pages, run in a process pool.
+"""
+import hashlib
+import importlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional
+
+from common.metrics import metrics
+from pdf_service.pdf_processor import PDF_LIBRARIES
+
+# Pages with fewer extracted characters than this are considered to have no text layer
+MIN_TEXT_CHARS = 8
+
+# Words recognized with a lower confidence (0-100) are dropped
+MIN_WORD_CONFIDENCE = 30
+
+
+def ocr_available(tesseract_cmd: str = "tesseract") -> bool:
+    """
+    Check whether the OCR dependencies are installed.
+
+    Args:
+        tesseract_cmd: Name or path of the Tesseract executable
+
+    Returns:
+        True if pytesseract, pypdfium2 and Tesseract itself are available
+    """
+    return (
+        importlib.util.find_spec("pytesseract") is not None
+        and importlib.util.find_spec("pypdfium2") is not None
+        and shutil.which(tesseract_cmd) is not None
+    )
+
+
+def _init_worker(tesseract_cmd: str) -> None:
+    """Set up a pool process; pages run in parallel, so Tesseract itself uses one thread."""
+    import pytesseract
+
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+
+
+def _recognize_page(file_path: str, page_number: int, dpi: int, language: str) -> Dict[str, Any]:
+    """
+    Render one page and recognize its text.
+
+    Word boxes are returned in points, relative to the bottom-left corner of
+    the page as displayed, i.e. after its rotation is applied.
+    """
+    import pypdfium2
+    import pytesseract
+
+    pdf = pypdfium2.PdfDocument(file_path)
+    try:
+        page = pdf[page_number - 1]
+        rotation = page.get_rotation()
+        image = page.render(scale=dpi / 72).to_pil()
+    finally:
+        pdf.close()
+
+    data = pytesseract.image_to_data(image, lang=language, output_type=pytesseract.Output.DICT)
+    points = 72 / dpi
+    page_height = image.height * points
+
+    words = []
+    lines: Dict[tuple, List[str]] = {}
+    for index, word in enumerate(data["text"]):
+        word = word.strip()
+        if not word or float(data["conf"][index]) < MIN_WORD_CONFIDENCE:
+            continue
+        left, top = data["left"][index] * points, data["top"][index] * points
+        width, height = data["width"][index] * points, data["height"][index] * points
+        words.append([
+            round(left, 2), round(page_height - top - height, 2),
+            round(left + width, 2), round(page_height - top, 2),
+            word
+        ])
+        line = (data["block_num"][index], data["par_num"][index], data["line_num"][index])
+        lines.setdefault(line, []).append(word)
+
+    return {
+        "text": "\n".join(" ".join(line) for _, line in sorted(lines.items())),
+        "words": words,
+        "rotation": rotation
+    }
+
+
+class OCREngine:
+    """
+    Recognizes the text of pages that have no text layer.
+
+    Pages are rendered and recognized in parallel in a pool of processes.
+    Results are cached in the storage backend by page fingerprint, so a page
+    is only recognized once, however many versions and documents contain it;
+    a new version that changes some pages only recognizes those.
+    """
+
+    def __init__(
+        self,
+        backend,
+        workers: int = 2,
+        language: str = "eng",
+        dpi: int = 300,
+        tesseract_cmd: str = "tesseract"
+    ):
+        """
+        Initialize the engine.
+
+        Args:
+            backend: ``StorageBackend`` the results are cached in
+            workers: Number of pool processes
+            language: Tesseract language(s), e.g. "eng" or "eng+deu"
+            dpi: Resolution pages are rendered at
+            tesseract_cmd: Name or path of the Tesseract executable
+        """
+        self.backend = backend
+        self.workers = workers
+        self.language = language
+        self.dpi = dpi
+        self.tesseract_cmd = tesseract_cmd
+        # Results depend on the settings as well as on the page
+        settings = json.dumps([language, dpi]).encode("utf-8")
+        self._settings_key = hashlib.blake2b(settings, digest_size=8).hexdigest()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    def cache_key(self, fingerprint: Dict[str, Any]) -> str:
+        """
+        Get the storage key of the cached result of a page.
+
+        Pages are identified by their content and images; their text layer
+        is what OCR replaces, so it is not part of the key.
+
+        Args:
+            fingerprint: Page fingerprint as returned by ``PDFProcessor.page_fingerprints``
+
+        Returns:
+            Storage key
+        """
+        page_key = hashlib.blake2b(
+            json.dumps([fingerprint["content"], fingerprint["images"]]).encode("utf-8"),
+            digest_size=16
+        ).hexdigest()
+        return f"ocr/{self._settings_key}/{page_key[:2]}/{page_key}.json"
+
+    def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.backend.open_path(key), 'r') as f:
+                return json.load(f)
+        except (ValueError, FileNotFoundError):
+            return None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                if not ocr_available(self.tesseract_cmd):
+                    raise ImportError("OCR requires pytesseract, pypdfium2 and Tesseract")
+                # Waits for imports still running in other threads before forking
+                for module_name in PDF_LIBRARIES:
+                    importlib.import_module(module_name)
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("fork"),
+                    initializer=_init_worker,
+                    initargs=(self.tesseract_cmd,)
+                )
+            return self._pool
+
+    def pages_without_text(self, text: Dict[int, str]) -> List[int]:
+        """
+        Find the pages that have no usable text layer.
+
+        Args:
+            text: Extracted text by page number
+
+        Returns:
+            Page numbers in ascending order
+        """
+        return sorted(page for page, content in text.items() if len(content.strip()) < MIN_TEXT_CHARS)
+
+    def recognize(self, file_path: str, fingerprints: Dict[int, Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+        """
+        Recognize the text of pages, reusing cached results.
+
+        Args:
+            file_path: Path to the PDF file
+            fingerprints: Fingerprints of the pages to recognize, by page number
+
+        Returns:
+            Results by page number, each with the page "text" and the "words"
+            with their boxes
+
+        Raises:
+            ImportError: If the OCR dependencies are not installed
+            ValueError: If a page cannot be recognized
+        """
+        results: Dict[int, Dict[str, Any]] = {}
+        pending = {}
+        for page, fingerprint in fingerprints.items():
+            key = self.cache_key(fingerprint)
+            cached = self._load(key)
+            if cached is not None:
+                results[page] = cached
+            else:
+                pending[page] = key
+        metrics.inc("ocr_pages_total", len(results), "Pages processed by OCR", result="cached")
+
+        if not pending:
+            return results
+
+        started = time.perf_counter()
+        executor = self._executor()
+        futures = {
+            page: executor.submit(_recognize_page, file_path, page, self.dpi, self.language)
+            for page in pending
+        }
+        try:
+            for page, future in futures.items():
+                results[page] = future.result()
+                self.backend.put_file(
+                    pending[page],
+                    io.BytesIO(json.dumps(results[page], separators=(",", ":")).encode("utf-8"))
+                )
+        except BrokenProcessPool as e:
+            # A pool process died, e.g. on a hostile page; start a new pool next time
+            with self._pool_lock:
+                if self._pool is executor:
+                    self._pool = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise ValueError(f"OCR worker terminated: {str(e)}")
+        except ImportError:
+            raise
+        except Exception as e:
+            for future in futures.values():
+                future.cancel()
+            raise ValueError(f"Error recognizing text: {str(e)}")
+
+        metrics.inc("ocr_pages_total", len(pending), "Pages processed by OCR", result="recognized")
+        metrics.observe("ocr_seconds", time.perf_counter() - started, "Time spent recognizing the pages of a version")
+        return results
+
+    def recognize_missing(
+        self,
+        file_path: str,
+        text: Dict[int, str],
+        fingerprints: List[Dict[str, Any]]
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        Recognize the pages of a file that have no text layer.
+
+        Args:
+            file_path: Path to the PDF file
+            text: Extracted text by page number
+            fingerprints: Fingerprints of every page, in page order
+
+        Returns:
+            Results by page number for the pages without a text layer
+        """
+        pages = [page for page in self.pages_without_text(text) if page <= len(fingerprints)]
+        metrics.inc("ocr_pages_total", len(text) - len(pages), "Pages processed by OCR", result="skipped")
+        return self.recognize(file_path, {page: fingerprints[page - 1] for page in pages})
+
+    def close(self) -> None:
+        """Shut down the process pool."""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -1,22 +1,144 @@
 """
 PDF Processing Service - Core functionality for PDF manipulation.
 """
+import functools
+import importlib
+import io
 import os
+import sys
+import time
 import uuid
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 from pathlib import Path
-import tempfile
-
-from pypdf import PdfReader, PdfWriter
-from pikepdf import Pdf
-import PyPDFForm
 
 from common.models import APIResponse
+from common.metrics import metrics
+
+# PDF libraries are imported on first use, or up front by PDFProcessor.warm_up(),
+# so that importing the service does not pay for their native dependencies
+PDF_LIBRARIES = ("pypdf", "pikepdf", "PyPDFForm", "reportlab.pdfgen.canvas", "reportlab.lib.utils")
+
+# Standard fonts used for text elements, loaded by PDFProcessor.preload_resources()
+STANDARD_FONTS = (
+    "Helvetica", "Helvetica-Bold", "Helvetica-Oblique", "Helvetica-BoldOblique",
+    "Times-Roman", "Times-Bold", "Times-Italic", "Times-BoldItalic",
+    "Courier", "Courier-Bold", "Courier-Oblique", "Courier-BoldOblique"
+)
+
+# Watermark texts rendered ahead of time by PDFProcessor.preload_resources()
+STANDARD_WATERMARKS = ("CONFIDENTIAL", "DRAFT", "COPY", "SAMPLE")
+
+# Operations that can be chained by PDFProcessor.run_pipeline(), with the
+# arguments each one takes; names and arguments match the standalone methods
+PIPELINE_OPERATIONS = {
+    "extract_pages": ("pages",),
+    "rotate_pages": ("rotations",),
+    "add_watermark": ("watermark_text",),
+    "compress_pdf": (),
+}
+
+
+@functools.lru_cache(maxsize=64)
+def _render_watermark(watermark_text: str) -> bytes:
+    """
+    Render a single-page watermark overlay.
+    
+    Overlays are cached, so repeated watermarks with the same text are only
+    rendered once per process; overlays rendered before the workers are forked
+    are shared by all of them.
+    
+    Args:
+        watermark_text: Text to use as watermark
+        
+    Returns:
+        The overlay as PDF bytes
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+    
+    watermark_buffer = io.BytesIO()
+    c = canvas.Canvas(watermark_buffer, pagesize=letter)
+    width, height = letter
+    
+    # Set transparency
+    c.setFillAlpha(0.3)
+    # Set font and size
+    c.setFont("Helvetica", 60)
+    # Rotate text and position it
+    c.saveState()
+    c.translate(width/2, height/2)
+    c.rotate(45)
+    c.drawCentredString(0, 0, watermark_text)
+    c.restoreState()
+    c.save()
+    
+    return watermark_buffer.getvalue()
 
 
 class PDFProcessor:
     """Core PDF processing functionality."""
     
+    @staticmethod
+    def warm_up() -> Dict[str, float]:
+        """
+        Import the PDF libraries ahead of the first request.
+        
+        Returns:
+            Mapping of module names to the seconds spent importing them;
+            modules that were already loaded report 0
+        """
+        timings = {}
+        for module_name in PDF_LIBRARIES:
+            if module_name in sys.modules:
+                timings[module_name] = 0.0
+                continue
+            start = time.perf_counter()
+            importlib.import_module(module_name)
+            timings[module_name] = time.perf_counter() - start
+            metrics.set_gauge(
+                "pdf_library_import_seconds",
+                timings[module_name],
+                "Time spent importing a PDF library",
+                module=module_name
+            )
+        return timings
+    
+    @staticmethod
+    def preload_resources() -> None:
+        """
+        Load fonts and render the standard watermark overlays.
+        
+        Called before workers are forked so that they share these resources.
+        """
+        from reportlab.pdfbase import pdfmetrics
+        
+        for font_name in STANDARD_FONTS:
+            pdfmetrics.getFont(font_name)
+        for watermark_text in STANDARD_WATERMARKS:
+            _render_watermark(watermark_text)
+    
+    @staticmethod
+    def _write_output(writer: "PdfWriter", output_path: str) -> str:
+        """
+        Write a PDF to the output path, removing the partial file on failure.
+        
+        Args:
+            writer: Writer holding the PDF to serialize
+            output_path: Path where the PDF will be saved
+            
+        Returns:
+            Path to the written PDF file
+        """
+        try:
+            with open(output_path, 'wb') as f:
+                writer.write(f)
+        except Exception:
+            if os.path.exists(output_path):
+                os.unlink(output_path)
+            raise
+        
+        return output_path
+    
     @staticmethod
     def get_pdf_info(file_path: str) -> Dict[str, Any]:
         """
@@ -29,6 +151,8 @@ class PDFProcessor:
             Dictionary containing PDF metadata
         """
         try:
+            from pypdf import PdfReader
+            
             # Use pypdf for basic info
             with open(file_path, 'rb') as f:
                 reader = PdfReader(f)
@@ -45,6 +169,8 @@ class PDFProcessor:
                             # Convert from possible PDF objects to string
                             info['metadata'][key] = str(value)
                 
+                info['document_info'] = PDFProcessor._document_info(reader.metadata)
+                
                 # Check if the document has form fields
                 info['has_form'] = len(reader.get_fields() or {}) > 0
                 
@@ -52,6 +178,50 @@ class PDFProcessor:
         except Exception as e:
             raise ValueError(f"Error extracting PDF info: {str(e)}")
     
+    @staticmethod
+    def _document_info(metadata) -> Dict[str, Any]:
+        """
+        Normalize a PDF document information dictionary.
+        
+        Args:
+            metadata: pypdf document information, or None
+            
+        Returns:
+            Title, author, subject, keywords and ISO-formatted creation and
+            modification dates; missing or malformed entries are None
+        """
+        info = {
+            'title': None,
+            'author': None,
+            'subject': None,
+            'keywords': [],
+            'creation_date': None,
+            'modification_date': None
+        }
+        if not metadata:
+            return info
+        
+        for field in ('title', 'author', 'subject'):
+            value = getattr(metadata, field, None)
+            if value:
+                info[field] = str(value).strip() or None
+        
+        keywords = metadata.get('/Keywords')
+        if keywords:
+            separator = ';' if ';' in str(keywords) else ','
+            info['keywords'] = [keyword.strip() for keyword in str(keywords).split(separator) if keyword.strip()]
+        
+        for field in ('creation_date', 'modification_date'):
+            try:
+                value = getattr(metadata, field)
+            except Exception:
+                # Malformed PDF date strings are common, treat them as missing
+                value = None
+            if value:
+                info[field] = value.isoformat()
+        
+        return info
+    
     @staticmethod
     def merge_pdfs(file_paths: List[str], output_path: str) -> str:
         """
@@ -65,15 +235,14 @@ class PDFProcessor:
             Path to the merged PDF file
         """
         try:
+            from pypdf import PdfWriter
+            
             merger = PdfWriter()
             
             for path in file_paths:
                 merger.append(path)
                 
-            with open(output_path, 'wb') as f:
-                merger.write(f)
-                
-            return output_path
+            return PDFProcessor._write_output(merger, output_path)
         except Exception as e:
             raise ValueError(f"Error merging PDFs: {str(e)}")
     
@@ -90,6 +259,8 @@ class PDFProcessor:
             List of paths to the individual PDF pages
         """
         try:
+            from pypdf import PdfReader, PdfWriter
+            
             reader = PdfReader(file_path)
             output_files = []
             
@@ -98,10 +269,7 @@ class PDFProcessor:
                 writer.add_page(page)
                 output_file = os.path.join(output_dir, f"page_{i+1}.pdf")
                 
-                with open(output_file, 'wb') as f:
-                    writer.write(f)
-                
-                output_files.append(output_file)
+                output_files.append(PDFProcessor._write_output(writer, output_file))
                 
             return output_files
         except Exception as e:
@@ -121,6 +289,8 @@ class PDFProcessor:
             Path to the new PDF file with extracted pages
         """
         try:
+            from pypdf import PdfReader, PdfWriter
+            
             reader = PdfReader(file_path)
             writer = PdfWriter()
             
@@ -129,10 +299,7 @@ class PDFProcessor:
                 if 1 <= page_num <= len(reader.pages):
                     writer.add_page(reader.pages[page_num - 1])
             
-            with open(output_path, 'wb') as f:
-                writer.write(f)
-                
-            return output_path
+            return PDFProcessor._write_output(writer, output_path)
         except Exception as e:
             raise ValueError(f"Error extracting pages: {str(e)}")
     
@@ -150,6 +317,8 @@ class PDFProcessor:
             Path to the rotated PDF file
         """
         try:
+            from pypdf import PdfReader, PdfWriter
+            
             reader = PdfReader(file_path)
             writer = PdfWriter()
             
@@ -163,10 +332,7 @@ class PDFProcessor:
                     # Add the page without rotation
                     writer.add_page(page)
             
-            with open(output_path, 'wb') as f:
-                writer.write(f)
-                
-            return output_path
+            return PDFProcessor._write_output(writer, output_path)
         except Exception as e:
             raise ValueError(f"Error rotating pages: {str(e)}")
     
@@ -182,6 +348,9 @@ class PDFProcessor:
             Dictionary containing form field information
         """
         try:
+            import PyPDFForm
+            from pypdf import PdfReader
+            
             # Use PyPDFForm to get form field information
             pdf_form = PyPDFForm.PdfWrapper(file_path)
             fields = pdf_form.get_fields()
@@ -235,6 +404,8 @@ class PDFProcessor:
             Path to the filled PDF file
         """
         try:
+            import PyPDFForm
+            
             # Use PyPDFForm to fill the form
             pdf_form = PyPDFForm.PdfWrapper(file_path).fill(form_data)
             
@@ -259,32 +430,11 @@ class PDFProcessor:
             Path to the watermarked PDF file
         """
         try:
-            # Create a temporary file for the watermark
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
-                watermark_path = tmp.name
-            
-            # Create a watermark PDF using reportlab
-            from reportlab.pdfgen import canvas
-            from reportlab.lib.pagesizes import letter
-            
-            c = canvas.Canvas(watermark_path, pagesize=letter)
-            width, height = letter
-            
-            # Set transparency
-            c.setFillAlpha(0.3)
-            # Set font and size
-            c.setFont("Helvetica", 60)
-            # Rotate text and position it
-            c.saveState()
-            c.translate(width/2, height/2)
-            c.rotate(45)
-            c.drawCentredString(0, 0, watermark_text)
-            c.restoreState()
-            c.save()
+            from pypdf import PdfReader, PdfWriter
             
             # Apply the watermark to each page
             reader = PdfReader(file_path)
-            watermark_reader = PdfReader(watermark_path)
+            watermark_reader = PdfReader(io.BytesIO(_render_watermark(watermark_text)))
             watermark_page = watermark_reader.pages[0]
             
             writer = PdfWriter()
@@ -293,15 +443,162 @@ class PDFProcessor:
                 page.merge_page(watermark_page)
                 writer.add_page(page)
             
-            with open(output_path, 'wb') as f:
-                writer.write(f)
+            return PDFProcessor._write_output(writer, output_path)
+        except Exception as e:
+            raise ValueError(f"Error adding watermark: {str(e)}")
+    
+    @staticmethod
+    def flatten_annotations(file_path: str, elements: Dict[str, List[Dict[str, Any]]], output_path: str) -> str:
+        """
+        Draw text, highlight and signature elements permanently onto their pages.
+        
+        Element positions are in PDF points measured from the top-left corner of
+        the page, and pages are numbered from 0, matching the editor.
+        
+        Args:
+            file_path: Path to the PDF file
+            elements: Mapping of element kinds ("text", "highlight", "signature") to element lists
+            output_path: Path where the flattened PDF will be saved
             
-            # Clean up the temporary watermark file
-            os.unlink(watermark_path)
+        Returns:
+            Path to the flattened PDF file
+        """
+        try:
+            from pypdf import PdfReader, PdfWriter
+            from reportlab.pdfgen import canvas
+            
+            writer = PdfWriter(clone_from=file_path)
+            
+            # Group elements by page, keeping their drawing order
+            by_page: Dict[int, List[Tuple[str, Dict[str, Any]]]] = {}
+            for kind in ("highlight", "signature", "text"):
+                for element in elements.get(kind, []):
+                    page_index = int(element.get("page", 0))
+                    if 0 <= page_index < len(writer.pages):
+                        by_page.setdefault(page_index, []).append((kind, element))
+            
+            if not by_page:
+                return PDFProcessor._write_output(writer, output_path)
+            
+            # Render one overlay page per annotated page, so resources such as a
+            # repeated signature image are stored once in the overlay document
+            overlay_buffer = io.BytesIO()
+            overlay = canvas.Canvas(overlay_buffer)
+            images: Dict[str, Any] = {}
+            page_indexes = sorted(by_page)
+            for page_index in page_indexes:
+                box = writer.pages[page_index].mediabox
+                width, height = float(box.width), float(box.height)
+                overlay.setPageSize((width, height))
+                overlay.translate(float(box.left), float(box.bottom))
                 
-            return output_path
+                for kind, element in by_page[page_index]:
+                    if kind == "text":
+                        PDFProcessor._draw_text(overlay, element, height)
+                    elif kind == "highlight":
+                        PDFProcessor._draw_highlight(overlay, element, height)
+                    else:
+                        PDFProcessor._draw_image(overlay, element, height, images)
+                
+                overlay.showPage()
+            overlay.save()
+            
+            overlay_buffer.seek(0)
+            overlay_reader = PdfReader(overlay_buffer)
+            for overlay_page, page_index in zip(overlay_reader.pages, page_indexes):
+                writer.pages[page_index].merge_page(overlay_page)
+            
+            return PDFProcessor._write_output(writer, output_path)
         except Exception as e:
-            raise ValueError(f"Error adding watermark: {str(e)}")
+            raise ValueError(f"Error flattening annotations: {str(e)}")
+    
+    @staticmethod
+    def _font_name(style: Dict[str, Any]) -> str:
+        """Map an editor text style to one of the standard PDF fonts."""
+        family = str(style.get("fontFamily", "Helvetica")).lower()
+        bold = str(style.get("fontWeight", "normal")).lower() in ("bold", "700", "800", "900")
+        italic = str(style.get("fontStyle", "normal")).lower() in ("italic", "oblique")
+        
+        if "times" in family or family == "serif":
+            base, suffixes = "Times", {(False, False): "-Roman", (True, False): "-Bold", (False, True): "-Italic", (True, True): "-BoldItalic"}
+        elif "courier" in family or "mono" in family:
+            base, suffixes = "Courier", {(False, False): "", (True, False): "-Bold", (False, True): "-Oblique", (True, True): "-BoldOblique"}
+        else:
+            base, suffixes = "Helvetica", {(False, False): "", (True, False): "-Bold", (False, True): "-Oblique", (True, True): "-BoldOblique"}
+        return base + suffixes[(bold, italic)]
+    
+    @staticmethod
+    def _draw_text(overlay, element: Dict[str, Any], page_height: float) -> None:
+        """Draw a text element on an overlay canvas."""
+        from reportlab.lib.colors import HexColor
+        
+        style = element.get("style") or {}
+        position = element.get("position") or {}
+        font_size = float(style.get("fontSize", 12))
+        align = style.get("textAlign", "left")
+        x = float(position.get("x", 0))
+        y = page_height - float(position.get("y", 0)) - font_size
+        
+        overlay.setFont(PDFProcessor._font_name(style), font_size)
+        overlay.setFillColor(HexColor(style.get("color", "#000000")))
+        for line in str(element.get("content", "")).split("\n"):
+            if align == "center":
+                overlay.drawCentredString(x, y, line)
+            elif align == "right":
+                overlay.drawRightString(x, y, line)
+            else:
+                overlay.drawString(x, y, line)
+            y -= font_size * 1.2
+    
+    @staticmethod
+    def _draw_highlight(overlay, element: Dict[str, Any], page_height: float) -> None:
+        """Draw a translucent highlight rectangle on an overlay canvas."""
+        from reportlab.lib.colors import HexColor
+        
+        position = element.get("position") or {}
+        width = float(element.get("width", 100))
+        height = float(element.get("height", 20))
+        
+        overlay.saveState()
+        overlay.setFillColor(HexColor(element.get("color", "#ffff00")))
+        overlay.setFillAlpha(0.4)
+        overlay.rect(float(position.get("x", 0)), page_height - float(position.get("y", 0)) - height, width, height, stroke=0, fill=1)
+        overlay.restoreState()
+    
+    @staticmethod
+    def _draw_image(overlay, element: Dict[str, Any], page_height: float, images: Dict[str, Any]) -> None:
+        """
+        Draw a signature or stamp image on an overlay canvas.
+        
+        Stored images are referenced by ``image_path`` and loaded once per
+        overlay, so every placement of the same image shares one image XObject.
+        Inline base64 ``image_data`` is still accepted for older elements.
+        """
+        import base64
+        from reportlab.lib.utils import ImageReader
+        
+        image_path = element.get("image_path")
+        if image_path:
+            if image_path not in images:
+                images[image_path] = ImageReader(image_path)
+            image = images[image_path]
+        else:
+            image_data = element.get("image_data", "")
+            if "," in image_data and image_data.startswith("data:"):
+                image_data = image_data.split(",", 1)[1]
+            image = ImageReader(io.BytesIO(base64.b64decode(image_data)))
+        
+        position = element.get("position") or {}
+        width = float(element.get("width", 150))
+        height = float(element.get("height", 50))
+        overlay.drawImage(
+            image,
+            float(position.get("x", 0)),
+            page_height - float(position.get("y", 0)) - height,
+            width=width,
+            height=height,
+            mask="auto"
+        )
     
     @staticmethod
     def compress_pdf(file_path: str, output_path: str) -> str:
@@ -316,6 +613,8 @@ class PDFProcessor:
             Path to the compressed PDF file
         """
         try:
+            from pikepdf import Pdf
+            
             # Use pikepdf for compression
             with Pdf.open(file_path) as pdf:
                 # Save with compression settings
@@ -327,8 +626,251 @@ class PDFProcessor:
                 
             return output_path
         except Exception as e:
+            if os.path.exists(output_path):
+                os.unlink(output_path)
             raise ValueError(f"Error compressing PDF: {str(e)}")
     
+    @staticmethod
+    def validate_pipeline(operations: List[Dict[str, Any]]) -> None:
+        """
+        Check that a pipeline only uses known operations with their arguments.
+        
+        Args:
+            operations: Ordered operations, each with an "op" name and its arguments
+            
+        Raises:
+            ValueError: If an operation is unknown or misses an argument
+        """
+        if not operations:
+            raise ValueError("Pipeline has no operations")
+        for index, operation in enumerate(operations):
+            name = operation.get("op")
+            if name not in PIPELINE_OPERATIONS:
+                raise ValueError(f"Unknown pipeline operation at step {index + 1}: {name}")
+            for argument in PIPELINE_OPERATIONS[name]:
+                if operation.get(argument) is None:
+                    raise ValueError(f"Pipeline operation {name} at step {index + 1} requires {argument}")
+    
+    @staticmethod
+    def run_pipeline(file_path: str, operations: List[Dict[str, Any]], output_path: str) -> str:
+        """
+        Apply a sequence of operations to a PDF file in a single pass.
+        
+        The file is parsed once, every operation is applied to the same
+        in-memory document, and the result is serialized once, instead of
+        writing and re-parsing a complete PDF after each step. The operations
+        behave like their standalone counterparts; compression takes effect
+        when the result is saved, wherever it appears in the sequence.
+        
+        Args:
+            file_path: Path to the PDF file
+            operations: Ordered operations, each with an "op" name from
+                ``PIPELINE_OPERATIONS`` and that operation's arguments
+            output_path: Path where the resulting PDF will be saved
+            
+        Returns:
+            Path to the resulting PDF file
+        """
+        PDFProcessor.validate_pipeline(operations)
+        
+        try:
+            from pikepdf import Pdf, Rectangle
+            
+            compress = False
+            with Pdf.open(file_path) as pdf:
+                for operation in operations:
+                    name = operation["op"]
+                    if name == "extract_pages":
+                        # Selected pages may repeat; repeated pages are copied
+                        selected = [
+                            pdf.pages[page_num - 1]
+                            for page_num in operation["pages"]
+                            if 1 <= page_num <= len(pdf.pages)
+                        ]
+                        del pdf.pages[:]
+                        pdf.pages.extend(selected)
+                    elif name == "rotate_pages":
+                        for page_num, angle in operation["rotations"].items():
+                            page_num = int(page_num)
+                            if 1 <= page_num <= len(pdf.pages):
+                                pdf.pages[page_num - 1].rotate(angle, relative=True)
+                    elif name == "add_watermark":
+                        # The overlay is embedded once and referenced from every page
+                        with Pdf.open(io.BytesIO(_render_watermark(operation["watermark_text"]))) as watermark:
+                            watermark_page = watermark.pages[0]
+                            overlay = pdf.copy_foreign(watermark_page.as_form_xobject())
+                            overlay_rect = Rectangle(*[float(value) for value in watermark_page.mediabox])
+                        for page in pdf.pages:
+                            page.add_overlay(overlay, overlay_rect)
+                    elif name == "compress_pdf":
+                        compress = True
+                
+                if compress:
+                    pdf.save(output_path,
+                             compress_streams=True,
+                             object_stream_mode=1,
+                             normalize_content=True,
+                             linearize=False)
+                else:
+                    pdf.save(output_path)
+            
+            return output_path
+        except Exception as e:
+            if os.path.exists(output_path):
+                os.unlink(output_path)
+            raise ValueError(f"Error running pipeline: {str(e)}")
+    
+    @staticmethod
+    def add_text_layer(file_path: str, pages: Dict[int, Dict[str, Any]], output_path: str) -> str:
+        """
+        Add invisible, selectable text over recognized pages.
+        
+        Args:
+            file_path: Path to the PDF file
+            pages: OCR results by page number (1-based), each with "words" as
+                ``[x0, y0, x1, y1, text]`` boxes in points relative to the
+                bottom-left corner of the page as displayed
+            output_path: Path where the resulting PDF will be saved
+            
+        Returns:
+            Path to the resulting PDF file
+        """
+        try:
+            from pypdf import PdfReader, PdfWriter
+            from reportlab.pdfgen import canvas
+            from reportlab.pdfbase.pdfmetrics import stringWidth
+            
+            reader = PdfReader(file_path)
+            writer = PdfWriter()
+            
+            for index, page in enumerate(reader.pages):
+                result = pages.get(index + 1) or pages.get(str(index + 1))
+                if result and result["words"]:
+                    left, bottom = float(page.mediabox.left), float(page.mediabox.bottom)
+                    width, height = float(page.mediabox.width), float(page.mediabox.height)
+                    rotation = page.rotation % 360
+                    
+                    overlay_buffer = io.BytesIO()
+                    overlay = canvas.Canvas(overlay_buffer, pagesize=(left + width, bottom + height))
+                    for x0, y0, x1, y1, word in result["words"]:
+                        font_size = max(y1 - y0, 1)
+                        # Map the displayed position back to unrotated page space
+                        if rotation == 90:
+                            x, y = width - y0, x0
+                        elif rotation == 180:
+                            x, y = width - x0, height - y0
+                        elif rotation == 270:
+                            x, y = y0, height - x0
+                        else:
+                            x, y = x0, y0
+                        
+                        overlay.saveState()
+                        overlay.translate(left + x, bottom + y)
+                        overlay.rotate(rotation)
+                        text = overlay.beginText(0, 0)
+                        # Render mode 3 draws nothing but keeps the text selectable
+                        text.setTextRenderMode(3)
+                        text.setFont("Helvetica", font_size)
+                        text.setHorizScale(100 * (x1 - x0) / max(stringWidth(word, "Helvetica", font_size), 0.01))
+                        text.textOut(word)
+                        overlay.drawText(text)
+                        overlay.restoreState()
+                    overlay.save()
+                    
+                    page.merge_page(PdfReader(io.BytesIO(overlay_buffer.getvalue())).pages[0])
+                writer.add_page(page)
+            
+            return PDFProcessor._write_output(writer, output_path)
+        except Exception as e:
+            raise ValueError(f"Error adding text layer: {str(e)}")
+    
+    @staticmethod
+    def render_thumbnail(file_path: str, max_size: int = 256, page_number: int = 1) -> bytes:
+        """
+        Render a page as a PNG thumbnail.
+        
+        Rendering uses the optional pypdfium2 package.
+        
+        Args:
+            file_path: Path to the PDF file
+            max_size: Maximum width or height of the thumbnail in pixels
+            page_number: Page to render (1-based indexing)
+            
+        Returns:
+            PNG image bytes
+            
+        Raises:
+            ImportError: If pypdfium2 is not installed
+        """
+        import pypdfium2
+        
+        try:
+            pdf = pypdfium2.PdfDocument(file_path)
+            try:
+                page = pdf[page_number - 1]
+                width, height = page.get_size()
+                image = page.render(scale=max_size / max(width, height, 1)).to_pil()
+                
+                buffer = io.BytesIO()
+                image.save(buffer, format="PNG", optimize=True)
+                return buffer.getvalue()
+            finally:
+                pdf.close()
+        except Exception as e:
+            raise ValueError(f"Error rendering thumbnail: {str(e)}")
+    
+    @staticmethod
+    def page_fingerprints(file_path: str) -> List[Dict[str, Any]]:
+        """
+        Compute fingerprints of every page of a PDF file.
+        
+        Each page gets a hash of its decoded content stream, a hash of its
+        extracted text and a hash per embedded image, so that two versions can
+        be compared page by page without parsing them again.
+        
+        Args:
+            file_path: Path to the PDF file
+            
+        Returns:
+            List of fingerprints in page order, each with "content", "text" and "images"
+        """
+        try:
+            import hashlib
+            from pypdf import PdfReader
+            
+            def digest(data: bytes) -> str:
+                return hashlib.blake2b(data, digest_size=16).hexdigest()
+            
+            reader = PdfReader(file_path)
+            fingerprints = []
+            
+            for page in reader.pages:
+                contents = page.get_contents()
+                content_data = contents.get_data() if contents is not None else b""
+                
+                images = []
+                resources = page.get("/Resources")
+                xobjects = resources.get_object().get("/XObject") if resources else None
+                for _, xobject in sorted((xobjects.get_object() if xobjects else {}).items()):
+                    xobject = xobject.get_object()
+                    if xobject.get("/Subtype") != "/Image":
+                        continue
+                    try:
+                        images.append(digest(xobject.get_data()))
+                    except Exception:
+                        # Undecodable image data is compared by its encoded form
+                        images.append(digest(xobject._data))
+                
+                fingerprints.append({
+                    "content": digest(content_data),
+                    "text": digest(page.extract_text().encode("utf-8")),
+                    "images": images
+                })
+            
+            return fingerprints
+        except Exception as e:
+            raise ValueError(f"Error computing page fingerprints: {str(e)}")
+    
     @staticmethod
     def extract_text(file_path: str, page_numbers: Optional[List[int]] = None) -> Dict[int, str]:
         """
@@ -342,6 +884,8 @@ class PDFProcessor:
             Dictionary mapping page numbers to extracted text
         """
         try:
+            from pypdf import PdfReader
+            
             reader = PdfReader(file_path)
             result = {}
             
@@ -359,3 +903,35 @@ class PDFProcessor:
             return result
         except Exception as e:
             raise ValueError(f"Error extracting text: {str(e)}")
+    
+    @staticmethod
+    def iter_text(file_path: str, start_page: int = 1, end_page: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+        """
+        Extract text page by page, yielding each page as soon as it is extracted.
+        
+        Only one page's text is held at a time, and stopping the iteration
+        stops the extraction.
+        
+        Args:
+            file_path: Path to the PDF file
+            start_page: First page to extract (1-based indexing)
+            end_page: Optional last page to extract, defaults to the last page
+            
+        Yields:
+            Tuples of page number and extracted text
+        """
+        from pypdf import PdfReader
+        
+        try:
+            reader = PdfReader(file_path)
+            page_count = len(reader.pages)
+        except Exception as e:
+            raise ValueError(f"Error extracting text: {str(e)}")
+        
+        last_page = min(end_page or page_count, page_count)
+        for page_num in range(max(start_page, 1), last_page + 1):
+            try:
+                text = reader.pages[page_num - 1].extract_text()
+            except Exception as e:
+                raise ValueError(f"Error extracting text from page {page_num}: {str(e)}")
+            yield page_num, text
@@ -1,14 +1,26 @@
 """
 Backend API routes for PDF text editing functionality
 """
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, BackgroundTasks, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from typing import Optional, List, Dict, Any
 from pydantic import BaseModel
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+import base64
+import binascii
+import io
 import json
 import os
 import uuid
 from pdf_service.pdf_processor import PDFProcessor
-from document_service.document_manager import DocumentManager
+from pdf_service.annotation_store import AnnotationStore
+from pdf_service.image_store import ImageStore, ImageInUse
+from pdf_service.sandbox import SandboxLimitExceeded
+from document_service.routes import (
+    document_manager, temp_workspaces, pdf_sandbox, scheduler, DEFAULT_TIER, enforce_rate_limit, rejection_error, store_upload
+)
+from common.scheduler import AdmissionRejected
 
 router = APIRouter(prefix="/api/pdf", tags=["pdf"])
 
@@ -17,10 +29,12 @@ class TextElement(BaseModel):
     content: str
     style: Dict[str, Any]
     position: Dict[str, float]
+    page: int = 0
 
 class TextRequest(BaseModel):
     document_id: str
     text: TextElement
+    user_id: Optional[str] = None
 
 class TextResponse(BaseModel):
     id: str
@@ -33,152 +47,457 @@ class TextResponse(BaseModel):
 class TextUpdateRequest(BaseModel):
     document_id: str
     text: TextElement
+    user_id: Optional[str] = None
+
+class CompactRequest(BaseModel):
+    document_id: str
+    user_id: Optional[str] = None
+
+class PipelineOperation(BaseModel):
+    op: str
+    pages: Optional[List[int]] = None
+    rotations: Optional[Dict[int, int]] = None
+    watermark_text: Optional[str] = None
+
+class PipelineRequest(BaseModel):
+    document_id: str
+    version_id: Optional[str] = None
+    operations: List[PipelineOperation]
+    save_as_version: bool = False
+    user_id: Optional[str] = None
+    comment: Optional[str] = None
 
 # PDF processor instance
 pdf_processor = PDFProcessor()
-document_manager = DocumentManager()
+
+# Edits are recorded in a per-document log and flattened into a new version
+# once the document has been idle for a while or the log grows too long
+ANNOTATION_COMPACT_AFTER_OPS = int(os.environ.get("PDF_EDITOR_ANNOTATION_COMPACT_OPS", "500"))
+ANNOTATION_IDLE_SECONDS = float(os.environ.get("PDF_EDITOR_ANNOTATION_IDLE_SECONDS", "300"))
+image_store = ImageStore(document_manager.storage_dir, document_manager.layout)
+annotation_store = AnnotationStore(
+    document_manager,
+    temp_workspaces,
+    image_store=image_store,
+    compact_after_ops=ANNOTATION_COMPACT_AFTER_OPS,
+    sandbox=pdf_sandbox,
+    tier=DEFAULT_TIER,
+    scheduler=scheduler
+)
+
+
+@router.on_event("startup")
+async def start_annotation_compactor():
+    """Flatten annotations of documents whose editing session went idle."""
+    annotation_store.start_compactor(idle_seconds=ANNOTATION_IDLE_SECONDS)
+
+
+@router.on_event("shutdown")
+async def stop_annotation_compactor():
+    """Stop the background annotation compactor."""
+    annotation_store.stop_compactor()
+
+
+async def _schedule_compaction(background_tasks: BackgroundTasks, document_id: str) -> None:
+    """Compact a document's log after the response once it has grown too long."""
+    if await run_in_threadpool(annotation_store.needs_compaction, document_id):
+        background_tasks.add_task(annotation_store.compact_scheduled, document_id)
+
 
 @router.post("/text", response_model=TextResponse)
-async def add_text_to_pdf(request: TextRequest):
+async def add_text_to_pdf(request: TextRequest, background_tasks: BackgroundTasks):
     """
     Add text to a PDF document with formatting
     """
     try:
-        # Generate a unique ID for the text element
-        text_id = str(uuid.uuid4())
-        
-        # Default to page 0 if not specified
-        page = 0
+        text_element = await run_in_threadpool(
+            annotation_store.add_element,
+            request.document_id,
+            "text",
+            request.text.model_dump(),
+            request.user_id
+        )
+        await _schedule_compaction(background_tasks, request.document_id)
         
-        # Create text element
-        text_element = {
-            "id": text_id,
-            "document_id": request.document_id,
-            "page": page,
-            "content": request.text.content,
-            "style": request.text.style,
-            "position": request.text.position
-        }
-        
-        # In a real implementation, we would update the PDF here
-        # For now, we'll just return the text element
         return text_element
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to add text: {str(e)}")
 
 @router.put("/text/{text_id}", response_model=TextResponse)
-async def update_text_in_pdf(text_id: str, request: TextUpdateRequest):
+async def update_text_in_pdf(text_id: str, request: TextUpdateRequest, background_tasks: BackgroundTasks):
     """
     Update existing text in a PDF document
     """
     try:
-        # In a real implementation, we would fetch the existing text element
-        # and update it in the PDF
-        
-        # For now, we'll just return the updated text element
-        text_element = {
-            "id": text_id,
-            "document_id": request.document_id,
-            "page": 0,  # Default to page 0
-            "content": request.text.content,
-            "style": request.text.style,
-            "position": request.text.position
-        }
+        text_element = await run_in_threadpool(
+            annotation_store.update_element,
+            request.document_id,
+            "text",
+            text_id,
+            request.text.model_dump(),
+            request.user_id
+        )
+        await _schedule_compaction(background_tasks, request.document_id)
         
         return text_element
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update text: {str(e)}")
 
 @router.delete("/text/{text_id}")
-async def delete_text_from_pdf(text_id: str, document_id: str):
+async def delete_text_from_pdf(text_id: str, document_id: str, background_tasks: BackgroundTasks, user_id: Optional[str] = None):
     """
     Delete text from a PDF document
     """
     try:
-        # In a real implementation, we would delete the text element from the PDF
+        await run_in_threadpool(annotation_store.delete_element, document_id, "text", text_id, user_id)
+        await _schedule_compaction(background_tasks, document_id)
         
         return {"status": "success", "message": f"Text element {text_id} deleted"}
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete text: {str(e)}")
 
 @router.post("/highlight", response_model=Dict[str, Any])
-async def add_highlight_to_pdf(request: Dict[str, Any]):
+async def add_highlight_to_pdf(request: Dict[str, Any], background_tasks: BackgroundTasks):
     """
     Add highlight to a PDF document
     """
     try:
-        # Generate a unique ID for the highlight element
-        highlight_id = str(uuid.uuid4())
-        
-        # Create highlight element
-        highlight_element = {
-            "id": highlight_id,
-            "document_id": request["document_id"],
-            "page": request["highlight"].get("page", 0),
-            "position": request["highlight"]["position"],
-            "width": request["highlight"].get("width", 100),
-            "height": request["highlight"].get("height", 20),
-            "color": request["highlight"].get("color", "#ffff00")
-        }
+        highlight_element = await run_in_threadpool(
+            annotation_store.add_element,
+            request["document_id"],
+            "highlight",
+            {
+                "page": request["highlight"].get("page", 0),
+                "position": request["highlight"]["position"],
+                "width": request["highlight"].get("width", 100),
+                "height": request["highlight"].get("height", 20),
+                "color": request["highlight"].get("color", "#ffff00")
+            },
+            request.get("user_id")
+        )
+        await _schedule_compaction(background_tasks, request["document_id"])
         
         return highlight_element
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to add highlight: {str(e)}")
 
+@router.post("/images", response_model=Dict[str, Any])
+async def upload_image(
+    file: UploadFile = File(...),
+    user_id: str = Form(...),
+    kind: str = Form("signature")
+):
+    """
+    Upload a signature or stamp image once so placements can refer to it by ID
+    """
+    try:
+        return await run_in_threadpool(store_upload, file, lambda upload: image_store.save(upload, user_id, kind))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to upload image: {str(e)}")
+
+@router.get("/images", response_model=List[Dict[str, Any]])
+async def list_images(user_id: str, kind: Optional[str] = None):
+    """
+    List a user's stored images
+    """
+    try:
+        return await run_in_threadpool(image_store.list, user_id, kind)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to list images: {str(e)}")
+
+@router.get("/images/{image_id}")
+async def get_image(image_id: str, user_id: str):
+    """
+    Download a stored image
+    """
+    try:
+        metadata = await run_in_threadpool(image_store.get, user_id, image_id)
+        path = await run_in_threadpool(image_store.path, user_id, image_id)
+        return FileResponse(
+            path,
+            media_type=metadata["content_type"],
+            headers={"ETag": f'"{image_id}"', "Cache-Control": "private, max-age=31536000, immutable"}
+        )
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Image {image_id} not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get image: {str(e)}")
+
+@router.delete("/images/{image_id}", response_model=Dict[str, Any])
+async def delete_image(image_id: str, user_id: str):
+    """
+    Delete a stored image
+    
+    Images still placed by edits that were not flattened yet cannot be deleted.
+    """
+    try:
+        await run_in_threadpool(image_store.delete, user_id, image_id)
+        return {"id": image_id, "deleted": True}
+    except ImageInUse as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Image {image_id} not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete image: {str(e)}")
+
 @router.post("/signature", response_model=Dict[str, Any])
-async def add_signature_to_pdf(request: Dict[str, Any]):
+async def add_signature_to_pdf(request: Dict[str, Any], background_tasks: BackgroundTasks):
     """
     Add signature to a PDF document
+    
+    The signature refers to an uploaded image by ``image_id``. Inline base64
+    ``image_data`` is still accepted and is stored as an image on the fly.
     """
     try:
-        # Generate a unique ID for the signature element
-        signature_id = str(uuid.uuid4())
+        signature = request["signature"]
+        user_id = request.get("user_id")
+        if user_id is None:
+            user_id = (await run_in_threadpool(document_manager.get_document, request["document_id"]))["owner_id"]
         
-        # Create signature element
-        signature_element = {
-            "id": signature_id,
-            "document_id": request["document_id"],
-            "page": request["signature"].get("page", 0),
-            "position": request["signature"]["position"],
-            "image_data": request["signature"]["image_data"],
-            "width": request["signature"].get("width", 150),
-            "height": request["signature"].get("height", 50)
+        image_id = signature.get("image_id")
+        if image_id:
+            try:
+                await run_in_threadpool(image_store.get, user_id, image_id)
+            except KeyError:
+                raise HTTPException(status_code=404, detail=f"Image {image_id} not found")
+        else:
+            image_data = signature["image_data"]
+            if image_data.startswith("data:") and "," in image_data:
+                image_data = image_data.split(",", 1)[1]
+            try:
+                image = await run_in_threadpool(image_store.save, io.BytesIO(base64.b64decode(image_data)), user_id)
+            except (ValueError, binascii.Error) as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            image_id = image["id"]
+        
+        element = {
+            "page": signature.get("page", 0),
+            "position": signature["position"],
+            "image_id": image_id,
+            "image_user_id": user_id,
+            "width": signature.get("width", 150),
+            "height": signature.get("height", 50)
         }
+        try:
+            signature_element = await run_in_threadpool(
+                annotation_store.add_element, request["document_id"], "signature", element, request.get("user_id")
+            )
+        except KeyError:
+            # The image was deleted in the meantime
+            raise HTTPException(status_code=404, detail=f"Image {image_id} not found")
+        await _schedule_compaction(background_tasks, request["document_id"])
         
         return signature_element
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to add signature: {str(e)}")
 
+@router.get("/text/stream")
+async def stream_text(
+    request: Request,
+    document_id: str,
+    version_id: Optional[str] = None,
+    start_page: int = Query(1, ge=1, description="First page to extract (1-based)"),
+    end_page: Optional[int] = Query(None, ge=1, description="Last page to extract"),
+    output_format: str = Query("ndjson", alias="format", pattern="^(ndjson|sse)$", description="Output format, ndjson or sse")
+):
+    """
+    Stream the text of a PDF document page by page
+    
+    Each page is sent as soon as it is extracted, as one JSON line or one
+    Server-Sent Event with the page number as its event ID. Pages without a
+    text layer get the text recognized by OCR, if any. An interrupted
+    stream is resumed with ``start_page``, or with the ``Last-Event-ID``
+    header for SSE. Extraction stops when the client disconnects.
+    """
+    try:
+        document, version, file_path = await run_in_threadpool(document_manager.resolve_version, document_id, version_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    enforce_rate_limit(document["owner_id"])
+    
+    # Scanned pages are served with the text recognized when the version was stored
+    recognized_text = await run_in_threadpool(document_manager.get_recognized_text, version)
+    
+    last_event_id = request.headers.get("last-event-id")
+    if output_format == "sse" and last_event_id and last_event_id.isdigit():
+        start_page = max(start_page, int(last_event_id) + 1)
+    
+    def encode(event: str, payload: Dict[str, Any], event_id: Optional[int] = None) -> bytes:
+        data = json.dumps(payload)
+        if output_format == "ndjson":
+            return (data + "\n").encode("utf-8")
+        prefix = f"id: {event_id}\n" if event_id is not None else ""
+        return f"{prefix}event: {event}\ndata: {data}\n\n".encode("utf-8")
+    
+    async def pages():
+        iterator = PDFProcessor.iter_text(file_path, start_page, end_page)
+        sent = 0
+        try:
+            while True:
+                if await request.is_disconnected():
+                    return
+                try:
+                    # Each page takes its own slot, so long streams do not hold up other tenants
+                    async with scheduler.aslot(document["owner_id"]):
+                        item = await run_in_threadpool(next, iterator, None)
+                except ValueError as e:
+                    yield encode("error", {"error": str(e), "next_page": start_page + sent})
+                    return
+                except AdmissionRejected as e:
+                    yield encode("error", {**e.to_dict(), "next_page": start_page + sent})
+                    return
+                if item is None:
+                    break
+                page_num, text = item
+                text = recognized_text.get(page_num, text)
+                sent += 1
+                yield encode("page", {"page": page_num, "text": text}, page_num)
+            yield encode("end", {"done": True, "version_id": version["version_id"], "pages": sent})
+        finally:
+            try:
+                iterator.close()
+            except ValueError:
+                # Still extracting a page in a worker thread; it stops after that page
+                pass
+    
+    return StreamingResponse(
+        pages(),
+        media_type="application/x-ndjson" if output_format == "ndjson" else "text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.post("/info", response_model=Dict[str, Any])
 async def get_pdf_info(request: Dict[str, str]):
     """
     Get information about a PDF document
     """
     try:
-        # Mock PDF info
+        document = await run_in_threadpool(document_manager.get_document, request["document_id"])
+        latest_version = document["versions"][-1] if document["versions"] else None
+        elements = await run_in_threadpool(annotation_store.get_elements, document["id"])
+        pending_ops = await run_in_threadpool(annotation_store.pending_ops, document["id"])
+        
         return {
-            "id": "sample-pdf-123",
-            "name": "Sample PDF Document",
-            "pages": 5,
-            "text_elements": [
-                {
-                    "id": "text-1",
-                    "document_id": "sample-pdf-123",
-                    "page": 0,
-                    "content": "Sample text in the PDF",
-                    "style": {
-                        "fontFamily": "Arial",
-                        "fontSize": 14,
-                        "fontWeight": "normal",
-                        "fontStyle": "normal",
-                        "textDecoration": "none",
-                        "textAlign": "left",
-                        "color": "#000000"
-                    },
-                    "position": {"x": 100, "y": 100}
-                }
-            ],
-            "url": "https://example.com/sample.pdf"
+            "id": document["id"],
+            "name": document["name"],
+            "pages": document["metadata"].get("page_count", 0),
+            "version_id": latest_version["version_id"] if latest_version else None,
+            "pending_operations": pending_ops,
+            "text_elements": elements["text"],
+            "highlight_elements": elements["highlight"],
+            "signature_elements": elements["signature"],
+            "url": f"/api/documents/{document['id']}/download"
+                   + (f"?version_id={latest_version['version_id']}" if latest_version else "")
         }
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get PDF info: {str(e)}")
+
+@router.post("/compact", response_model=Dict[str, Any])
+async def compact_annotations(request: CompactRequest):
+    """
+    Flatten pending edits of a PDF document into a new version
+    """
+    try:
+        document = document_manager.get_document(request.document_id)
+        enforce_rate_limit(document["owner_id"])
+        
+        async with scheduler.aslot(document["owner_id"], document["metadata"].get("page_count") or 1) as tier:
+            version_id = await run_in_threadpool(annotation_store.compact, request.document_id, request.user_id, tier)
+        
+        return {
+            "document_id": request.document_id,
+            "version_id": version_id,
+            "compacted": version_id is not None
+        }
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise rejection_error(e)
+    except SandboxLimitExceeded as e:
+        raise HTTPException(status_code=422, detail=e.to_dict())
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to compact annotations: {str(e)}")
+
+@router.post("/pipeline", response_model=None)
+async def run_pipeline(request: PipelineRequest):
+    """
+    Apply a sequence of operations to a stored PDF document in a single pass
+    
+    The document is parsed and serialized once, however many operations are
+    chained. The result is returned as a file, or saved as a new version of
+    the document with ``save_as_version``.
+    """
+    operations = [operation.model_dump(exclude_none=True) for operation in request.operations]
+    try:
+        PDFProcessor.validate_pipeline(operations)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        document, version, source_path = await run_in_threadpool(document_manager.resolve_version, request.document_id, request.version_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    enforce_rate_limit(document["owner_id"])
+    
+    workspace = temp_workspaces.create()
+    try:
+        output_path = workspace.path(suffix=".pdf")
+        async with scheduler.aslot(document["owner_id"], document["metadata"].get("page_count") or 1) as tier:
+            await run_in_threadpool(pdf_sandbox.run, "run_pipeline", source_path, operations, output_path, tier=tier)
+        workspace.account(output_path)
+        
+        if not request.save_as_version:
+            # The workspace is removed once the file has been sent
+            response = FileResponse(
+                output_path,
+                media_type="application/pdf",
+                filename=f"{document['name']}.pdf",
+                background=BackgroundTask(workspace.close)
+            )
+            workspace = None
+            return response
+        
+        comment = request.comment or "Pipeline: " + ", ".join(operation["op"] for operation in operations)
+        version_id = await run_in_threadpool(
+            document_manager.add_document_version,
+            request.document_id,
+            output_path,
+            request.user_id or document["owner_id"],
+            comment=comment,
+            move=True
+        )
+        return {
+            "document_id": request.document_id,
+            "source_version_id": version["version_id"],
+            "version_id": version_id,
+            "operations": len(operations)
+        }
+    except AdmissionRejected as e:
+        raise rejection_error(e)
+    except SandboxLimitExceeded as e:
+        raise HTTPException(status_code=422, detail=e.to_dict())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to run pipeline: {str(e)}")
+    finally:
+        if workspace:
+            workspace.close()
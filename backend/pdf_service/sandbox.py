@@ -0,0 +1,331 @@
+"""
+Sandboxed execution of PDF operations in short-lived, resource-limited processes.
+"""
+import errno
+import importlib
+import json
+import math
+import multiprocessing
+import os
+import signal
+import time
+from typing import Any, Dict, NamedTuple, Optional
+
+from common.metrics import metrics
+from common.models import SubscriptionTier
+from pdf_service.pdf_processor import PDF_LIBRARIES
+
+# Interval at which the supervising process samples the worker's memory
+POLL_INTERVAL_SECONDS = 0.02
+
+MB = 1024 * 1024
+
+
+class ResourceLimits(NamedTuple):
+    """Resources a single sandboxed operation may use."""
+    memory_mb: int
+    cpu_seconds: float
+    output_mb: int
+    wall_seconds: float
+
+
+# Budget per subscription tier
+TIER_LIMITS: Dict[SubscriptionTier, ResourceLimits] = {
+    SubscriptionTier.FREE: ResourceLimits(memory_mb=256, cpu_seconds=10, output_mb=50, wall_seconds=30),
+    SubscriptionTier.BASIC: ResourceLimits(memory_mb=512, cpu_seconds=30, output_mb=200, wall_seconds=60),
+    SubscriptionTier.PREMIUM: ResourceLimits(memory_mb=1024, cpu_seconds=60, output_mb=500, wall_seconds=120),
+    SubscriptionTier.ENTERPRISE: ResourceLimits(memory_mb=2048, cpu_seconds=120, output_mb=2048, wall_seconds=300),
+}
+
+# Operations known to need more room scale the tier budget by these factors
+OPERATION_SCALES: Dict[str, Dict[str, float]] = {
+    "compress_pdf": {"memory_mb": 2.0, "cpu_seconds": 2.0, "wall_seconds": 2.0},
+    "merge_pdfs": {"memory_mb": 2.0, "cpu_seconds": 2.0, "wall_seconds": 2.0},
+    "flatten_annotations": {"memory_mb": 1.5, "cpu_seconds": 1.5},
+    "run_pipeline": {"memory_mb": 2.0, "cpu_seconds": 2.0, "wall_seconds": 2.0},
+}
+
+
+class SandboxLimitExceeded(ValueError):
+    """Raised when a sandboxed operation exceeds one of its resource limits."""
+
+    def __init__(self, operation: str, limit: str, value: float, message: str):
+        super().__init__(message)
+        self.operation = operation
+        self.limit = limit
+        self.value = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Structured form of the error for API responses."""
+        return {
+            "error": "resource_limit_exceeded",
+            "operation": self.operation,
+            "limit": self.limit,
+            "value": self.value,
+            "message": str(self)
+        }
+
+
+def _read_proc_pages(pid: int, field: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[field]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _read_cpu_seconds(pid: int) -> float:
+    """Get the CPU time a process has used so far, in seconds."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            # Fields following the command name, which may contain spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def _cpu_rlimit(limits: ResourceLimits) -> int:
+    """Get the soft CPU time rlimit, in whole seconds, enforcing a CPU limit."""
+    return max(1, math.ceil(limits.cpu_seconds))
+
+
+def _classify(error: BaseException) -> Optional[str]:
+    """Find a resource exhaustion behind an exception, including wrapped ones."""
+    while error is not None:
+        if isinstance(error, MemoryError):
+            return "memory_mb"
+        if isinstance(error, OSError) and error.errno == errno.EFBIG:
+            return "output_mb"
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def _run_limited(connection, operation: str, args: tuple, kwargs: dict, limits: ResourceLimits) -> None:
+    """Entry point of the sandbox process."""
+    import resource
+    from pdf_service.pdf_processor import PDFProcessor
+
+    # Writes beyond the output limit fail with EFBIG instead of killing the process
+    signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+
+    cpu_seconds = _cpu_rlimit(limits)
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+    output_bytes = int(limits.output_mb * MB)
+    resource.setrlimit(resource.RLIMIT_FSIZE, (output_bytes, output_bytes))
+
+    # Address space backstop on top of what the process already maps; resident
+    # memory itself is enforced by the supervising process
+    memory_bytes = int(limits.memory_mb * MB)
+    address_space = _read_proc_pages(os.getpid(), 0) + 2 * memory_bytes
+    resource.setrlimit(resource.RLIMIT_AS, (address_space, address_space))
+
+    # Memory is budgeted on top of the interpreter and the preloaded libraries
+    baseline = _read_proc_pages(os.getpid(), 1)
+    connection.send(("started", baseline))
+
+    try:
+        result = ("ok", getattr(PDFProcessor, operation)(*args, **kwargs))
+    except BaseException as e:
+        limit = _classify(e)
+        if limit:
+            result = ("limit", limit, str(e))
+        else:
+            result = ("error", type(e).__name__, str(e))
+
+    # Spikes shorter than the sampling interval still count against the budget
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+    if result[0] != "limit" and peak > memory_bytes:
+        result = ("limit", "memory_mb", f"peak resident memory of {peak / MB:.1f} MB")
+
+    try:
+        connection.send(result + (peak,))
+    except Exception as e:
+        connection.send(("error", type(e).__name__, f"Unable to return result: {str(e)}", peak))
+    finally:
+        connection.close()
+
+
+class PDFSandbox:
+    """
+    Runs ``PDFProcessor`` operations in forked processes with resource limits.
+
+    Each call gets a fresh process limited in CPU time and output file size
+    through rlimits, and in resident memory and wall time by the calling
+    process, which samples the worker and kills it when a limit is crossed.
+    The PDF libraries are imported before forking, so that a worker never
+    inherits the lock of an import another thread was in the middle of.
+    A hostile document therefore fails its own operation with a
+    ``SandboxLimitExceeded`` error instead of taking down the API worker.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        tier_limits: Optional[Dict[SubscriptionTier, ResourceLimits]] = None,
+        operation_scales: Optional[Dict[str, Dict[str, float]]] = None
+    ):
+        """
+        Initialize the sandbox.
+
+        Args:
+            enabled: Whether operations run in sandbox processes; if False they run in-process
+            tier_limits: Optional budget per subscription tier, defaults to ``TIER_LIMITS``
+            operation_scales: Optional per-operation factors applied to the tier budget
+        """
+        self.enabled = enabled
+        self.tier_limits = dict(tier_limits or TIER_LIMITS)
+        self.operation_scales = dict(operation_scales if operation_scales is not None else OPERATION_SCALES)
+        self._context = multiprocessing.get_context("fork")
+
+    @classmethod
+    def from_config(cls, enabled: bool, config: Optional[str] = None) -> "PDFSandbox":
+        """
+        Create a sandbox from a JSON configuration string.
+
+        The configuration may contain "tiers", mapping tier names to limit
+        fields, and "operations", mapping operation names to scale factors,
+        e.g. ``{"tiers": {"free": {"memory_mb": 128}}, "operations": {"compress_pdf": {"cpu_seconds": 3}}}``.
+
+        Args:
+            enabled: Whether operations run in sandbox processes
+            config: Optional JSON configuration overriding the defaults
+
+        Returns:
+            The configured sandbox
+        """
+        tier_limits = dict(TIER_LIMITS)
+        operation_scales = {operation: dict(scales) for operation, scales in OPERATION_SCALES.items()}
+
+        if config:
+            parsed = json.loads(config)
+            for tier, fields in parsed.get("tiers", {}).items():
+                tier = SubscriptionTier(tier)
+                tier_limits[tier] = tier_limits[tier]._replace(**fields)
+            for operation, scales in parsed.get("operations", {}).items():
+                operation_scales.setdefault(operation, {}).update(scales)
+
+        return cls(enabled, tier_limits, operation_scales)
+
+    def limits_for(self, operation: str, tier: SubscriptionTier = SubscriptionTier.FREE) -> ResourceLimits:
+        """
+        Resolve the limits of an operation for a subscription tier.
+
+        Args:
+            operation: Name of the ``PDFProcessor`` method
+            tier: Subscription tier the operation is billed to
+
+        Returns:
+            Effective resource limits
+        """
+        limits = self.tier_limits[SubscriptionTier(tier)]
+        scales = self.operation_scales.get(operation, {})
+        return limits._replace(**{field: getattr(limits, field) * factor for field, factor in scales.items()})
+
+    def run(self, operation: str, *args, tier: SubscriptionTier = SubscriptionTier.FREE, **kwargs) -> Any:
+        """
+        Run a ``PDFProcessor`` operation within its resource limits.
+
+        Args:
+            operation: Name of the ``PDFProcessor`` static method to call
+            *args: Positional arguments of the operation
+            tier: Subscription tier whose limits apply
+            **kwargs: Keyword arguments of the operation
+
+        Returns:
+            The operation's return value
+
+        Raises:
+            SandboxLimitExceeded: If the operation hit a resource limit
+            ValueError: If the operation failed
+        """
+        if not self.enabled:
+            from pdf_service.pdf_processor import PDFProcessor
+            return getattr(PDFProcessor, operation)(*args, **kwargs)
+
+        # Waits for imports still running in other threads, e.g. the startup warm-up
+        for module_name in PDF_LIBRARIES:
+            importlib.import_module(module_name)
+
+        limits = self.limits_for(operation, tier)
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_run_limited,
+            args=(sender, operation, args, kwargs, limits),
+            name=f"sandbox-{operation}",
+            daemon=True
+        )
+
+        started = time.monotonic()
+        process.start()
+        sender.close()
+
+        result = None
+        exceeded = None
+        baseline = 0
+        peak_rss = 0
+        cpu_used = 0.0
+        try:
+            while True:
+                if receiver.poll(POLL_INTERVAL_SECONDS):
+                    try:
+                        message = receiver.recv()
+                    except EOFError:
+                        break
+                    if message[0] == "started":
+                        baseline = message[1]
+                        continue
+                    result, peak_rss = message[:-1], max(peak_rss, message[-1])
+                    break
+                # Sampled while the process lives; the rlimit kill only follows a
+                # full second past the soft limit, so the last sample reaches it
+                cpu_used = max(cpu_used, _read_cpu_seconds(process.pid))
+                if not process.is_alive():
+                    break
+
+                if baseline:
+                    peak_rss = max(peak_rss, _read_proc_pages(process.pid, 1) - baseline)
+                if peak_rss > limits.memory_mb * MB:
+                    exceeded = ("memory_mb", f"Operation {operation} exceeded its memory limit of {limits.memory_mb:g} MB")
+                elif time.monotonic() - started > limits.wall_seconds:
+                    exceeded = ("wall_seconds", f"Operation {operation} exceeded its time limit of {limits.wall_seconds:g} s")
+                if exceeded:
+                    process.kill()
+                    break
+        finally:
+            process.join(timeout=5)
+            receiver.close()
+
+        if result is None and exceeded is None:
+            killed = process.exitcode == -signal.SIGKILL
+            if process.exitcode == -signal.SIGXCPU or (killed and cpu_used >= _cpu_rlimit(limits)):
+                exceeded = ("cpu_seconds", f"Operation {operation} exceeded its CPU time limit of {limits.cpu_seconds:g} s")
+            elif killed:
+                # Killed by the kernel well within its CPU time, i.e. by the OOM killer
+                exceeded = (
+                    "memory_mb",
+                    f"Operation {operation} was killed with SIGKILL after {cpu_used:.1f} s of CPU time, "
+                    "most likely for running out of memory"
+                )
+            elif process.exitcode is not None and process.exitcode < 0:
+                number = -process.exitcode
+                result = ("error", "SandboxError", f"Operation {operation} was killed by signal {number} ({signal.strsignal(number)})")
+            else:
+                result = ("error", "SandboxError", f"Operation {operation} terminated unexpectedly (exit code {process.exitcode})")
+
+        if result and result[0] == "limit":
+            exceeded = (result[1], f"Operation {operation} exceeded its {result[1]} limit: {result[2]}")
+
+        outcome = "limit" if exceeded else result[0]
+        metrics.inc("sandbox_runs_total", 1, "Sandboxed PDF operations", operation=operation, outcome=outcome)
+        metrics.observe("sandbox_peak_rss_bytes", peak_rss, "Peak resident memory added by sandboxed operations", operation=operation)
+
+        if exceeded:
+            limit, message = exceeded
+            raise SandboxLimitExceeded(operation, limit, getattr(limits, limit), message)
+        if result[0] == "error":
+            if result[1] in ("ImportError", "ModuleNotFoundError"):
+                # Optional dependency missing, callers treat this like the in-process case
+                raise ImportError(result[2])
+            raise ValueError(result[2])
+        return result[1]
@@ -0,0 +1,182 @@
+"""
+Tests for annotation log compaction.
+"""
+import io
+import os
+import shutil
+import threading
+
+import pytest
+
+from common.temp_workspace import TempWorkspaceManager
+from document_service.document_manager import DocumentManager
+from pdf_service.annotation_store import AnnotationStore
+from pdf_service.image_store import ImageStore, ImageInUse
+
+PDF_BYTES = b"%PDF-1.4\n1 0 obj\n<<>>\nendobj\ntrailer\n<<>>\n%%EOF\n"
+
+
+class BlockingSandbox:
+    """Sandbox stand-in whose flattening copies the source once released."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.runs = 0
+
+    def run(self, operation, source_path, elements, output_path, tier=None):
+        self.runs += 1
+        self.started.set()
+        assert self.release.wait(10)
+        shutil.copyfile(source_path, output_path)
+
+
+@pytest.fixture
+def document_manager(tmp_path):
+    return DocumentManager(str(tmp_path / "storage"))
+
+
+@pytest.fixture
+def document_id(document_manager, tmp_path):
+    source_path = tmp_path / "source.pdf"
+    source_path.write_bytes(PDF_BYTES)
+    return document_manager.create_document(str(source_path), "source.pdf", "owner")
+
+
+def _store(document_manager, tmp_path, sandbox):
+    return AnnotationStore(
+        document_manager,
+        TempWorkspaceManager(str(tmp_path / "workspaces")),
+        sandbox=sandbox
+    )
+
+
+def _add_texts(store, document_id, count, prefix):
+    for index in range(count):
+        store.add_element(document_id, "text", {"page": 0, "x": index, "y": index, "text": f"{prefix}{index}"})
+
+
+def test_concurrent_compactions_do_not_overlap(document_manager, document_id, tmp_path):
+    sandbox = BlockingSandbox()
+    # Two stores on the same storage stand in for two workers
+    first = _store(document_manager, tmp_path, sandbox)
+    second = _store(document_manager, tmp_path, sandbox)
+    _add_texts(first, document_id, 5, "before")
+
+    result = {}
+    compaction = threading.Thread(target=lambda: result.setdefault("version_id", first.compact(document_id)))
+    compaction.start()
+    assert sandbox.started.wait(10)
+
+    # Edits keep coming in while the first compaction renders
+    _add_texts(first, document_id, 3, "during")
+    assert second.compact(document_id) is None
+    assert first.compact(document_id) is None
+
+    sandbox.release.set()
+    compaction.join(10)
+
+    assert result["version_id"]
+    assert sandbox.runs == 1
+    assert len(document_manager.get_document(document_id)["versions"]) == 2
+    for store in (first, second):
+        texts = store.get_elements(document_id)["text"]
+        assert sorted(text["text"] for text in texts) == ["during0", "during1", "during2"]
+        assert store.pending_ops(document_id) == 3
+
+    assert second.compact(document_id)
+    assert len(document_manager.get_document(document_id)["versions"]) == 3
+    assert first.get_elements(document_id)["text"] == []
+
+
+def test_replay_ignores_state_cached_for_previous_generation(document_manager, document_id, tmp_path):
+    sandbox = BlockingSandbox()
+    sandbox.release.set()
+    store = _store(document_manager, tmp_path, sandbox)
+    _add_texts(store, document_id, 2, "first")
+    store.get_elements(document_id)
+    stale_state = store._cache[document_id][2]
+    assert store.compact(document_id)
+
+    _add_texts(store, document_id, 1, "second")
+    log_path = store._log_path(document_id)
+    with open(log_path, 'rb') as f:
+        base_length = len(f.readline())
+    # Pretend the rewritten log reused the inode of the replayed one
+    store._cache[document_id] = (os.stat(log_path).st_ino, base_length, stale_state)
+
+    texts = store.get_elements(document_id)["text"]
+    assert [text["text"] for text in texts] == ["second0"]
+
+
+def test_placed_images_cannot_be_deleted_until_flattened(document_manager, document_id, tmp_path):
+    from PIL import Image
+
+    sandbox = BlockingSandbox()
+    sandbox.release.set()
+    image_store = ImageStore(document_manager.storage_dir, document_manager.layout)
+    store = AnnotationStore(
+        document_manager,
+        TempWorkspaceManager(str(tmp_path / "workspaces")),
+        image_store=image_store,
+        sandbox=sandbox
+    )
+    upload = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(upload, "PNG")
+    upload.seek(0)
+    image_id = image_store.save(upload, "owner")["id"]
+
+    signature = store.add_element(
+        document_id, "signature", {"page": 0, "position": {"x": 0, "y": 0}, "image_id": image_id, "image_user_id": "owner"}
+    )
+    store.delete_element(document_id, "signature", signature["id"])
+    with pytest.raises(ImageInUse):
+        image_store.delete("owner", image_id)
+
+    assert store.compact(document_id)
+    image_store.delete("owner", image_id)
+    with pytest.raises(KeyError):
+        store.add_element(
+            document_id, "signature", {"page": 0, "position": {"x": 0, "y": 0}, "image_id": image_id, "image_user_id": "owner"}
+        )
+    assert store.pending_ops(document_id) == 0
+
+
+def test_interrupted_compaction_is_not_flattened_twice(document_manager, document_id, tmp_path, monkeypatch):
+    sandbox = BlockingSandbox()
+    sandbox.release.set()
+    store = _store(document_manager, tmp_path, sandbox)
+    _add_texts(store, document_id, 2, "before")
+
+    # The worker dies after storing the flattened version
+    def crash(*args, **kwargs):
+        raise SystemExit
+    monkeypatch.setattr(store, "_rewrite_log", crash)
+    with pytest.raises(SystemExit):
+        store.compact(document_id)
+    monkeypatch.undo()
+    _add_texts(store, document_id, 1, "after")
+
+    restarted = _store(document_manager, tmp_path, sandbox)
+    version_id = restarted.compact(document_id)
+
+    versions = document_manager.get_document(document_id)["versions"]
+    assert sandbox.runs == 1
+    assert [version["version_id"] for version in versions][1:] == [version_id]
+    assert [text["text"] for text in restarted.get_elements(document_id)["text"]] == ["after0"]
+    assert restarted.pending_ops(document_id) == 1
+
+
+def test_edits_survive_until_deleted_document_is_purged(document_manager, document_id, tmp_path):
+    from document_service.retention import GarbageCollector
+
+    store = _store(document_manager, tmp_path, BlockingSandbox())
+    _add_texts(store, document_id, 2, "kept")
+
+    document_manager.delete_document(document_id)
+    document_manager.restore_document(document_id)
+    assert sorted(text["text"] for text in store.get_elements(document_id)["text"]) == ["kept0", "kept1"]
+
+    document_manager.delete_document(document_id)
+    GarbageCollector(document_manager, grace_seconds=0).purge_trash()
+    assert not os.path.exists(store._log_path(document_id))
@@ -27,6 +27,7 @@ import FileUploadIcon from '@mui/icons-material/FileUpload';
 import DescriptionIcon from '@mui/icons-material/Description';
 
 import { fetchDocuments } from '../services/documentsSlice';
+import { subscribeToDocumentEvents } from '../services/documentEvents';
 import FileUpload from '../components/FileUpload';
 
 const Dashboard = () => {
@@ -39,6 +40,13 @@ const Dashboard = () => {
     dispatch(fetchDocuments());
   }, [dispatch]);
   
+  // Keep documents current as collaborators change them
+  useEffect(() => {
+    // In a real app, you'd get the user ID from authentication
+    const userId = 'user123';
+    return subscribeToDocumentEvents(userId, dispatch);
+  }, [dispatch]);
+  
   // Update recent documents when documents change
   useEffect(() => {
     if (documents && documents.length > 0) {
@@ -0,0 +1,31 @@
+import { fetchDocuments, refreshDocument, removeDocument } from './documentsSlice';
+
+const CHANGE_EVENTS = ['created', 'updated', 'version_added', 'permissions_changed'];
+
+// Subscribe to changes of the documents a user can view, instead of polling
+// the document list. The browser reconnects on its own and resumes from the
+// last event it received. Returns a function that closes the subscription.
+export const subscribeToDocumentEvents = (userId, dispatch) => {
+  const source = new EventSource(`/api/documents/events?user_id=${encodeURIComponent(userId)}`);
+  
+  const onChange = (event) => {
+    const change = JSON.parse(event.data);
+    if (change.type === 'permissions_changed' && !change.has_access) {
+      dispatch(removeDocument(change.document_id));
+    } else {
+      dispatch(refreshDocument(change.document_id));
+    }
+  };
+  CHANGE_EVENTS.forEach(type => source.addEventListener(type, onChange));
+  
+  source.addEventListener('deleted', (event) => {
+    dispatch(removeDocument(JSON.parse(event.data).document_id));
+  });
+  
+  // Changes were missed while disconnected
+  source.addEventListener('reset', () => {
+    dispatch(fetchDocuments());
+  });
+  
+  return () => source.close();
+};
@@ -18,6 +18,21 @@ export const fetchDocuments = createAsyncThunk(
   }
 );
 
+export const refreshDocument = createAsyncThunk(
+  'documents/refreshDocument',
+  async (documentId, { rejectWithValue }) => {
+    try {
+      const response = await axios.get(`/api/documents/${documentId}`);
+      if (!response.data.success) {
+        return rejectWithValue(response.data);
+      }
+      return response.data.data;
+    } catch (error) {
+      return rejectWithValue(error.response?.data || error.message);
+    }
+  }
+);
+
 export const createDocument = createAsyncThunk(
   'documents/createDocument',
   async ({ file, name, ownerId, folderId }, { rejectWithValue }) => {
@@ -97,6 +112,12 @@ const documentsSlice = createSlice({
     clearCurrentDocument: (state) => {
       state.currentDocument = null;
     },
+    removeDocument: (state, action) => {
+      state.documents = state.documents.filter(doc => doc.id !== action.payload);
+      if (state.currentDocument?.id === action.payload) {
+        state.currentDocument = null;
+      }
+    },
   },
   extraReducers: (builder) => {
     builder
@@ -113,6 +134,19 @@ const documentsSlice = createSlice({
         state.error = action.payload;
       })
       
+      // refreshDocument, after a change event; the list status is left alone
+      .addCase(refreshDocument.fulfilled, (state, action) => {
+        const index = state.documents.findIndex(doc => doc.id === action.payload.id);
+        if (index !== -1) {
+          state.documents[index] = action.payload;
+        } else {
+          state.documents.push(action.payload);
+        }
+        if (state.currentDocument?.id === action.payload.id) {
+          state.currentDocument = action.payload;
+        }
+      })
+      
       // createDocument
       .addCase(createDocument.pending, (state) => {
         state.status = 'loading';
@@ -184,6 +218,6 @@ const documentsSlice = createSlice({
   },
 });
 
-export const { setCurrentDocument, clearCurrentDocument } = documentsSlice.actions;
+export const { setCurrentDocument, clearCurrentDocument, removeDocument } = documentsSlice.actions;
 
 export default documentsSlice.reducer;